@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# copy_strategy.py
+#
+#----------------------------------------------------------------------------
+# File copying for foundry_install.py.
+#
+# Vendor files (GDS, liberty, SPICE, etc.) are copied into the staging area
+# mostly unchanged, and for large libraries the copy takes a large amount
+# of time and disk space.  The copy strategy selects how files are copied:
+#
+#   copy:	Copy the file contents (the default;  same as shutil.copy()).
+#   hardlink:	Make a hard link to the source file.  This requires that the
+#		source and staging area are on the same filesystem.
+#   reflink:	Make a copy-on-write clone of the source file (ioctl FICLONE;
+#		supported by btrfs, XFS, and some others).  The clone shares
+#		disk blocks with the source until either one is modified.
+#
+# If a file cannot be linked or cloned (e.g., the source is on a different
+# filesystem, or the filesystem does not support clones), then it is copied.
+#
+# A hard link is the same file as the source, so a file in the staging area
+# that is a hard link must not be changed in place, or the vendor source
+# file would be changed with it.  Any code that modifies a file in place
+# (filter scripts, changing file permissions) must call break_link() on the
+# file first, which replaces a hard link with a copy of its own.  Clones do
+# not need this, as the filesystem copies blocks when they are modified.
+#----------------------------------------------------------------------------
+
+import os
+import sys
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+strategies = ['copy', 'hardlink', 'reflink']
+strategy = 'copy'
+
+# Linux ioctl number for FICLONE (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# Errors that mean a file cannot be linked or cloned, but can be copied
+fallback_errors = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+		errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.EACCES]
+
+#----------------------------------------------------------------------------
+# Set the copy strategy (one of "strategies").
+#----------------------------------------------------------------------------
+
+def set_strategy(name):
+    global strategy
+    if name not in strategies:
+        raise ValueError('Unknown copy strategy "' + name + '"')
+    if name == 'reflink' and (fcntl is None or not sys.platform.startswith('linux')):
+        print('Warning:  File clones are not supported on this system;  copying files.')
+        name = 'copy'
+    strategy = name
+
+#----------------------------------------------------------------------------
+# Clone file "src" to "dst" with ioctl FICLONE.  Raises OSError if the
+# filesystem cannot clone the file.
+#----------------------------------------------------------------------------
+
+def reflink(src, dst):
+    with open(src, 'rb') as ifile:
+        with open(dst, 'wb') as ofile:
+            try:
+                fcntl.ioctl(ofile.fileno(), FICLONE, ifile.fileno())
+            except OSError:
+                ofile.close()
+                os.remove(dst)
+                raise
+
+#----------------------------------------------------------------------------
+# Copy file "src" to "dst" using the current copy strategy.  Works like
+# shutil.copy(), and can be used as the "copy_function" of
+# shutil.copytree().  Returns the destination file name.
+#----------------------------------------------------------------------------
+
+def copy_file(src, dst, *, follow_symlinks=True):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    if strategy == 'copy' or (not follow_symlinks and os.path.islink(src)):
+        return shutil.copy(src, dst, follow_symlinks=follow_symlinks)
+
+    try:
+        if strategy == 'hardlink':
+            os.link(src, dst)
+            return dst
+        elif strategy == 'reflink':
+            reflink(src, dst)
+            shutil.copymode(src, dst)
+            return dst
+    except OSError as e:
+        if e.errno not in fallback_errors:
+            raise
+    return shutil.copy(src, dst)
+
+#----------------------------------------------------------------------------
+# Copy directory "src" to "dst" using the current copy strategy.  Works
+# like shutil.copytree().
+#----------------------------------------------------------------------------
+
+def copy_tree(src, dst, **kwargs):
+    return shutil.copytree(src, dst, copy_function=copy_file, **kwargs)
+
+#----------------------------------------------------------------------------
+# If "filepath" is a hard link to another file (such as the vendor source
+# file it was installed from), then replace it with a copy, so that it can
+# be modified without changing the other file.  Symbolic links and files
+# with a single link are left alone.  Returns True if the file was copied.
+#----------------------------------------------------------------------------
+
+def break_link(filepath):
+    if os.path.islink(filepath) or not os.path.isfile(filepath):
+        return False
+    if os.stat(filepath).st_nlink < 2:
+        return False
+
+    # Copy to a temporary name in the same directory, then rename over the
+    # link, so that the file is never missing or partly written.
+    tmppath = os.path.join(os.path.dirname(filepath),
+		'.' + os.path.basename(filepath) + '.' + str(os.getpid()) + '.tmp')
+    try:
+        shutil.copy2(filepath, tmppath)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    return True
@@ -9,17 +9,25 @@
 # for the "-gds" install.
 #
 # Because GDS files are large, this script supports reading gzipped GDS files.
-# The file (de-)compression is handled in Magic;  it is only necessary in this
-# script to accept ".gds.gz" as a valid filename extension for GDS files.
+#
+# The library is made by copying the cells from each file directly into the
+# library file, one file at a time.  A cell that appears in more than one
+# file is written once if all copies are identical;  if they differ, the
+# first one is kept and the conflict is reported.  If the files cannot be
+# combined this way (e.g., they have different units), or if option
+# "-magic" is given, then the library is made by reading all of the files
+# into magic and writing them out again.
 #----------------------------------------------------------------------------
 
 import os
 import sys
 import glob
 import gzip
+import hashlib
 import fnmatch
-import subprocess
 import natural_sort
+import magic_session
+import gds_stream
 
 #----------------------------------------------------------------------------
 
@@ -27,7 +35,7 @@ def usage():
     print('')
     print('Usage:')
     print('    create_gds_library <destlibdir> <destlib> <startup_script> ')
-    print('             [-compile-only] [-excludelist="file1,file2,..."] [-keep]')
+    print('             [-compile-only] [-excludelist="file1,file2,..."] [-keep] [-magic]')
     print('')
     print('Create a single GDS library from a set of individual GDS files.')
     print('')
@@ -38,11 +46,161 @@ def usage():
     print('    -compile-only     removes the indidual files if specified')
     print('    -excludelist=     is a comma-separated list of files to ignore')
     print('    -keep             keep the Tcl script used to generate the library')
+    print('    -magic            use magic to generate the library')
     print('')
 
 #----------------------------------------------------------------------------
 
-def create_gds_library(destlibdir, destlib, startup_script, do_compile_only=False, excludelist=[], keep=False):
+#----------------------------------------------------------------------------
+# Return the pieces of the GDS library made from the files in "glist", to
+# be written in order by gds_stream.write_gds().  Each file is opened only
+# while its cells are being written.  Raises GDSError if the files cannot
+# be combined.
+#----------------------------------------------------------------------------
+
+def merge_chunks(glist, libname):
+    units = None
+    cells = {}
+    for gdsfile in glist:
+        with gds_stream.GDSFile(gdsfile) as gds:
+            data = gds.data
+            libheader = gds_stream.library_header(data)
+            if gds_stream.UNITS not in libheader:
+                raise gds_stream.GDSError('No units in file ' + gdsfile)
+            if units is None:
+                # Library header:  Take the version and dates from the
+                # first file.
+                units = bytes(libheader[gds_stream.UNITS])
+                for rectype in [gds_stream.HEADER, gds_stream.BGNLIB]:
+                    if rectype in libheader:
+                        yield libheader[rectype]
+                yield gds_stream.string_record(gds_stream.LIBNAME, libname)
+                yield units
+            elif bytes(libheader[gds_stream.UNITS]) != units:
+                raise gds_stream.GDSError('File ' + gdsfile +
+			' has different units than ' + glist[0])
+
+            for cell in gds_stream.structures(data):
+                if cell.name == '(UNNAMED)':
+                    continue
+                # Compare cells by contents, not including the dates
+                digest = hashlib.blake2b(data[cell.nameoffset:cell.end],
+			digest_size=20).digest()
+                if cell.name in cells:
+                    firstfile, firstdigest = cells[cell.name]
+                    if digest != firstdigest:
+                        print('Warning:  Cell ' + cell.name + ' in ' + gdsfile +
+				' is different from cell ' + cell.name + ' in ' +
+				firstfile + ' (keeping the first one)')
+                    continue
+                cells[cell.name] = (gdsfile, digest)
+                yield data[cell.start:cell.end]
+
+    yield gds_stream.header.pack(4, gds_stream.ENDLIB, gds_stream.NODATA)
+
+#----------------------------------------------------------------------------
+# Write the GDS library "alllibname" with library name "libname" from the
+# files in "glist".  Returns True on success, or False if the files cannot
+# be combined without magic.
+#----------------------------------------------------------------------------
+
+def merge_gds(glist, alllibname, libname):
+    try:
+        gds_stream.write_gds(alllibname, merge_chunks(glist, libname))
+    except (OSError, gds_stream.GDSError) as e:
+        print('Cannot combine GDS files directly:  ' + str(e))
+        return False
+    return True
+
+#----------------------------------------------------------------------------
+# Write the GDS library <destlibroot>.gds from the files in "glist" using
+# magic.
+#----------------------------------------------------------------------------
+
+def create_gds_library_magic(destlibdir, destlibroot, glist, startup_script, keep=False):
+    if os.path.isfile(startup_script):
+        # If the symbolic link exists, remove it.
+        if os.path.isfile(destlibdir + '/.magicrc'):
+            os.remove(destlibdir + '/.magicrc')
+        os.symlink(startup_script, destlibdir + '/.magicrc')
+
+    # A GDS library is binary and requires handling in Magic
+    print('Creating magic generation script to generate GDS library.') 
+    with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
+        print('#!/usr/bin/env wish', file=ofile)
+        print('#--------------------------------------------', file=ofile)
+        print('# Script to generate .gds library from files   ', file=ofile)
+        print('#--------------------------------------------', file=ofile)
+        print('drc off', file=ofile)
+        print('locking off', file=ofile)
+        print('gds readonly true', file=ofile)
+        # print('gds flatten true', file=ofile)
+        print('gds polygon subcell true', file=ofile)
+        print('gds rescale false', file=ofile)
+        print('tech unlock *', file=ofile)
+
+        for gdsfile in glist:
+            print('gds read ' + gdsfile, file=ofile)
+
+        # Remove any cell named "(UNNAMED)"
+        print('cellname delete \(UNNAMED\)', file=ofile)
+
+        # Get list of cell names, which may be different than the
+        # file names.
+        print('set glist [cellname list top]', file=ofile)
+
+        print('puts stdout "Creating cell ' + destlibroot + '"', file=ofile)
+        print('load ' + destlibroot, file=ofile)
+        print('puts stdout "Adding cells to library"', file=ofile)
+        print('box values 0 0 0 0', file=ofile)
+
+        # for gdsfile in glist:
+        #     gdsroot = os.path.split(gdsfile)[1]
+        #     gdsname = os.path.splitext(gdsroot)[0]
+        #     print('getcell ' + gdsname, file=ofile)
+        #     # Could properly make space for the cell here. . . 
+        #     print('box move e 200', file=ofile)
+
+        print('foreach gcell $glist {', file=ofile)
+        print('    getcell $gcell', file=ofile)
+        print('    box move e 200', file=ofile)
+        print('}', file=ofile)
+                            
+        print('puts stdout "Writing GDS library ' + destlibroot + '"', file=ofile)
+        print('gds library true', file=ofile)
+        print('gds write ' + destlibroot, file=ofile)
+        print('puts stdout "Done."', file=ofile)
+        print('quit -noprompt', file=ofile)
+
+    # Run magic to read in the individual GDS files and
+    # write out the consolidated GDS library
+
+    print('Running magic to create GDS library.')
+    sys.stdout.flush()
+
+    # Run on a (pre-started) magic process from the session pool
+    pool = magic_session.get_pool()
+    script = 'source ' + magic_session.tcl_quote(destlibdir + '/generate_magic.tcl')
+    rcfile = destlibdir + '/.magicrc'
+    if not os.path.exists(rcfile):
+        rcfile = None
+    returncode, outlines, errlines = pool.run_script(script, destlibdir, rcfile)
+
+    if outlines:
+        for line in outlines:
+            print(line)
+    if errlines:
+        print('Error message output from magic:')
+        for line in errlines:
+            print(line)
+    if returncode != 0:
+        print('ERROR:  Magic exited with status ' + str(returncode))
+    if not keep:
+        os.remove(destlibdir + '/generate_magic.tcl')
+
+#----------------------------------------------------------------------------
+
+def create_gds_library(destlibdir, destlib, startup_script, do_compile_only=False, excludelist=[], keep=False, use_magic=False):
 
     # destlib should not have a file extension
     destlibroot = os.path.splitext(destlib)[0]
@@ -85,89 +243,18 @@ def create_gds_library(destlibdir, destlib, startup_script, do_compile_only=Fals
     if len(glist) > 1:
         print('New file is:  ' + alllibname)
 
-        if os.path.isfile(startup_script):
-            # If the symbolic link exists, remove it.
-            if os.path.isfile(destlibdir + '/.magicrc'):
-                os.remove(destlibdir + '/.magicrc')
-            os.symlink(startup_script, destlibdir + '/.magicrc')
-
-        # A GDS library is binary and requires handling in Magic
-        print('Creating magic generation script to generate GDS library.') 
-        with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
-            print('#!/usr/bin/env wish', file=ofile)
-            print('#--------------------------------------------', file=ofile)
-            print('# Script to generate .gds library from files   ', file=ofile)
-            print('#--------------------------------------------', file=ofile)
-            print('drc off', file=ofile)
-            print('locking off', file=ofile)
-            print('gds readonly true', file=ofile)
-            # print('gds flatten true', file=ofile)
-            print('gds polygon subcell true', file=ofile)
-            print('gds rescale false', file=ofile)
-            print('tech unlock *', file=ofile)
-
-            for gdsfile in glist:
-                print('gds read ' + gdsfile, file=ofile)
-
-            # Remove any cell named "(UNNAMED)"
-            print('cellname delete \(UNNAMED\)', file=ofile)
-
-            # Get list of cell names, which may be different than the
-            # file names.
-            print('set glist [cellname list top]', file=ofile)
-
-            print('puts stdout "Creating cell ' + destlibroot + '"', file=ofile)
-            print('load ' + destlibroot, file=ofile)
-            print('puts stdout "Adding cells to library"', file=ofile)
-            print('box values 0 0 0 0', file=ofile)
-
-            # for gdsfile in glist:
-            #     gdsroot = os.path.split(gdsfile)[1]
-            #     gdsname = os.path.splitext(gdsroot)[0]
-            #     print('getcell ' + gdsname, file=ofile)
-            #     # Could properly make space for the cell here. . . 
-            #     print('box move e 200', file=ofile)
-
-            print('foreach gcell $glist {', file=ofile)
-            print('    getcell $gcell', file=ofile)
-            print('    box move e 200', file=ofile)
-            print('}', file=ofile)
-                                
-            print('puts stdout "Writing GDS library ' + destlibroot + '"', file=ofile)
-            print('gds library true', file=ofile)
-            print('gds write ' + destlibroot, file=ofile)
-            print('puts stdout "Done."', file=ofile)
-            print('quit -noprompt', file=ofile)
-
-        # Run magic to read in the individual GDS files and
-        # write out the consolidated GDS library
-
-        print('Running magic to create GDS library.')
-        sys.stdout.flush()
-
-        mproc = subprocess.run(['magic', '-dnull', '-noconsole',
-			destlibdir + '/generate_magic.tcl'],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE, cwd = destlibdir,
-			universal_newlines = True)
-
-        if mproc.stdout:
-            for line in mproc.stdout.splitlines():
-                print(line)
-        if mproc.stderr:
-            print('Error message output from magic:')
-            for line in mproc.stderr.splitlines():
-                print(line)
-        if mproc.returncode != 0:
-            print('ERROR:  Magic exited with status ' + str(mproc.returncode))
+        merged = False
+        if not use_magic:
+            print('Copying cells from ' + str(len(glist)) + ' files into GDS library.')
+            merged = merge_gds(glist, alllibname, destlibroot)
+        if not merged:
+            create_gds_library_magic(destlibdir, destlibroot, glist, startup_script, keep)
+
         if do_compile_only == True:
             print('Compile-only:  Removing individual GDS files')
             for gfile in glist:
                 if os.path.isfile(gfile):
                     os.remove(gfile)
-        if not keep:
-            os.remove(destlibdir + '/generate_magic.tcl')
     else:
         print('Only one file (' + str(glist) + ');  ignoring "compile" option.')
 
@@ -184,6 +271,7 @@ if __name__ == '__main__':
     # Defaults
     do_compile_only = False
     keep = False
+    use_magic = False
     excludelist = []
 
     # Break arguments into groups where the first word begins with "-".
@@ -200,6 +288,8 @@ if __name__ == '__main__':
                         do_compile_only = True
                 else:
                     do_compile_only = True
+            elif keyval[0] == 'magic':
+                use_magic = True
             elif keyval[1] == 'exclude' or key == 'excludelist':
                 if len(keyval) > 0:
                     excludelist = keyval[1].trim('"').split(',')
@@ -235,7 +325,7 @@ if __name__ == '__main__':
     print('Keep generating script: ' + 'Yes' if keep else 'No')
     print('')
 
-    create_gds_library(destlibdir, destlib, startup_script, do_compile_only, excludelist, keep)
+    create_gds_library(destlibdir, destlib, startup_script, do_compile_only, excludelist, keep, use_magic)
     print('Done.')
     sys.exit(0)
 
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# digest_index.py
+#
+#----------------------------------------------------------------------------
+# Content digests of files, used by staging_install.py to find installed
+# files that are identical to vendor source files or to the files of
+# another installed PDK variant, so that they can be replaced by symbolic
+# links.
+#
+# The index records the size, modification time, and content digest
+# (blake2b) of each file it has read, keyed by absolute path.  The digest
+# of a file whose size and modification time are unchanged is taken from
+# the index and the file is not read again.  The index can be saved to a
+# file and loaded by the next install, so that (for example) the vendor
+# source files and the files of the first PDK variant installed are only
+# read once for all variants.  The index file is JSON:
+#
+#    {"version": 1, "files": {"<path>": [<size>, <mtime_ns>, "<digest>"]}}
+#----------------------------------------------------------------------------
+
+import os
+import stat
+import json
+import hashlib
+
+index_version = 1
+
+#----------------------------------------------------------------------------
+# Return the blake2b content digest of a file.
+#----------------------------------------------------------------------------
+
+def file_digest(filepath):
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(filepath, 'rb') as ifile:
+        while True:
+            block = ifile.read(1 << 20)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+#----------------------------------------------------------------------------
+# Index of file digests.  If "indexfile" is given, then the index is
+# loaded from that file, and save() writes it back.
+#----------------------------------------------------------------------------
+
+class DigestIndex(object):
+
+    def __init__(self, indexfile=None):
+        self.indexfile = indexfile
+        self.files = {}
+        self.modified = False
+        self.hits = 0
+        self.misses = 0
+        if indexfile:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.indexfile, 'r') as ifile:
+                data = json.load(ifile)
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('version') == index_version:
+            self.files = data.get('files', {})
+
+    # Write the index to the index file.  The file is written under a
+    # temporary name and renamed, so that an install running at the same
+    # time never reads a partly written index.  Entries for files that no
+    # longer exist are dropped.
+
+    def save(self):
+        if not self.indexfile or not self.modified:
+            return
+        for filepath in list(self.files.keys()):
+            if not os.path.isfile(filepath):
+                del self.files[filepath]
+        os.makedirs(os.path.dirname(os.path.abspath(self.indexfile)), exist_ok=True)
+        tmpfile = self.indexfile + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpfile, 'w') as ofile:
+            json.dump({'version': index_version, 'files': self.files}, ofile)
+        os.replace(tmpfile, self.indexfile)
+        self.modified = False
+
+    # Return the digest of the file "filepath", which has the status
+    # "st" (from os.stat()).
+
+    def digest(self, filepath, st=None):
+        filepath = os.path.abspath(filepath)
+        if st is None:
+            st = os.stat(filepath)
+        entry = self.files.get(filepath)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        digest = file_digest(filepath)
+        self.files[filepath] = [st.st_size, st.st_mtime_ns, digest]
+        self.modified = True
+        return digest
+
+    # Return True if "file1" and "file2" are regular files with the same
+    # contents (the equivalent of filecmp.cmp(file1, file2, shallow=False)).
+    # Files of different sizes are never read.
+
+    def same_contents(self, file1, file2):
+        st1 = os.stat(file1)
+        st2 = os.stat(file2)
+        if not stat.S_ISREG(st1.st_mode) or not stat.S_ISREG(st2.st_mode):
+            return False
+        if st1.st_size != st2.st_size:
+            return False
+        if st1.st_dev == st2.st_dev and st1.st_ino == st2.st_ino:
+            return True
+        return self.digest(file1, st1) == self.digest(file2, st2)
@@ -8,9 +8,16 @@
 #
 # Options:
 #    -timestamp <value>	Pass a timestamp to use for stamping GDS and MAG files
+#			(the dates of all installed GDS files are set to
+#			this value, including vendor GDS files)
 #    -clean		Clear out and remove target directory before starting
 #    -source <path>	Path to source data top level directory
 #    -target <path>	Path to target (staging) top level directory
+#    -jobs <number>	Run up to <number> independent stages (library
+#			compiles, magic runs, CDL conversions, filter
+#			scripts) in parallel
+#    -nocache		Always run, even if the staging manifest shows that
+#			nothing has changed since the last run (see below)
 #
 # All other options represent paths to vendor files.  They may all be
 # wildcarded with "*", or with specific escapes like "%l" for library
@@ -167,6 +174,12 @@
 #		    netlist (implies that the layout uses the "device
 #		    primitive" property).
 #
+#	shards:	   Followed by "=" and a number.  Used with "-gds".  Split
+#		    the conversion of GDS to magic database and LEF files
+#		    among <number> magic processes, each of which reads the
+#		    GDS and writes its share of the cells.  The output is
+#		    the same as when using a single magic process.
+#
 #	options:   Followed by "=" and the name of a script.  Behavior
 #		    is dependent on the mode;  if applied to "-gds",
 #		    then the script is inserted before the GDS read
@@ -182,33 +195,87 @@
 #		    that are excluded from a library but are handled by
 #		    a filter script to be cleaned up afterward.
 #
+# Each run of this script with a given set of options records a manifest
+# in the ".stage_manifest" directory of the staging area, containing the
+# content digests of all source files read and of the files that earlier runs
+# have staged in the same library directories, a digest of the install and
+# filter scripts, and the size and time of every file written.  If the same
+# options are given again, all of these are unchanged, and the files written
+# are still intact, then the script exits without doing anything.
+#
+# The output of each command run (magic, cdl2spi, filter scripts) is
+# written to a log file in the ".stage_logs" directory of the staging area
+# as well as to the console.  The file ".stage_logs/summary.jsonl" records
+# each command with its run time, CPU time, and peak memory use (see
+# stage_log.py).  If the environment variable OPEN_PDKS_TRACE is set, then
+# the time taken by each step is also recorded in a trace file (see
+# stage_trace.py and trace_report.py).  The hierarchy and layer statistics
+# of the GDS files of each library installed are written to the file
+# ".stage_logs/gds_stats_<library>.json" (see gds_stats.py).
+#
+# With the option "-copy hardlink", vendor files are installed into the
+# staging area as hard links to the source files instead of copies, and
+# with "-copy reflink", as copy-on-write clones (on filesystems that support
+# them).  Files that cannot be linked or cloned are copied.  Any installed
+# file that is modified by a filter or has its permissions changed is first
+# replaced by a copy of its own, so that the source is never modified (see
+# copy_strategy.py).  This saves time and disk space for large libraries.
+#
+# With the option "-plan" (or "-plan json"), nothing is installed;  the
+# script prints a JSON list of the steps that it would run (file copies,
+# filters, library compiles, and conversions to derived formats), with the
+# source files read and the files written by each step and the steps that
+# each step depends on.  With "-plan make", the same steps are printed as a
+# Makefile fragment.  The staging area is not read or changed.
+#
 # NOTE:  This script can be called once for all libraries if all file
 # types (gds, cdl, lef, etc.) happen to all work with the same wildcards.
 # However, it is more likely that it will be called several times for the
 # same PDK, once to install I/O cells, once to install digital, and so
 # forth, as made possible by the wild-carding.
 
+import io
 import re
 import os
+import ast
 import sys
+import json
 import glob
 import stat
 import shutil
 import fnmatch
+import threading
+import contextlib
+import importlib.util
+import multiprocessing
+import tempfile
 import subprocess
+import concurrent.futures
 
 # Import local routines
 import natural_sort
+import gds_dates
+import gds_stats
 from create_gds_library import create_gds_library
 from create_spice_library import create_spice_library
 from create_lef_library import create_lef_library
 from create_lib_library import create_lib_library
 from create_verilog_library import create_verilog_library
+from stage_scheduler import StageScheduler
+import stage_manifest
+import stage_log
+import stage_trace
+import magic_session
+import copy_strategy
 
 def usage():
     print("foundry_install.py [options...]")
-    print("   -copy             Copy files from source to target (default)")
+    print("   -copy [<strategy>] Copy files from source to target (default).  <strategy>")
+    print("                     is copy (default), hardlink, or reflink (see below)")
     print("   -timestamp <value> Use <value> for timestamping files")
+    print("   -jobs <number>    Run up to <number> independent stages in parallel")
+    print("   -nocache          Run even if the staging manifest is up to date")
+    print("   -plan [json|make] Print the install steps without running them")
     print("")
     print("   -source <path>    Path to top of source directory tree")
     print("   -target <path>    Path to top of target directory tree")
@@ -255,6 +322,9 @@ def subprocess_run(name, cmd, stdin=subprocess.DEVNULL, cwd=None):
     sys.stdout.flush()
     sys.stderr.flush()
 
+    logkey = stdin.name if stdin != subprocess.DEVNULL else ''
+    log = stage_log.StageLog(name, cmd, cwd, logkey)
+
     fproc = subprocess.Popen(
         cmd,
         stdin = stdin,
@@ -263,37 +333,105 @@ def subprocess_run(name, cmd, stdin=subprocess.DEVNULL, cwd=None):
         universal_newlines = True,
         cwd = cwd or os.curdir,
     )
-    stdout, stderr = fproc.communicate()
-    if stdout:
-        for line in stdout.splitlines():
-            print(line)
-    if stderr:
-        print('Error message output from {} script:'.format(name))
-        for line in stderr.splitlines():
-            print(line)
-
-    if fproc.returncode != 0:
-        emsg = [
-            "Command {} failed with exit code: {}\n".format(
-                name, fproc.returncode),
-            "  " + " ".join(cmd),
-        ]
-        if stdin != subprocess.DEVNULL:
-            stdin.seek(0)
-            input_script = stdin.read()
-            emsg += [
-                "\nInput script was:\n",
-                '-'*75,'\n',
-                input_script,'\n',
-                '-'*75,'\n',
-            ]
-        raise SystemError("".join(emsg))
+
+    # Pass output through line by line as it is produced, reading stderr
+    # in a separate thread so that neither pipe can fill up and block.
+    errthread = threading.Thread(target=log_lines, args=(fproc.stderr, log.error))
+    errthread.start()
+    log_lines(fproc.stdout, log.output)
+    errthread.join()
+
+    rusage = stage_log.wait_rusage(fproc)
+    log.finish(fproc.returncode, rusage)
+
+    input_script = None
+    if fproc.returncode != 0 and stdin != subprocess.DEVNULL:
+        stdin.seek(0)
+        input_script = stdin.read()
+
+    log.check(input_script)
+
+def log_lines(stream, logfunc):
+    for line in stream:
+        logfunc(line)
+    stream.close()
+
+#----------------------------------------------------------------------------
+# Run a GDS to magic database script (see "shards" option) in "nshards"
+# magic processes at once.  Tcl variables "shard" and "nshards" are set
+# before running the script, and the script writes only the cells and LEF
+# macros belonging to its shard.  Each shard writes LEF views into its own
+# directory ("sharddir").  When all shards have finished, the files in
+# "leffiles" are deleted and the LEF views are moved to "lefdest".
+#----------------------------------------------------------------------------
+
+def run_magic_shards(tclfile, cwd, nshards, leffiles, lefdest):
+    with open(tclfile, 'r') as ifile:
+        script = ifile.read()
+
+    rcfile = cwd + '/.magicrc'
+    if not os.path.exists(rcfile):
+        rcfile = None
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    # Get all of the magic processes first so that any that have to be
+    # started all load the technology at the same time.  The processes are
+    # kept in the pool afterward for the next library.
+    pool = magic_session.get_pool(nshards)
+    sessions = []
+    sharddirs = []
+    logs = []
+    for shard in range(nshards):
+        sessions.append(pool.acquire(rcfile))
+        sharddirs.append(tempfile.mkdtemp(prefix='.shard' + str(shard) + '_', dir=cwd))
+        # Output is not printed until all shards are done, to keep the
+        # output of each shard together.
+        logs.append(stage_log.StageLog('magic', ['magic', '-dnull', '-noconsole'],
+			cwd, tclfile + ':' + str(shard), echo=False))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(nshards) as executor:
+            futures = []
+            for shard in range(nshards):
+                shardscript = 'set shard ' + str(shard) + '\n'
+                shardscript += 'set nshards ' + str(nshards) + '\n'
+                shardscript += 'set sharddir ' + magic_session.tcl_quote(sharddirs[shard]) + '\n'
+                shardscript += script
+                futures.append(executor.submit(sessions[shard].run_script,
+				shardscript, cwd, logs[shard].output, logs[shard].error))
+            results = list(future.result() for future in futures)
+
+        for shard in range(nshards):
+            logs[shard].finish(results[shard][0])
+
+        for shard in range(nshards):
+            print('Output from magic process ' + str(shard + 1) + ' of ' + str(nshards) + ':')
+            logs[shard].replay()
+            logs[shard].check(script)
+
+        # Replace the original LEF files with the LEF views from all shards
+        if lefdest:
+            for leffile in leffiles:
+                if os.path.isfile(leffile):
+                    os.remove(leffile)
+            for sharddir in sharddirs:
+                for leffile in sorted(os.listdir(sharddir)):
+                    shutil.move(sharddir + '/' + leffile, lefdest + leffile)
+    finally:
+        for session in sessions:
+            pool.release(session)
+        for sharddir in sharddirs:
+            shutil.rmtree(sharddir, ignore_errors=True)
 
 #----------------------------------------------------------------------------
 #----------------------------------------------------------------------------
 
 def makeuserwritable(filepath):
     if os.path.exists(filepath):
+        # A hard link to a vendor file must not have its permissions changed
+        copy_strategy.break_link(filepath)
         st = os.stat(filepath)
         os.chmod(filepath, st.st_mode | stat.S_IWUSR)
 
@@ -402,14 +540,14 @@ def get_gds_properties(magfile):
     return proplines
 
 #----------------------------------------------------------------------------
-# Read subcircuit ports from a CDL file, given a subcircuit name that should
-# appear in the file as a subcircuit entry, and return a dictionary of ports
-# and their indexes in the subcircuit line.
+# Read all subcircuit entries from a CDL file in a single pass, and return
+# a dictionary keyed by the (lowercase) subcircuit name, where each value is
+# a dictionary of ports and their indexes in the subcircuit line.  If a
+# subcircuit appears more than once in the file, the first entry is used.
 #----------------------------------------------------------------------------
 
-def get_subckt_ports(cdlfile, subname):
-    portdict = {}
-    pidx = 1
+def read_subckt_ports(cdlfile):
+    subcktdict = {}
     portrex = re.compile(r'^\.subckt[ \t]+([^ \t]+)[ \t]+(.*)$', flags=re.IGNORECASE)
     with open(cdlfile, 'r') as ifile:
         cdltext = ifile.read()
@@ -417,13 +555,47 @@ def get_subckt_ports(cdlfile, subname):
         for line in cdllines:
             lmatch = portrex.match(line)
             if lmatch:
-                if lmatch.group(1).lower() == subname.lower():
-                    ports = lmatch.group(2).split()
-                    for port in ports:
-                        portdict[port.lower()] = pidx
-                        pidx += 1
-                    break
-    return portdict
+                subname = lmatch.group(1).lower()
+                if subname in subcktdict:
+                    continue
+                portdict = {}
+                pidx = 1
+                for port in lmatch.group(2).split():
+                    portdict[port.lower()] = pidx
+                    pidx += 1
+                subcktdict[subname] = portdict
+    return subcktdict
+
+#----------------------------------------------------------------------------
+# Read subcircuit ports from a CDL file, given a subcircuit name that should
+# appear in the file as a subcircuit entry, and return a dictionary of ports
+# and their indexes in the subcircuit line.
+#----------------------------------------------------------------------------
+
+def get_subckt_ports(cdlfile, subname):
+    return read_subckt_ports(cdlfile).get(subname.lower(), {})
+
+#----------------------------------------------------------------------------
+# Build an index of subcircuit ports for all CDL files in a library
+# directory, reading each CDL file only once.  Returns a dictionary keyed by
+# CDL file name, where each value is the dictionary returned by
+# read_subckt_ports() for that file.  The special key None holds the merged
+# index of all files in natural sort order, where the first file declaring
+# a subcircuit with a non-empty port list takes precedence (same as calling
+# get_subckt_ports() on each file in turn until one returns any ports).
+#----------------------------------------------------------------------------
+
+def get_subckt_index(cdllibdir):
+    subcktindex = {None: {}}
+    cdlfiles = glob.glob(cdllibdir + '/*.cdl')
+    cdlfiles = natural_sort.natural_sort(cdlfiles)
+    for cdlfile in cdlfiles:
+        subcktdict = read_subckt_ports(cdlfile)
+        subcktindex[cdlfile] = subcktdict
+        for subname, portdict in subcktdict.items():
+            if portdict and subname not in subcktindex[None]:
+                subcktindex[None][subname] = portdict
+    return subcktindex
 
 #----------------------------------------------------------------------------
 # Filter a verilog file to remove any backslash continuation lines, which
@@ -475,29 +647,1315 @@ def vfilter(targetroot):
 # For issues that are PDK-specific, a script can be written and put in
 # the PDK's custom/scripts/ directory, and passed to the foundry_install
 # script using the "filter" option.
+#
+# A filter script is run as "<script> <input> <output>".  However, if the
+# script is a python module that defines a function "filter(inname,
+# outname)" and does nothing else at the top level except imports,
+# definitions, and additions to sys.path to find the modules it imports
+# (the command-line handling must be inside an "if __name__ == '__main__':"
+# block), then the script is imported once and the function is called
+# directly for each file.  A return value other than 0 or None indicates
+# failure.  The scripts in */custom/scripts/ follow this form.
+#----------------------------------------------------------------------------
+
+filter_plugins = {}
+
+# Return True if "node" is a call to sys.path.append() or sys.path.insert().
+
+def is_path_setup(node):
+    if not isinstance(node, ast.Expr) or not isinstance(node.value, ast.Call):
+        return False
+    func = node.value.func
+    return (isinstance(func, ast.Attribute) and func.attr in ['append', 'insert'] and
+		isinstance(func.value, ast.Attribute) and func.value.attr == 'path' and
+		isinstance(func.value.value, ast.Name) and func.value.value.id == 'sys')
+
+def is_filter_module(tree):
+    have_filter = False
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.ClassDef)):
+            continue
+        elif isinstance(node, ast.FunctionDef):
+            if node.name == 'filter' and len(node.args.args) >= 2:
+                have_filter = True
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            continue
+        elif is_path_setup(node):
+            continue
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            continue
+        elif isinstance(node, ast.If):
+            # Only accept "if __name__ == '__main__':"
+            test = node.test
+            if not isinstance(test, ast.Compare) or not isinstance(test.left, ast.Name):
+                return False
+            if test.left.id != '__name__':
+                return False
+        else:
+            return False
+    return have_filter
+
+# Return the filter function of a filter script, or None if the script must
+# be run as a separate process.
+
+def load_filter(filterscript):
+    filterpath = os.path.abspath(filterscript)
+    if filterpath in filter_plugins:
+        return filter_plugins[filterpath]
+
+    plugin = None
+    try:
+        with open(filterpath, 'r') as ifile:
+            tree = ast.parse(ifile.read(), filterpath)
+    except (OSError, SyntaxError, ValueError):
+        tree = None
+
+    if tree and is_filter_module(tree):
+        filterdir, filterroot = os.path.split(filterpath)
+        modname = 'filter_' + os.path.splitext(filterroot)[0].replace('-', '_')
+        spec = importlib.util.spec_from_file_location(modname, filterpath)
+        module = importlib.util.module_from_spec(spec)
+        # Let the script import modules from its own directory, as it
+        # could if it were run from the command line.
+        sys.path.insert(0, filterdir)
+        try:
+            spec.loader.exec_module(module)
+            plugin = module.filter
+        finally:
+            sys.path.remove(filterdir)
+
+    filter_plugins[filterpath] = plugin
+    return plugin
+
+# Run a filter script on a single file.
+
+def run_filter(filterscript, infile, outfile):
+    plugin = load_filter(filterscript)
+    if not plugin:
+        subprocess_run('filter', [filterscript, infile, outfile])
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        result = plugin(infile, outfile)
+    except SystemExit as e:
+        result = e.code
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    if result:
+        raise SystemError('Filter {} failed on file {} with status: {}'.format(
+			filterscript, infile, result))
+
+# Run each filter script in "filter_scripts" on file "tfile" in turn.
+
+def filter_file(tfile, filter_scripts):
+    if filter_scripts:
+        copy_strategy.break_link(tfile)
+    for filter_script in filter_scripts:
+        filterroot = os.path.split(filter_script)[1]
+        print('   Filtering file ' + tfile + ' with ' + filterroot)
+        run_filter(filter_script, tfile, tfile)
+
+# Same as filter_file(), but return the output instead of printing it, for
+# use in a worker process.  Returns (output, error message or None).
+
+def filter_file_captured(tfile, filter_scripts):
+    output = io.StringIO()
+    errmsg = None
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            filter_file(tfile, filter_scripts)
+        except Exception as e:
+            errmsg = str(e)
+    return (output.getvalue(), errmsg)
+
+def tfilter(targetroot, filterscript, outfile=[], jobs=1):
+    if os.path.isfile(targetroot):
+        filterroot = os.path.split(filterscript)[1]
+        print('   Filtering file ' + targetroot + ' with ' + filterroot)
+
+        if not outfile:
+            outfile = targetroot
+            copy_strategy.break_link(outfile)
+        else:
+            # Make sure this file is writable (as the original may not be)
+            makeuserwritable(outfile)
+
+        run_filter(filterscript, targetroot, outfile)
+
+    else:
+        tfilter_all([(targetroot, [filterscript])], jobs)
+
+#----------------------------------------------------------------------------
+# Apply filters to a list of (target, filter_scripts) pairs, where each
+# target is a file or a directory of files.  The filter scripts for each
+# file are run in order.  With jobs > 1, files are filtered in parallel
+# in forked worker processes, and the output is printed in file order.
+#----------------------------------------------------------------------------
+
+def tfilter_all(targets, jobs=1):
+    tasks = []
+    for targetroot, filter_scripts in targets:
+        if not filter_scripts:
+            continue
+        if os.path.isfile(targetroot):
+            tasks.append((targetroot, filter_scripts))
+        else:
+            tlist = glob.glob(targetroot + '/*')
+            for tfile in tlist:
+                if os.path.isfile(tfile):
+                    tasks.append((tfile, filter_scripts))
+
+    # Load each filter once, before any worker processes are forked.
+    for tfile, filter_scripts in tasks:
+        for filter_script in filter_scripts:
+            load_filter(filter_script)
+
+    if jobs == 1 or len(tasks) < 2:
+        for tfile, filter_scripts in tasks:
+            filter_file(tfile, filter_scripts)
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(min(jobs, len(tasks))) as pool:
+        results = pool.starmap(filter_file_captured, tasks, chunksize=16)
+
+    errors = []
+    for output, errmsg in results:
+        sys.stdout.write(output)
+        if errmsg:
+            errors.append(errmsg)
+    sys.stdout.flush()
+    if errors:
+        raise SystemError('\n'.join(errors))
+
+#----------------------------------------------------------------------------
+# Return the default file extension for an install option type.
+#----------------------------------------------------------------------------
+
+def get_file_extension(optiontype):
+    if optiontype == 'verilog':
+        return '.v'
+    elif optiontype == 'liberty' or optiontype == 'lib':
+        return '.lib'
+    elif optiontype == 'spice' or optiontype == 'spi':
+        return '.spice'
+    elif optiontype == 'techlef':
+        return '.lef'
+    else:
+        return '.' + optiontype
+
+#----------------------------------------------------------------------------
+# Parse the keywords that follow the path of an install option for files
+# that are installed into libraries (e.g., "-cdl <path> compile stub
+# exclude=a,b").  Returns a dictionary of the settings.
+#----------------------------------------------------------------------------
+
+def get_install_options(option, scriptdir):
+    settings = {}
+
+    # If the option is followed by the keyword "up" and a number, then
+    # the source should be copied (or linked) from <number> levels up
+    # in the hierarchy (see below).
+
+    settings['hier_up'] = 0
+    for item in option:
+        if item.split('=')[0] == 'up':
+            settings['hier_up'] = int(item.split('=')[1])
+            break
+
+    settings['filter_scripts'] = []
+    for item in option:
+        if item.split('=')[0] == 'filter':
+            settings['filter_scripts'].append(item.split('=')[1])
+
+    # Option 'collate' is a standalone keyword
+    settings['do_collate'] = 'collate' in option
+
+    # Option 'stub' applies to netlists ('cdl' or 'spice') and generates
+    # a file with only stub entries.
+    settings['do_stub'] = 'stub' in option
+
+    # Option 'compile' is a standalone keyword ('comp' may be used).
+    settings['do_compile'] = 'compile' in option or 'comp' in option
+    settings['do_compile_only'] = 'compile-only' in option or 'comp-only' in option
+
+    # Option 'nospecify' is a standalone keyword ('nospec' may be used).
+    settings['do_remove_spec'] = 'nospecify' in option or 'nospec' in option
+
+    # Option 'remove' is a standalone keyword.
+    settings['do_remove'] = 'remove' in option
+
+    # Option 'privileged' is a standalone keyword.
+    settings['do_priv'] = 'priv' in option or 'privileged' in option or 'private' in option
+
+    # Option 'exclude' has an argument
+    settings['excludelist'] = []
+    try:
+        settings['excludelist'] = list(item.split('=')[1].split(',') for item in option if item.startswith('excl'))[0]
+    except IndexError:
+        pass
+
+    # Option 'no-copy' has an argument
+    settings['nocopylist'] = []
+    try:
+        settings['nocopylist'] = list(item.split('=')[1].split(',') for item in option if item.startswith('no-copy'))[0]
+    except IndexError:
+        pass
+
+    # Option 'include' has an argument
+    settings['includelist'] = []
+    try:
+        settings['includelist'] = list(item.split('=')[1].split(',') for item in option if item.startswith('incl'))[0]
+    except IndexError:
+        pass
+
+    # Option 'header' has an argument
+    try:
+        settings['headerfile'] = list(item.split('=')[1] for item in option if item.startswith('header'))[0]
+    except IndexError:
+        settings['headerfile'] = None
+
+    # Option 'rename' has an argument.  If the name has no extension, then
+    # the default extension for the file format is added.
+    try:
+        newname = list(item.split('=')[1] for item in option if item.startswith('rename'))[0]
+    except IndexError:
+        settings['newname'] = None
+    else:
+        if os.path.splitext(newname)[1] == '':
+            newname = newname + get_file_extension(option[0])
+        settings['newname'] = newname
+
+    # Option 'sort' has an argument. . .
+    try:
+        settings['sortscript'] = list(item.split('=')[1] for item in option if item.startswith('sort'))[0]
+    except IndexError:
+        # If option 'sort' is not specified, then use the "natural sort" script
+        settings['sortscript'] = scriptdir + '/sort_pdkfiles.py'
+        settings['have_sortscript'] = False
+    else:
+        settings['have_sortscript'] = True
+
+    return settings
+
+#----------------------------------------------------------------------------
+# Find the source files to install for one library from an install option.
+# Returns the source path pattern after substitution, the list of files
+# (after applying the exclude list), the file parts for each file if
+# collating, the names of excluded files, the names of all files found, and
+# the names of files not to be copied.
+#----------------------------------------------------------------------------
+
+def get_library_files(sourcedir, option, library, settings):
+
+    # Parse the option and replace each '/*/' with the library name,
+    # and check if it is a valid directory name.  Then glob the
+    # resulting option name.  Warning:  This assumes that all
+    # occurences of the text '/*/' match a library name.  It should
+    # be possible to wild-card the directory name in such a way that
+    # this is always true.
+
+    testpath = substitute(sourcedir + '/' + option[1], library[1])
+    liblist = glob.glob(testpath)
+    liblist = natural_sort.natural_sort(liblist)
+
+    splitfiles = {}
+    if settings['do_collate']:
+        # Rework liblist so that file parts are put into a list and
+        # associated with the final filename.  Replace the file parts
+        # in liblist with the collated filename.  Assume that the
+        # parts are named with an additional extension such as ".part1"
+        # ".part2" etc., and that these extensions are in natural sort
+        # order.  Note that it is not necessary for all files in the
+        # list to be split into parts.
+
+        # Regular expression catches filename "a.b.c", handling any
+        # leading dots (such as "../") and returns string "a.b"
+        basenamerex = re.compile(r'(\.?\.?[^.]+\..+)\.+')
+        baseliblist = []
+        for libfile in liblist:
+            bmatch = basenamerex.match(libfile)
+            if bmatch:
+                basename = bmatch.group(1)
+                if basename not in baseliblist:
+                    baseliblist.append(basename)
+                    splitfiles[basename] = [libfile]
+                else:
+                    splitfiles[basename].append(libfile)
+            else:
+                baseliblist.append(libfile)   ;# not a split file
+        liblist = baseliblist
+
+    # Create exclude list with glob-style matching using fnmatch
+    liblistnames = list(os.path.split(item)[1] for item in liblist)
+    notliblist = []
+    if len(liblist) > 0:
+        for exclude in settings['excludelist']:
+            if '/' in exclude:
+                # Names come from files in a path that is not the source
+                excludefiles = os.listdir(os.path.split(exclude)[0])
+                pattern = os.path.split(exclude)[1]
+                notliblist.extend(fnmatch.filter(excludefiles, pattern))
+            else:
+                notliblist.extend(fnmatch.filter(liblistnames, exclude))
+
+        # Apply exclude list
+        if len(notliblist) > 0:
+            for file in liblist[:]:
+                if os.path.split(file)[1] in notliblist:
+                    liblist.remove(file)
+
+    # Create a list of cell names not to be copied from "nocopylist"
+    nocopynames = []
+    for nocopy in settings['nocopylist']:
+        if '/' in nocopy:
+            # Names come from files in a path that is not the source
+            nocopyfiles = os.listdir(os.path.split(nocopy)[0])
+            pattern = os.path.split(nocopy)[1]
+            nocopynames.extend(fnmatch.filter(nocopyfiles, pattern))
+        else:
+            nocopynames.extend(fnmatch.filter(liblistnames, nocopy))
+
+    return (testpath, liblist, splitfiles, notliblist, liblistnames, nocopynames)
+
+#----------------------------------------------------------------------------
+# Return the path (relative to the library format directory) and name of
+# the installed file for source file "libname", one of "nfiles" files being
+# installed, and the default file extension for the format.  Returns
+# (destpath, destfile, fileext, rename_error) where rename_error is True if
+# "rename" was given a single name for multiple files.
+#----------------------------------------------------------------------------
+
+def get_dest_file(libname, nfiles, optiontype, settings):
+    hier_up = settings['hier_up']
+    newname = settings['newname']
+
+    # Note that there may be a hierarchy to the files in option[1],
+    # say for liberty timing files under different conditions, so
+    # make sure directories have been created as needed.
+
+    libfile = os.path.split(libname)[1]
+    libfilepath = os.path.split(libname)[0]
+    destpathcomp = []
+    for i in range(hier_up):
+        destpathcomp.append('/' + os.path.split(libfilepath)[1])
+        libfilepath = os.path.split(libfilepath)[0]
+    destpathcomp.reverse()
+    destpath = ''.join(destpathcomp)
+
+    fileext = get_file_extension(optiontype)
+
+    rename_error = False
+    if newname:
+        if nfiles == 1:
+            destfile = newname
+        elif newname.startswith('*.'):
+            destfile = os.path.splitext(libfile)[0] + newname[1:]
+        elif newname.startswith('.'):
+            destfile = os.path.splitext(libfile)[0] + newname
+        else:
+            if not settings['do_compile'] and not settings['do_compile_only']:
+                rename_error = True
+            destfile = libfile
+    else:
+        destfile = libfile
+
+    return (destpath, destfile, fileext, rename_error)
+
+#----------------------------------------------------------------------------
+# Return a list of all source files and directories that are read by the
+# install options, for recording in the staging manifest.  This includes
+# the files matched by each option, and any files named in option
+# arguments (filter scripts, sort scripts, Tcl options, headers, and
+# exclude/include lists).  If any libraries are being installed, then the
+# magic setup files in the staging area are also inputs.
+#----------------------------------------------------------------------------
+
+def get_stage_inputs(sourcedir, targetdir, optionlist, libraries):
+    libnames = list(library[1] for library in libraries)
+    if libnames == [] or 'primitive' in libraries[0]:
+        libnames.append(None)
+
+    pathlist = []
+    for option in optionlist:
+        if len(option) < 2:
+            continue
+        for libname in libnames:
+            pathlist.extend(glob.glob(substitute(sourcedir + '/' + option[1], libname)))
+
+        for item in option[2:]:
+            if '=' not in item:
+                continue
+            value = item.split('=')[1]
+            if item.startswith('header'):
+                for libname in libnames:
+                    pathlist.extend(glob.glob(substitute(sourcedir + '/' + value, libname)))
+            elif item.startswith('excl') or item.startswith('incl') or item.startswith('no-copy'):
+                for name in value.split(','):
+                    if '/' in name:
+                        pathlist.extend(glob.glob(name))
+            elif os.path.isfile(value):
+                pathlist.append(value)
+
+    if libraries != []:
+        pathlist.append(targetdir + '/libs.tech/magic')
+
+    return pathlist
+
+#----------------------------------------------------------------------------
+# Return the directories of all python scripts named in option arguments
+# (filter scripts, sort scripts), whose other python modules (which the
+# scripts may import) are part of the version recorded in the staging
+# manifest.
+#----------------------------------------------------------------------------
+
+def get_stage_scriptdirs(optionlist):
+    scriptdirs = []
+    for option in optionlist:
+        for item in option[2:]:
+            if '=' not in item:
+                continue
+            value = item.split('=')[1]
+            if value.endswith('.py') and os.path.isfile(value):
+                scriptdirs.append(os.path.dirname(os.path.abspath(value)))
+    return scriptdirs
+
+#----------------------------------------------------------------------------
+# Return the plan of an install without doing it:  A list of steps, one
+# for each copy of files into the staging area (with any filters applied
+# afterward), library compile, move to the privileged area, and conversion
+# to a derived format.  Each step is a dictionary with entries
+#
+#    id:	Unique name of the step (e.g., "install gds mylib")
+#    type:	"install", "compile", "privileged", "gds2mag", "lefanno",
+#		"maglef", "cdl2spi", or "extract"
+#    deps:	List of ids of steps that must be done first
+#    inputs:	List of files and directories read by the step
+#    outputs:	List of files and directories written by the step
+#
+# plus other entries specific to the type of step.  Source wildcards and
+# substitutions are expanded and exclude, include, and no-copy lists are
+# applied in the same way as for an install.  Files that do not exist yet
+# (because they are generated by an earlier step) are not expanded, so the
+# inputs and outputs of steps that work on the staging area are given as
+# directories.  The plan only reads the source directory.
+#----------------------------------------------------------------------------
+
+def make_plan(sourcedir, targetdir, scriptdir, optionlist, libraries):
+    steps = []
+    optionlist = optionlist[:]
+
+    def add_step(stepid, steptype, deps, inputs, outputs, **data):
+        step = {'id': stepid, 'type': steptype, 'deps': deps,
+			'inputs': inputs, 'outputs': outputs}
+        step.update(data)
+        steps.append(step)
+        return stepid
+
+    def get_destlib(library):
+        return library[2] if len(library) == 3 else library[1]
+
+    def get_filters(option):
+        return list(item.split('=')[1] for item in option
+			if item.split('=')[0] == 'filter')
+
+    # Files with no library, installed into libs.tech (see the start of
+    # part 1 below).
+
+    if libraries == [] or 'primitive' in libraries[0]:
+        for option in optionlist[:]:
+            if len(libraries) > 0 and 'primitive' in libraries[0]:
+                if option[0] != 'techlef' and option[0] != 'techLEF' and option[0] != 'models':
+                    continue
+
+            if option[0] == 'techlef' or option[0] == 'techLEF':
+                tooldir = targetdir + '/libs.tech/lef'
+            else:
+                tooldir = targetdir + '/libs.tech/' + option[0]
+
+            toollist = glob.glob(substitute(sourcedir + '/' + option[1], None))
+            files = list({'source': toolname,
+			'target': tooldir + '/' + os.path.split(toolname)[1]}
+			for toolname in toollist)
+            add_step('install ' + option[0], 'install', [],
+			list(item['source'] for item in files),
+			list(item['target'] for item in files),
+			files=files, filters=get_filters(option))
+            optionlist.remove(option)
+
+    # Files installed into libraries, and library compiles
+
+    part1 = {}
+    last_stage = {}
+    for library in libraries:
+        part1[get_destlib(library)] = []
+
+    for option in optionlist:
+        if libraries == []:
+            break
+
+        settings = get_install_options(option, scriptdir)
+        filter_scripts = settings['filter_scripts']
+
+        for library in libraries:
+            destlib = get_destlib(library)
+            destlibdir = targetdir + '/libs.ref/' + destlib + '/' + option[0]
+
+            (testpath, liblist, splitfiles, notliblist, liblistnames,
+			nocopynames) = get_library_files(sourcedir, option,
+			library, settings)
+
+            files = []
+            destfilelist = []
+            for libname in liblist:
+                (destpath, destfile, fileext, rename_error) = get_dest_file(
+				libname, len(liblist), option[0], settings)
+                targname = destlibdir + destpath + '/' + destfile
+                destfilelist.append(destfile)
+
+                if os.path.split(libname)[1] in nocopynames:
+                    continue
+                local_filter_scripts = filter_scripts[:]
+                if option[0] == 'verilog' and settings['do_remove_spec']:
+                    local_filter_scripts.append(scriptdir + '/remove_specify.py')
+                elif option[0] in ['cdl', 'spi', 'spice'] and settings['do_stub']:
+                    local_filter_scripts.append(scriptdir + '/makestub.py')
+
+                entry = {'source': libname, 'target': targname}
+                if settings['do_collate'] and libname in splitfiles:
+                    entry['parts'] = splitfiles[libname]
+                if local_filter_scripts:
+                    entry['filters'] = local_filter_scripts
+                files.append(entry)
+
+            sources = []
+            for entry in files:
+                sources.extend(entry.get('parts', [entry['source']]))
+
+            headername = None
+            if settings['headerfile']:
+                headerlist = glob.glob(substitute(sourcedir + '/' +
+				settings['headerfile'], library[1]))
+                if len(headerlist) == 1:
+                    headername = os.path.split(headerlist[0])[1]
+                    sources.append(headerlist[0])
+                    files.append({'source': headerlist[0],
+				'target': destlibdir + '/' + headername})
+
+            for incname in settings['includelist']:
+                if '/' in incname:
+                    incfiles = os.listdir(os.path.split(incname)[0])
+                    pattern = os.path.split(incname)[1]
+                    destfilelist.extend(fnmatch.filter(incfiles, pattern))
+                else:
+                    destfilelist.extend(fnmatch.filter(liblistnames, incname))
+
+            # A second install into the same directory waits for the compile
+            # of the first one.
+            deps = []
+            if (option[0], destlib) in last_stage:
+                deps.append(last_stage[(option[0], destlib)])
+
+            stepid = add_step('install ' + option[0] + ' ' + destlib, 'install',
+			deps, sources, list(entry['target'] for entry in files),
+			files=files, excluded=notliblist,
+			remove=settings['do_remove'])
+            part1[destlib].append(stepid)
+            last_stage[(option[0], destlib)] = stepid
+
+            if settings['do_compile'] or settings['do_compile_only']:
+                stepid = add_step('compile ' + option[0] + ' ' + destlib,
+			'compile', [stepid], [destlibdir], [destlibdir],
+			cells=destfilelist, header=headername,
+			exclude=settings['excludelist'],
+			remove_sources=settings['do_compile_only'],
+			rename=settings['newname'])
+                part1[destlib].append(stepid)
+                last_stage[(option[0], destlib)] = stepid
+
+            if settings['do_priv']:
+                privdir = targetdir + '/libs.priv/' + destlib + '/' + option[0]
+                stepid = add_step('privileged ' + option[0] + ' ' + destlib,
+			'privileged', [stepid], [destlibdir], [privdir, destlibdir])
+                part1[destlib].append(stepid)
+                last_stage[(option[0], destlib)] = stepid
+
+    # Conversions to derived formats, with the same conditions as part 2
+    # below.  All of part 2 is run after part 1 is complete.
+
+    have = {}
+    for option in optionlist:
+        have[option[0]] = option
+
+    def reflib(optiontype):
+        option = have.get(optiontype, [])
+        if 'priv' in option or 'privileged' in option or 'private' in option:
+            return '/libs.priv/'
+        return '/libs.ref/'
+
+    gdsoption = have.get('gds', [])
+    lefoption = have.get('lef', [])
+    cdloption = have.get('cdl', [])
+    have_lefanno = 'annotate' in lefoption or 'anno' in lefoption
+    have_lef = 'lef' in have and not have_lefanno
+    have_spice = 'spice' in have or 'spi' in have
+    gds_convert = 'gds' in have and 'noconvert' not in gdsoption
+    magicrc = targetdir + '/libs.tech/magic'
+
+    gdsstages = []
+    for library in libraries:
+        destlib = get_destlib(library)
+        if gds_convert:
+            libdir = targetdir + reflib('gds') + destlib
+            outputs = [libdir + '/mag']
+            if not have_lef:
+                outputs.append(targetdir + reflib('lef') + destlib + '/lef')
+            shards = 1
+            for item in gdsoption:
+                if item.split('=')[0] == 'shards':
+                    try:
+                        shards = max(1, int(item.split('=')[1]))
+                    except ValueError:
+                        pass
+            gdsstages.append(add_step('gds2mag ' + destlib, 'gds2mag',
+			part1[destlib], [libdir + '/gds', magicrc], outputs,
+			tool='magic', shards=shards))
+
+    if have_lefanno:
+        destlib = get_destlib(libraries[-1])
+        lefdir = targetdir + reflib('lef') + destlib + '/lef'
+        add_step('lefanno', 'lefanno', gdsstages + part1[destlib], [lefdir],
+			[lefdir], compile='compile' in lefoption,
+			compile_only='compile-only' in lefoption)
+
+    for library in libraries:
+        destlib = get_destlib(library)
+        deps = list(stepid for stepid in ['gds2mag ' + destlib, 'lefanno']
+			if any(step['id'] == stepid for step in steps))
+        deps.extend(part1[destlib])
+
+        if (have_lef or gds_convert) and 'noconvert' not in lefoption:
+            add_step('maglef ' + destlib, 'maglef', deps,
+			[targetdir + reflib('lef') + destlib + '/lef', magicrc],
+			[targetdir + '/libs.ref/' + destlib + '/maglef'], tool='magic')
+
+        if have_spice:
+            pass
+        elif 'cdl' in have and 'noconvert' not in cdloption:
+            cdldir = targetdir + reflib('cdl') + destlib + '/cdl'
+            spicedir = targetdir + reflib('cdl') + destlib + '/spice'
+            add_step('cdl2spi ' + destlib, 'cdl2spi', part1[destlib], [cdldir],
+			[spicedir], tool=scriptdir + '/cdl2spi.py')
+        elif gds_convert and 'noextract' not in gdsoption:
+            add_step('extract ' + destlib, 'extract', deps,
+			[targetdir + reflib('gds') + destlib + '/gds',
+			targetdir + reflib('lef') + destlib + '/lef', magicrc],
+			[targetdir + reflib('cdl') + destlib + '/spice'], tool='magic',
+			parasitics='dorcx' in gdsoption)
+
+    return steps
+
+#----------------------------------------------------------------------------
+# Print a plan from make_plan() as JSON (format "json") or as a Makefile
+# fragment (format "make").  In the Makefile fragment, each step is a phony
+# target "stage/<id>" (with spaces in the id replaced by "/") depending on
+# the targets of the steps it needs and on its source files, and the
+# variable "<target>_OUTPUTS" lists the files and directories it writes.
+#----------------------------------------------------------------------------
+
+def write_plan(steps, planformat, ofile=sys.stdout):
+    if planformat == 'json':
+        json.dump(steps, ofile, indent=2)
+        print('', file=ofile)
+        return
+
+    def maketarget(stepid):
+        return 'stage/' + stepid.replace(' ', '/')
+
+    def makequote(path):
+        return path.replace('$', '$$').replace(' ', '\\ ').replace('#', '\\#')
+
+    print('# Install steps from foundry_install.py -plan make', file=ofile)
+    for step in steps:
+        target = maketarget(step['id'])
+        prereqs = list(maketarget(dep) for dep in step['deps'])
+        if step['type'] == 'install':
+            prereqs.extend(makequote(path) for path in step['inputs'])
+        print('', file=ofile)
+        print('.PHONY: ' + target, file=ofile)
+        print(target + ':' + ''.join(' \\\n\t' + item for item in prereqs),
+			file=ofile)
+        print(target + '_OUTPUTS := ' + ' '.join(makequote(path)
+			for path in step['outputs']), file=ofile)
+
+#----------------------------------------------------------------------------
+# Run magic in batch mode on a Tcl script, running in directory "cwd" with
+# the .magicrc startup file found there.  The script is run on a magic
+# process from the pool in magic_session.py, which has already read the
+# startup file and is kept for the scripts that follow.  If "source" is True, then the script is sourced (same as
+# passing the script name to magic on the command line);  otherwise, the
+# script contents are passed to magic on standard input.
+#----------------------------------------------------------------------------
+
+def run_magic_script(tclfile, cwd, source=False):
+    if source:
+        script = 'source ' + magic_session.tcl_quote(tclfile) + '\n'
+    else:
+        with open(tclfile, 'r') as ifile:
+            script = ifile.read()
+
+    rcfile = cwd + '/.magicrc'
+    if not os.path.exists(rcfile):
+        rcfile = None
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    log = stage_log.StageLog('magic', ['magic', '-dnull', '-noconsole'], cwd,
+		tclfile)
+    pool = magic_session.get_pool()
+    returncode, outlines, errlines = pool.run_script(script, cwd, rcfile,
+		outfunc=log.output, errfunc=log.error)
+    log.finish(returncode)
+    log.check(script)
+
+#----------------------------------------------------------------------------
+# Compile a single library file from the individual files installed into
+# "destlibdir" (option "compile" or "compile-only"), then apply "rename" to
+# the compiled file if requested.  "startup_script" is the magic startup
+# file used to compile GDS libraries, or None if magic is not available.
+#----------------------------------------------------------------------------
+
+def compile_library(libtype, destlibdir, compname, do_compile_only, do_stub,
+		excludelist, headerfile, startup_script, have_lefanno,
+		newname, fileext, destpath, targname, sortscript):
+
+    # NOTE:  The purpose of "rename" is to put a destlib-named
+    # library elsewhere so that it can be merged with another
+    # library into a compiled <destlib>.<ext> on another pass.
+
+    # To do:  Make this compatible with linking from another PDK.
+
+    if libtype == 'verilog':
+        # If there is not a single file with all verilog cells in it,
+        # then compile one, because one does not want to have to have
+        # an include line for every single cell used in a design.
+
+        create_verilog_library(destlibdir, compname, do_compile_only, do_stub, excludelist)
+
+    elif libtype == 'gds' and startup_script:
+        # If there is not a single file with all GDS cells in it,
+        # then compile one.
+
+        create_gds_library(destlibdir, compname, startup_script, do_compile_only, excludelist)
+
+    elif libtype == 'liberty' or libtype == 'lib':
+        # If there is not a single file with all liberty cells in it,
+        # then compile one, because one does not want to have to have
+        # an include line for every single cell used in a design.
+
+        create_lib_library(destlibdir, compname, do_compile_only, excludelist, headerfile)
+
+    elif libtype == 'spice' or libtype == 'spi':
+        # If there is not a single file with all SPICE subcircuits in it,
+        # then compile one, because one does not want to have to have
+        # an include line for every single cell used in a design.
+
+        spiext = '.spice'
+        create_spice_library(destlibdir, compname, spiext, do_compile_only, do_stub, excludelist)
+
+    elif libtype == 'cdl':
+        # If there is not a single file with all CDL subcircuits in it,
+        # then compile one, because one does not want to have to have
+        # an include line for every single cell used in a design.
+
+        create_spice_library(destlibdir, compname, '.cdl', do_compile_only, do_stub, excludelist)
+
+    elif libtype == 'lef':
+        # If there is not a single file with all LEF cells in it,
+        # then compile one, because one does not want to have to have
+        # an include line for every single cell used in a design.
+
+        # (If the LEF files are used for annotation, then the library
+        # is compiled after magic has generated the LEF views.)
+
+        if not have_lefanno:
+            create_lef_library(destlibdir, compname, do_compile_only, excludelist)
+
+            if do_compile_only == True:
+                if newname and targname:
+                    if os.path.isfile(targname):
+                        os.remove(targname)
+
+    # "rename" with "compile" or "compile-only":  Change the name
+    # of the compiled file.
+
+    if newname:
+        print('   Renaming ' + compname + fileext + ' to ' + newname)
+        origname = destlibdir + '/' + compname + fileext
+        targrename = destlibdir + destpath + '/' + newname
+        if os.path.isfile(origname):
+            os.rename(origname, targrename)
+
+    # If "filelist.txt" was created, remove it
+    if sortscript:
+        if os.path.isfile(destlibdir + '/filelist.txt'):
+            os.remove(destlibdir + '/filelist.txt')
+
+#----------------------------------------------------------------------------
+# Move the files in "srclibdir" to the privileged space "destlibdir".
+#----------------------------------------------------------------------------
+
+def move_to_privileged(srclibdir, destlibdir):
+    if not os.path.exists(destlibdir):
+        os.makedirs(destlibdir)
+
+    print('Moving files in ' + srclibdir + ' to privileged space.')
+    filelist = os.listdir(srclibdir)
+    for file in filelist:
+        srcfile = srclibdir + '/' + file
+        destfile = destlibdir + '/' + file
+        if os.path.isfile(destfile):
+            os.remove(destfile)
+        elif os.path.isdir(destfile):
+            shutil.rmtree(destfile)
+
+        if os.path.isfile(srcfile):
+            copy_strategy.copy_file(srcfile, destfile)
+            os.remove(srcfile)
+        else:
+            copy_strategy.copy_tree(srcfile, destfile)
+            shutil.rmtree(srcfile)
+
+#----------------------------------------------------------------------------
+# Compile the LEF library from the LEF views written by magic, for LEF
+# files that were used for annotation only.
+#----------------------------------------------------------------------------
+
+def compile_annotated_lef(lef_savelibname, lefsrclibdir, destlib, lef_compile,
+		lef_compile_only, lef_exclude):
+
+    # If a single vendor library file was used for annotation, remove it now.
+    if lef_savelibname:
+        if os.path.isfile(lef_savelibname):
+            os.remove(lef_savelibname)
+
+    if lef_compile or lef_compile_only:
+        create_lef_library(lefsrclibdir, destlib, lef_compile_only, lef_exclude)
+
+#----------------------------------------------------------------------------
+# Create the abstract views (maglef) of library "destlib" in "destlibdir"
+# from the LEF files in "srclibdir", then annotate them and the full views
+# in "maglibdir" with the GDS properties and with the port order from the
+# CDL files in "cdllibdir".  "netlibdir" is the directory of CDL or SPICE
+# netlists read to make sure that ports are present, or None.  This is run
+# as a stage after the magic databases (and any LEF views) for the library
+# have been generated from GDS.
+#----------------------------------------------------------------------------
+
+def generate_maglef(destlib, destlibdir, srclibdir, maglibdir, cdllibdir,
+		netlibdir, startup_script, lef_exclude, pdklibrary, devlist,
+		fixedlist, datestamp):
+
+    # Link to the PDK magic startup file from the target directory
+    # If the symbolic link exists, remove it.
+    if os.path.isfile(destlibdir + '/.magicrc'):
+        os.remove(destlibdir + '/.magicrc')
+    os.symlink(startup_script, destlibdir + '/.magicrc')
+
+    # Find LEF file names in the source
+    leffiles = []
+    if os.path.isdir(srclibdir):
+        leffiles = os.listdir(srclibdir)
+        leffiles = list(item for item in leffiles if os.path.splitext(item)[1].lower() == '.lef')
+
+    # Get list of abstract views to make from LEF macros
+    lefmacros = []
+    err_no_macros = False
+    for leffile in leffiles:
+        with open(srclibdir + '/' + leffile, 'r') as ifile:
+            ltext = ifile.read()
+            llines = ltext.splitlines()
+            for lline in llines:
+                ltok = re.split(r' |\t|\(', lline)
+                if ltok[0] == 'MACRO':
+                    lefmacros.append(ltok[1])
+
+    # Create exclude list with glob-style matching using fnmatch
+    if len(lefmacros) > 0:
+        lefnames = list(os.path.split(item)[1] for item in lefmacros)
+        notlefnames = []
+        for exclude in lef_exclude:
+            notlefnames.extend(fnmatch.filter(lefnames, exclude))
+
+        # Apply exclude list
+        if len(notlefnames) > 0:
+            for file in lefmacros[:]:
+                if os.path.split(file)[1] in notlefnames:
+                    lefmacros.remove(file)
+
+    if len(leffiles) == 0:
+        print('Warning:  No LEF files found in ' + srclibdir)
+        return
+
+    print('Generating conversion script to create magic databases from LEF')
+
+    # Generate a script called "generate_magic.tcl" and leave it in
+    # the target directory.  Use it as input to magic to create the
+    # .mag files from the database.
+
+    with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
+        print('#!/usr/bin/env wish', file=ofile)
+        print('#--------------------------------------------', file=ofile)
+        print('# Script to generate .mag files from .lef    ', file=ofile)
+        print('#--------------------------------------------', file=ofile)
+        print('tech unlock *', file=ofile)
+
+        # If there are devices in the LEF file that come from the
+        # PDK library, then copy this list into the script.
+
+        if pdklibrary:
+            shortdevlist = []
+            for macro in lefmacros:
+                if macro in devlist:
+                    shortdevlist.append(macro)
+
+            tcldevlist = '{' + ' '.join(shortdevlist) + '}'
+            print('set devlist ' + tcldevlist, file=ofile)
+
+        # Force the abstract view timestamps to match the full views
+        if datestamp != None:
+            print('lef datestamp ' + str(datestamp), file=ofile)
+
+        for leffile in leffiles:
+            print('lef read ' + srclibdir + '/' + leffile, file=ofile)
+
+        # Use CDL or SPICE netlists to make sure that ports are
+        # present, and to set the port order
+
+        if netlibdir:
+            # Find CDL/SPICE file names in the source
+            # Ignore "sources.txt" if it is in the list.
+            netfiles = os.listdir(netlibdir)
+            print('puts stdout "Annotating cells from CDL/SPICE"',
+			file=ofile)
+            for netfile in netfiles:
+                if os.path.split(netfile)[1] != 'sources.txt':
+                    print('catch {readspice ' + netlibdir + '/' + netfile
+				+ '}', file=ofile)
+
+        for lefmacro in lefmacros:
+
+            if pdklibrary and lefmacro in shortdevlist:
+                print('set cellname ' + lefmacro, file=ofile)
+                print('if {[lsearch $devlist $cellname] >= 0} {',
+				file=ofile)
+                print('    load $cellname', file=ofile)
+                print('    property gencell $cellname', file=ofile)
+                print('    property parameter m=1', file=ofile)
+                print('    property library ' + pdklibrary, file=ofile)
+                print('}', file=ofile)
+
+        # Load one of the LEF files so that the default (UNNAMED) cell
+        # is not loaded, then delete (UNNAMED) so it doesn't generate
+        # an error message.
+        if len(lefmacros) > 0:
+            print('load ' + lefmacros[0], file=ofile)
+            # print(r'cellname delete \(UNNAMED\)', file=ofile)
+        else:
+            err_no_macros = True
+        print('writeall force', file=ofile)
+        print('puts stdout "Done."', file=ofile)
+        print('quit -noprompt', file=ofile)
+
+    if err_no_macros == True:
+        print('Warning:  No LEF macros were defined.')
+
+    print('Running magic to create magic databases from LEF')
+    sys.stdout.flush()
+
+    # Run magic to read in the LEF file and write out magic databases.
+    run_magic_script(destlibdir + '/generate_magic.tcl', destlibdir)
+
+    # Now list all the .mag files generated, and for each, read the
+    # corresponding file from the mag/ directory, pull the GDS file
+    # properties, and add those properties to the maglef view.  Also
+    # read the CDL (or SPICE) netlist, read the ports, and rewrite
+    # the port order in the mag and maglef file accordingly.
+
+    # Diagnostic
+    print('Annotating files in ' + destlibdir)
+    sys.stdout.flush()
+
+    # Read the CDL files only once for all cells in the library
+    subckt_index = get_subckt_index(cdllibdir)
+
+    magfiles = os.listdir(destlibdir)
+    magfiles = list(item for item in magfiles if os.path.splitext(item)[1] == '.mag')
+    for magroot in magfiles:
+        magname = os.path.splitext(magroot)[0]
+        magfile = maglibdir + '/' + magroot
+        magleffile = destlibdir + '/' + magroot
+        prop_lines = get_gds_properties(magfile)
+
+        # Make sure properties include the Tcl generated cell
+        # information from the PDK script
+
+        prop_gencell = []
+        if pdklibrary:
+            if magname in fixedlist:
+                prop_gencell.append('gencell ' + magname)
+                prop_gencell.append('library ' + pdklibrary)
+                prop_gencell.append('parameter m=1')
+
+        nprops = len(prop_lines) + len(prop_gencell)
+
+        cdlfile = cdllibdir + '/' + magname + '.cdl'
+        if os.path.exists(cdlfile):
+            cdlkey = cdlfile
+        else:
+            # Assume there is at least one file with all cell subcircuits
+            # in it.
+            cdlkey = None
+        port_dict = subckt_index.get(cdlkey, {}).get(magname.lower(), {})
+
+        if port_dict == {}:
+            print('No CDL file contains ' + destlib + ' device ' + magname)
+            cdlfile = None
+            # To be done:  If destlib is 'primitive', then look in
+            # SPICE models for port order.
+            if destlib == 'primitive':
+                print('Fix me:  Need to look in SPICE models!')
+
+        proprex = re.compile('<< properties >>')
+        endrex = re.compile('<< end >>')
+        rlabrex = re.compile(r'rlabel[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+([^ \t]+)')
+        flabrex = re.compile(r'flabel[ \t]+.*[ \t]+([^ \t]+)[ \t]*')
+        portrex = re.compile(r'port[ \t]+([^ \t]+)[ \t]+(.*)')
+        gcellrex = re.compile('string gencell')
+        portnum = -1
+
+        with open(magleffile, 'r') as ifile:
+            magtext = ifile.read().splitlines()
+
+        with open(magleffile, 'w') as ofile:
+            has_props = False
+            is_gencell = False
+            for line in magtext:
+                tmatch = portrex.match(line)
+                if tmatch:
+                    if portnum >= 0:
+                        line = 'port ' + str(portnum) + ' ' + tmatch.group(2)
+                    else:
+                        line = 'port ' + tmatch.group(1) + ' ' + tmatch.group(2)
+                ematch = endrex.match(line)
+                if ematch and nprops > 0:
+                    if not has_props:
+                        print('<< properties >>', file=ofile)
+                    if not is_gencell:
+                        for prop in prop_gencell:
+                            print('string ' + prop, file=ofile)
+                    for prop in prop_lines:
+                        print('string ' + prop, file=ofile)
+
+                print(line, file=ofile)
+                pmatch = proprex.match(line)
+                if pmatch:
+                    has_props = True
+
+                gmatch = gcellrex.match(line)
+                if gmatch:
+                    is_gencell = True
+
+                lmatch = flabrex.match(line)
+                if not lmatch:
+                    lmatch = rlabrex.match(line)
+                if lmatch:
+                    labname = lmatch.group(1).lower()
+                    try:
+                        portnum = port_dict[labname]
+                    except:
+                        portnum = -1
+
+        if os.path.exists(magfile):
+            with open(magfile, 'r') as ifile:
+                magtext = ifile.read().splitlines()
+
+            with open(magfile, 'w') as ofile:
+                for line in magtext:
+                    tmatch = portrex.match(line)
+                    if tmatch:
+                        if portnum >= 0:
+                            line = 'port ' + str(portnum) + ' ' + tmatch.group(2)
+                        else:
+                            line = 'port ' + tmatch.group(1) + ' ' + tmatch.group(2)
+                    ematch = endrex.match(line)
+                    print(line, file=ofile)
+                    lmatch = flabrex.match(line)
+                    if not lmatch:
+                        lmatch = rlabrex.match(line)
+                    if lmatch:
+                        labname = lmatch.group(1).lower()
+                        try:
+                            portnum = port_dict[labname]
+                        except:
+                            portnum = -1
+        elif os.path.splitext(magfile)[1] == '.mag':
+            # NOTE:  Possibly this means the GDS cell has a different name.
+            print('Error: No file ' + magfile + '.  Why is it in maglef???')
+
+#----------------------------------------------------------------------------
+# Extract a SPICE library for library "destlib" into "destlibdir" from the
+# GDS files in "srclibdir", annotated with the LEF files in "leflibdir" and,
+# if "cdllibdir" is not None, with the pin order from the CDL files there.
+# This is run as a stage after the magic databases (and any LEF views) for
+# the library have been generated from GDS.
 #----------------------------------------------------------------------------
 
-def tfilter(targetroot, filterscript, outfile=[]):
-    filterroot = os.path.split(filterscript)[1]
-    if os.path.isfile(targetroot):
-        print('   Filtering file ' + targetroot + ' with ' + filterroot)
+def generate_spice_from_gds(destlib, destlibdir, srclibdir, leflibdir,
+		cdllibdir, startup_script, tcllines, do_parasitics,
+		do_compile_only, do_stub, excludelist):
+
+    # Link to the PDK magic startup file from the target directory
+    if os.path.isfile(startup_script):
+        # If the symbolic link exists, remove it.
+        if os.path.isfile(destlibdir + '/.magicrc'):
+            os.remove(destlibdir + '/.magicrc')
+        os.symlink(startup_script, destlibdir + '/.magicrc')
+
+    # Get the consolidated GDS library file, or a list of all GDS files
+    # if there is no single consolidated library
+
+    allgdslibname = srclibdir + '/' + destlib + '.gds'
+    if not os.path.isfile(allgdslibname):
+        glist = glob.glob(srclibdir + '/*.gds')
+        glist.extend(glob.glob(srclibdir + '/*.gdsii'))
+        glist.extend(glob.glob(srclibdir + '/*.gds2'))
+        glist = natural_sort.natural_sort(glist)
+
+    allleflibname = leflibdir + '/' + destlib + '.lef'
+    if not os.path.isfile(allleflibname):
+        llist = glob.glob(leflibdir + '/*.lef')
+        llist = natural_sort.natural_sort(llist)
+
+    if cdllibdir:
+        # CDL is not being converted directly to SPICE but it exists,
+        # and being the only source of pin order, it should be used
+        # for pin order annotation.
+        allcdllibname = cdllibdir + '/' + destlib + '.cdl'
+        if not os.path.isfile(allcdllibname):
+            clist = glob.glob(cdllibdir + '/*.cdl')
+            clist = natural_sort.natural_sort(clist)
+
+    print('Creating magic generation script to generate SPICE library.') 
+    with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
+        print('#!/usr/bin/env wish', file=ofile)
+        print('#---------------------------------------------', file=ofile)
+        print('# Script to generate SPICE library from GDS   ', file=ofile)
+        print('#---------------------------------------------', file=ofile)
+        print('drc off', file=ofile)
+        print('locking off', file=ofile)
+        print('gds readonly true', file=ofile)
+        print('gds flatten true', file=ofile)
+        print('gds rescale false', file=ofile)
+        print('tech unlock *', file=ofile)
+
+        # Add custom Tcl script lines before "gds read".
+        for line in tcllines:
+            print(line, file=ofile)
+
+        if not os.path.isfile(allgdslibname):
+            for gdsfile in glist:
+                print('gds read ' + gdsfile, file=ofile)
+        else:
+            print('gds read ' + allgdslibname, file=ofile)
 
-        if not outfile:
-            outfile = targetroot
+        if not os.path.isfile(allleflibname):
+            # Annotate the cells with information from the LEF files
+            for leffile in llist:
+                print('lef read ' + leffile, file=ofile)
         else:
-            # Make sure this file is writable (as the original may not be)
-            makeuserwritable(outfile)
+            print('lef read ' + allleflibname, file=ofile)
+
+        if cdllibdir:
+            if not os.path.isfile(allcdllibname):
+                # Annotate the cells with pin order from the CDL files
+                for cdlfile in clist:
+                    print('catch {readspice ' + cdlfile + '}', file=ofile)
+            else:
+                print('catch {readspice ' + allcdllibname + '}', file=ofile)
 
-        arguments = [filterscript, targetroot, outfile]
+        # Load first file and remove the (UNNAMED) cell
+        if not os.path.isfile(allgdslibname):
+            if len(glist) > 0:
+                print('load ' + os.path.splitext(glist[0])[0], file=ofile)
+        else:
+            gdslibroot = os.path.split(allgdslibname)[1]
+            print('load ' + os.path.splitext(gdslibroot)[0], file=ofile)
+        print(r'catch {cellname delete \(UNNAMED\)}', file=ofile)
+
+        print('ext2spice lvs', file=ofile)
+
+        # NOTE:  Leaving "subcircuit top" as "auto" (default) can cause
+        # cells like decap that have no I/O to be output without a subcircuit
+        # wrapper.  Also note that if this happens, it is an indication that
+        # power supplies have not been labeled as ports, which is harder to
+        # handle and should be fixed in the source.
+        print('ext2spice subcircuit top on', file=ofile)
+
+        # Use option "dorcx" if parasitics should be extracted.
+        # NOTE:  Currently only does parasitic capacitance extraction.
+        if do_parasitics:
+            print('ext2spice cthresh 0.1', file=ofile)
+
+        if os.path.isfile(allgdslibname):
+            # Do not depend absolutely on the library having a top
+            # level cell, but query for it from inside magic
+            print('if {[cellname list exists ' + allgdslibname + ']} {',
+			file=ofile)
+            print('   select top cell', file=ofile)
+            print('   set glist [cellname list children]', file=ofile)
+            print('} else {', file=ofile)
+            print('   set glist [cellname list top]', file=ofile)
+            print('}', file=ofile)
+        else:
+            print('set glist [cellname list top]', file=ofile)
 
-        subprocess_run('filter', arguments)
+        print('foreach cell $glist {', file=ofile)
+        print('    load $cell', file=ofile)
+        print('    puts stdout "Extracting cell $cell"', file=ofile)
+        print('    extract all', file=ofile)
+        print('    ext2spice', file=ofile)
+        print('}', file=ofile)
 
-    else:
-        tlist = glob.glob(targetroot + '/*')
-        for tfile in tlist:
-            if os.path.isfile(tfile):
-                print('   Filtering file ' + tfile + ' with ' + filterroot)
-                subprocess_run('filter', [filterscript, tfile, tfile])
+        print('puts stdout "Done."', file=ofile)
+        print('quit -noprompt', file=ofile)
+
+    # Run magic to read in the individual GDS files and
+    # write out the consolidated GDS library
+
+    print('Running magic to create GDS library.')
+    sys.stdout.flush()
+
+    run_magic_script(destlibdir + '/generate_magic.tcl', destlibdir,
+		source=True)
+
+    # Remove intermediate extraction files
+    extfiles = glob.glob(destlibdir + '/*.ext')
+    for extfile in extfiles:
+        os.remove(extfile)
+
+    # If the GDS file was a consolidated file of all cells, then
+    # create a similar SPICE library of all cells.
+
+    if os.path.isfile(allgdslibname):
+        spiext = '.spice'
+        create_spice_library(destlibdir, destlib, spiext, do_compile_only, do_stub, excludelist)
 
 #----------------------------------------------------------------------------
 # This is the main entry point for the foundry install script.
@@ -509,6 +1967,8 @@ if __name__ == '__main__':
         print("No options given to foundry_install.py.")
         usage()
         sys.exit(0)
+
+    stage_trace.start_run(sys.argv[0], sys.argv[1:])
     
     optionlist = []
     newopt = []
@@ -521,6 +1981,10 @@ if __name__ == '__main__':
     timestamp_value = 0
     do_clean = False
     lef_savelibname = None
+    targname = None
+    jobs = 1
+    do_cache = True
+    planformat = None
 
     have_lef = False
     have_techlef = False
@@ -573,6 +2037,36 @@ if __name__ == '__main__':
         elif option[0] == 'clean':
             do_clean = True
 
+        elif option[0] == 'nocache':
+            optionlist.remove(option)
+            do_cache = False
+
+        elif option[0] == 'copy':
+            optionlist.remove(option)
+            copymode = option[1] if len(option) > 1 else 'copy'
+            if copymode not in copy_strategy.strategies:
+                print('Error: Option "copy" value must be one of: ' +
+			', '.join(copy_strategy.strategies) + '.')
+                sys.exit(1)
+            copy_strategy.set_strategy(copymode)
+
+        elif option[0] == 'plan':
+            optionlist.remove(option)
+            planformat = option[1] if len(option) > 1 else 'json'
+            if planformat not in ['json', 'make']:
+                print('Error: Option "plan" value must be "json" or "make".')
+                sys.exit(1)
+
+        elif option[0] == 'jobs':
+            optionlist.remove(option)
+            if len(option) > 1:
+                try:
+                    jobs = int(option[1])
+                except ValueError:
+                    print('Error: Option "jobs" value is not an integer.')
+            else:
+                print('Error: Option "jobs" used with no value.')
+
     # Check for options "source" and "target"
     for option in optionlist[:]:
         if option[0] == 'source':
@@ -592,6 +2086,19 @@ if __name__ == '__main__':
         print("No target directory specified.  Exiting.")
         sys.exit(1)
 
+    # Here's where common scripts are found:
+    openpdksdir = os.path.dirname(os.path.realpath(__file__))
+    scriptdir = os.path.split(openpdksdir)[0] + '/common'
+
+    # Print the plan of the install and stop without changing anything
+    if planformat:
+        if not sourcedir:
+            print("No source directory specified.  Exiting.")
+            sys.exit(1)
+        write_plan(make_plan(sourcedir, targetdir, scriptdir, optionlist,
+			libraries), planformat)
+        sys.exit(0)
+
     # Take the target PDK name from the target path last component
     pdkname = os.path.split(targetdir)[1]
 
@@ -622,9 +2129,12 @@ if __name__ == '__main__':
     # Create the target directory
     os.makedirs(targetdir, exist_ok=True)
 
-    # Here's where common scripts are found:
-    openpdksdir = os.path.dirname(os.path.realpath(__file__))
-    scriptdir = os.path.split(openpdksdir)[0] + '/common'
+    # Output of all commands run is logged in the target directory
+    stage_log.set_logdir(targetdir + '/.stage_logs')
+
+    # Independent stages are run through the scheduler, which runs them
+    # immediately if jobs = 1, or in parallel at each call to run().
+    scheduler = StageScheduler(jobs)
 
     #----------------------------------------------------------------
     # Installation part 1:  Install files into the staging directory
@@ -644,6 +2154,7 @@ if __name__ == '__main__':
     # it has the wrong version.
     have_mag_8_2 = False
     have_mag_8_3_261 = False
+    mag_version = None
     try:
         mproc = subprocess.run(
             ['magic', '--version'],
@@ -683,6 +2194,44 @@ if __name__ == '__main__':
         print('Please install or correct the search path.')
         print('Magic database files will not be created, and other missing file formats may not be generated.')
 
+    # Check the staging manifest from the last run with the same options.
+    # If nothing has changed, then there is nothing to do.
+
+    if do_cache:
+        stage_options = [sourcedir, timestamp_value, libraries, optionlist]
+        manifestfile = stage_manifest.manifest_name(targetdir, stage_options)
+        oldmanifest = stage_manifest.read_manifest(manifestfile)
+        stage_version = stage_manifest.script_version(scriptdir, mag_version,
+			get_stage_scriptdirs(optionlist))
+
+        # The directories that this run will write to.  Files written there
+        # by earlier runs (e.g., GDS or LEF views staged by an earlier call
+        # for the same library) may be read by this run, and so are inputs.
+        stage_outdirs = []
+        for library in libraries:
+            destlib = library[2] if len(library) == 3 else library[1]
+            stage_outdirs.append('libs.ref/' + destlib)
+            stage_outdirs.append('libs.priv/' + destlib)
+        if libraries == [] or 'primitive' in libraries[0]:
+            stage_outdirs.append('libs.tech')
+
+        stage_inputs = stage_manifest.collect_inputs(
+			get_stage_inputs(sourcedir, targetdir, optionlist, libraries),
+			oldmanifest)
+        stage_order = stage_manifest.stage_order(manifestfile, oldmanifest)
+        stage_inputs.update(stage_manifest.collect_inputs(
+			stage_manifest.staged_files(manifestfile, targetdir,
+			stage_outdirs, stage_order), oldmanifest))
+
+        if stage_manifest.manifest_is_current(oldmanifest, stage_version,
+			stage_inputs, targetdir):
+            print('Source files and options are unchanged since the last install.')
+            print('Staging area is up to date;  nothing to do.')
+            sys.exit(0)
+
+        # Record the state of the directories that this run will write to.
+        stage_before = stage_manifest.snapshot(targetdir, stage_outdirs)
+
     # Populate any targets that do not specify a library, or where the library is
     # specified as "primitive".  
 
@@ -726,13 +2275,13 @@ if __name__ == '__main__':
                     targname = techlefdir + '/' + leffile
 
                     if os.path.isfile(lefname):
-                        shutil.copy(lefname, targname)
+                        copy_strategy.copy_file(lefname, targname)
                     else:
-                        shutil.copytree(lefname, targname)
+                        copy_strategy.copy_tree(lefname, targname)
 
                     for filter_script in filter_scripts:
                         # Apply filter script to all files in the target directory
-                        tfilter(targname, filter_script)
+                        tfilter(targname, filter_script, jobs=jobs)
 
                 optionlist.remove(option)
 
@@ -782,18 +2331,18 @@ if __name__ == '__main__':
 
                             if os.path.isfile(subtoolname):
                                 os.makedirs(os.path.split(subtargname)[0], exist_ok=True)
-                                shutil.copy(subtoolname, subtargname)
+                                copy_strategy.copy_file(subtoolname, subtargname)
                             else:
                                 print('   copy tree from ' + subtoolname + ' to ' + subtargname)
                                 # emulate Python3.8 dirs_exist_ok option
                                 try:
-                                    shutil.copytree(subtoolname, subtargname)
+                                    copy_strategy.copy_tree(subtoolname, subtargname)
                                 except FileExistsError:
                                     pass
 
                             for filter_script in filter_scripts:
                                 # Apply filter script to all files in the target directory
-                                tfilter(subtargname, filter_script)
+                                tfilter(subtargname, filter_script, jobs=jobs)
 
                     else:
                         # Remove any existing file
@@ -803,13 +2352,13 @@ if __name__ == '__main__':
                             shutil.rmtree(targname)
 
                         if os.path.isfile(toolname):
-                            shutil.copy(toolname, targname)
+                            copy_strategy.copy_file(toolname, targname)
                         else:
-                            shutil.copytree(toolname, targname)
+                            copy_strategy.copy_tree(toolname, targname)
 
                         for filter_script in filter_scripts:
                             # Apply filter script to all files in the target directory
-                            tfilter(targname, filter_script)
+                            tfilter(targname, filter_script, jobs=jobs)
 
                 optionlist.remove(option)
 
@@ -857,9 +2406,26 @@ if __name__ == '__main__':
         elif option[0] == 'lib' or option[0] == 'liberty':
             have_lib = True
 
+    # If GDS will be converted to magic layout, then start a magic process
+    # now so that the technology is loaded while the vendor files are being
+    # copied.  (Stages run in parallel each start their own processes.)
+
+    gds_convert = any(option[0] == 'gds' and 'noconvert' not in option
+		for option in optionlist)
+
+    if gds_convert and have_mag_8_2 and jobs == 1:
+        startup_script = targetdir + mag_current + pdkname + '-F.magicrc'
+        if not os.path.isfile(startup_script):
+            startup_script = targetdir + mag_current + pdkname + '.magicrc'
+        if os.path.isfile(startup_script):
+            magic_session.get_pool().prestart(startup_script)
+
     # The remaining options in optionlist should all be types like 'lef' or 'liberty'
     # and there should be a corresponding library list specified by '-library'
 
+    # Option types with library compiles that may not have run yet
+    staged_types = []
+
     for option in optionlist[:]:
 
         # Ignore if no library list---should have been taken care of above.
@@ -869,95 +2435,42 @@ if __name__ == '__main__':
         # Diagnostic
         print("Install option: " + str(option[0]))
 
+        # If a previous option installed into the same directories, then
+        # its library compile must finish before files are copied again.
+        if option[0] in staged_types:
+            scheduler.run()
+            staged_types = []
+
         if option[0] == 'lef' and have_lefanno:
             print("LEF files used for annotation only.  Temporary install.")
 
-        # If the option is followed by the keyword "up" and a number, then
-        # the source should be copied (or linked) from <number> levels up
-        # in the hierarchy (see below).
-
-        hier_up = 0
-        for item in option:
-            if item.split('=')[0] == 'up':
-                hier_up = int(item.split('=')[1])
-                break
-
-        filter_scripts = []
-        for item in option:
-            if item.split('=')[0] == 'filter':
-                filter_scripts.append(item.split('=')[1])
-
-        # Option 'collate' is a standalone keyword
-        do_collate = 'collate' in option
-
-        # Option 'stub' applies to netlists ('cdl' or 'spice') and generates
-        # a file with only stub entries.
-        do_stub = 'stub' in option
-
-        # Option 'compile' is a standalone keyword ('comp' may be used).
-        do_compile = 'compile' in option or 'comp' in option
-        do_compile_only = 'compile-only' in option or 'comp-only' in option
- 
-        # Option 'nospecify' is a standalone keyword ('nospec' may be used).
-        do_remove_spec = 'nospecify' in option or 'nospec' in option
-
-        # Option 'remove' is a standalone keyword.
-        do_remove = 'remove' in option
-
-        # Option 'exclude' has an argument
-        excludelist = []
-        try:
-            excludelist = list(item.split('=')[1].split(',') for item in option if item.startswith('excl'))[0]
-        except IndexError:
-            pass
+        settings = get_install_options(option, scriptdir)
+        hier_up = settings['hier_up']
+        filter_scripts = settings['filter_scripts']
+        do_collate = settings['do_collate']
+        do_stub = settings['do_stub']
+        do_compile = settings['do_compile']
+        do_compile_only = settings['do_compile_only']
+        do_remove_spec = settings['do_remove_spec']
+        do_remove = settings['do_remove']
+        excludelist = settings['excludelist']
+        nocopylist = settings['nocopylist']
+        includelist = settings['includelist']
+        headerfile = settings['headerfile']
+        newname = settings['newname']
+        sortscript = settings['sortscript']
 
         if len(excludelist) > 0:
             print('Excluding files: ' + (',').join(excludelist))
-
-        # Option 'no-copy' has an argument
-        nocopylist = []
-        try:
-            nocopylist = list(item.split('=')[1].split(',') for item in option if item.startswith('no-copy'))[0]
-        except IndexError:
-            pass
-
         if len(nocopylist) > 0:
             print('Not copying files: ' + (',').join(nocopylist))
-
-        # Option 'include' has an argument
-        includelist = []
-        try:
-            includelist = list(item.split('=')[1].split(',') for item in option if item.startswith('incl'))[0]
-        except IndexError:
-            pass
-
         if len(includelist) > 0:
             print('Including files: ' + (',').join(includelist))
-
-        # Option 'header' has an argument
-        headerfile = None
-        try:
-            headerfile = list(item.split('=')[1] for item in option if item.startswith('header'))[0]
-        except IndexError:
-            headerfile = None
-        else:
+        if headerfile:
             print('Header file is: ' + headerfile)
-
-        # Option 'rename' has an argument
-        try:
-            newname = list(item.split('=')[1] for item in option if item.startswith('rename'))[0]
-        except IndexError:
-            newname = None
-        else:
+        if newname:
             print('Renaming file to: ' + newname)
-
-        # Option 'sort' has an argument. . .
-        try:
-            sortscript = list(item.split('=')[1] for item in option if item.startswith('sort'))[0]
-        except IndexError:
-            # If option 'sort' is not specified, then use the "natural sort" script
-            sortscript = scriptdir + '/sort_pdkfiles.py'
-        else:
+        if settings['have_sortscript']:
             print('Sorting files with script ' + sortscript)
 
         # For each library, create the library subdirectory
@@ -971,88 +2484,33 @@ if __name__ == '__main__':
             destlibdir = destdir
 
             os.makedirs(destlibdir, exist_ok=True)
+            copytrace = stage_trace.Span('install ' + option[0] + ' ' + destlib)
 
             # Populate the library subdirectory
-            # Parse the option and replace each '/*/' with the library name,
-            # and check if it is a valid directory name.  Then glob the
-            # resulting option name.  Warning:  This assumes that all
-            # occurences of the text '/*/' match a library name.  It should
-            # be possible to wild-card the directory name in such a way that
-            # this is always true.
-
-            testpath = substitute(sourcedir + '/' + option[1], library[1])
-            liblist = glob.glob(testpath)
-            liblist = natural_sort.natural_sort(liblist)
-
-            if do_collate:
-                # Rework liblist so that file parts are put into a list and
-                # associated with the final filename.  Replace the file parts
-                # in liblist with the collated filename.  Assume that the
-                # parts are named with an additional extension such as ".part1"
-                # ".part2" etc., and that these extensions are in natural sort
-                # order.  Note that it is not necessary for all files in the
-                # list to be split into parts.
-
-                # Regular expression catches filename "a.b.c", handling any
-                # leading dots (such as "../") and returns string "a.b"
-                basenamerex = re.compile(r'(\.?\.?[^.]+\..+)\.+')
-                baseliblist = []
-                splitfiles = {}
-                for libfile in liblist:
-                    bmatch = basenamerex.match(libfile)
-                    if bmatch:
-                        basename = bmatch.group(1)
-                        if basename not in baseliblist:
-                            baseliblist.append(basename)
-                            splitfiles[basename] = [libfile]
-                        else:
-                            splitfiles[basename].append(libfile)
-                    else:
-                        baseliblist.append(libfile)   ;# not a split file
-                liblist = baseliblist
+            (testpath, liblist, splitfiles, notliblist, liblistnames,
+			nocopynames) = get_library_files(sourcedir, option,
+			library, settings)
 
             # Create a file "sources.txt" (or append to it if it exists)
             # and add the source directory name so that the staging install
-            # script can know where the files came from.
-
-            with open(destlibdir + '/sources.txt', 'a') as ofile:
-                print(testpath, file=ofile)
-
-            # Create exclude list with glob-style matching using fnmatch
-            if len(liblist) > 0:
-                liblistnames = list(os.path.split(item)[1] for item in liblist)
-                notliblist = []
-                for exclude in excludelist:
-                    if '/' in exclude:
-                        # Names come from files in a path that is not the source
-                        excludefiles = os.listdir(os.path.split(exclude)[0])
-                        pattern = os.path.split(exclude)[1]
-                        notliblist.extend(fnmatch.filter(excludefiles, pattern))
-                    else:
-                        notliblist.extend(fnmatch.filter(liblistnames, exclude))
-
-                # Apply exclude list
-                if len(notliblist) > 0:
-                    for file in liblist[:]:
-                        if os.path.split(file)[1] in notliblist:
-                            liblist.remove(file)
-
+            # script can know where the files came from.  Do not add the
+            # same name again when a staging step is repeated, so that the
+            # file is unchanged for the other steps that read it.
+
+            sourcelines = []
+            if os.path.isfile(destlibdir + '/sources.txt'):
+                with open(destlibdir + '/sources.txt', 'r') as ifile:
+                    sourcelines = ifile.read().splitlines()
+            if testpath not in sourcelines:
+                with open(destlibdir + '/sources.txt', 'a') as ofile:
+                    print(testpath, file=ofile)
+
+            if len(liblistnames) > 0:
                 if len(excludelist) > 0 and len(notliblist) == 0:
                     print('Warning:  Nothing from the exclude list found in sources.')
                     print('excludelist = ' + str(excludelist))
                     print('destlibdir = ' + destlibdir)
 
-            # Create a list of cell names not to be copied from "nocopylist"
-            nocopynames = []
-            for nocopy in nocopylist:
-                if '/' in nocopy:
-                    # Names come from files in a path that is not the source
-                    nocopyfiles = os.listdir(os.path.split(nocopy)[0])
-                    pattern = os.path.split(nocopy)[1]
-                    nocopynames.extend(fnmatch.filter(nocopyfiles, pattern))
-                else:
-                    nocopynames.extend(fnmatch.filter(liblistnames, nocopy))
-
             # Diagnostic
             print('Collecting files from ' + testpath)
             print('Files to install:')
@@ -1070,52 +2528,18 @@ if __name__ == '__main__':
                 print('(' + str(len(liblist)) + ' files total)')
 
             destfilelist = []
+            filtertargets = {}
 
             for libname in liblist:
      
-                # Note that there may be a hierarchy to the files in option[1],
-                # say for liberty timing files under different conditions, so
-                # make sure directories have been created as needed.
+                (destpath, destfile, fileext, rename_error) = get_dest_file(
+				libname, len(liblist), option[0], settings)
+                if rename_error:
+                    print('Error:  rename specified but more than one file found!')
 
                 libfile = os.path.split(libname)[1]
-                libfilepath = os.path.split(libname)[0]
-                destpathcomp = []
-                for i in range(hier_up):
-                    destpathcomp.append('/' + os.path.split(libfilepath)[1])
-                    libfilepath = os.path.split(libfilepath)[0]
-                destpathcomp.reverse()
-                destpath = ''.join(destpathcomp)
-
                 dontcopy = True if libfile in nocopynames else False
 
-                if option[0] == 'verilog':
-                    fileext = '.v'
-                elif option[0] == 'liberty' or option[0] == 'lib':
-                    fileext = '.lib'
-                elif option[0] == 'spice' or option[0] == 'spi':
-                    fileext = '.spice'
-                elif option[0] == 'techlef':
-                    fileext = '.lef'
-                else:
-                    fileext = '.' + option[0]
-
-                if newname:
-                    if os.path.splitext(newname)[1] == '':
-                        newname = newname + fileext
-
-                    if len(liblist) == 1:
-                        destfile = newname
-                    elif newname.startswith('*.'):
-                        destfile = os.path.splitext(libfile)[0] + newname[1:]
-                    elif newname.startswith('.'):
-                        destfile = os.path.splitext(libfile)[0] + newname
-                    else:
-                        if not do_compile and not do_compile_only:
-                            print('Error:  rename specified but more than one file found!')
-                        destfile = libfile
-                else:
-                    destfile = libfile
-
                 targname = destlibdir + destpath + '/' + destfile
 
                 # NOTE:  When using "up" with link_from, could just make
@@ -1144,7 +2568,7 @@ if __name__ == '__main__':
                     if not dontcopy:
                         if do_collate:
                             if libname not in splitfiles:
-                                shutil.copy(libname, targname)
+                                copy_strategy.copy_file(libname, targname)
                             else:
                                 allparts = splitfiles[libname]
                                 with open(targname, 'wb') as afd:
@@ -1152,10 +2576,13 @@ if __name__ == '__main__':
                                         with open(filepart, 'rb') as fd:
                                             shutil.copyfileobj(fd, afd)
                         else:
-                            shutil.copy(libname, targname)
+                            copy_strategy.copy_file(libname, targname)
                 else:
                     if not dontcopy:
-                        shutil.copytree(libname, targname)
+                        copy_strategy.copy_tree(libname, targname)
+
+                if not dontcopy and os.path.isfile(targname):
+                    copytrace.add(files=1, bytes=os.path.getsize(targname))
 
                 # File filtering options:  Two options 'stub' and 'nospec' are
                 # handled by scripts in ../common/.  Custom filters can also be
@@ -1174,12 +2601,34 @@ if __name__ == '__main__':
                     if do_stub:
                         local_filter_scripts.append(scriptdir + '/makestub.py')
 
-                for filter_script in local_filter_scripts:
-                    # Apply filter script to all files in the target directory
-                    tfilter(targname, filter_script)
+                # Filter scripts are applied to all files after copying
+                filtertargets.pop(targname, None)
+                filtertargets[targname] = local_filter_scripts
 
                 destfilelist.append(os.path.split(targname)[1])
 
+            copytrace.end()
+
+            if any(filtertargets.values()):
+                with stage_trace.Span('filter ' + option[0] + ' ' + destlib,
+				files=len(filtertargets)):
+                    tfilter_all(list(filtertargets.items()), jobs)
+
+            # Pre-flight check:  Record the size and hierarchy of the GDS
+            # files installed, which show how much work magic will have to
+            # do to read them.  The statistics of each file are saved in
+            # the log directory (see gds_stats.py).
+            if option[0] == 'gds' and stage_log.logdir:
+                gdsfiles = gds_dates.find_gds_files([destlibdir])
+                if gdsfiles:
+                    with stage_trace.Span('gds stats ' + destlib, files=len(gdsfiles)):
+                        gdsstats = gds_stats.files_stats(gdsfiles, jobs)
+                    statsfile = stage_log.logdir + '/gds_stats_' + destlib + '.json'
+                    with open(statsfile, 'w') as ofile:
+                        json.dump(gdsstats, ofile)
+                    print(gds_stats.library_summary(destlib, gdsstats))
+                    print('GDS statistics written to ' + statsfile)
+
             # If headerfile is non-null, then copy this file, too.  Do not add
             # it to "destfilelist", as it is handled separately.  Recast
             # headerfile as the name of the file without the path.
@@ -1191,7 +2640,7 @@ if __name__ == '__main__':
                     libname = headerlist[0]
                     destfile = os.path.split(libname)[1]
                     targname = destlibdir + destpath + '/' + destfile
-                    shutil.copy(libname, targname)
+                    copy_strategy.copy_file(libname, targname)
                     headerfile = destfile
 
             # Add names from "include" list to destfilelist before writing
@@ -1220,85 +2669,33 @@ if __name__ == '__main__':
                     )
 
             if do_compile == True or do_compile_only == True:
-                # NOTE:  The purpose of "rename" is to put a destlib-named
-                # library elsewhere so that it can be merged with another
-                # library into a compiled <destlib>.<ext> on another pass.
-
                 compname = destlib
-                    
-                # To do:  Make this compatible with linking from another PDK.
 
-                if option[0] == 'verilog':
-                    # If there is not a single file with all verilog cells in it,
-                    # then compile one, because one does not want to have to have
-                    # an include line for every single cell used in a design.
-
-                    create_verilog_library(destlibdir, compname, do_compile_only, do_stub, excludelist)
-
-                elif option[0] == 'gds' and have_mag_8_2:
-                    # If there is not a single file with all GDS cells in it,
-                    # then compile one.
-
-                    # Link to the PDK magic startup file from the target directory
+                if option[0] == 'lef' and have_lefanno and do_compile_only == True:
+                    if newname and targname:
+                        if os.path.isfile(targname):
+                            # If the original source is a single file
+                            # but is used for annotation, then save the
+                            # file name and delete it just before writing
+                            # the LEF library
+                            lef_savelibname = targname
+
+                # Link to the PDK magic startup file from the target directory
+                startup_script = None
+                if option[0] == 'gds' and have_mag_8_2:
                     startup_script = targetdir + mag_current + pdkname + '-F.magicrc'
                     if not os.path.isfile(startup_script):
                         startup_script = targetdir + mag_current + pdkname + '.magicrc'
-                    create_gds_library(destlibdir, compname, startup_script, do_compile_only, excludelist)
-
-                elif option[0] == 'liberty' or option[0] == 'lib':
-                    # If there is not a single file with all liberty cells in it,
-                    # then compile one, because one does not want to have to have
-                    # an include line for every single cell used in a design.
-
-                    create_lib_library(destlibdir, compname, do_compile_only, excludelist, headerfile)
-
-                elif option[0] == 'spice' or option[0] == 'spi':
-                    # If there is not a single file with all SPICE subcircuits in it,
-                    # then compile one, because one does not want to have to have
-                    # an include line for every single cell used in a design.
 
-                    spiext = '.spice'
-                    create_spice_library(destlibdir, compname, spiext, do_compile_only, do_stub, excludelist)
+                scheduler.add('compile ' + option[0] + ' ' + destlib, [],
+			compile_library, option[0], destlibdir, compname,
+			do_compile_only, do_stub, excludelist, headerfile,
+			startup_script, have_lefanno, newname, fileext, destpath,
+			targname, sortscript)
+                staged_types.append(option[0])
 
-                elif option[0] == 'cdl':
-                    # If there is not a single file with all CDL subcircuits in it,
-                    # then compile one, because one does not want to have to have
-                    # an include line for every single cell used in a design.
-
-                    create_spice_library(destlibdir, compname, '.cdl', do_compile_only, do_stub, excludelist)
-
-                elif option[0] == 'lef':
-                    # If there is not a single file with all LEF cells in it,
-                    # then compile one, because one does not want to have to have
-                    # an include line for every single cell used in a design.
-
-                    if not have_lefanno:
-                        create_lef_library(destlibdir, compname, do_compile_only, excludelist)
-
-                    if do_compile_only == True:
-                        if newname and targname:
-                            if os.path.isfile(targname):
-                                if have_lefanno:
-                                    # If the original source is a single file
-                                    # but is used for annotation, then save the
-                                    # file name and delete it just before writing
-                                    # the LEF library
-                                    lef_savelibname = targname
-                                else:
-                                    os.remove(targname)
-
-                # "rename" with "compile" or "compile-only":  Change the name
-                # of the compiled file.
-
-                if newname:
-                    print('   Renaming ' + compname + fileext + ' to ' + newname)
-                    origname = destlibdir + '/' + compname + fileext
-                    targrename = destlibdir + destpath + '/' + newname
-                    if os.path.isfile(origname):
-                        os.rename(origname, targrename)
-      
             # If "filelist.txt" was created, remove it
-            if sortscript:
+            elif sortscript:
                 if os.path.isfile(destlibdir + '/filelist.txt'):
                     os.remove(destlibdir + '/filelist.txt')
 
@@ -1322,25 +2719,14 @@ if __name__ == '__main__':
                 srclibdir = targetdir + '/libs.ref/' + destlib + '/' + option[0]
                 destlibdir = targetdir + '/libs.priv/' + destlib + '/' + option[0]
 
-                if not os.path.exists(destlibdir):
-                    os.makedirs(destlibdir)
-
-                print('Moving files in ' + srclibdir + ' to privileged space.')
-                filelist = os.listdir(srclibdir)
-                for file in filelist:
-                    srcfile = srclibdir + '/' + file
-                    destfile = destlibdir + '/' + file
-                    if os.path.isfile(destfile):
-                        os.remove(destfile)
-                    elif os.path.isdir(destfile):
-                        shutil.rmtree(destfile)
-
-                    if os.path.isfile(srcfile):
-                        shutil.copy(srcfile, destfile)
-                        os.remove(srcfile)
-                    else:
-                        shutil.copytree(srcfile, destfile)
-                        shutil.rmtree(srcfile)
+                scheduler.add('privileged ' + option[0] + ' ' + destlib,
+			['compile ' + option[0] + ' ' + destlib],
+			move_to_privileged, srclibdir, destlibdir)
+                staged_types.append(option[0])
+
+    # Wait for all library compiles to finish before generating derived
+    # file formats from the installed files.
+    scheduler.run()
 
     print("Completed installation of vendor files.")
 
@@ -1363,6 +2749,7 @@ if __name__ == '__main__':
     lef_compile = False
     lef_compile_only = False
     lefopts = None
+    gds_shards = 1
 
     cdl_exclude = []
     lef_exclude = []
@@ -1451,6 +2838,15 @@ if __name__ == '__main__':
             if item.split('=')[0] == 'lefopts':
                 if option[0] == 'lef':
                     lefopts = item.split('=')[1].strip('"')
+
+        # Find number of magic processes to use for GDS conversion
+        for item in option:
+            if item.split('=')[0] == 'shards':
+                if option[0] == 'gds':
+                    try:
+                        gds_shards = max(1, int(item.split('=')[1]))
+                    except ValueError:
+                        print('Error:  Option "shards" value is not an integer.')
  
     devlist = []
     pdklibrary = None
@@ -1557,6 +2953,8 @@ if __name__ == '__main__':
                 # .mag files from the database.
 
                 print('Creating magic generation script to generate magic database files.') 
+                shard_leffiles = []
+                shard_lefdest = None
                 with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
                     print('#!/usr/bin/env wish', file=ofile)
                     print('#--------------------------------------------', file=ofile)
@@ -1646,7 +3044,23 @@ if __name__ == '__main__':
 
                     # print(r'cellname delete \(UNNAMED\)', file=ofile)
                     print('puts stdout "Writing all magic database files"', file=ofile)
-                    print('writeall force', file=ofile)
+                    if gds_shards > 1:
+                        # Each shard (see run_magic_shards()) writes every
+                        # Nth cell in sorted order.  Note that "writeall force"
+                        # with no cells listed writes everything.
+                        print('set shardcells {}', file=ofile)
+                        print('set cellidx 0', file=ofile)
+                        print('foreach cellname [lsort [cellname list allcells]] {', file=ofile)
+                        print('    if {$cellidx % $nshards == $shard} {', file=ofile)
+                        print('        lappend shardcells $cellname', file=ofile)
+                        print('    }', file=ofile)
+                        print('    incr cellidx', file=ofile)
+                        print('}', file=ofile)
+                        print('if {$shardcells != {}} {', file=ofile)
+                        print('    writeall force {*}$shardcells', file=ofile)
+                        print('}', file=ofile)
+                    else:
+                        print('writeall force', file=ofile)
 
                     leffiles = []
                     lefmacros = []
@@ -1794,12 +3208,26 @@ if __name__ == '__main__':
                         # original source LEF file.
                         lefdest = lefsrclibdir + '/' if have_lefanno else ''
 
-                        # Delete the original files in case the naming is different
-                        for leffile in leffiles:
-                            print('file delete ' + lefsrclibdir + '/' + leffile, file=ofile)
+                        if gds_shards > 1:
+                            # Each shard writes its share of the macros into
+                            # a directory of its own.  The original files are
+                            # deleted and replaced after all shards are done
+                            # (see run_magic_shards()), since the other shards
+                            # may still be reading them.
+                            shard_leffiles = list(lefsrclibdir + '/' + leffile
+					for leffile in leffiles)
+                            shard_lefdest = lefdest if lefdest else destlibdir + '/'
+                            lefdest = '$sharddir/'
+                        else:
+                            # Delete the original files in case the naming is different
+                            for leffile in leffiles:
+                                print('file delete ' + lefsrclibdir + '/' + leffile, file=ofile)
 
-                        for lefmacro in lefmacros:
-                            print('if {[cellname list exists ' + lefmacro + '] != 0} {', file=ofile)
+                        for idx, lefmacro in enumerate(lefmacros):
+                            if gds_shards > 1:
+                                print('if {$shard == ' + str(idx % gds_shards) + ' && [cellname list exists ' + lefmacro + '] != 0} {', file=ofile)
+                            else:
+                                print('if {[cellname list exists ' + lefmacro + '] != 0} {', file=ofile)
                             print('   load ' + lefmacro, file=ofile)
                             if lefopts:
                                 print('   lef write ' + lefdest + lefmacro + ' ' + lefopts, file=ofile)
@@ -1814,13 +3242,13 @@ if __name__ == '__main__':
                 sys.stdout.flush()
 
                 # Run magic to read in the GDS file and write out magic databases.
-                with open(destlibdir + '/generate_magic.tcl', 'r') as ifile:
-                    subprocess_run(
-                        'magic',
-                        ['magic', '-dnull', '-noconsole'],
-                        stdin = ifile,
-                        cwd = destlibdir,
-                    )
+                if gds_shards > 1:
+                    scheduler.add('gds2mag ' + destlib, [], run_magic_shards,
+			destlibdir + '/generate_magic.tcl', destlibdir, gds_shards,
+			shard_leffiles, shard_lefdest)
+                else:
+                    scheduler.add('gds2mag ' + destlib, [], run_magic_script,
+			destlibdir + '/generate_magic.tcl', destlibdir)
 
                 # Set have_lef now that LEF files were made, so they
                 # can be used to generate the maglef/ databases.
@@ -1839,14 +3267,12 @@ if __name__ == '__main__':
         # the LEF output from magic.
         print("Compiling LEF library from magic output.")
 
-        # If a single vendor library file was used for annotation, remove it now.
-        if lef_savelibname:
-            if os.path.isfile(lef_savelibname):
-                os.remove(lef_savelibname)
-
-        if lef_compile or lef_compile_only:
-            lefsrclibdir = targetdir + lef_reflib + destlib + '/lef'
-            create_lef_library(lefsrclibdir, destlib, lef_compile_only, lef_exclude)
+        lefsrclibdir = targetdir + lef_reflib + destlib + '/lef'
+        gdsstages = list('gds2mag ' + (library[2] if len(library) == 3
+			else library[1]) for library in libraries)
+        scheduler.add('lefanno', gdsstages, compile_annotated_lef,
+			lef_savelibname, lefsrclibdir, destlib, lef_compile,
+			lef_compile_only, lef_exclude)
 
     if have_lef and not no_lef_convert:
         print("Migrating LEF files to layout.")
@@ -1856,6 +3282,17 @@ if __name__ == '__main__':
         cdldir = targetdir + cdl_reflib + 'cdl'
         os.makedirs(destdir, exist_ok=True)
 
+        # Link to the PDK magic startup file from the target directory
+        startup_script = targetdir + mag_current + pdkname + '-F.magicrc'
+        if not os.path.isfile(startup_script):
+            startup_script = targetdir + mag_current + pdkname + '.magicrc'
+
+        # Force the abstract view timestamps to match the full views
+        if do_timestamp and have_mag_8_3_261:
+            datestamp = timestamp_value
+        else:
+            datestamp = None
+
         # For each library, create the library subdirectory
         for library in libraries:
             if len(library) == 3:
@@ -1863,291 +3300,27 @@ if __name__ == '__main__':
             else:
                 destlib = library[1]
 
-            destdir = targetdir + '/libs.ref/' + destlib + '/maglef'
-            srcdir = targetdir + lef_reflib + destlib + '/lef'
-            magdir = targetdir + gds_reflib + destlib + '/mag'
-            cdldir = targetdir + cdl_reflib + destlib + '/cdl'
-            cdir = targetdir + cdl_reflib + destlib + '/cdl'
-            sdir = targetdir + cdl_reflib + destlib + '/spice'
-
-            destlibdir = destdir
-            srclibdir = srcdir
-            maglibdir = magdir
-            cdllibdir = cdldir
-            clibdir = cdir
-            slibdir = sdir
+            destlibdir = targetdir + '/libs.ref/' + destlib + '/maglef'
+            srclibdir = targetdir + lef_reflib + destlib + '/lef'
+            maglibdir = targetdir + gds_reflib + destlib + '/mag'
+            cdllibdir = targetdir + cdl_reflib + destlib + '/cdl'
+
+            # Use CDL or SPICE netlists to make sure that ports are
+            # present, and to set the port order
+            if have_cdl:
+                netlibdir = cdllibdir
+            elif have_spice:
+                netlibdir = targetdir + cdl_reflib + destlib + '/spice'
+            else:
+                netlibdir = None
 
             os.makedirs(destlibdir, exist_ok=True)
 
-            # Link to the PDK magic startup file from the target directory
-            startup_script = targetdir + mag_current + pdkname + '-F.magicrc'
-            if not os.path.isfile(startup_script):
-                startup_script = targetdir + mag_current + pdkname + '.magicrc'
-
             if have_mag_8_2 and os.path.isfile(startup_script):
-                # If the symbolic link exists, remove it.
-                if os.path.isfile(destlibdir + '/.magicrc'):
-                    os.remove(destlibdir + '/.magicrc')
-                os.symlink(startup_script, destlibdir + '/.magicrc')
- 
-                # Find LEF file names in the source
-                leffiles = []
-                if os.path.isdir(srclibdir):
-                    leffiles = os.listdir(srclibdir)
-                    leffiles = list(item for item in leffiles if os.path.splitext(item)[1].lower() == '.lef')
-
-                # Get list of abstract views to make from LEF macros
-                lefmacros = []
-                err_no_macros = False
-                for leffile in leffiles:
-                    with open(srclibdir + '/' + leffile, 'r') as ifile:
-                        ltext = ifile.read()
-                        llines = ltext.splitlines()
-                        for lline in llines:
-                            ltok = re.split(r' |\t|\(', lline)
-                            if ltok[0] == 'MACRO':
-                                lefmacros.append(ltok[1])
-
-                # Create exclude list with glob-style matching using fnmatch
-                if len(lefmacros) > 0:
-                    lefnames = list(os.path.split(item)[1] for item in lefmacros)
-                    notlefnames = []
-                    for exclude in lef_exclude:
-                        notlefnames.extend(fnmatch.filter(lefnames, exclude))
-
-                    # Apply exclude list
-                    if len(notlefnames) > 0:
-                        for file in lefmacros[:]:
-                            if os.path.split(file)[1] in notlefnames:
-                                lefmacros.remove(file)
-
-                if len(leffiles) == 0:
-                    print('Warning:  No LEF files found in ' + srclibdir)
-                    continue
-
-                print('Generating conversion script to create magic databases from LEF')
-
-                # Generate a script called "generate_magic.tcl" and leave it in
-                # the target directory.  Use it as input to magic to create the
-                # .mag files from the database.
-
-                with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
-                    print('#!/usr/bin/env wish', file=ofile)
-                    print('#--------------------------------------------', file=ofile)
-                    print('# Script to generate .mag files from .lef    ', file=ofile)
-                    print('#--------------------------------------------', file=ofile)
-                    print('tech unlock *', file=ofile)
-
-                    # If there are devices in the LEF file that come from the
-                    # PDK library, then copy this list into the script.
-
-                    if pdklibrary:
-                        shortdevlist = []
-                        for macro in lefmacros:
-                            if macro in devlist:
-                                shortdevlist.append(macro)
-
-                        tcldevlist = '{' + ' '.join(shortdevlist) + '}'
-                        print('set devlist ' + tcldevlist, file=ofile)
-
-                    # Force the abstract view timestamps to match the full views
-                    if do_timestamp and have_mag_8_3_261:
-                        print('lef datestamp ' + str(timestamp_value), file=ofile)
-
-                    for leffile in leffiles:
-                        print('lef read ' + srclibdir + '/' + leffile, file=ofile)
-
-                    # Use CDL or SPICE netlists to make sure that ports are
-                    # present, and to set the port order
-
-                    if have_cdl or have_spice:
-                        if have_cdl:
-                            netdir = clibdir
-                        else:
-                            netdir = slibdir
-
-                        # Find CDL/SPICE file names in the source
-                        # Ignore "sources.txt" if it is in the list.
-                        netfiles = os.listdir(netdir)
-                        print('puts stdout "Annotating cells from CDL/SPICE"',
-				file=ofile)
-                        for netfile in netfiles:
-                            if os.path.split(netfile)[1] != 'sources.txt':
-                                print('catch {readspice ' + netdir + '/' + netfile
-					+ '}', file=ofile)
-
-                    for lefmacro in lefmacros:
-
-                        if pdklibrary and lefmacro in shortdevlist:
-                            print('set cellname ' + lefmacro, file=ofile)
-                            print('if {[lsearch $devlist $cellname] >= 0} {',
-					file=ofile)
-                            print('    load $cellname', file=ofile)
-                            print('    property gencell $cellname', file=ofile)
-                            print('    property parameter m=1', file=ofile)
-                            print('    property library ' + pdklibrary, file=ofile)
-                            print('}', file=ofile)
-
-                    # Load one of the LEF files so that the default (UNNAMED) cell
-                    # is not loaded, then delete (UNNAMED) so it doesn't generate
-                    # an error message.
-                    if len(lefmacros) > 0:
-                        print('load ' + lefmacros[0], file=ofile)
-                        # print(r'cellname delete \(UNNAMED\)', file=ofile)
-                    else:
-                        err_no_macros = True
-                    print('writeall force', file=ofile)
-                    print('puts stdout "Done."', file=ofile)
-                    print('quit -noprompt', file=ofile)
-
-                if err_no_macros == True:
-                    print('Warning:  No LEF macros were defined.')
-
-                print('Running magic to create magic databases from LEF')
-                sys.stdout.flush()
-
-                # Run magic to read in the LEF file and write out magic databases.
-                with open(destlibdir + '/generate_magic.tcl', 'r') as ifile:
-                    subprocess_run(
-                        'magic',
-                        ['magic', '-dnull', '-noconsole'],
-                        stdin = ifile,
-                        cwd = destlibdir,
-                    )
-
-                # Now list all the .mag files generated, and for each, read the
-                # corresponding file from the mag/ directory, pull the GDS file
-                # properties, and add those properties to the maglef view.  Also
-                # read the CDL (or SPICE) netlist, read the ports, and rewrite
-                # the port order in the mag and maglef file accordingly.
-
-                # Diagnostic
-                print('Annotating files in ' + destlibdir)
-                sys.stdout.flush()
-                magfiles = os.listdir(destlibdir)
-                magfiles = list(item for item in magfiles if os.path.splitext(item)[1] == '.mag')
-                for magroot in magfiles:
-                    magname = os.path.splitext(magroot)[0]
-                    magfile = maglibdir + '/' + magroot
-                    magleffile = destlibdir + '/' + magroot
-                    prop_lines = get_gds_properties(magfile)
-
-                    # Make sure properties include the Tcl generated cell
-                    # information from the PDK script
-
-                    prop_gencell = []
-                    if pdklibrary:
-                        if magname in fixedlist:
-                            prop_gencell.append('gencell ' + magname)
-                            prop_gencell.append('library ' + pdklibrary)
-                            prop_gencell.append('parameter m=1')
-
-                    nprops = len(prop_lines) + len(prop_gencell)
-
-                    cdlfile = cdllibdir + '/' + magname + '.cdl'
-                    if os.path.exists(cdlfile):
-                        cdlfiles = [cdlfile]
-                    else:
-                        # Assume there is at least one file with all cell subcircuits
-                        # in it.
-                        try:
-                            cdlfiles = glob.glob(cdllibdir + '/*.cdl')
-                            cdlfiles = natural_sort.natural_sort(cdlfiles)
-                        except:
-                            pass
-                    if len(cdlfiles) > 0:
-                        for cdlfile in cdlfiles:
-                            port_dict = get_subckt_ports(cdlfile, magname)
-                            if port_dict != {}:
-                                break
-                    else:
-                        port_dict = {}
-
-                    if port_dict == {}:
-                        print('No CDL file contains ' + destlib + ' device ' + magname)
-                        cdlfile = None
-                        # To be done:  If destlib is 'primitive', then look in
-                        # SPICE models for port order.
-                        if destlib == 'primitive':
-                            print('Fix me:  Need to look in SPICE models!')
-
-                    proprex = re.compile('<< properties >>')
-                    endrex = re.compile('<< end >>')
-                    rlabrex = re.compile(r'rlabel[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+[^ \t]+[ \t]+([^ \t]+)')
-                    flabrex = re.compile(r'flabel[ \t]+.*[ \t]+([^ \t]+)[ \t]*')
-                    portrex = re.compile(r'port[ \t]+([^ \t]+)[ \t]+(.*)')
-                    gcellrex = re.compile('string gencell')
-                    portnum = -1
-
-                    with open(magleffile, 'r') as ifile:
-                        magtext = ifile.read().splitlines()
-
-                    with open(magleffile, 'w') as ofile:
-                        has_props = False
-                        is_gencell = False
-                        for line in magtext:
-                            tmatch = portrex.match(line)
-                            if tmatch:
-                                if portnum >= 0:
-                                    line = 'port ' + str(portnum) + ' ' + tmatch.group(2)
-                                else:
-                                    line = 'port ' + tmatch.group(1) + ' ' + tmatch.group(2)
-                            ematch = endrex.match(line)
-                            if ematch and nprops > 0:
-                                if not has_props:
-                                    print('<< properties >>', file=ofile)
-                                if not is_gencell:
-                                    for prop in prop_gencell:
-                                        print('string ' + prop, file=ofile)
-                                for prop in prop_lines:
-                                    print('string ' + prop, file=ofile)
-
-                            print(line, file=ofile)
-                            pmatch = proprex.match(line)
-                            if pmatch:
-                                has_props = True
-
-                            gmatch = gcellrex.match(line)
-                            if gmatch:
-                                is_gencell = True
-
-                            lmatch = flabrex.match(line)
-                            if not lmatch:
-                                lmatch = rlabrex.match(line)
-                            if lmatch:
-                                labname = lmatch.group(1).lower()
-                                try:
-                                    portnum = port_dict[labname]
-                                except:
-                                    portnum = -1
-
-                    if os.path.exists(magfile):
-                        with open(magfile, 'r') as ifile:
-                            magtext = ifile.read().splitlines()
-
-                        with open(magfile, 'w') as ofile:
-                            for line in magtext:
-                                tmatch = portrex.match(line)
-                                if tmatch:
-                                    if portnum >= 0:
-                                        line = 'port ' + str(portnum) + ' ' + tmatch.group(2)
-                                    else:
-                                        line = 'port ' + tmatch.group(1) + ' ' + tmatch.group(2)
-                                ematch = endrex.match(line)
-                                print(line, file=ofile)
-                                lmatch = flabrex.match(line)
-                                if not lmatch:
-                                    lmatch = rlabrex.match(line)
-                                if lmatch:
-                                    labname = lmatch.group(1).lower()
-                                    try:
-                                        portnum = port_dict[labname]
-                                    except:
-                                        portnum = -1
-                    elif os.path.splitext(magfile)[1] == '.mag':
-                        # NOTE:  Possibly this means the GDS cell has a different name.
-                        print('Error: No file ' + magfile + '.  Why is it in maglef???')
-
+                scheduler.add('maglef ' + destlib, ['gds2mag ' + destlib, 'lefanno'],
+			generate_maglef, destlib, destlibdir, srclibdir, maglibdir,
+			cdllibdir, netlibdir, startup_script, lef_exclude, pdklibrary,
+			devlist, fixedlist if pdklibrary else [], datestamp)
             elif not have_mag_8_2:
                 print('The installer is not able to run magic.')
             else:
@@ -2206,7 +3379,8 @@ if __name__ == '__main__':
                     procopts.append('-ignore=' + item)
 
                 print('Running (in ' + destlibdir + '): ' + ' '.join(procopts))
-                subprocess_run('cdl2spi.py', procopts, cwd = destlibdir)
+                scheduler.add('cdl2spi ' + destlibdir + '/' + spiname, [],
+			subprocess_run, 'cdl2spi.py', procopts, cwd = destlibdir)
 
     elif have_gds and not no_gds_convert and not no_extract:
         # If neither SPICE nor CDL formats is available in the source, then
@@ -2216,6 +3390,11 @@ if __name__ == '__main__':
         # then the port numbering is arbitrary, and becomes whatever the
         # output of this script makes it.
 
+        # Link to the PDK magic startup file from the target directory
+        startup_script = targetdir + mag_current + pdkname + '-F.magicrc'
+        if not os.path.isfile(startup_script):
+            startup_script = targetdir + mag_current + pdkname + '.magicrc'
+
         # For each library, create the library subdirectory
         for library in libraries:
             if len(library) == 3:
@@ -2223,161 +3402,26 @@ if __name__ == '__main__':
             else:
                 destlib = library[1]
 
-            destdir = targetdir + cdl_reflib + destlib + '/spice'
-            srcdir = targetdir + gds_reflib + destlib + '/gds'
-            lefdir = targetdir + lef_reflib + destlib + '/lef'
-            cdldir = targetdir + cdl_reflib + destlib + '/cdl'
-
-            destlibdir = destdir
-            srclibdir = srcdir
-            leflibdir = lefdir
-            cdllibdir = cdldir
-
-            os.makedirs(destlibdir, exist_ok=True)
-
-            # Link to the PDK magic startup file from the target directory
-            startup_script = targetdir + mag_current + pdkname + '-F.magicrc'
-            if not os.path.isfile(startup_script):
-                startup_script = targetdir + mag_current + pdkname + '.magicrc'
-            if os.path.isfile(startup_script):
-                # If the symbolic link exists, remove it.
-                if os.path.isfile(destlibdir + '/.magicrc'):
-                    os.remove(destlibdir + '/.magicrc')
-                os.symlink(startup_script, destlibdir + '/.magicrc')
-
-            # Get the consolidated GDS library file, or a list of all GDS files
-            # if there is no single consolidated library
-
-            allgdslibname = srclibdir + '/' + destlib + '.gds'
-            if not os.path.isfile(allgdslibname):
-                glist = glob.glob(srclibdir + '/*.gds')
-                glist.extend(glob.glob(srclibdir + '/*.gdsii'))
-                glist.extend(glob.glob(srclibdir + '/*.gds2'))
-                glist = natural_sort.natural_sort(glist)
-
-            allleflibname = leflibdir + '/' + destlib + '.lef'
-            if not os.path.isfile(allleflibname):
-                llist = glob.glob(leflibdir + '/*.lef')
-                llist = natural_sort.natural_sort(llist)
+            destlibdir = targetdir + cdl_reflib + destlib + '/spice'
+            srclibdir = targetdir + gds_reflib + destlib + '/gds'
+            leflibdir = targetdir + lef_reflib + destlib + '/lef'
 
+            # CDL files not converted to SPICE are used for the pin order
             if have_cdl and no_cdl_convert:
-                # CDL is not being converted directly to SPICE but it exists,
-                # and being the only source of pin order, it should be used
-                # for pin order annotation.
-                allcdllibname = cdllibdir + '/' + destlib + '.cdl'
-                if not os.path.isfile(allcdllibname):
-                    clist = glob.glob(cdllibdir + '/*.cdl')
-                    clist = natural_sort.natural_sort(clist)
-
-            print('Creating magic generation script to generate SPICE library.') 
-            with open(destlibdir + '/generate_magic.tcl', 'w') as ofile:
-                print('#!/usr/bin/env wish', file=ofile)
-                print('#---------------------------------------------', file=ofile)
-                print('# Script to generate SPICE library from GDS   ', file=ofile)
-                print('#---------------------------------------------', file=ofile)
-                print('drc off', file=ofile)
-                print('locking off', file=ofile)
-                print('gds readonly true', file=ofile)
-                print('gds flatten true', file=ofile)
-                print('gds rescale false', file=ofile)
-                print('tech unlock *', file=ofile)
-
-                # Add custom Tcl script lines before "gds read".
-                if tclscript:
-                    for line in tcllines:
-                        print(line, file=ofile)
-
-                if not os.path.isfile(allgdslibname):
-                    for gdsfile in glist:
-                        print('gds read ' + gdsfile, file=ofile)
-                else:
-                    print('gds read ' + allgdslibname, file=ofile)
-
-                if not os.path.isfile(allleflibname):
-                    # Annotate the cells with information from the LEF files
-                    for leffile in llist:
-                        print('lef read ' + leffile, file=ofile)
-                else:
-                    print('lef read ' + allleflibname, file=ofile)
-
-                if have_cdl and no_cdl_convert:
-                    if not os.path.isfile(allcdllibname):
-                        # Annotate the cells with pin order from the CDL files
-                        for cdlfile in clist:
-                            print('catch {readspice ' + cdlfile + '}', file=ofile)
-                    else:
-                        print('catch {readspice ' + allcdllibname + '}', file=ofile)
-
-                # Load first file and remove the (UNNAMED) cell
-                if not os.path.isfile(allgdslibname):
-                    if len(glist) > 0:
-                        print('load ' + os.path.splitext(glist[0])[0], file=ofile)
-                else:
-                    gdslibroot = os.path.split(allgdslibname)[1]
-                    print('load ' + os.path.splitext(gdslibroot)[0], file=ofile)
-                print(r'catch {cellname delete \(UNNAMED\)}', file=ofile)
-
-                print('ext2spice lvs', file=ofile)
-
-                # NOTE:  Leaving "subcircuit top" as "auto" (default) can cause
-                # cells like decap that have no I/O to be output without a subcircuit
-                # wrapper.  Also note that if this happens, it is an indication that
-                # power supplies have not been labeled as ports, which is harder to
-                # handle and should be fixed in the source.
-                print('ext2spice subcircuit top on', file=ofile)
-
-                # Use option "dorcx" if parasitics should be extracted.
-                # NOTE:  Currently only does parasitic capacitance extraction.
-                if do_parasitics:
-                    print('ext2spice cthresh 0.1', file=ofile)
-
-                if os.path.isfile(allgdslibname):
-                    # Do not depend absolutely on the library having a top
-                    # level cell, but query for it from inside magic
-                    print('if {[cellname list exists ' + allgdslibname + ']} {',
-				file=ofile)
-                    print('   select top cell', file=ofile)
-                    print('   set glist [cellname list children]', file=ofile)
-                    print('} else {', file=ofile)
-                    print('   set glist [cellname list top]', file=ofile)
-                    print('}', file=ofile)
-                else:
-                    print('set glist [cellname list top]', file=ofile)
-
-                print('foreach cell $glist {', file=ofile)
-                print('    load $cell', file=ofile)
-                print('    puts stdout "Extracting cell $cell"', file=ofile)
-                print('    extract all', file=ofile)
-                print('    ext2spice', file=ofile)
-                print('}', file=ofile)
-
-                print('puts stdout "Done."', file=ofile)
-                print('quit -noprompt', file=ofile)
-
-            # Run magic to read in the individual GDS files and
-            # write out the consolidated GDS library
-
-            print('Running magic to create GDS library.')
-            sys.stdout.flush()
-
-            subprocess_run(
-                'magic',
-                ['magic', '-dnull', '-noconsole',
-                 destlibdir + '/generate_magic.tcl'],
-                cwd = destlibdir,
-            )
+                cdllibdir = targetdir + cdl_reflib + destlib + '/cdl'
+            else:
+                cdllibdir = None
 
-            # Remove intermediate extraction files
-            extfiles = glob.glob(destlibdir + '/*.ext')
-            for extfile in extfiles:
-                os.remove(extfile)
+            os.makedirs(destlibdir, exist_ok=True)
 
-            # If the GDS file was a consolidated file of all cells, then
-            # create a similar SPICE library of all cells.
+            scheduler.add('extract ' + destlib, ['gds2mag ' + destlib, 'lefanno'],
+			generate_spice_from_gds, destlib, destlibdir, srclibdir,
+			leflibdir, cdllibdir, startup_script,
+			tcllines if tclscript else [], do_parasitics, do_compile_only,
+			do_stub, excludelist)
 
-            if os.path.isfile(allgdslibname):
-                spiext = '.spice'
-                create_spice_library(destlibdir, destlib, spiext, do_compile_only, do_stub, excludelist)
+    # Wait for all stages to finish before removing temporary files
+    scheduler.run()
 
     # Remove any files/directories that were marked for removal
     for targname in removelist:
@@ -2386,4 +3430,27 @@ if __name__ == '__main__':
         elif os.path.isdir(targname):
             shutil.rmtree(targname)
 
+    # Magic stamps the GDS files it writes, but vendor GDS files are copied
+    # unchanged.  Set the dates of every GDS file of the libraries installed
+    # to the timestamp, so that all GDS files are stamped the same way.
+    if do_timestamp:
+        gdsdirs = []
+        for library in libraries:
+            destlib = library[2] if len(library) == 3 else library[1]
+            for libdir in ['libs.ref', 'libs.priv']:
+                gdsdir = os.path.join(targetdir, libdir, destlib, 'gds')
+                if os.path.isdir(gdsdir):
+                    gdsdirs.append(gdsdir)
+        if gdsdirs:
+            with stage_trace.Span('timestamp gds', dirs=len(gdsdirs)):
+                gds_dates.print_results(gds_dates.set_tree_dates(gdsdirs,
+				timestamp_value, timestamp_value, jobs))
+
+    # Record the staging manifest for this run
+    if do_cache:
+        stage_after = stage_manifest.snapshot(targetdir, stage_outdirs)
+        stage_outputs = stage_manifest.snapshot_changes(stage_before, stage_after)
+        stage_manifest.write_manifest(manifestfile, stage_options, stage_version,
+			stage_inputs, stage_outputs, stage_order)
+
     sys.exit(0)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# gds_dates.py
+#
+#----------------------------------------------------------------------------
+# Set the dates in GDS files, for reproducible builds.
+#
+# The creation and modification dates of the library (BGNLIB record) and of
+# each structure (BGNSTR records) are set to the same values in every GDS
+# file of a directory tree.  The date records are always the same size, so
+# an uncompressed file is changed in place through a writable memory map,
+# and only the records whose dates are different are written.  Files whose
+# dates are all correct are not changed at all.  A compressed file, or a
+# file that is a hard link to another file (which must not be changed with
+# it), is written out again, but only if any of its dates are different.
+#----------------------------------------------------------------------------
+
+import os
+import sys
+import multiprocessing
+
+import gds_stream
+
+gds_extensions = ['.gds', '.gds.gz', '.gdsii', '.gds2']
+
+#----------------------------------------------------------------------------
+# Return the 24-byte date data of a BGNLIB or BGNSTR record for creation
+# time "createstamp" and modification time "modstamp" (see
+# gds_stream.make_timestamp()).  If "modstamp" is zero or negative, then
+# the modification time is the same as the creation time.
+#----------------------------------------------------------------------------
+
+def date_data(createstamp, modstamp=0):
+    try:
+        if int(modstamp) <= 0:
+            modstamp = createstamp
+    except ValueError:
+        pass
+    return gds_stream.make_timestamp(createstamp) + gds_stream.make_timestamp(modstamp)
+
+#----------------------------------------------------------------------------
+# Return the list of GDS files in "paths" (files or directories, which are
+# searched recursively).  Symbolic links are not followed, as the files
+# they point to are not part of the tree.
+#----------------------------------------------------------------------------
+
+def find_gds_files(paths):
+    gdsfiles = []
+    for path in paths:
+        if os.path.islink(path):
+            continue
+        elif os.path.isfile(path):
+            gdsfiles.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not any(filename.endswith(ext) for ext in gds_extensions):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                if not os.path.islink(filepath):
+                    gdsfiles.append(filepath)
+    return gdsfiles
+
+#----------------------------------------------------------------------------
+# Set the dates of GDS file "filepath" to "datestamp" (from date_data()).
+# Returns (number of date records changed, total number of date records).
+#----------------------------------------------------------------------------
+
+def set_dates(filepath, datestamp):
+    in_place = not gds_stream.is_gzip(filepath) and os.stat(filepath).st_nlink == 1
+    changed = 0
+    total = 0
+    chunks = []
+    dataptr = 0
+    with gds_stream.GDSFile(filepath, writable=in_place) as gds:
+        data = gds.data
+        for offset, reclen, rectype, datatype in gds_stream.records(data):
+            if rectype not in [gds_stream.BGNLIB, gds_stream.BGNSTR] or reclen != 28:
+                continue
+            total += 1
+            if data[offset + 4:offset + 28] == datestamp:
+                continue
+            changed += 1
+            if in_place:
+                data[offset + 4:offset + 28] = datestamp
+            else:
+                chunks.append(data[dataptr:offset + 4])
+                chunks.append(datestamp)
+                dataptr = offset + 28
+
+        if changed and not in_place:
+            chunks.append(data[dataptr:])
+            gds_stream.write_gds(filepath, chunks)
+        chunks = None
+    return (changed, total)
+
+# Same as set_dates(), for use in a worker process.  Returns (filepath,
+# changed, total, error message or None).
+
+def set_dates_task(filepath, datestamp):
+    try:
+        changed, total = set_dates(filepath, datestamp)
+    except (OSError, gds_stream.GDSError) as e:
+        return (filepath, 0, 0, str(e))
+    return (filepath, changed, total, None)
+
+#----------------------------------------------------------------------------
+# Set the dates of every GDS file in "paths" (see find_gds_files()), with
+# "jobs" files in parallel.  Returns a list of (filepath, changed, total,
+# error message or None) for each file.
+#----------------------------------------------------------------------------
+
+def set_tree_dates(paths, createstamp, modstamp=0, jobs=1):
+    datestamp = date_data(createstamp, modstamp)
+    gdsfiles = find_gds_files(paths)
+    tasks = list((filepath, datestamp) for filepath in gdsfiles)
+    if jobs == 1 or len(tasks) < 2:
+        return list(set_dates_task(*task) for task in tasks)
+
+    sys.stdout.flush()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(min(jobs, len(tasks))) as pool:
+        return pool.starmap(set_dates_task, tasks, chunksize=8)
+
+#----------------------------------------------------------------------------
+# Print a summary of the results from set_tree_dates().  Returns the number
+# of files that could not be changed.
+#----------------------------------------------------------------------------
+
+def print_results(results, verbose=False):
+    errors = 0
+    current = []
+    updated = 0
+    for filepath, changed, total, errmsg in results:
+        if errmsg:
+            print('Error:  ' + filepath + ': ' + errmsg)
+            errors += 1
+        elif changed:
+            updated += 1
+            if verbose:
+                print('Set ' + str(changed) + ' of ' + str(total) + ' dates in ' + filepath)
+        else:
+            current.append(filepath)
+    if verbose and current:
+        print('Dates already correct in:')
+        for filepath in current:
+            print('   ' + filepath)
+    print('GDS dates:  ' + str(updated) + ' files updated, ' + str(len(current)) +
+		' files already correct, ' + str(errors) + ' errors.')
+    return errors
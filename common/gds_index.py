@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# gds_index.py
+#
+#----------------------------------------------------------------------------
+# Index of the structures (cells) in a GDS file, for finding a structure
+# without reading through the whole file.
+#
+# For each structure, the index records the byte range of the structure in
+# the file, the names of the structures it references (SREF and AREF
+# records), and the (layer, datatype) pairs used by its elements.  The
+# index of a file is saved in a sidecar file next to it, named
+# ".<filename>.idx", and is used again as long as the size and modification
+# time of the GDS file are unchanged.  The sidecar file is JSON:
+#
+#    {"version": 1, "size": <size>, "mtime_ns": <mtime_ns>,
+#     "structures": [[<name>, <start>, <nameoffset>, <end>,
+#		[<child>, ...], [[<layer>, <datatype>], ...]], ...]}
+#
+# Offsets of structures in a compressed file are offsets into the
+# decompressed data.
+#----------------------------------------------------------------------------
+
+import os
+import json
+import struct
+import collections
+
+import gds_stream
+
+index_version = 1
+
+# A structure in the index:  The structure name, the offset of its BGNSTR
+# record, the offset of its STRNAME record, the offset just past its ENDSTR
+# record, the list of names of referenced structures, and the list of
+# (layer, datatype) pairs used.
+IndexEntry = collections.namedtuple('IndexEntry',
+		['name', 'start', 'nameoffset', 'end', 'children', 'layers'])
+
+#----------------------------------------------------------------------------
+# Return the name of the sidecar index file for GDS file "filepath".
+#----------------------------------------------------------------------------
+
+def index_file(filepath):
+    gdsdir, gdsname = os.path.split(os.path.abspath(filepath))
+    return os.path.join(gdsdir, '.' + gdsname + '.idx')
+
+#----------------------------------------------------------------------------
+# Read the GDS data "data" and return the list of IndexEntry, in the order
+# the structures appear in the data.
+#----------------------------------------------------------------------------
+
+def build_index(data):
+    unpack = gds_stream.header.unpack_from
+    int2 = struct.Struct('>h').unpack_from
+    entries = []
+    end = len(data)
+    offset = 0
+    strstart = None
+    name = None
+    layer = None
+    while offset + 4 <= end:
+        reclen, rectype, datatype = unpack(data, offset)
+        if reclen < 4 or offset + reclen > end:
+            raise gds_stream.record_error(reclen, offset)
+        if rectype == gds_stream.BGNSTR:
+            strstart = offset
+            name = None
+            children = []
+            childset = set()
+            layers = []
+        elif rectype == gds_stream.STRNAME and name is None:
+            if datatype != gds_stream.ASCII:
+                raise gds_stream.GDSError('Structure name record is not a string!')
+            name = gds_stream.record_string(data, offset, reclen)
+            nameoffset = offset
+        elif rectype == gds_stream.ENDSTR:
+            if strstart is not None and name is not None:
+                entries.append(IndexEntry(name, strstart, nameoffset,
+			offset + reclen, children, layers))
+            strstart = None
+            name = None
+        elif strstart is None:
+            if rectype == gds_stream.ENDLIB:
+                break
+        elif rectype == gds_stream.SNAME:
+            child = gds_stream.record_string(data, offset, reclen)
+            if child not in childset:
+                childset.add(child)
+                children.append(child)
+        elif rectype == gds_stream.LAYER:
+            layer = int2(data, offset + 4)[0]
+        elif rectype in [gds_stream.DATATYPE, gds_stream.TEXTTYPE, gds_stream.BOXTYPE]:
+            pair = [layer, int2(data, offset + 4)[0]]
+            if pair not in layers:
+                layers.append(pair)
+        offset += reclen
+    return entries
+
+#----------------------------------------------------------------------------
+# Index of a GDS file.  "data" is the contents of the file (from
+# gds_stream.GDSFile).  If "cache" is True, then the index is read from the
+# sidecar file if it is up to date, and otherwise built and saved to the
+# sidecar file (if the directory is writable).
+#
+# "entries" is the list of IndexEntry in file order, and "structures" is a
+# dictionary of IndexEntry by structure name (for a name that appears more
+# than once, the last structure with the name).
+#----------------------------------------------------------------------------
+
+class GDSIndex(object):
+
+    def __init__(self, filepath, data, cache=True):
+        self.filepath = filepath
+        self.indexfile = index_file(filepath) if cache else None
+        self.cached = False
+        self.entries = None
+        if self.indexfile:
+            self.load(data)
+        if self.entries is None:
+            self.entries = build_index(data)
+            if self.indexfile:
+                self.save()
+        self.structures = dict((entry.name, entry) for entry in self.entries)
+
+    # Read the sidecar file, if it exists and matches the GDS file.  As a
+    # check against a stale index, the first structure's records must be
+    # where the index says.
+
+    def load(self, data):
+        try:
+            st = os.stat(self.filepath)
+            with open(self.indexfile, 'r') as ifile:
+                index = json.load(ifile)
+        except (OSError, ValueError):
+            return
+        if not isinstance(index, dict) or index.get('version') != index_version:
+            return
+        if index.get('size') != st.st_size or index.get('mtime_ns') != st.st_mtime_ns:
+            return
+        try:
+            entries = list(IndexEntry(*item) for item in index['structures'])
+        except (KeyError, TypeError):
+            return
+        if entries and not self.check(data, entries[0]):
+            return
+        self.entries = entries
+        self.cached = True
+
+    # Return True if "entry" matches the structure at its offsets in "data".
+
+    def check(self, data, entry):
+        try:
+            reclen, rectype, datatype = gds_stream.header.unpack_from(data, entry.start)
+            if rectype != gds_stream.BGNSTR:
+                return False
+            reclen, rectype, datatype = gds_stream.header.unpack_from(data, entry.nameoffset)
+            if rectype != gds_stream.STRNAME:
+                return False
+            return gds_stream.record_string(data, entry.nameoffset, reclen) == entry.name
+        except (struct.error, UnicodeDecodeError):
+            return False
+
+    # Write the sidecar file.  The file is written under a temporary name
+    # and renamed, so that a partly written index is never read.  An index
+    # that cannot be written (e.g., read-only directory) is not an error.
+
+    def save(self):
+        tmpfile = self.indexfile + '.' + str(os.getpid()) + '.tmp'
+        try:
+            st = os.stat(self.filepath)
+            with open(tmpfile, 'w') as ofile:
+                json.dump({'version': index_version, 'size': st.st_size,
+			'mtime_ns': st.st_mtime_ns,
+			'structures': list(list(entry) for entry in self.entries)}, ofile)
+            os.replace(tmpfile, self.indexfile)
+        except OSError:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    # Return the IndexEntry for structure "name", or None.
+
+    def find(self, name):
+        return self.structures.get(name)
+
+    # Return the names of structure "name" and all structures under it in
+    # the hierarchy, each one after all of the structures it references
+    # (the order in which a GDS writer writes them).  Names of referenced
+    # structures that are not in the file are returned in "missing".
+
+    def closure(self, name):
+        order = []
+        missing = []
+        seen = set([name])
+        stack = [(name, 0)]
+        while stack:
+            cellname, childidx = stack.pop()
+            entry = self.structures.get(cellname)
+            if not entry:
+                missing.append(cellname)
+                continue
+            if childidx < len(entry.children):
+                # Come back to this cell after its next child
+                stack.append((cellname, childidx + 1))
+                child = entry.children[childidx]
+                if child not in seen:
+                    seen.add(child)
+                    stack.append((child, 0))
+            else:
+                order.append(cellname)
+        return order, missing
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+#
+# gds_stats.py
+#
+#----------------------------------------------------------------------------
+# Hierarchy and layer statistics of GDS files, read in one pass through the
+# file without loading it into magic.  The statistics show how large a
+# vendor GDS library is before it is staged (and so roughly how long magic
+# will take to read it and how much memory it will need).
+#
+# Usage:
+#
+#    gds_stats.py [-jobs=<n>] [-summary] [-output=<file>] <path_to_gds> ...
+#
+# The statistics are printed as JSON (to <file> if "-output" is given):
+# For a single GDS file, one object;  for several files, an object with
+# the statistics of each file keyed by file name.  Directories are searched
+# recursively for GDS files.  With "-summary", one line per file is printed
+# instead.  Option "-jobs=<n>" reads <n> files in parallel.
+#
+# The statistics of a file are:
+#
+#    file, size:	File name and size in bytes
+#    library:	Library name
+#    cells:		Number of cells (structures)
+#    top:		Cells that are not used by any other cell
+#    missing:	Cells that are used but not defined in the file
+#    depth:		Depth of the hierarchy (0 if no cell uses another)
+#    totals:	Number of each element type ("boundary" (polygon),
+#			"path", "box", "text", "node", "sref", "aref") in all
+#			cells, the number of cell instances ("instances",
+#			counting each element of an array), and the number
+#			of XY points ("vertices")
+#    flat:		Number of shapes and instances in the fully flattened
+#			layout of all top cells
+#    layers:	For each "<layer>/<datatype>", the number of each
+#			element type, the number of shapes, the number of
+#			shapes when flattened ("flat"), the number of XY
+#			points, and a histogram of the number of XY points
+#			per shape, keyed by the upper bound of each bin
+#    cellstats:	For each cell, the number of each element type, the
+#			number of instances, the depth of the hierarchy under
+#			the cell, the number of times the cell is placed in
+#			the flattened layout ("placements"), the cells it uses
+#			with the number of instances of each, and the number
+#			of shapes on each layer
+#    tree:		The hierarchy as a list of nodes, one per top cell.
+#			Each node has the cell name, the number of instances
+#			in the parent ("count"), and the nodes of the cells it
+#			uses ("children").  A cell that appears more than once
+#			is only expanded the first time.
+#----------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import struct
+import multiprocessing
+
+import gds_stream
+import gds_dates
+
+NODETYPE = 42
+
+element_names = {
+	gds_stream.BOUNDARY: 'boundary',
+	gds_stream.PATH: 'path',
+	gds_stream.BOX: 'box',
+	gds_stream.TEXT: 'text',
+	gds_stream.NODE: 'node',
+	gds_stream.SREF: 'sref',
+	gds_stream.AREF: 'aref'
+}
+
+shape_types = ['boundary', 'path', 'box', 'text', 'node']
+
+def usage():
+    print('gds_stats.py [-jobs=<n>] [-summary] [-output=<file>] <path_to_gds> ...')
+
+#----------------------------------------------------------------------------
+# Return the histogram bin (upper bound) for a shape with "npoints" points.
+#----------------------------------------------------------------------------
+
+def histogram_bin(npoints):
+    if npoints <= 1:
+        return 1
+    return 1 << (npoints - 1).bit_length()
+
+#----------------------------------------------------------------------------
+# Read the GDS data "data" and return (library name, dictionary of cell
+# statistics by cell name, list of names of cells defined more than once).
+# Per-layer counts in the cell statistics are keyed by (layer, datatype)
+# and are lists [element counts by type, number of points, histogram].
+#----------------------------------------------------------------------------
+
+def read_cells(data):
+    unpack = gds_stream.header.unpack_from
+    int2 = struct.Struct('>h').unpack_from
+    colrow = struct.Struct('>hh').unpack_from
+    XY = gds_stream.XY
+    LAYER = gds_stream.LAYER
+    ENDEL = gds_stream.ENDEL
+    typerecs = set([gds_stream.DATATYPE, gds_stream.TEXTTYPE, gds_stream.BOXTYPE, NODETYPE])
+
+    cells = {}
+    duplicates = []
+    libname = None
+    cell = None
+    element = None
+    counts = children = layers = None
+    layer = sname = None
+    dtype = npoints = 0
+    ninst = 1
+    end = len(data)
+    offset = 0
+    while offset + 4 <= end:
+        reclen, rectype, datatype = unpack(data, offset)
+        if reclen < 4 or offset + reclen > end:
+            raise gds_stream.record_error(reclen, offset)
+
+        if rectype == XY:
+            npoints = (reclen - 4) >> 3
+        elif rectype == LAYER:
+            layer = int2(data, offset + 4)[0]
+        elif rectype in typerecs:
+            dtype = int2(data, offset + 4)[0]
+        elif rectype == ENDEL:
+            if cell is None or element is None:
+                pass
+            elif sname is not None:
+                counts[element] += 1
+                children[sname] = children.get(sname, 0) + ninst
+                counts['instances'] += ninst
+            else:
+                counts[element] += 1
+                counts['vertices'] += npoints
+                key = (layer, dtype)
+                entry = layers.get(key)
+                if entry is None:
+                    entry = layers[key] = [dict.fromkeys(shape_types, 0), 0, {}]
+                entry[0][element] += 1
+                entry[1] += npoints
+                hbin = histogram_bin(npoints)
+                entry[2][hbin] = entry[2].get(hbin, 0) + 1
+            element = None
+        elif rectype in element_names:
+            element = element_names[rectype]
+            layer = None
+            dtype = 0
+            npoints = 0
+            sname = None
+            ninst = 1
+        elif rectype == gds_stream.SNAME:
+            sname = gds_stream.record_string(data, offset, reclen)
+        elif rectype == gds_stream.COLROW:
+            cols, rows = colrow(data, offset + 4)
+            ninst = cols * rows
+        elif rectype == gds_stream.BGNSTR:
+            cell = None
+            element = None
+            counts = dict.fromkeys(list(element_names.values()) + ['instances', 'vertices'], 0)
+            children = {}
+            layers = {}
+        elif rectype == gds_stream.STRNAME and cell is None:
+            cell = gds_stream.record_string(data, offset, reclen)
+        elif rectype == gds_stream.ENDSTR:
+            if cell is not None:
+                if cell in cells:
+                    duplicates.append(cell)
+                cells[cell] = {'counts': counts, 'children': children, 'layers': layers}
+            cell = None
+        elif rectype == gds_stream.LIBNAME:
+            libname = gds_stream.record_string(data, offset, reclen)
+        elif rectype == gds_stream.ENDLIB:
+            break
+        offset += reclen
+    return libname, cells, duplicates
+
+#----------------------------------------------------------------------------
+# Return the cell names of "cells" (from read_cells()) in an order in which
+# each cell comes after all of the cells it uses, and the set of the names
+# of cells that are used but not defined.  A cell that uses itself through
+# its hierarchy (which is not valid GDS) is not followed a second time.
+#----------------------------------------------------------------------------
+
+def bottom_up_order(cells):
+    order = []
+    missing = set()
+    done = set()
+    for name in cells:
+        if name in done:
+            continue
+        done.add(name)
+        stack = [(name, iter(cells[name]['children']))]
+        while stack:
+            cellname, childiter = stack[-1]
+            for child in childiter:
+                if child not in cells:
+                    missing.add(child)
+                elif child not in done:
+                    done.add(child)
+                    stack.append((child, iter(cells[child]['children'])))
+                    break
+            else:
+                stack.pop()
+                order.append(cellname)
+    return order, missing
+
+#----------------------------------------------------------------------------
+# Return the statistics of the GDS data "data" as a dictionary (see above).
+#----------------------------------------------------------------------------
+
+def gds_stats(data):
+    libname, cells, duplicates = read_cells(data)
+    order, missing = bottom_up_order(cells)
+
+    used = set()
+    for cell in cells.values():
+        used.update(cell['children'])
+    top = list(name for name in cells if name not in used)
+
+    # Depth of the hierarchy under each cell
+    depth = {}
+    for name in order:
+        depth[name] = max((depth.get(child, -1) + 1 for child in cells[name]['children']
+			if child in cells), default=0)
+
+    # Number of placements of each cell in the flattened layout
+    placements = dict.fromkeys(cells, 0)
+    for name in top:
+        placements[name] = 1
+    for name in reversed(order):
+        count = placements[name]
+        if count == 0:
+            continue
+        for child, ninst in cells[name]['children'].items():
+            if child in placements:
+                placements[child] += count * ninst
+
+    totals = dict.fromkeys(list(element_names.values()) + ['instances', 'vertices'], 0)
+    flat = {'shapes': 0, 'instances': 0}
+    layers = {}
+    cellstats = {}
+    for name in order:
+        cell = cells[name]
+        counts = cell['counts']
+        count = placements[name]
+        for key, value in counts.items():
+            totals[key] += value
+        flat['instances'] += count * counts['instances']
+        celllayers = {}
+        for (layer, dtype), (elements, npoints, histogram) in cell['layers'].items():
+            layerkey = str(layer) + '/' + str(dtype)
+            nshapes = sum(elements.values())
+            celllayers[layerkey] = nshapes
+            flat['shapes'] += count * nshapes
+            entry = layers.get(layerkey)
+            if entry is None:
+                entry = layers[layerkey] = dict.fromkeys(shape_types, 0)
+                entry.update({'shapes': 0, 'flat': 0, 'vertices': 0, 'histogram': {}})
+            for element, value in elements.items():
+                entry[element] += value
+            entry['shapes'] += nshapes
+            entry['flat'] += count * nshapes
+            entry['vertices'] += npoints
+            for hbin, value in histogram.items():
+                entry['histogram'][hbin] = entry['histogram'].get(hbin, 0) + value
+        stats = dict(counts)
+        stats['depth'] = depth[name]
+        stats['placements'] = count
+        stats['children'] = cell['children']
+        stats['layers'] = celllayers
+        cellstats[name] = stats
+
+    def layer_order(key):
+        layer, dtype = key.split('/')
+        return (int(layer) if layer != 'None' else -1, int(dtype))
+
+    sortedlayers = {}
+    for key in sorted(layers, key=layer_order):
+        entry = layers[key]
+        entry['histogram'] = dict((str(hbin), entry['histogram'][hbin])
+			for hbin in sorted(entry['histogram']))
+        sortedlayers[key] = entry
+
+    return {'library': libname,
+	    'cells': len(cells),
+	    'top': top,
+	    'missing': sorted(missing),
+	    'duplicates': duplicates,
+	    'depth': max((depth[name] for name in top), default=0),
+	    'totals': totals,
+	    'flat': flat,
+	    'layers': sortedlayers,
+	    'cellstats': cellstats,
+	    'tree': hierarchy_tree(cells, top)}
+
+#----------------------------------------------------------------------------
+# Return the hierarchy of "cells" under the cells "top" as a list of nested
+# nodes (see above).
+#----------------------------------------------------------------------------
+
+def hierarchy_tree(cells, top):
+    expanded = set()
+    tree = []
+    for name in top:
+        root = {'cell': name, 'count': 1}
+        tree.append(root)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            cellname = node['cell']
+            if cellname in expanded or cellname not in cells:
+                continue
+            expanded.add(cellname)
+            children = cells[cellname]['children']
+            if children:
+                node['children'] = list({'cell': child, 'count': ninst}
+			for child, ninst in children.items())
+                stack.extend(reversed(node['children']))
+    return tree
+
+#----------------------------------------------------------------------------
+# Return the statistics of GDS file "filepath".
+#----------------------------------------------------------------------------
+
+def file_stats(filepath):
+    with gds_stream.GDSFile(filepath) as gds:
+        stats = gds_stats(gds.data)
+    stats = dict([('file', filepath), ('size', os.path.getsize(filepath))] +
+		list(stats.items()))
+    return stats
+
+# Same as file_stats(), for use in a worker process.  An error reading the
+# file is returned as {"file": <filepath>, "error": <message>}.
+
+def file_stats_task(filepath):
+    try:
+        return file_stats(filepath)
+    except (OSError, gds_stream.GDSError, UnicodeDecodeError) as e:
+        return {'file': filepath, 'error': str(e)}
+
+#----------------------------------------------------------------------------
+# Return the list of statistics of the GDS files "filelist", with "jobs"
+# files read in parallel.
+#----------------------------------------------------------------------------
+
+def files_stats(filelist, jobs=1):
+    if jobs == 1 or len(filelist) < 2:
+        return list(file_stats_task(filepath) for filepath in filelist)
+
+    sys.stdout.flush()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(min(jobs, len(filelist))) as pool:
+        return pool.map(file_stats_task, filelist, chunksize=1)
+
+#----------------------------------------------------------------------------
+# Return a one-line summary of the statistics "stats" of a file.
+#----------------------------------------------------------------------------
+
+def summary(stats):
+    if 'error' in stats:
+        return stats['file'] + ':  Error:  ' + stats['error']
+    totals = stats['totals']
+    shapes = sum(totals[element] for element in shape_types)
+    return (stats['file'] + ':  ' + str(stats['cells']) + ' cells, ' +
+		str(len(stats['top'])) + ' top, depth ' + str(stats['depth']) + ', ' +
+		str(len(stats['layers'])) + ' layers, ' + str(shapes) + ' shapes (' +
+		str(stats['flat']['shapes']) + ' flat), ' + str(totals['instances']) +
+		' instances')
+
+#----------------------------------------------------------------------------
+# Return a one-line summary of the statistics "statslist" of the GDS files
+# of library "libname".
+#----------------------------------------------------------------------------
+
+def library_summary(libname, statslist):
+    cells = 0
+    shapes = 0
+    flatshapes = 0
+    depth = 0
+    errors = 0
+    for stats in statslist:
+        if 'error' in stats:
+            errors += 1
+            continue
+        cells += stats['cells']
+        shapes += sum(stats['totals'][element] for element in shape_types)
+        flatshapes += stats['flat']['shapes']
+        depth = max(depth, stats['depth'])
+    line = ('GDS statistics for ' + libname + ':  ' + str(len(statslist)) + ' files, ' +
+		str(cells) + ' cells, depth ' + str(depth) + ', ' + str(shapes) +
+		' shapes (' + str(flatshapes) + ' flat)')
+    if errors > 0:
+        line += ', ' + str(errors) + ' files could not be read'
+    return line
+
+if __name__ == '__main__':
+
+    if len(sys.argv) == 1:
+        print("No options given to gds_stats.py.")
+        usage()
+        sys.exit(0)
+
+    optionlist = []
+    arguments = []
+
+    for option in sys.argv[1:]:
+        if option.find('-', 0) == 0:
+            optionlist.append(option)
+        else:
+            arguments.append(option)
+
+    jobs = 1
+    do_summary = False
+    outfile = None
+    for option in optionlist:
+        opval = option.split('=')
+        if opval[0] == '-summary':
+            do_summary = True
+        elif opval[0] == '-jobs' and len(opval) == 2:
+            jobs = max(1, int(opval[1]))
+        elif opval[0] == '-output' and len(opval) == 2:
+            outfile = opval[1]
+        else:
+            print('Unknown option ' + option)
+            usage()
+            sys.exit(1)
+
+    filelist = gds_dates.find_gds_files(arguments)
+
+    if len(filelist) == 0:
+        print("No GDS files given to gds_stats.py.")
+        usage()
+        sys.exit(0)
+
+    results = files_stats(filelist, jobs)
+    errors = sum(1 for stats in results if 'error' in stats)
+
+    ofile = open(outfile, 'w') if outfile else sys.stdout
+    if do_summary:
+        for stats in results:
+            print(summary(stats), file=ofile)
+    elif len(results) == 1:
+        json.dump(results[0], ofile, indent=1)
+        print('', file=ofile)
+    else:
+        json.dump(dict((stats['file'], stats) for stats in results), ofile, indent=1)
+        print('', file=ofile)
+    if outfile:
+        ofile.close()
+
+    sys.exit(1 if errors > 0 else 0)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+#
+# gds_stream.py
+#
+#----------------------------------------------------------------------------
+# Reading GDSII stream files, shared by the GDS scripts (change_gds_cell.py,
+# change_gds_string.py, change_gds_date.py, find_gds_prefix.py,
+# get_gds_date.py, and the GDS filter scripts).
+#
+# A GDS file is a sequence of records.  Each record starts with a 4-byte
+# header:  The record length (2 bytes, big-endian, including the header),
+# the record type (1 byte), and the data type (1 byte).  Structures (cells)
+# start with a BGNSTR record, followed by the STRNAME record with the
+# structure name, and end with an ENDSTR record.
+#
+# Files are memory-mapped, not read, and records are returned as offsets
+# into the mapped data, so that large GDS files are not copied into memory
+# to be parsed.  Compressed (gzip) files cannot be mapped, and are
+# decompressed into memory when opened.
+#
+# Typical use:
+#
+#    with gds_stream.GDSFile(filename) as gds:
+#        for offset, reclen, rectype, datatype in gds_stream.records(gds.data):
+#            body = gds.data[offset + 4:offset + reclen]
+#----------------------------------------------------------------------------
+
+import os
+import gzip
+import mmap
+import shutil
+import struct
+import datetime
+import collections
+
+# Record types
+HEADER = 0
+BGNLIB = 1
+LIBNAME = 2
+UNITS = 3
+ENDLIB = 4
+BGNSTR = 5
+STRNAME = 6
+ENDSTR = 7
+BOUNDARY = 8
+PATH = 9
+SREF = 10
+AREF = 11
+TEXT = 12
+LAYER = 13
+DATATYPE = 14
+WIDTH = 15
+XY = 16
+ENDEL = 17
+SNAME = 18
+COLROW = 19
+NODE = 21
+TEXTTYPE = 22
+PRESENTATION = 23
+STRING = 25
+STRANS = 26
+MAG = 27
+ANGLE = 28
+PATHTYPE = 33
+PROPATTR = 43
+PROPVALUE = 44
+BOX = 45
+BOXTYPE = 46
+
+# Data types
+NODATA = 0
+BITARRAY = 1
+INT2 = 2
+INT4 = 3
+REAL4 = 4
+REAL8 = 5
+ASCII = 6
+
+header = struct.Struct('>HBB')
+timestamp = struct.Struct('>6H')
+
+# A structure found by structures():  The structure name, the offset of
+# its BGNSTR record, the offset of its STRNAME record, and the offset just
+# past its ENDSTR record.
+Structure = collections.namedtuple('Structure', ['name', 'start', 'nameoffset', 'end'])
+
+class GDSError(Exception):
+    pass
+
+#----------------------------------------------------------------------------
+# Return True if the file "filepath" is compressed with gzip.
+#----------------------------------------------------------------------------
+
+def is_gzip(filepath):
+    with open(filepath, 'rb') as ifile:
+        return ifile.read(2) == b'\x1f\x8b'
+
+#----------------------------------------------------------------------------
+# An open GDS file.  "data" is a memoryview of the file contents, and
+# "buffer" is the underlying mmap (or bytes, for a compressed or empty
+# file), which can be searched with find().  If "writable" is True, then
+# changes made to "data" are written to the file (not possible for a
+# compressed file).
+#----------------------------------------------------------------------------
+
+class GDSFile(object):
+
+    def __init__(self, filepath, writable=False):
+        self.filepath = filepath
+        self.mmap = None
+        self.compressed = is_gzip(filepath)
+        if self.compressed:
+            if writable:
+                raise GDSError('Cannot modify compressed file ' + filepath + ' in place')
+            with gzip.open(filepath, 'rb') as ifile:
+                self.buffer = ifile.read()
+        else:
+            with open(filepath, 'r+b' if writable else 'rb') as ifile:
+                if os.fstat(ifile.fileno()).st_size == 0:
+                    self.buffer = b''
+                else:
+                    access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+                    self.mmap = mmap.mmap(ifile.fileno(), 0, access=access)
+                    self.buffer = self.mmap
+        self.data = memoryview(self.buffer)
+
+    def close(self):
+        self.data.release()
+        if self.mmap:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # Slices of "data" are still in use;  the mapping is
+                # closed when they are released.
+                pass
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#----------------------------------------------------------------------------
+# Return the error for a record at "offset" with invalid length "reclen".
+#----------------------------------------------------------------------------
+
+def record_error(reclen, offset):
+    if reclen == 0:
+        return GDSError('found zero-length record at position ' + str(offset))
+    return GDSError('found bad record length ' + str(reclen) + ' at position ' + str(offset))
+
+#----------------------------------------------------------------------------
+# Iterate over the records in "data" (bytes, mmap, or memoryview) from
+# offset "start" to "end", yielding (offset, reclen, rectype, datatype) for
+# each record.  Iteration stops after the ENDLIB record, so that padding at
+# the end of the file is not read as records.  Raises GDSError on a record
+# with an invalid length.
+#----------------------------------------------------------------------------
+
+def records(data, start=0, end=None):
+    if end is None:
+        end = len(data)
+    unpack = header.unpack_from
+    offset = start
+    while offset + 4 <= end:
+        reclen, rectype, datatype = unpack(data, offset)
+        if reclen < 4 or offset + reclen > end:
+            raise record_error(reclen, offset)
+        yield (offset, reclen, rectype, datatype)
+        if rectype == ENDLIB:
+            return
+        offset += reclen
+
+#----------------------------------------------------------------------------
+# Return the string value of a record body (data following the header).
+# Odd-length strings are padded with a null byte, which is removed.
+#----------------------------------------------------------------------------
+
+def string_value(body):
+    bstring = bytes(body)
+    if bstring and bstring[-1] == 0:
+        bstring = bstring[:-1]
+    return bstring.decode('ascii')
+
+#----------------------------------------------------------------------------
+# Return the string value of the record at "offset" in "data".
+#----------------------------------------------------------------------------
+
+def record_string(data, offset, reclen):
+    return string_value(data[offset + 4:offset + reclen])
+
+#----------------------------------------------------------------------------
+# Return a string record of type "rectype" with the string "value".
+#----------------------------------------------------------------------------
+
+def string_record(rectype, value):
+    bstring = value.encode('ascii')
+    if len(bstring) % 2 != 0:
+        bstring += b'\x00'
+    return header.pack(len(bstring) + 4, rectype, ASCII) + bstring
+
+#----------------------------------------------------------------------------
+# Return a dictionary of the library header records in "data" (the records
+# before the first structure), keyed by record type, where each entry is
+# the record (a slice of "data").
+#----------------------------------------------------------------------------
+
+def library_header(data):
+    libheader = {}
+    for offset, reclen, rectype, datatype in records(data):
+        if rectype in [BGNSTR, ENDLIB]:
+            break
+        libheader[rectype] = data[offset:offset + reclen]
+    return libheader
+
+#----------------------------------------------------------------------------
+# Iterate over the structures in "data", yielding a Structure for each.
+#----------------------------------------------------------------------------
+
+def structures(data, start=0, end=None):
+    if end is None:
+        end = len(data)
+    # This is records() with the loop written out, as it is the inner loop
+    # of most GDS scripts.
+    unpack = header.unpack_from
+    offset = start
+    strstart = None
+    name = None
+    while offset + 4 <= end:
+        reclen, rectype, datatype = unpack(data, offset)
+        if reclen < 4 or offset + reclen > end:
+            raise record_error(reclen, offset)
+        if rectype == BGNSTR:
+            strstart = offset
+            name = None
+        elif rectype == STRNAME and name is None:
+            if datatype != ASCII:
+                raise GDSError('Structure name record is not a string!')
+            name = record_string(data, offset, reclen)
+            nameoffset = offset
+        elif rectype == ENDSTR:
+            if strstart is not None and name is not None:
+                yield Structure(name, strstart, nameoffset, offset + reclen)
+            strstart = None
+            name = None
+        elif rectype == ENDLIB:
+            return
+        offset += reclen
+
+#----------------------------------------------------------------------------
+# Convert a time to the 12-byte form used in BGNLIB and BGNSTR records
+# (year since 1900, month, day, hour, minute, second).  The time "stamp"
+# may be an integer (seconds since the epoch) or a string in the form
+# "MM/DD/YYYY HH:MM:SS".
+#----------------------------------------------------------------------------
+
+def make_timestamp(stamp):
+    try:
+        stime = datetime.datetime.fromtimestamp(int(stamp))
+    except ValueError:
+        stime = datetime.datetime.strptime(stamp, "%m/%d/%Y %H:%M:%S")
+    return timestamp.pack(stime.year - 1900, stime.month, stime.day,
+		stime.hour, stime.minute, stime.second)
+
+#----------------------------------------------------------------------------
+# Return the time at "offset" in "data" (12 bytes, as in BGNLIB and BGNSTR
+# records) as a tuple (year, month, day, hour, minute, second).
+#----------------------------------------------------------------------------
+
+def read_timestamp(data, offset):
+    year, month, day, hour, minute, second = timestamp.unpack_from(data, offset)
+    return (year + 1900, month, day, hour, minute, second)
+
+#----------------------------------------------------------------------------
+# Return the 8-byte real number at "offset" in "data".  GDS reals are not
+# IEEE format:  The first byte is the sign bit and a base-16 exponent in
+# excess-64 notation, and the remaining 7 bytes are the mantissa.
+#----------------------------------------------------------------------------
+
+def read_real8(data, offset):
+    value = int.from_bytes(data[offset:offset + 8], 'big')
+    mantissa = (value & 0x00ffffffffffffff) / (1 << 56)
+    exponent = ((value >> 56) & 0x7f) - 64
+    if value >> 63:
+        mantissa = -mantissa
+    return mantissa * (16.0 ** exponent)
+
+#----------------------------------------------------------------------------
+# Find every occurrence of each byte string in "replacements" (a dictionary
+# of byte strings to replacement byte strings) in "buffer" (bytes or mmap).
+# Returns the list of pieces of the modified data, which are slices of
+# "data" (a memoryview of "buffer") and replacement strings, and the number
+# of replacements made.  Where occurrences overlap, the first one found
+# in the data is replaced.
+#----------------------------------------------------------------------------
+
+def replace_bytes(buffer, data, replacements):
+    found = []
+    for search, replace in replacements.items():
+        offset = buffer.find(search)
+        while offset >= 0:
+            found.append((offset, len(search), replace))
+            offset = buffer.find(search, offset + len(search))
+    found.sort(key=lambda item: item[0])
+
+    chunks = []
+    count = 0
+    dataptr = 0
+    for offset, length, replace in found:
+        if offset < dataptr:
+            continue
+        chunks.append(data[dataptr:offset])
+        chunks.append(replace)
+        dataptr = offset + length
+        count += 1
+    chunks.append(data[dataptr:])
+    return chunks, count
+
+#----------------------------------------------------------------------------
+# Write the list of pieces "chunks" (bytes or memoryview) to the GDS file
+# "filepath", compressed if the name ends in ".gz".  The data is written
+# under a temporary name and renamed, so that "filepath" may be the file
+# the data was read from (and is still mapped).  If "filepath" is a
+# symbolic link, then the file it points to is written.
+#----------------------------------------------------------------------------
+
+def write_gds(filepath, chunks):
+    filepath = os.path.realpath(filepath)
+    tmppath = os.path.join(os.path.dirname(filepath),
+		'.' + os.path.basename(filepath) + '.' + str(os.getpid()) + '.tmp')
+    try:
+        if filepath.endswith('.gz'):
+            ofile = gzip.open(tmppath, 'wb')
+        else:
+            ofile = open(tmppath, 'wb')
+        with ofile:
+            for chunk in chunks:
+                ofile.write(chunk)
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmppath)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
@@ -3,7 +3,8 @@
 
 import os
 import sys
-import datetime
+
+import gds_stream
 
 def usage():
     print('get_gds_date.py <path_to_gds_in> [-created | -modified]')
@@ -45,28 +46,16 @@ if __name__ == '__main__':
     sourcedir = os.path.split(source)[0]
     gdsinfile = os.path.split(source)[1]
 
-    with open(source, 'rb') as ifile:
-        gdsdata = ifile.read()
-
-    datalen = len(gdsdata)
-    dataptr = 0
-    while dataptr < datalen:
-        # Read stream records up to any string, then search for search text.
-        bheader = gdsdata[dataptr:dataptr + 2]
-        reclen = int.from_bytes(bheader, 'big')
-        if reclen == 0:
-            print('Error: found zero-length record at position ' + str(dataptr))
-            break
-
-        rectype = gdsdata[dataptr + 2]
-        datatype = gdsdata[dataptr + 3]
+    gds = gds_stream.GDSFile(source)
+    gdsdata = gds.data
 
-        brectype = rectype.to_bytes(1, byteorder='big')
-        bdatatype = datatype.to_bytes(1, byteorder='big')
+    try:
+        for offset, reclen, rectype, datatype in gds_stream.records(gdsdata):
+            if rectype != gds_stream.BGNLIB:
+                continue
 
-        if rectype == 1:		# 1 = beginlib
             # Datatype should be 2
-            if datatype != 2:
+            if datatype != gds_stream.INT2:
                 print('Error:  Header data type is not 2-byte integer!')
             if reclen != 28:
                 print('Error:  Header record length is not 28!')
@@ -74,43 +63,16 @@ if __name__ == '__main__':
                 print('Record type = ' + str(rectype) + ' data type = ' + str(datatype) + ' length = ' + str(reclen))
 
             if created: 
-                crec1 = gdsdata[dataptr + 4:dataptr + 6]
-                crec2 = gdsdata[dataptr + 6:dataptr + 8]
-                crec3 = gdsdata[dataptr + 8:dataptr + 10]
-                crec4 = gdsdata[dataptr + 10:dataptr + 12]
-                crec5 = gdsdata[dataptr + 12:dataptr + 14]
-                crec6 = gdsdata[dataptr + 14:dataptr + 16]
-
-                modyear = int.from_bytes(crec1, 'big')
-                year = modyear + 1900
-                month = int.from_bytes(crec2, 'big')
-                day = int.from_bytes(crec3, 'big')
-                hour = int.from_bytes(crec4, 'big')
-                minute = int.from_bytes(crec5, 'big')
-                second = int.from_bytes(crec6, 'big')
-
+                year, month, day, hour, minute, second = gds_stream.read_timestamp(gdsdata, offset + 4)
                 print('Created date: {}-{}-{}-{}-{}-{}'.format(year, month, day, hour, minute, second))
 
             if modified:
-                mrec1 = gdsdata[dataptr + 16:dataptr + 18]
-                mrec2 = gdsdata[dataptr + 18:dataptr + 20]
-                mrec3 = gdsdata[dataptr + 20:dataptr + 22]
-                mrec4 = gdsdata[dataptr + 22:dataptr + 24]
-                mrec5 = gdsdata[dataptr + 24:dataptr + 26]
-                mrec6 = gdsdata[dataptr + 26:dataptr + 28]
-
-                modyear = int.from_bytes(mrec1, 'big')
-                year = modyear + 1900
-                month = int.from_bytes(mrec2, 'big')
-                day = int.from_bytes(mrec3, 'big')
-                hour = int.from_bytes(mrec4, 'big')
-                minute = int.from_bytes(mrec5, 'big')
-                second = int.from_bytes(mrec6, 'big')
-
+                year, month, day, hour, minute, second = gds_stream.read_timestamp(gdsdata, offset + 16)
                 print('Modified date: {}-{}-{}-{}-{}-{}'.format(year, month, day, hour, minute, second))
             break
+    except gds_stream.GDSError as e:
+        print('Error: ' + str(e))
 
-        # Advance the pointer past the data
-        dataptr += reclen
+    gds.close()
 
     exit(0)
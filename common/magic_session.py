@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+#
+# magic_session.py
+#
+#----------------------------------------------------------------------------
+# Manage long-lived magic processes for the install and checking scripts.
+#
+# Starting magic and loading a PDK technology (tech file, device generator
+# script, etc.) takes a noticeable amount of time, and the scripts run magic
+# in batch mode many times.  This module keeps a pool of magic processes for
+# each startup (.magicrc) file and set of command-line options.  Each
+# process is started with "magic -dnull -noconsole", reads the startup file
+# once, and then runs any number of Tcl scripts sent to it on its standard
+# input.
+#
+# The end of each script is detected by a sentinel marker, which is written
+# to both standard output and standard error after the script has run, so
+# that all output of the script (and only that output) has been read when
+# the script is done.  A "quit" command in a script does not end the
+# process;  it is ignored, as scripts here always end with it.
+#
+# Between scripts, the process is returned to the state that it had after
+# reading the startup file:  All cells are deleted (leaving an empty
+# "(UNNAMED)" cell), global Tcl variables set by the script are removed, and
+# the GDS, LEF, CIF, snap, extract, and ext2spice settings are restored.  A
+# process is not reused (it is shut down, and replaced if processes were
+# started with prestart()) if:
+#
+#   - a Tcl error was raised while running the script;
+#   - the process exited (for example, on "exit" or a crash);
+#   - the script used a command whose effect cannot be undone (scalegrid,
+#     "tech load", or a "cif *..." output option);  or
+#   - it has run "maxuses" scripts, to bound its memory use.
+#
+# Each process is started in a private temporary directory containing a
+# ".magicrc" link to the startup file (so startup is identical to running
+# magic in a directory with that .magicrc), and changes directory to the
+# requested working directory before running each script.
+#
+# This module is also installed next to the sky130 checking scripts (e.g.,
+# check_density.py), so it must not import anything else from common/.
+#----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+import multiprocessing.util
+
+sentinel = '@@magic_session_done@@'
+
+#----------------------------------------------------------------------------
+# Tcl commands sent to each new magic process after it starts, to save the
+# state to restore between scripts and to define the procedures used to
+# start and end each script.
+#----------------------------------------------------------------------------
+
+session_init = r'''
+namespace eval magic_session {
+    variable dirty 0
+    variable globals [info globals]
+    variable settings {}
+    foreach {query restore} {
+	{gds readonly} {gds readonly}
+	{gds flatten} {gds flatten}
+	{gds rescale} {gds rescale}
+	{gds drccheck} {gds drccheck}
+	{gds library} {gds library}
+	{gds polygon subcell} {gds polygon subcell}
+	{gds datestamp} {gds datestamp}
+	{lef datestamp} {lef datestamp}
+	{cif list ostyle} {cif ostyle}
+	{cif list istyle} {cif istyle}
+	{extract list style} {extract style}
+	{snap list} {snap}
+    } {
+	if {![catch {eval $query} value]} {
+	    lappend settings $restore $value
+	}
+    }
+}
+
+proc magic_session::wrap {cmd test} {
+    if {[info commands ::$cmd] eq {}} {return}
+    rename ::$cmd ::magic_session::orig_$cmd
+    proc ::$cmd {args} [string map [list %CMD% $cmd %TEST% $test] {
+	if {%TEST%} {set ::magic_session::dirty 1}
+	uplevel 1 [linsert $args 0 ::magic_session::orig_%CMD%]
+    }]
+}
+
+magic_session::wrap scalegrid 1
+magic_session::wrap tech {[lindex $args 0] eq "load"}
+magic_session::wrap cif {[string index [lindex $args 0] 0] eq "*"}
+
+if {[info commands ::quit] ne {}} {
+    rename ::quit ::magic_session::quit
+}
+proc ::quit {args} {}
+
+proc magic_session::reset {} {
+    variable globals
+    variable settings
+    foreach name [info globals] {
+	if {[lsearch -exact $globals $name] < 0} {
+	    catch {uplevel #0 [list unset $name]}
+	}
+    }
+    catch {load magic_session_blank}
+    foreach cell [cellname list allcells] {
+	if {$cell ne "magic_session_blank"} {
+	    catch {cellname delete $cell -noprompt}
+	}
+    }
+    catch {load}
+    catch {cellname delete magic_session_blank -noprompt}
+    foreach {restore value} $settings {
+	catch {eval $restore [list $value]}
+    }
+    catch {ext2spice default}
+}
+
+proc magic_session::begin {reset} {
+    variable dirty
+    if {$reset} {reset}
+    set dirty 0
+    set ::errorInfo {}
+}
+
+proc magic_session::done {marker} {
+    variable dirty
+    set failed [expr {$::errorInfo ne {}}]
+    puts stderr $marker
+    flush stderr
+    puts stdout "$marker $failed $dirty"
+    flush stdout
+}
+'''
+
+#----------------------------------------------------------------------------
+# Quote a string for use as a single Tcl word.
+#----------------------------------------------------------------------------
+
+def tcl_quote(value):
+    return '{' + value + '}'
+
+#----------------------------------------------------------------------------
+# A single magic process.
+#----------------------------------------------------------------------------
+
+class MagicSession(object):
+
+    def __init__(self, rcfile=None, options=[], env=None):
+        self.rcfile = rcfile
+        self.options = list(options)
+        self.count = 0
+        self.failed = False
+        self.reusable = True
+        self.rundir = tempfile.mkdtemp(prefix='magic_session_')
+        if rcfile:
+            os.symlink(os.path.abspath(rcfile), self.rundir + '/.magicrc')
+
+        self.proc = subprocess.Popen(
+		['magic', '-dnull', '-noconsole'] + self.options,
+		stdin = subprocess.PIPE,
+		stdout = subprocess.PIPE,
+		stderr = subprocess.PIPE,
+		universal_newlines = True,
+		cwd = self.rundir,
+		env = env)
+
+        # Collect stderr in the background so that the process never
+        # blocks on a full stderr pipe.  "errdone" is the last sentinel
+        # marker seen on stderr.
+        self.errlines = []
+        self.errfunc = None
+        self.errdone = None
+        self.erreof = False
+        self.errcond = threading.Condition()
+        self.errthread = threading.Thread(target=self._read_stderr, daemon=True)
+        self.errthread.start()
+
+        self._write_stdin(session_init)
+
+    def _error_line(self, line):
+        if self.errfunc:
+            self.errfunc(line)
+        else:
+            self.errlines.append(line)
+
+    def _read_stderr(self):
+        for line in self.proc.stderr:
+            line = line.rstrip('\n')
+            index = line.find(sentinel)
+            with self.errcond:
+                if index < 0:
+                    self._error_line(line)
+                    continue
+                if index > 0:
+                    self._error_line(line[0:index])
+                self.errdone = line[index:]
+                self.errcond.notify_all()
+        with self.errcond:
+            self.erreof = True
+            self.errcond.notify_all()
+
+    def _take_stderr(self):
+        errlines = self.errlines
+        self.errlines = []
+        return errlines
+
+    def _write_stdin(self, text):
+        try:
+            self.proc.stdin.write(text)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            pass
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    # Run a complete Tcl script on this process in directory "cwd", and
+    # wait for the sentinel that marks its end.  Returns (returncode,
+    # stdout lines, stderr lines).  The return code is 0 if the script ran
+    # to the end, or the exit status of magic if the process exited.  If
+    # "outfunc" and "errfunc" are given, then each line of output is passed
+    # to them as it is produced instead of being returned.  If "reset" is
+    # False, then the script continues from the state left by the previous
+    # script instead of the state after startup.
+    #
+    # Afterward, self.failed is True if any script run on the process has
+    # raised a Tcl error or if the process has exited, and self.reusable is
+    # False if the process should not be given to another user.
+
+    def run_script(self, script, cwd=None, outfunc=None, errfunc=None,
+		reset=True):
+        self.count += 1
+        marker = sentinel + str(self.count) + '@@'
+
+        with self.errcond:
+            # Any stderr output from the startup file that has already been
+            # read is passed on first.
+            if errfunc:
+                for line in self._take_stderr():
+                    errfunc(line)
+            self.errfunc = errfunc
+
+        text = 'magic_session::begin ' + ('1' if reset and self.count > 1 else '0') + '\n'
+        if cwd:
+            text += 'cd ' + tcl_quote(os.path.abspath(cwd)) + '\n'
+        text += script
+        if not script.endswith('\n'):
+            text += '\n'
+        text += 'magic_session::done ' + marker + '\n'
+
+        # The script is written from another thread while the output is
+        # read here, so that neither process blocks on a full pipe.
+        writer = threading.Thread(target=self._write_stdin, args=(text,), daemon=True)
+        writer.start()
+
+        outlines = []
+        finished = False
+        for line in self.proc.stdout:
+            line = line.rstrip('\n')
+            index = line.find(marker)
+            if index >= 0:
+                line, status = line[0:index], line[index + len(marker):].split()
+                if status[0:1] != ['0']:
+                    self.failed = True
+                if self.failed or status[1:2] != ['0']:
+                    self.reusable = False
+                finished = True
+            if line or not finished:
+                if outfunc:
+                    outfunc(line)
+                else:
+                    outlines.append(line)
+            if finished:
+                break
+
+        if finished:
+            returncode = 0
+            with self.errcond:
+                self.errcond.wait_for(lambda: self.errdone == marker or self.erreof)
+        else:
+            # The process exited before the end of the script.
+            self.failed = True
+            self.reusable = False
+            returncode = self.proc.wait()
+            self.errthread.join()
+        writer.join()
+
+        with self.errcond:
+            self.errfunc = None
+            errlines = self._take_stderr()
+        return (returncode, outlines, errlines)
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.write('magic_session::quit -noprompt\n')
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError, ValueError):
+                pass
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        shutil.rmtree(self.rundir, ignore_errors=True)
+
+#----------------------------------------------------------------------------
+# A pool of magic processes, keyed by startup file and magic options.
+# "size" is the number of idle processes kept for each key, and a process is
+# retired after running "maxuses" scripts.  "env" is the environment for
+# the magic processes (by default, that of this process).  The pool may be
+# used from several threads at once.  Idle processes are shut down when the
+# python process exits.
+#----------------------------------------------------------------------------
+
+class MagicPool(object):
+
+    def __init__(self, size=1, maxuses=50, env=None):
+        self.size = size
+        self.maxuses = maxuses
+        self.env = env
+        self.idle = {}
+        self.wanted = set()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def _key(self, rcfile, options):
+        if rcfile:
+            rcfile = os.path.realpath(rcfile)
+        return (rcfile, tuple(options))
+
+    def _start(self, key):
+        session = MagicSession(key[0], key[1], self.env)
+        session.key = key
+        return session
+
+    # Start idle processes for the given startup file so that they are
+    # ready (with the technology loaded) when needed, and start a new one
+    # whenever one is retired.
+
+    def prestart(self, rcfile, options=[]):
+        key = self._key(rcfile, options)
+        with self.lock:
+            self.wanted.add(key)
+            sessions = self.idle.setdefault(key, [])
+            sessions[:] = list(session for session in sessions if session.alive())
+            while len(sessions) < self.size:
+                sessions.append(self._start(key))
+
+    def acquire(self, rcfile, options=[]):
+        key = self._key(rcfile, options)
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            while sessions:
+                session = sessions.pop(0)
+                if session.alive():
+                    return session
+                session.close()
+        return self._start(key)
+
+    # Return a process to the pool after use, or shut it down if it can not
+    # be reused or if enough processes are already idle.
+
+    def release(self, session):
+        key = session.key
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            if (session.reusable and session.alive() and
+			session.count < self.maxuses and len(sessions) < self.size):
+                sessions.insert(0, session)
+                return
+        session.close()
+        if key in self.wanted:
+            self.prestart(key[0], key[1])
+
+    # Run a complete Tcl script (text) in directory "cwd" on a process from
+    # the pool.  Returns the same as MagicSession.run_script().
+
+    def run_script(self, script, cwd, rcfile, options=[], outfunc=None,
+		errfunc=None):
+        session = self.acquire(rcfile, options)
+        try:
+            return session.run_script(script, cwd, outfunc, errfunc)
+        finally:
+            self.release(session)
+
+    def close(self):
+        with self.lock:
+            for sessions in self.idle.values():
+                for session in sessions:
+                    session.close()
+            self.idle = {}
+
+#----------------------------------------------------------------------------
+# Return the pool for this process, keeping at least "size" idle processes
+# for each key.  A process forked from the one that created the pool (see
+# stage_scheduler.py) gets a new pool of its own and leaves the processes of
+# the parent's pool alone.
+#----------------------------------------------------------------------------
+
+default_pool = None
+
+def get_pool(size=1):
+    global default_pool
+    if not default_pool or default_pool.pid != os.getpid():
+        default_pool = MagicPool()
+    default_pool.size = max(default_pool.size, size)
+    return default_pool
@@ -3,13 +3,113 @@
 # split_gds.py --
 #
 # Script to read a GDS library and write into individual GDS files, one per cell
+#
+# Each file contains the cell and all of the cells under it in the hierarchy.
+# The files are written directly from the GDS data of the library, with the
+# cells in the order magic writes them (each cell after the cells it uses).
+# Option "-magic" does the same thing by running magic, which requires the
+# magic techfile argument.
 
 import os
 import sys
-import subprocess
+
+import gds_stream
+import gds_index
+import magic_session
 
 def usage():
-    print('split_gds.py <path_to_gds_library> <magic_techfile> [<file_with_list_of_cells>]')
+    print('split_gds.py <path_to_gds_library> [<magic_techfile>] <file_with_list_of_cells> [-magic]')
+
+#----------------------------------------------------------------------------
+# Return the data for a GDS file of cell "cellname", with the cells in
+# "cellorder" (from GDSIndex.closure()), as a list of pieces.  The library
+# header is copied from the source, with the library named after the cell.
+#----------------------------------------------------------------------------
+
+def cell_chunks(data, index, libheader, cellname, cellorder):
+    chunks = []
+    for rectype in [gds_stream.HEADER, gds_stream.BGNLIB]:
+        if rectype in libheader:
+            chunks.append(libheader[rectype])
+    chunks.append(gds_stream.string_record(gds_stream.LIBNAME, cellname))
+    if gds_stream.UNITS in libheader:
+        chunks.append(libheader[gds_stream.UNITS])
+    for name in cellorder:
+        entry = index.find(name)
+        chunks.append(data[entry.start:entry.end])
+    chunks.append(gds_stream.header.pack(4, gds_stream.ENDLIB, gds_stream.NODATA))
+    return chunks
+
+#----------------------------------------------------------------------------
+# Write each cell in "celllist" from GDS library "source" to file
+# <cellname>.gds in the same directory as the library.  Returns the
+# number of cells that could not be written.
+#----------------------------------------------------------------------------
+
+def split_gds(source, celllist):
+    destdir = os.path.split(source)[0]
+    errors = 0
+    with gds_stream.GDSFile(source) as gds:
+        data = gds.data
+        index = gds_index.GDSIndex(source, data, cache=False)
+        libheader = gds_stream.library_header(data)
+
+        for cellname in celllist:
+            cellorder, missing = index.closure(cellname)
+            if cellname in missing:
+                print('Error:  Cell ' + cellname + ' is not in ' + source)
+                errors += 1
+                continue
+            for name in missing:
+                print('Warning:  Cell ' + name + ' used by ' + cellname +
+			' is not in ' + source)
+            print('Writing cell ' + cellname + ' (' + str(len(cellorder)) + ' cells)')
+            gds_stream.write_gds(os.path.join(destdir, cellname + '.gds'),
+			cell_chunks(data, index, libheader, cellname, cellorder))
+    return errors
+
+#----------------------------------------------------------------------------
+# Same as split_gds(), but run magic to read the library and write the cells.
+#----------------------------------------------------------------------------
+
+def split_gds_magic(source, techfile, celllist):
+    destdir = os.path.split(source)[0]
+    gdsfile = os.path.split(source)[1]
+
+    with open(destdir + '/split_gds.tcl', 'w') as ofile:
+        print('#!/usr/bin/env wish', file=ofile)
+        print('drc off', file=ofile)
+        print('crashbackups stop', file=ofile)
+        print('locking off', file=ofile)
+        print('gds readonly true', file=ofile)
+        print('gds rescale false', file=ofile)
+        print('tech unlock *', file=ofile)
+        print('gds read ' + gdsfile, file=ofile)
+
+        for cell in celllist:
+            print('load ' + cell, file=ofile)
+            print('gds write ' + cell, file=ofile)
+
+        print('quit -noprompt', file=ofile)
+
+    # Magic reads the .magicrc file in the library directory, if there is
+    # one, the same as if it were started there.
+    rcfile = destdir + '/.magicrc'
+    if not os.path.isfile(rcfile):
+        rcfile = None
+    returncode, outlines, errlines = magic_session.get_pool().run_script(
+		'source ' + magic_session.tcl_quote(destdir + '/split_gds.tcl'),
+		destdir, rcfile, ['-T', techfile])
+    for line in outlines:
+        print(line)
+    if errlines:
+        print('Error message output from magic:')
+        for line in errlines:
+            print(line)
+        if returncode != 0:
+            print('ERROR:  Magic exited with status ' + str(returncode))
+
+    os.remove(destdir + '/split_gds.tcl')
 
 if __name__ == '__main__':
 
@@ -27,6 +127,11 @@ if __name__ == '__main__':
         else:
             arguments.append(option)
 
+    use_magic = '-magic' in optionlist
+
+    if len(arguments) == 2 and not use_magic:
+        arguments = [arguments[0], None, arguments[1]]
+
     if len(arguments) != 3:
         print("Wrong number of arguments given to split_gds.py.")
         usage()
@@ -36,46 +141,18 @@ if __name__ == '__main__':
 
     techfile = arguments[1]
 
+    # The list of cells is a file with one cell per line, or a comma-
+    # separated list of cell names.
     celllist = arguments[2]
     if os.path.isfile(celllist):
         with open(celllist, 'r') as ifile:
             celllist = ifile.read().splitlines()
-
-    destdir = os.path.split(source)[0]
-    gdsfile = os.path.split(source)[1]
-
-    with open(destdir + '/split_gds.tcl', 'w') as ofile:
-        print('#!/usr/bin/env wish', file=ofile)
-        print('drc off', file=ofile)
-        print('crashbackups stop', file=ofile)
-        print('locking off', file=ofile)
-        print('gds readonly true', file=ofile)
-        print('gds rescale false', file=ofile)
-        print('tech unlock *', file=ofile)
-        print('gds read ' + gdsfile, file=ofile)
-
-        for cell in celllist:
-            print('load ' + cell, file=ofile)
-            print('gds write ' + cell, file=ofile)
-
-        print('quit -noprompt', file=ofile)
-
-    mproc = subprocess.run(['magic', '-dnull', '-noconsole',
-		'-T', techfile,
-		destdir + '/split_gds.tcl'],
-		stdin = subprocess.DEVNULL,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.PIPE, cwd = destdir,
-		universal_newlines = True)
-    if mproc.stdout:
-        for line in mproc.stdout.splitlines():
-            print(line)
-    if mproc.stderr:
-        print('Error message output from magic:')
-        for line in mproc.stderr.splitlines():
-            print(line)
-        if mproc.returncode != 0:
-            print('ERROR:  Magic exited with status ' + str(mproc.returncode))
-
-    os.remove(destdir + '/split_gds.tcl')
+    else:
+        celllist = celllist.split(',')
+    celllist = list(cell.strip() for cell in celllist if cell.strip())
+
+    if use_magic:
+        split_gds_magic(source, techfile, celllist)
+    elif split_gds(source, celllist) > 0:
+        sys.exit(1)
     exit(0)
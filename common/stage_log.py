@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# stage_log.py
+#
+#----------------------------------------------------------------------------
+# Output handling for the commands run by foundry_install.py (magic,
+# cdl2spi, filter scripts, etc.).
+#
+# Output from a command is handled one line at a time as it is produced:
+# Each line is printed to the console (if requested) and written to a log
+# file for the command, and only the last few lines of standard output and
+# standard error are kept in memory for reporting errors.  When the command
+# exits, a record of the command with its wall-clock time, CPU time, and
+# peak memory use is appended to the file "summary.jsonl" in the log
+# directory, one JSON object per line:
+#
+#    {"name": "magic", "cmd": [...], "cwd": "...", "returncode": 0,
+#     "wall": <seconds>, "user": <seconds>, "sys": <seconds>,
+#     "maxrss": <kilobytes>, "log": "<log file name>", "pid": <pid>}
+#
+# Logging to files is enabled by calling set_logdir();  otherwise output is
+# only printed.
+#----------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import collections
+
+import stage_trace
+
+logdir = None
+
+#----------------------------------------------------------------------------
+# Set the directory for log files and the summary file.
+#----------------------------------------------------------------------------
+
+def set_logdir(dirname):
+    global logdir
+    logdir = dirname
+    if logdir:
+        os.makedirs(logdir, exist_ok=True)
+
+#----------------------------------------------------------------------------
+# Convert a status from os.wait4() into a return code in the same form as
+# subprocess.Popen.returncode.
+#----------------------------------------------------------------------------
+
+def exitcode(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    elif os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return status
+
+#----------------------------------------------------------------------------
+# Wait for the process "proc" (a subprocess.Popen) to exit and return its
+# resource usage.  This replaces proc.wait(), which does not give the usage.
+#----------------------------------------------------------------------------
+
+def wait_rusage(proc):
+    if proc.returncode is not None:
+        return None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            # Already collected elsewhere
+            proc.wait()
+            return None
+    proc.returncode = exitcode(status)
+    return rusage
+
+#----------------------------------------------------------------------------
+# Log for one command.  "cmd" is the command as a list, and "key" is any
+# additional text (e.g., the name of an input script) used to make a unique
+# log file name for the command.  If "echo" is False, then the output is
+# only logged (see replay()).
+#----------------------------------------------------------------------------
+
+class StageLog(object):
+
+    def __init__(self, name, cmd, cwd=None, key='', echo=True, tail=100):
+        self.name = name
+        self.cmd = list(cmd)
+        self.cwd = os.path.abspath(cwd or os.curdir)
+        self.echo = echo
+        self.outtail = collections.deque(maxlen=tail)
+        self.errtail = collections.deque(maxlen=tail)
+        self.have_errors = False
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+        self.logfile = None
+        self.logname = None
+        if logdir:
+            logkey = json.dumps([self.cmd, self.cwd, key])
+            digest = hashlib.sha1(logkey.encode('utf-8')).hexdigest()[0:12]
+            self.logname = logdir + '/' + os.path.split(name)[1] + '-' + digest + '.log'
+            self.logfile = open(self.logname, 'w')
+
+    # Handle one line of standard output
+
+    def output(self, line):
+        line = line.rstrip('\n')
+        with self.lock:
+            self.outtail.append(line)
+            if self.logfile:
+                print(line, file=self.logfile)
+            if self.echo:
+                print(line)
+                sys.stdout.flush()
+
+    # Handle one line of standard error
+
+    def error(self, line):
+        line = line.rstrip('\n')
+        with self.lock:
+            self.errtail.append(line)
+            header = not self.have_errors
+            self.have_errors = True
+            if self.logfile:
+                if header:
+                    print('Error message output from {} script:'.format(self.name),
+				file=self.logfile)
+                print(line, file=self.logfile)
+            if self.echo:
+                if header:
+                    print('Error message output from {} script:'.format(self.name))
+                print(line)
+                sys.stdout.flush()
+
+    # Close the log and record the command in the summary.  "rusage" is
+    # the resource usage of the command from os.wait4().
+
+    def finish(self, returncode, rusage=None):
+        self.returncode = returncode
+        if self.logfile:
+            self.logfile.close()
+            self.logfile = None
+        if not logdir and not stage_trace.tracefile:
+            return
+
+        record = {
+		'name': self.name,
+		'cmd': self.cmd,
+		'cwd': self.cwd,
+		'returncode': returncode,
+		'wall': round(time.monotonic() - self.start, 3),
+		'user': round(rusage.ru_utime, 3) if rusage else None,
+		'sys': round(rusage.ru_stime, 3) if rusage else None,
+		'maxrss': rusage.ru_maxrss if rusage else None,
+		'log': os.path.split(self.logname)[1] if self.logname else None,
+		'pid': os.getpid(),
+	}
+        # The same record goes to the build trace, if there is one.
+        stage_trace.record('command', self.name, **dict((key, value)
+		for key, value in record.items() if key != 'name'))
+        if not logdir:
+            return
+
+        # A single write in append mode, so that records from stages running
+        # in parallel do not get mixed together.
+        with open(logdir + '/summary.jsonl', 'a') as ofile:
+            ofile.write(json.dumps(record) + '\n')
+
+    # Print the log file (for commands run with echo = False).  If there is
+    # no log file, then only the saved tail of the output can be printed.
+
+    def replay(self):
+        sys.stdout.flush()
+        if self.logname and os.path.isfile(self.logname):
+            with open(self.logname, 'r') as ifile:
+                for line in ifile:
+                    sys.stdout.write(line)
+        else:
+            for line in self.outtail:
+                print(line)
+            if self.errtail:
+                print('Error message output from {} script:'.format(self.name))
+                for line in self.errtail:
+                    print(line)
+        sys.stdout.flush()
+
+    # Raise SystemError if the command failed, with the end of the output
+    # and (if given) the input script passed to the command.
+
+    def check(self, input_script=None):
+        if self.returncode == 0:
+            return
+        emsg = [
+            "Command {} failed with exit code: {}\n".format(
+                self.name, self.returncode),
+            "  " + " ".join(self.cmd),
+        ]
+        if self.logname:
+            emsg += ["\nFull output is in " + self.logname]
+        if self.errtail:
+            emsg += [
+                "\nLast lines of error output:\n",
+                '\n'.join(self.errtail), '\n',
+            ]
+        if input_script != None:
+            emsg += [
+                "\nInput script was:\n",
+                '-'*75,'\n',
+                input_script,'\n',
+                '-'*75,'\n',
+            ]
+        raise SystemError("".join(emsg))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#
+# stage_manifest.py
+#
+#----------------------------------------------------------------------------
+# Routines used by foundry_install.py to skip a staging step when nothing
+# has changed since the last time the same step was run.
+#
+# Each invocation of foundry_install.py (one "${STAGE}" call in the PDK
+# Makefile) writes a manifest file into the directory ".stage_manifest"
+# in the staging area.  The manifest file name is a hash of the options
+# passed to foundry_install.py, and the manifest contains:
+#
+#    version:  A hash of the install scripts, the python modules in the
+#	       directories of any filter scripts, and the magic version
+#    inputs:   The size, modification time, and content digest of every
+#	       source file read by the step, and of every file that earlier
+#	       steps have written into the staging directories of the step
+#    order:    The position of the step in the sequence of steps run
+#    outputs:  The size and modification time of every file in the
+#	       staging area that was written by the step
+#
+# If the version and the content digests of all inputs match, and all of
+# the outputs are still present and unmodified in the staging area, then
+# the step does not need to be run again.  Content digests of input files
+# whose size and modification time are unchanged are taken from the
+# previous manifest, so that unchanged vendor files are not read again.
+#----------------------------------------------------------------------------
+
+import os
+import glob
+import json
+import hashlib
+
+manifest_dirname = '.stage_manifest'
+
+#----------------------------------------------------------------------------
+# Return the content digest of a file.
+#----------------------------------------------------------------------------
+
+def file_digest(filepath):
+    hasher = hashlib.sha1()
+    with open(filepath, 'rb') as ifile:
+        while True:
+            block = ifile.read(1 << 20)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+#----------------------------------------------------------------------------
+# Return the name of the manifest file for the given options.
+#----------------------------------------------------------------------------
+
+def manifest_name(targetdir, options):
+    optkey = json.dumps(options)
+    optdigest = hashlib.sha1(optkey.encode('utf-8')).hexdigest()
+    return targetdir + '/' + manifest_dirname + '/' + optdigest + '.json'
+
+#----------------------------------------------------------------------------
+# Read a manifest file.  Return None if the file does not exist or cannot
+# be parsed.
+#----------------------------------------------------------------------------
+
+def read_manifest(manifestfile):
+    if not os.path.isfile(manifestfile):
+        return None
+    try:
+        with open(manifestfile, 'r') as ifile:
+            return json.load(ifile)
+    except (OSError, ValueError):
+        return None
+
+#----------------------------------------------------------------------------
+# Write a manifest file.
+#----------------------------------------------------------------------------
+
+def write_manifest(manifestfile, options, version, inputs, outputs, order=0):
+    os.makedirs(os.path.split(manifestfile)[0], exist_ok=True)
+    manifest = {
+	'options': options,
+	'order': order,
+	'version': version,
+	'inputs': inputs,
+	'outputs': outputs,
+    }
+    with open(manifestfile + '.tmp', 'w') as ofile:
+        json.dump(manifest, ofile, indent=1, sort_keys=True)
+    os.replace(manifestfile + '.tmp', manifestfile)
+
+#----------------------------------------------------------------------------
+# Return a version string made from the contents of all python scripts in
+# "scriptdir" and in each of the directories "scriptdirs" (e.g., those of
+# the filter scripts, which may import other modules found there), plus
+# any additional string (e.g., the magic version).
+#----------------------------------------------------------------------------
+
+def script_version(scriptdir, extra='', scriptdirs=[]):
+    hasher = hashlib.sha1()
+    dirlist = [scriptdir] + sorted(set(os.path.abspath(path) for path in scriptdirs))
+    for dirpath in dirlist:
+        for script in sorted(glob.glob(dirpath + '/*.py')):
+            hasher.update(os.path.split(script)[1].encode('utf-8'))
+            hasher.update(file_digest(script).encode('utf-8'))
+    hasher.update(str(extra).encode('utf-8'))
+    return hasher.hexdigest()
+
+#----------------------------------------------------------------------------
+# Given a list of files and directories, return a dictionary of all files
+# (recursively descending into directories) with their size, modification
+# time, and content digest.  If "oldmanifest" is given, then reuse the
+# content digest from the manifest for any file whose size and modification
+# time have not changed.
+#----------------------------------------------------------------------------
+
+def collect_inputs(pathlist, oldmanifest=None):
+    oldinputs = oldmanifest['inputs'] if oldmanifest else {}
+    inputs = {}
+
+    filelist = []
+    for path in pathlist:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filelist.append(os.path.join(dirpath, filename))
+        elif os.path.isfile(path):
+            filelist.append(path)
+
+    for filepath in filelist:
+        filepath = os.path.abspath(filepath)
+        if filepath in inputs:
+            continue
+        st = os.stat(filepath)
+        olddata = oldinputs.get(filepath)
+        if olddata and olddata[0] == st.st_size and olddata[1] == st.st_mtime_ns:
+            digest = olddata[2]
+        else:
+            digest = file_digest(filepath)
+        inputs[filepath] = [st.st_size, st.st_mtime_ns, digest]
+    return inputs
+
+#----------------------------------------------------------------------------
+# Return a dictionary of all files under the subdirectories "subdirs" of
+# "targetdir", keyed by the path relative to targetdir, with the size and
+# modification time of each file.  Symbolic links are recorded by their
+# target path.
+#----------------------------------------------------------------------------
+
+def snapshot(targetdir, subdirs):
+    snap = {}
+    for subdir in subdirs:
+        topdir = targetdir + '/' + subdir
+        if not os.path.isdir(topdir):
+            continue
+        for dirpath, dirnames, filenames in os.walk(topdir):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(filepath, targetdir)
+                if os.path.islink(filepath):
+                    snap[relpath] = ['link', os.readlink(filepath)]
+                else:
+                    st = os.stat(filepath)
+                    snap[relpath] = [st.st_size, st.st_mtime_ns]
+    return snap
+
+#----------------------------------------------------------------------------
+# Return the manifests of all other steps recorded in the same directory
+# as "manifestfile".
+#----------------------------------------------------------------------------
+
+def other_manifests(manifestfile):
+    manifests = []
+    for otherfile in sorted(glob.glob(os.path.split(manifestfile)[0] + '/*.json')):
+        if otherfile == manifestfile:
+            continue
+        manifest = read_manifest(otherfile)
+        if manifest:
+            manifests.append(manifest)
+    return manifests
+
+#----------------------------------------------------------------------------
+# Return the order of a step among all steps writing into the staging area.
+# A step keeps the order from its previous manifest;  a step run for the
+# first time comes after all steps already recorded.  Since the PDK Makefile
+# runs the steps in the same sequence every time, this tells which steps
+# came before a given step, whether or not any of them were run again.
+#----------------------------------------------------------------------------
+
+def stage_order(manifestfile, oldmanifest):
+    if oldmanifest and 'order' in oldmanifest:
+        return oldmanifest['order']
+    orders = list(manifest.get('order', 0) for manifest in
+		other_manifests(manifestfile))
+    return max(orders, default=0) + 1
+
+#----------------------------------------------------------------------------
+# Return the list of files under the subdirectories "subdirs" of
+# "targetdir" that were written by steps coming before "order".  These are
+# the files that a step may read from the staging area (e.g., to annotate
+# LEF files or to generate magic views from staged GDS files).  Files
+# written by later steps are not included, since they cannot have been
+# read, and including them would make each step depend on the next.
+#----------------------------------------------------------------------------
+
+def staged_files(manifestfile, targetdir, subdirs, order):
+    prefixes = tuple(subdir + '/' for subdir in subdirs)
+    filelist = set()
+    for manifest in other_manifests(manifestfile):
+        if manifest.get('order', 0) >= order:
+            continue
+        for relpath in manifest.get('outputs', {}):
+            if relpath.startswith(prefixes):
+                filelist.add(targetdir + '/' + relpath)
+    return sorted(filelist)
+
+#----------------------------------------------------------------------------
+# Return the entries in snapshot "after" that are new or different from
+# the entries in snapshot "before".
+#----------------------------------------------------------------------------
+
+def snapshot_changes(before, after):
+    return dict((key, value) for key, value in after.items() if before.get(key) != value)
+
+#----------------------------------------------------------------------------
+# Return True if the manifest matches the given version and inputs, and
+# all of the outputs recorded in the manifest are unchanged in targetdir.
+#----------------------------------------------------------------------------
+
+def manifest_is_current(manifest, version, inputs, targetdir):
+    if not manifest:
+        return False
+    if manifest.get('version') != version:
+        return False
+
+    oldinputs = manifest.get('inputs', {})
+    if set(oldinputs.keys()) != set(inputs.keys()):
+        return False
+    for filepath, data in inputs.items():
+        if oldinputs[filepath][2] != data[2]:
+            return False
+
+    outputs = manifest.get('outputs', {})
+    if not outputs:
+        return False
+    for relpath, data in outputs.items():
+        filepath = targetdir + '/' + relpath
+        if data[0] == 'link':
+            if not os.path.islink(filepath) or os.readlink(filepath) != data[1]:
+                return False
+        elif os.path.islink(filepath) or not os.path.isfile(filepath):
+            return False
+        else:
+            st = os.stat(filepath)
+            if st.st_size != data[0] or st.st_mtime_ns != data[1]:
+                return False
+    return True
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# stage_scheduler.py
+#
+#----------------------------------------------------------------------------
+# A small dependency-aware scheduler for the stages run by foundry_install.py
+# (library compiles, magic database generation, CDL to SPICE conversion,
+# etc.).  Each stage is a python callable with a name and a list of names of
+# stages that must complete before it can be started.
+#
+# With jobs = 1 (the default) each stage is run as soon as it is added, so
+# that the behavior is exactly the same as calling the function directly.
+# With jobs > 1, stages are deferred until run() is called, at which point
+# up to "jobs" stages are run at a time, each in its own (forked) process.
+# All output from a stage, including the output of any subprocesses that
+# it runs, is captured in a temporary log file, and the logs are printed in
+# the order in which the stages were added, so that the output does not
+# depend on the order in which the stages happened to finish.
+#
+# If a stage fails, then all stages that depend on it are skipped, and
+# run() raises SystemError after all other running stages have finished.
+#----------------------------------------------------------------------------
+
+import os
+import sys
+import tempfile
+import multiprocessing
+import multiprocessing.connection
+
+import stage_trace
+
+#----------------------------------------------------------------------------
+# Procedure run in the forked child process:  Redirect stdout and stderr
+# (at the file descriptor level, so that the output of subprocesses is also
+# captured) to the stage log file, then run the stage.
+#----------------------------------------------------------------------------
+
+def run_stage(logfd, name, func, args, kwargs):
+    os.dup2(logfd, 1)
+    os.dup2(logfd, 2)
+    stage_trace.call(name, func, *args, **kwargs)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+#----------------------------------------------------------------------------
+
+class StageScheduler(object):
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, int(jobs))
+        self.pending = []
+        self.failed = []
+
+    # Add a stage named "name" which will run func(*args, **kwargs) after
+    # all stages named in "deps" have completed.  Names in "deps" that do
+    # not refer to a stage that is pending are ignored (the stage either
+    # already ran or was never needed).
+
+    def add(self, name, deps, func, *args, **kwargs):
+        if self.jobs == 1:
+            stage_trace.call(name, func, *args, **kwargs)
+        else:
+            self.pending.append((name, list(deps), func, args, kwargs))
+        return name
+
+    # Run all pending stages and wait for them to complete.  This acts as
+    # a barrier:  After run() returns, all stages added so far are done.
+
+    def run(self):
+        if not self.pending:
+            return
+
+        stages = self.pending
+        self.pending = []
+        self.failed = []
+        names = set(stage[0] for stage in stages)
+
+        # Make sure that nothing buffered in the parent is duplicated
+        # in the output of the children.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        ctx = multiprocessing.get_context('fork')
+        status = {}
+        logs = {}
+        running = {}
+        printed = 0
+
+        while True:
+            # Start (or skip) every stage whose dependencies are resolved,
+            # in the order in which the stages were added.
+            changed = True
+            while changed:
+                changed = False
+                for (name, deps, func, args, kwargs) in stages:
+                    if name in logs:
+                        continue
+                    depstatus = list(status.get(dep) for dep in deps if dep in names)
+                    if False in depstatus:
+                        status[name] = False
+                        logs[name] = None
+                        self.failed.append(name)
+                        changed = True
+                        continue
+                    if None in depstatus:
+                        continue
+                    if len(running) >= self.jobs:
+                        continue
+
+                    logfile = tempfile.TemporaryFile()
+                    proc = ctx.Process(target=run_stage,
+				args=(logfile.fileno(), name, func, args, kwargs))
+                    proc.start()
+                    logs[name] = logfile
+                    running[proc.sentinel] = (name, proc)
+
+            # Print the logs of all completed stages in order.
+            while printed < len(stages):
+                name = stages[printed][0]
+                if name not in status:
+                    break
+                logfile = logs[name]
+                if not logfile:
+                    print('Stage "' + name + '" skipped due to failed dependency.')
+                else:
+                    logfile.seek(0)
+                    sys.stdout.flush()
+                    sys.stdout.buffer.write(logfile.read())
+                    sys.stdout.flush()
+                    logfile.close()
+                printed += 1
+
+            if not running:
+                break
+
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                (name, proc) = running.pop(sentinel)
+                proc.join()
+                status[name] = (proc.exitcode == 0)
+                if proc.exitcode != 0:
+                    self.failed.append(name)
+
+        if self.failed:
+            raise SystemError('Stage(s) failed: ' + ', '.join(self.failed))
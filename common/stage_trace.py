@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# stage_trace.py
+#
+#----------------------------------------------------------------------------
+# Timing trace for foundry_install.py and staging_install.py.
+#
+# If the environment variable OPEN_PDKS_TRACE is set to a file name, then
+# the install scripts append records to that file, one JSON object per
+# line.  Since every call to the install scripts in a PDK build appends to
+# the same file, setting the variable for a whole build, e.g.,
+#
+#    make OPEN_PDKS_TRACE=/tmp/pdk_trace.jsonl
+#
+# gives a trace of the entire build, which can be summarized with the
+# script trace_report.py.  If the variable is not set, nothing is recorded.
+#
+# Each record has the following entries:
+#
+#    run:	A unique name for one call to an install script
+#    script:	The name of the install script
+#    event:	"run" (the entire call, recorded at exit), "span" (one step
+#		of the install), or "command" (one command run by the step)
+#    name:	Name of the step or command
+#    start:	Start time (seconds since the epoch)
+#    wall:	Elapsed time, in seconds
+#    cpu:	CPU time (user + system, including child processes), seconds
+#    read_bytes, write_bytes:  Block I/O from rusage, in bytes
+#
+# plus any counts specific to the step, such as "files" and "bytes" (files
+# and bytes handled by the step), and the command line options for "run"
+# records.
+#----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import atexit
+import resource
+
+tracefile = os.environ.get('OPEN_PDKS_TRACE')
+runname = None
+scriptname = None
+
+#----------------------------------------------------------------------------
+# Return the CPU time and block I/O used so far by this process and all of
+# its child processes that have exited.
+#----------------------------------------------------------------------------
+
+def usage():
+    selfusage = resource.getrusage(resource.RUSAGE_SELF)
+    childusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = 0.0
+    blocks_in = 0
+    blocks_out = 0
+    for ru in (selfusage, childusage):
+        cpu += ru.ru_utime + ru.ru_stime
+        blocks_in += ru.ru_inblock
+        blocks_out += ru.ru_oublock
+    return (cpu, blocks_in, blocks_out)
+
+#----------------------------------------------------------------------------
+# Append one record to the trace file.
+#----------------------------------------------------------------------------
+
+def record(event, name, **data):
+    if not tracefile:
+        return
+    entry = {
+	'run': runname,
+	'script': scriptname,
+	'event': event,
+	'name': name,
+	'pid': os.getpid(),
+    }
+    entry.update(data)
+    # A single write in append mode, so that records from processes running
+    # in parallel do not get mixed together.
+    with open(tracefile, 'a') as ofile:
+        ofile.write(json.dumps(entry) + '\n')
+
+#----------------------------------------------------------------------------
+# One timed step.  The step starts when the Span is created and ends when
+# end() is called.  Counts can be added with add() while the step runs.
+#----------------------------------------------------------------------------
+
+class Span(object):
+
+    def __init__(self, name, event='span', **data):
+        self.name = name
+        self.event = event
+        self.data = dict(data)
+        self.start = time.time()
+        self.wallstart = time.monotonic()
+        self.usagestart = usage()
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.data[key] = self.data.get(key, 0) + value
+
+    def end(self, **data):
+        self.data.update(data)
+        if not tracefile:
+            return
+        cpu, blocks_in, blocks_out = usage()
+        record(self.event, self.name,
+		start = round(self.start, 3),
+		wall = round(time.monotonic() - self.wallstart, 3),
+		cpu = round(cpu - self.usagestart[0], 3),
+		read_bytes = (blocks_in - self.usagestart[1]) * 512,
+		write_bytes = (blocks_out - self.usagestart[2]) * 512,
+		**self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type and exc_type is not SystemExit:
+            self.end(failed=True)
+        else:
+            self.end()
+        return False
+
+#----------------------------------------------------------------------------
+# Start tracing a call to an install script.  The "run" record for the
+# call is written when the script exits.
+#----------------------------------------------------------------------------
+
+def start_run(script, arguments):
+    global runname, scriptname
+    if not tracefile:
+        return
+    scriptname = os.path.split(script)[1]
+    runname = scriptname + ':' + str(os.getpid()) + ':' + str(round(time.time(), 3))
+    runspan = Span(scriptname, event='run', args=list(arguments))
+    pid = os.getpid()
+
+    def end_run():
+        # Processes forked from this one do not record the run.
+        if os.getpid() == pid:
+            runspan.end()
+
+    atexit.register(end_run)
+
+#----------------------------------------------------------------------------
+# Call func(*args, **kwargs) as a traced step.
+#----------------------------------------------------------------------------
+
+def call(name, func, *args, **kwargs):
+    with Span(name):
+        return func(*args, **kwargs)
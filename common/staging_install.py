@@ -60,17 +60,55 @@ Less common options:
 
   -verbose           Output more information about the install process.
 
+  -nocache           Copy all files from staging, and do not use or update
+                     the file digest index (see below).
+
+  -uninstall         Remove the files written by the last install to the
+                     target directory (see below).
+
+  -jobs <number>     Use up to <number> threads to copy files, and up to
+                     <number> processes to change path references to the
+                     staging area in installed files.
+
+Each install records the files it wrote, with their content digests, in
+the file ".install_manifest.json" in the target directory.  When the same
+staging area is installed again with the same options, only the files
+that have changed in the staging area (or that have been changed or
+removed in the target directory) are copied, and files from the last
+install that are no longer in the staging area are removed.  With
+-uninstall, all files listed in the manifest are removed, except for any
+that have been modified since they were installed.
+
+Files are replaced by symbolic links (see -link_from) when their contents
+match, as found by comparing content digests.  The digests are kept in the
+file ".digest_index.json" in the parent directory of the staging area, and
+are reused by later installs (for example, of other variants of the same
+PDK) for all files whose size and modification time have not changed.
+
+If the environment variable OPEN_PDKS_TRACE is set to a file name, then
+the time taken by each step of the install is appended to that file (see
+stage_trace.py and trace_report.py).
+
 If <target> is unspecified then <name> is used for the target.
 """
 
+import io
 import re
 import os
 import sys
 import glob
+import json
+import mmap
+import errno
 import stat
 import shutil
-import filecmp
+import contextlib
 import subprocess
+import multiprocessing
+import concurrent.futures
+
+import stage_trace
+import digest_index
 
 # NOTE:  This version of copy_tree from distutils works like shutil.copytree()
 # in Python 3.8 and up ONLY using "dirs_exist_ok=True".  Since
@@ -88,20 +126,45 @@ def makeuserwritable(filepath):
         st = os.stat(filepath)
         os.chmod(filepath, st.st_mode | stat.S_IWUSR)
 
-# Filter files to replace all strings matching "stagingdir" with "finaldir" for
-# every file in "tooldir".  If "tooldir" contains subdirectories, then recursively
-# apply the replacement filter to all files in the subdirectories.  Do not follow
-# symbolic links.
-
-def filter_recursive(tooldir, stagingdir, finaldir):
-    # Add any non-ASCII file types here
-    bintypes = ['.gds', '.gds2', '.gdsii', '.png', '.swp']
-
+# Add any non-ASCII file types here
+bintypes = ['.gds', '.gds2', '.gdsii', '.png', '.swp']
+
+# Return True if the file "filepath" contains any of the byte strings in
+# "patterns".  The file is memory-mapped and searched without decoding it,
+# so that files that do not need to be changed are only read once.
+
+def file_has_patterns(filepath, patterns):
+    with open(filepath, 'rb') as ifile:
+        if os.fstat(ifile.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pattern in patterns:
+                if mm.find(pattern) >= 0:
+                    return True
+    return False
+
+# Replace all strings matching "stagingdir" or its parent directory with
+# "finaldir" or its parent directory in the file "filepath".  The file is
+# only rewritten if it contains either string.  As with install_file(),
+# the new contents are written under a temporary name and renamed to
+# "filepath", so that the file is never seen partly written.  Returns 1 if
+# the file was modified and 0 if not.
+
+def filter_file(filepath, stagingdir, finaldir):
     # Also do substitutions on strings containing the stagingdir parent
     # directory (replace with the finaldir parent directory).
     stagingparent = os.path.split(stagingdir)[0]
     localparent = os.path.split(finaldir)[0]
 
+    # Any file that needs a substitution contains stagingparent (which is
+    # also a prefix of stagingdir).
+    if stagingparent:
+        patterns = [stagingparent.encode('utf-8')]
+    else:
+        patterns = [stagingdir.encode('utf-8')]
+    if not file_has_patterns(filepath, patterns):
+        return 0
+
     # Alternative expressions for the final location when called from
     # Tcl scripts or shell scripts.  This affects startup scripts like
     # .magicrc and .xcircuitrc, and qflow setup scripts.  Note that the
@@ -118,6 +181,72 @@ def filter_recursive(tooldir, stagingdir, finaldir):
     tclfinaldir = finaldir.replace(homedir, '$::env(HOME)')
     tcllocalparent = localparent.replace(homedir, '$::env(HOME)')
 
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as ifile:
+        try:
+            flines = ifile.readlines()
+        except UnicodeDecodeError:
+            print('Failure to read file ' + filepath + '; non-ASCII content.')
+            return 0
+
+    # Make sure this file is writable (as the original may not be)
+    makeuserwritable(filepath)
+
+    # For cases in which the target is in the home directory, make
+    # the PDK more portable by replacing the home directory with the
+    # appropriate environment variable.  This is found in Tcl and shell
+    # scripts and needs to be handled accordingly.
+
+    fext = os.path.splitext(filepath)[1]
+    isshell = True if fext == '.sh' else False
+    istcl = True if fext.endswith('rc') else False
+
+    modified = False
+    dirpath, name = os.path.split(filepath)
+    tmppath = dirpath + '/.' + name + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmppath, 'wb') as ofile:
+            for line in flines:
+                if isshell:
+                    newline = line.replace(stagingdir, shfinaldir)
+                    newline = newline.replace(stagingparent, shlocalparent)
+                elif istcl:
+                    newline = line.replace(stagingdir, tclfinaldir)
+                    newline = newline.replace(stagingparent, tcllocalparent)
+                else:
+                    newline = line.replace(stagingdir, finaldir)
+                    newline = newline.replace(stagingparent, localparent)
+                ofile.write(newline.encode('utf-8'))
+                if newline != line:
+                    modified = True
+        if modified:
+            shutil.copymode(filepath, tmppath)
+            os.replace(tmppath, filepath)
+        else:
+            os.remove(tmppath)
+    except BaseException:
+        if os.path.lexists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    return 1 if modified else 0
+
+# Same as filter_file(), but return any output instead of printing it, for
+# use in a worker process.  Returns (number of files modified, output).
+
+def filter_file_captured(filepath, stagingdir, finaldir):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        total = filter_file(filepath, stagingdir, finaldir)
+    return (total, output.getvalue())
+
+# Filter files to replace all strings matching "stagingdir" with "finaldir" for
+# every file in "tooldir".  If "tooldir" contains subdirectories, then recursively
+# apply the replacement filter to all files in the subdirectories.  Do not follow
+# symbolic links.  Files are scanned for the staging path first, and only the
+# files containing it are rewritten.  With jobs > 1, files are filtered in
+# parallel in forked worker processes.  Returns the number of files modified.
+
+def filter_recursive(tooldir, stagingdir, finaldir, jobs=1):
     if not os.path.exists(tooldir):
         return 0
     elif os.path.islink(tooldir):
@@ -125,85 +254,327 @@ def filter_recursive(tooldir, stagingdir, finaldir):
     elif not os.path.isdir(tooldir):
         return 0
 
-    toolfiles = os.listdir(tooldir)
+    filelist = []
+    for dirpath, dirnames, filenames in os.walk(tooldir):
+        # os.walk() does not descend into symbolic links to directories
+        dirnames.sort()
+        for file in sorted(filenames):
+            # Do not attempt to do text substitutions on a binary file!
+            if os.path.splitext(file)[1] in bintypes:
+                continue
+            filepath = dirpath + '/' + file
+            if os.path.islink(filepath):
+                continue
+            filelist.append(filepath)
+
+    if jobs == 1 or len(filelist) < 2:
+        total = 0
+        for filepath in filelist:
+            total += filter_file(filepath, stagingdir, finaldir)
+        return total
+
+    sys.stdout.flush()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(min(jobs, len(filelist))) as pool:
+        results = pool.starmap(filter_file_captured, list((filepath, stagingdir,
+			finaldir) for filepath in filelist), chunksize=64)
+
     total = 0
+    for count, output in results:
+        sys.stdout.write(output)
+        total += count
+    sys.stdout.flush()
+    return total
 
-    for file in toolfiles:
-        # Do not attempt to do text substitutions on a binary file!
-        if os.path.splitext(file)[1] in bintypes:
-            continue
+# The install manifest records every file and symbolic link installed from
+# the staging area, so that a later install can copy only what changed and
+# an uninstall can remove exactly what was installed.  It is a JSON file in
+# the top level of the installed PDK:
+#
+#    {"version": 1, "options": {...}, "files": {"<relative path>": entry},
+#     "dirs": [<relative path>, ...]}
+#
+# where each entry has "type" ("file" or "link"), "staged" (the size and
+# modification time of the file in the staging area, or the target of a
+# link in the staging area) and, for the installed file, "size", "mtime_ns",
+# "mode", and "digest", or for an installed link, "target".
 
-        filepath = tooldir + '/' + file
-        if os.path.islink(filepath):
-            continue
-        elif os.path.isdir(filepath):
-            total += filter_recursive(filepath, stagingdir, finaldir)
-        else:
-            with open(filepath, 'r', encoding='utf-8', errors='replace') as ifile:
-                try:
-                    flines = ifile.readlines()
-                except UnicodeDecodeError:
-                    print('Failure to read file ' + filepath + '; non-ASCII content.')
+install_manifest_name = '.install_manifest.json'
+install_manifest_version = 1
+
+# Names of files and directories in the staging area that are not installed
+staging_ignore = ['.stage_manifest', '.stage_logs', install_manifest_name]
+
+def read_install_manifest(writedir):
+    try:
+        with open(writedir + '/' + install_manifest_name, 'r') as ifile:
+            manifest = json.load(ifile)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    if manifest.get('version') != install_manifest_version:
+        return None
+    return manifest
+
+def write_install_manifest(writedir, options, entries, dirs):
+    manifestfile = writedir + '/' + install_manifest_name
+    tmpfile = manifestfile + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpfile, 'w') as ofile:
+        json.dump({'version': install_manifest_version, 'options': options,
+		'files': entries, 'dirs': dirs}, ofile, indent=1, sort_keys=True)
+    os.replace(tmpfile, manifestfile)
+
+# Return a dictionary of all files and symbolic links in the staging area,
+# keyed by path relative to "stagingdir", with the value from os.lstat(),
+# and a list of all directories (relative to "stagingdir"), parents before
+# children.  Symbolic links to directories are not followed.
+
+def list_staging(stagingdir):
+    staged = {}
+    dirs = []
+    pending = ['']
+    while pending:
+        reldir = pending.pop(0)
+        dirpath = stagingdir + '/' + reldir if reldir else stagingdir
+        subdirs = []
+        with os.scandir(dirpath) as entries:
+            for entry in sorted(entries, key=lambda item: item.name):
+                if entry.name in staging_ignore:
                     continue
+                relpath = reldir + '/' + entry.name if reldir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relpath)
+                else:
+                    staged[relpath] = entry.stat(follow_symlinks=False)
+        dirs.extend(subdirs)
+        pending.extend(subdirs)
+    return (staged, dirs)
+
+# Return what is recorded in the install manifest about a file in the
+# staging area (the file status "st") to tell whether it has changed.
+
+def staged_signature(stagepath, st):
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(stagepath)
+    return [st.st_size, st.st_mtime_ns]
+
+# Return True if the installed file "writepath" for the staging file
+# "stagepath" is up to date according to the manifest entry "entry":  The
+# staging file has not changed since the last install, and the installed
+# file has not been changed or removed since then.
+
+def install_is_current(entry, stagepath, st, writepath):
+    if not entry or entry.get('staged') != staged_signature(stagepath, st):
+        return False
+    try:
+        wst = os.lstat(writepath)
+    except OSError:
+        return False
+    if entry['type'] == 'link':
+        return stat.S_ISLNK(wst.st_mode) and os.readlink(writepath) == entry['target']
+    return (stat.S_ISREG(wst.st_mode) and wst.st_size == entry['size'] and
+		wst.st_mtime_ns == entry['mtime_ns'] and
+		stat.S_IMODE(wst.st_mode) == entry['mode'])
+
+# Copy the contents of file "src" to "dst" using os.copy_file_range() (which
+# lets the filesystem copy the data without passing it through this process,
+# or clone it, and for NFS, copy it on the server), and otherwise using
+# shutil.copyfile() (which uses sendfile() where available).
+
+def copy_contents(src, dst):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as ifile, open(dst, 'wb') as ofile:
+                size = os.fstat(ifile.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    count = os.copy_file_range(ifile.fileno(), ofile.fileno(),
+				min(size - copied, 1 << 30))
+                    if count == 0:
+                        break
+                    copied += count
+                if copied >= size:
+                    return
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+			errno.EOPNOTSUPP, errno.EBADF, errno.EPERM]:
+                raise
+    shutil.copyfile(src, dst)
+
+# Install the staging file or symbolic link "stagepath" as "writepath".  The
+# file is written under a temporary name in the same directory and renamed
+# to "writepath", so that the installed file is replaced in one step and is
+# never seen partly written.  Returns the number of bytes copied.
+
+def install_file(stagepath, writepath, st):
+    dirpath, name = os.path.split(writepath)
+    tmppath = dirpath + '/.' + name + '.' + str(os.getpid()) + '.tmp'
+    try:
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(stagepath), tmppath)
+            size = 0
+        else:
+            copy_contents(stagepath, tmppath)
+            shutil.copystat(stagepath, tmppath)
+            size = st.st_size
+        if os.path.isdir(writepath) and not os.path.islink(writepath):
+            shutil.rmtree(writepath)
+        os.replace(tmppath, writepath)
+    except BaseException:
+        if os.path.lexists(tmppath):
+            os.remove(tmppath)
+        raise
+    return size
+
+# Remove the directory containing "filepath" and its parents up to (but not
+# including) "topdir", as long as they are empty.
+
+def remove_empty_dirs(filepath, topdir):
+    dirpath = os.path.dirname(filepath)
+    while dirpath != topdir and dirpath.startswith(topdir + '/'):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            break
+        dirpath = os.path.dirname(dirpath)
+
+# Copy the staging area to the install directory.  "staged" and "dirs" are
+# the staging files and directories from list_staging(), and "oldentries"
+# is the files entry of the install manifest from the last install (or
+# None).  Files that were installed last time but are no longer in the
+# staging area are removed.  If "incremental" is True, then only files that
+# have changed since the last install are copied;  otherwise, everything is
+# copied.  Files are copied by "jobs" threads in parallel (copying is
+# mostly waiting on the filesystem, especially over NFS), and each file is
+# replaced in one step (see install_file()), so that tools using the PDK
+# while it is being installed never see a missing or partly written file.
+# Returns the number of files copied.
+
+def install_files(stagingdir, writedir, staged, dirs, oldentries, incremental,
+		trace, jobs=1):
+    if not oldentries:
+        oldentries = {}
+
+    # Remove files from the last install that are not being installed again
+    for relpath in sorted(oldentries.keys()):
+        if relpath not in staged:
+            writepath = writedir + '/' + relpath
+            if os.path.lexists(writepath):
+                os.remove(writepath)
+                remove_empty_dirs(writepath, writedir)
+
+    # Create all directories first.  Anything in the way of a directory
+    # (such as a symbolic link from an earlier install) is removed.
+    for reldir in dirs:
+        writepath = writedir + '/' + reldir
+        if os.path.islink(writepath) or os.path.isfile(writepath):
+            os.remove(writepath)
+        os.makedirs(writepath, exist_ok=True)
+
+    copylist = []
+    for relpath, st in staged.items():
+        stagepath = stagingdir + '/' + relpath
+        writepath = writedir + '/' + relpath
+        if incremental and install_is_current(oldentries.get(relpath),
+			stagepath, st, writepath):
+            continue
+        copylist.append((stagepath, writepath, st))
 
-            # Make sure this file is writable (as the original may not be)
-            makeuserwritable(filepath)
-
-            # For cases in which the target is in the home directory, make
-            # the PDK more portable by replacing the home directory with the
-            # appropriate environment variable.  This is found in Tcl and shell
-            # scripts and needs to be handled accordingly.
-
-            fext = os.path.splitext(filepath)[1]
-            isshell = True if fext == '.sh' else False
-            istcl = True if fext.endswith('rc') else False
-
-            modified = False
-            with open(filepath, 'wb') as ofile:
-                for line in flines:
-                    if isshell:
-                        newline = line.replace(stagingdir, shfinaldir)
-                        newline = newline.replace(stagingparent, shlocalparent)
-                    elif istcl:
-                        newline = line.replace(stagingdir, tclfinaldir)
-                        newline = newline.replace(stagingparent, tcllocalparent)
-                    else:
-                        newline = line.replace(stagingdir, finaldir)
-                        newline = newline.replace(stagingparent, localparent)
-                    ofile.write(newline.encode('utf-8'))
-                    if newline != line:
-                        modified = True
-
-            if modified:
-                total += 1
-    return total
+    if jobs == 1 or len(copylist) < 2:
+        sizes = list(install_file(*item) for item in copylist)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            sizes = list(executor.map(lambda item: install_file(*item), copylist))
 
-# To avoid problems with various library functions that copy hierarchical
-# directory trees, remove all the files from the target that are going to
-# be replaced by the contents of staging.  This avoids problems with
-# symbolic links and such.
-
-def remove_target(stagingdir, targetdir, verbose=False):
-
-    slist = os.listdir(stagingdir)
-    tlist = os.listdir(targetdir)
-
-    for sfile in slist:
-        if sfile in tlist:
-            tpath = targetdir + '/' + sfile
-            if os.path.islink(tpath):
-                if verbose:
-                    print("Removing link", tpath)
-                os.unlink(tpath)
-            elif os.path.isdir(tpath):
-                remove_target(
-                    stagingdir + '/' + sfile,
-                    targetdir + '/' + sfile,
-                    verbose)
+    for (stagepath, writepath, st), size in zip(copylist, sizes):
+        if not stat.S_ISLNK(st.st_mode):
+            trace.add(files=1, bytes=size)
+
+    # Copy directory modes and times (as shutil.copytree() does), deepest
+    # first, after all files have been written.
+    for reldir in reversed(dirs):
+        shutil.copystat(stagingdir + '/' + reldir, writedir + '/' + reldir)
+
+    return len(copylist)
+
+# Make the install manifest entries for the files in "staged" that are
+# present in the install directory after the install.  Digests of files
+# that are unchanged since the last install are taken from "oldentries".
+
+def make_install_entries(stagingdir, writedir, staged, oldentries):
+    entries = {}
+    for relpath, st in staged.items():
+        writepath = writedir + '/' + relpath
+        try:
+            wst = os.lstat(writepath)
+        except OSError:
+            # Temporary files that were removed after installing
+            continue
+        entry = {'staged': staged_signature(stagingdir + '/' + relpath, st)}
+        if stat.S_ISLNK(wst.st_mode):
+            entry['type'] = 'link'
+            entry['target'] = os.readlink(writepath)
+        elif stat.S_ISREG(wst.st_mode):
+            entry['type'] = 'file'
+            entry['size'] = wst.st_size
+            entry['mtime_ns'] = wst.st_mtime_ns
+            entry['mode'] = stat.S_IMODE(wst.st_mode)
+            oldentry = oldentries.get(relpath) if oldentries else None
+            if (oldentry and oldentry['type'] == 'file' and
+			oldentry['size'] == wst.st_size and
+			oldentry['mtime_ns'] == wst.st_mtime_ns):
+                entry['digest'] = oldentry['digest']
             else:
-                if verbose:
-                    print("Removing", tpath)
-                os.remove(tpath)
+                entry['digest'] = digest_index.file_digest(writepath)
+        else:
+            continue
+        entries[relpath] = entry
+    return entries
+
+# Remove everything listed in the install manifest of "writedir".  Files
+# that have been modified since they were installed (their digest does not
+# match the manifest) are left in place.  Returns the number of files that
+# were left in place, or None if there is no install manifest.
+
+def uninstall(writedir, verbose=False):
+    manifest = read_install_manifest(writedir)
+    if not manifest:
+        return None
+
+    kept = 0
+    for relpath, entry in sorted(manifest['files'].items()):
+        writepath = writedir + '/' + relpath
+        if not os.path.lexists(writepath):
+            continue
+        if entry['type'] == 'link':
+            current = os.path.islink(writepath) and os.readlink(writepath) == entry['target']
+        else:
+            current = (os.path.isfile(writepath) and not os.path.islink(writepath)
+			and digest_index.file_digest(writepath) == entry['digest'])
+        if not current:
+            print('Not removing modified file ' + writepath)
+            kept += 1
+            continue
+        if verbose:
+            print('Removing ' + writepath)
+        os.remove(writepath)
+        remove_empty_dirs(writepath, writedir)
+
+    # Remove directories that were installed and are now empty, deepest
+    # first.
+    for reldir in sorted(manifest.get('dirs', []), key=lambda item: -item.count('/')):
+        try:
+            os.rmdir(writedir + '/' + reldir)
+        except OSError:
+            pass
+
+    os.remove(writedir + '/' + install_manifest_name)
+    try:
+        os.rmdir(writedir)
+    except OSError:
+        pass
+    return kept
 
 # Create a list of source files/directories from the contents of source.txt
 
@@ -221,31 +592,38 @@ def make_source_list(sources):
 # Because the installation may be distributed, there may be a difference
 # between where the files to be linked to currently are (checklist)
 # and where they will eventually be located (sourcelist).
+#
+# File contents are compared by digest, using "index" (a DigestIndex).
 
-def replace_with_symlinks(libfiles, sourcelist):
+def replace_with_symlinks(libfiles, sourcelist, index):
     # List of files that never get installed
     exclude = ['generate_magic.tcl', '.magicrc', 'sources.txt']
     total = 0
+
+    # Match files by name.  If more than one source has the same name,
+    # the first one is used.
+    sourcenames = {}
+    for item in sourcelist:
+        sourcenames.setdefault(os.path.split(item)[1], item)
+
     for libfile in libfiles:
         if os.path.islink(libfile):
             continue
         else:
-            try:
-                sourcefile = next(item for item in sourcelist if os.path.split(item)[1] == os.path.split(libfile)[1])
-            except:
-                pass
-            else:
+            sourcefile = sourcenames.get(os.path.split(libfile)[1])
+            if sourcefile:
                 if os.path.isdir(libfile):
                     newlibfiles = glob.glob(libfile + '/*')
                     newsourcelist = glob.glob(sourcefile + '/*')
-                    total += replace_with_symlinks(newlibfiles, newsourcelist)
-                elif filecmp.cmp(libfile, sourcefile, shallow=False):
-                    if not os.path.split(libfile)[1] in exclude:
-                        os.remove(libfile)
-                        # Use absolute path for the source file
-                        sourcepath = os.path.abspath(sourcefile)
-                        os.symlink(sourcepath, libfile)
-                        total += 1
+                    total += replace_with_symlinks(newlibfiles, newsourcelist, index)
+                elif os.path.split(libfile)[1] in exclude:
+                    continue
+                elif index.same_contents(libfile, sourcefile):
+                    os.remove(libfile)
+                    # Use absolute path for the source file
+                    sourcepath = os.path.abspath(sourcefile)
+                    os.symlink(sourcepath, libfile)
+                    total += 1
     return total
 
 # Similar to the routine above, replace files in "libdir" with symbolic
@@ -258,8 +636,10 @@ def replace_with_symlinks(libfiles, sourcelist):
 # Because the installation may be distributed, there may be a difference
 # between where the files to be linked to currently are (checklibdir)
 # and where they will eventually be located (srclibdir).
+#
+# File contents are compared by digest, using "index" (a DigestIndex).
 
-def replace_all_with_symlinks(libdir, srclibdir, checklibdir):
+def replace_all_with_symlinks(libdir, srclibdir, checklibdir, index):
     total = 0
     try:
         libfiles = os.listdir(libdir)
@@ -291,10 +671,10 @@ def replace_all_with_symlinks(libdir, srclibdir, checklibdir):
 
             if os.path.isdir(libpath):
                 if os.path.isdir(checkpath):
-                    total += replace_all_with_symlinks(libpath, srcpath, checkpath)
+                    total += replace_all_with_symlinks(libpath, srcpath, checkpath, index)
             else:
                 try:
-                    if filecmp.cmp(libpath, checkpath, shallow=False):
+                    if index.same_contents(libpath, checkpath):
                         os.remove(libpath)
                         os.symlink(srcpath, libpath)
                         total += 1
@@ -314,6 +694,8 @@ if __name__ == '__main__':
         print(__doc__)
         sys.exit(0)
 
+    stage_trace.start_run(sys.argv[0], sys.argv[1:])
+
     optionlist = []
     newopt = []
 
@@ -327,6 +709,8 @@ if __name__ == '__main__':
     finaldir = None  # Directory files will end up installed to.
 
     do_install = True
+    jobs = 1
+    do_cache = True
 
     # Break arguments into groups where the first word begins with "-".
     # All following words not beginning with "-" are appended to the
@@ -358,6 +742,18 @@ if __name__ == '__main__':
         elif option[0] == 'debug':
             optionlist.remove(option)
             debug = True
+        elif option[0] == 'nocache':
+            optionlist.remove(option)
+            do_cache = False
+        elif option[0] == 'jobs':
+            optionlist.remove(option)
+            if len(option) > 1:
+                try:
+                    jobs = max(1, int(option[1]))
+                except ValueError:
+                    print('Error: Option "jobs" value is not an integer.')
+            else:
+                print('Error: Option "jobs" used with no value.')
 
     # Check for options "link_from", "staging", "writeto", and "finalpath"
     # "target" and "local" are also parsed for backwards compatibility
@@ -432,12 +828,21 @@ if __name__ == '__main__':
     else:
         checkdir = ''
 
-    # Diagnostic
-    if do_install:
-        print("Installing in target directory " + writedir)
-    else:
+    # Uninstall removes what the last install wrote, as recorded in the
+    # install manifest.
+    if not do_install:
         print("Uninstalling from target directory " + writedir)
-        print("(Method not yet implemented)")
+        kept = uninstall(writedir, debug)
+        if kept is None:
+            print("No install manifest found in " + writedir + ";  nothing removed.")
+            sys.exit(1)
+        elif kept > 0:
+            print(str(kept) + " modified files were not removed.")
+        print("Done.")
+        sys.exit(0)
+
+    # Diagnostic
+    print("Installing in target directory " + writedir)
 
     # Create the top-level directories
 
@@ -463,13 +868,35 @@ if __name__ == '__main__':
             print('Fatal error:  Cannot make target directory ' + writedir + '!')
             exit(1)
 
-    # Remove any files from the target directory that are going to be replaced
-    print('Removing files from target')
-    remove_target(stagingdir, writedir)
-
-    print('Copying staging files to target')
-    # print('Diagnostic:  copytree ' + stagingdir + ' ' + writedir)
-    shutil.copytree(stagingdir, writedir, symlinks=True, dirs_exist_ok=True)
+    # If the PDK was installed before with the same options, then only the
+    # files that changed in staging (or in the install) since then need to
+    # be copied.  Anything else is copied after removing the files in the
+    # target directory that are going to be replaced.
+
+    install_options = {
+		'staging': os.path.abspath(stagingdir),
+		'finalpath': finaldir,
+		'variable': variable,
+		'link_from': link_from,
+    }
+    oldmanifest = read_install_manifest(writedir)
+    oldentries = oldmanifest['files'] if oldmanifest else None
+    incremental = (do_cache and oldmanifest is not None and
+		oldmanifest.get('options') == install_options)
+
+    if incremental:
+        print('Copying changed staging files to target')
+    else:
+        print('Copying staging files to target')
+    # (The staging manifest and logs written by foundry_install.py are not
+    # installed.)
+    with stage_trace.Span('copy staging') as trace:
+        staged, stageddirs = list_staging(stagingdir)
+        total = install_files(stagingdir, writedir, staged, stageddirs,
+			oldentries, incremental, trace, jobs)
+        trace.add(skipped=len(staged) - total)
+    if incremental:
+        print('(' + str(total) + ' of ' + str(len(staged)) + ' files copied)')
     print('Done.')
 
     # Magic and qflow setup files have references to the staging area that have
@@ -478,6 +905,7 @@ if __name__ == '__main__':
 
     print('Changing local path references from ' + stagingdir + ' to ' + finaldir)
     print('Part 1:  Tools')
+    trace = stage_trace.Span('filter tools')
 
     # If there are any tool directories that should *not* be checked, then add
     # them to the list below.
@@ -500,16 +928,28 @@ if __name__ == '__main__':
             # no attempt to check for possible symlinks to link_from if link_from
             # is a base PDK.
 
-            total = filter_recursive(tooldir, stagingdir, finaldir)
+            total = filter_recursive(tooldir, stagingdir, finaldir, jobs)
+            trace.add(substitutions=total)
             if total > 0:
                 substr = 'substitutions' if total > 1 else 'substitution'
                 print('      ' + tool + ' (' + str(total) + ' ' + substr + ')')
 
+    trace.end()
+
     # If "link_from" is another PDK, then check all files against the files in
     # the other PDK, and replace the file with a symbolic link if the file contents
     # match (Note:  This is done only for ngspice model files;  other tool files are
     # generally small and deemed unnecessary to make symbolic links).
 
+    # Content digests of the files compared below, shared by all installs
+    # from the same staging parent directory.
+    if do_cache:
+        indexfile = os.path.split(os.path.abspath(stagingdir))[0] + '/.digest_index.json'
+    else:
+        indexfile = None
+    index = digest_index.DigestIndex(indexfile)
+
+    trace = stage_trace.Span('symlink tools')
     if link_from not in ['source', None]:
         thispdk = os.path.split(writedir)[1]
 
@@ -528,11 +968,14 @@ if __name__ == '__main__':
                     else:
                         checktooldir = srctooldir
                     if os.path.exists(tooldir):
-                        total = replace_all_with_symlinks(tooldir, srctooldir, checktooldir)
+                        total = replace_all_with_symlinks(tooldir, srctooldir, checktooldir, index)
+                        trace.add(symlinks=total)
                         if total > 0:
                             symstr = 'symlinks' if total > 1 else 'symlink'
                             print('      ' + tool + ' (' + str(total) + ' ' + symstr + ')')
 
+    trace.end()
+
     # In .mag files in mag/ and maglef/, also need to change the staging
     # directory name to finaldir.  If "-variable" is specified in the options,
     # the replace the staging path with the variable name, not finaldir.
@@ -548,23 +991,28 @@ if __name__ == '__main__':
         refdirs.append('/libs.priv/')
 
     print('Part 2:  Libraries')
+    trace = stage_trace.Span('filter libraries')
     for refdir in refdirs:
         libraries = os.listdir(writedir + refdir)
         for library in libraries:
             print('   ' + library)
             for filetype in needcheck:
                 filedir = writedir + refdir + library + '/' + filetype
-                total = filter_recursive(filedir, stagingdir, localname)
+                total = filter_recursive(filedir, stagingdir, localname, jobs)
+                trace.add(substitutions=total)
                 if total > 0:
                     substr = 'substitutions' if total > 1 else 'substitution'
                     print('      ' + filetype + ' (' + str(total) + ' ' + substr + ')')
 
+    trace.end()
+
     # If "link_from" is "source", then check all files against the source
     # directory, and replace the file with a symbolic link if the file
     # contents match.  The "foundry_install.py" script should have added a
     # file "sources.txt" with the name of the source directories for each
     # install directory.
 
+    trace = stage_trace.Span('symlink libraries')
     if link_from == 'source':
         print('Replacing files with symbolic links to source where possible.')
         for refdir in refdirs:
@@ -583,7 +1031,8 @@ if __name__ == '__main__':
                             with open(libdir + '/sources.txt') as ifile:
                                 sources = ifile.read().splitlines()
                             sourcelist = make_source_list(sources)
-                            total = replace_with_symlinks(libfiles, sourcelist)
+                            total = replace_with_symlinks(libfiles, sourcelist, index)
+                            trace.add(symlinks=total)
                             if total > 0:
                                 symstr = 'symlinks' if total > 1 else 'symlink'
                                 print('      ' + filedir + ' (' + str(total) + ' ' + symstr + ')')
@@ -613,11 +1062,19 @@ if __name__ == '__main__':
                         else:
                             checklibdir = srclibdir
                         if os.path.exists(libdir):
-                            total = replace_all_with_symlinks(libdir, srclibdir, checklibdir)
+                            total = replace_all_with_symlinks(libdir, srclibdir, checklibdir, index)
+                            trace.add(symlinks=total)
                             if total > 0:
                                 symstr = 'symlinks' if total > 1 else 'symlink'
                                 print('      ' + filedir + ' (' + str(total) + ' ' + symstr + ')')
 
+    trace.end(digests_read=index.misses, digests_cached=index.hits)
+
+    try:
+        index.save()
+    except OSError:
+        print('Warning:  Cannot write file digest index ' + indexfile)
+
     # Remove temporary files:  Magic generation scripts, sources.txt
     # file, and magic extract files.
 
@@ -656,5 +1113,11 @@ if __name__ == '__main__':
                         elif os.path.splitext(libfile)[1] == '.orig':
                             os.remove(libfilepath)
 
+    # Record what was installed, for the next install and for uninstall
+    with stage_trace.Span('install manifest'):
+        write_install_manifest(writedir, install_options,
+		make_install_entries(stagingdir, writedir, staged, oldentries),
+		stageddirs)
+
     print('Done with PDK migration.')
     sys.exit(0)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+#
+# trace_report.py <tracefile> [-top=<number>] [-compare=<oldtracefile>]
+#
+# Summarize a build trace written by foundry_install.py and
+# staging_install.py when the environment variable OPEN_PDKS_TRACE is
+# set (see stage_trace.py).  Prints the total time of the build, the
+# slowest install script calls, the slowest steps, the slowest commands,
+# and the time spent in each kind of step.
+#
+# With "-compare=<oldtracefile>", also print the steps whose time changed
+# the most since the older trace (e.g., from a previous build), to find
+# regressions.
+#
+# Options:
+#    -top=<number>	Number of entries to print in each list (default 20)
+#    -compare=<file>	Trace file from an earlier build to compare against
+
+import os
+import sys
+import json
+
+def usage():
+    print('Usage:')
+    print('    trace_report.py <tracefile> [-top=<number>] [-compare=<oldtracefile>]')
+
+#----------------------------------------------------------------------------
+# Read a trace file and return the list of records.  Lines that cannot be
+# parsed (e.g., from a build that was interrupted) are ignored.
+#----------------------------------------------------------------------------
+
+def read_trace(tracefile):
+    records = []
+    with open(tracefile, 'r') as ifile:
+        for line in ifile:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+#----------------------------------------------------------------------------
+# Describe an install script call by its most significant arguments:  The
+# library names and the option types (e.g., "-gds") for foundry_install.py,
+# or the staging and final paths for staging_install.py.
+#----------------------------------------------------------------------------
+
+def describe_run(record):
+    args = record.get('args', [])
+    skip = ['-source', '-target', '-timestamp', '-jobs', '-staging', '-writeto',
+		'-library', '-finalpath', '-local', '-std_format', '-ef_format']
+    names = []
+    options = []
+    for idx, arg in enumerate(args):
+        if arg == '-library' and idx + 2 < len(args):
+            names.append(args[idx + 2])
+        elif arg in ['-finalpath', '-local'] and idx + 1 < len(args):
+            names.append(args[idx + 1])
+        elif arg.startswith('-') and arg not in skip:
+            options.append(arg)
+    return ' '.join([record.get('script', '')] + names + options)
+
+#----------------------------------------------------------------------------
+# Print a table of the first "top" records, sorted by wall-clock time.
+#----------------------------------------------------------------------------
+
+def print_table(title, rows, top):
+    print('')
+    print(title)
+    print('-' * len(title))
+    print('{:>10} {:>10}  {}'.format('wall (s)', 'cpu (s)', 'name'))
+    for wall, cpu, name in sorted(rows, key=lambda row: -row[0])[0:top]:
+        cpustr = '{:10.2f}'.format(cpu) if cpu is not None else '{:>10}'.format('-')
+        print('{:10.2f} {}  {}'.format(wall, cpustr, name))
+
+#----------------------------------------------------------------------------
+# Return a dictionary of total wall-clock time of each step, keyed by the
+# script and step name.
+#----------------------------------------------------------------------------
+
+def step_totals(records):
+    totals = {}
+    for record in records:
+        if record.get('event') != 'span':
+            continue
+        key = record.get('script', '') + ': ' + record['name']
+        totals[key] = totals.get(key, 0.0) + record.get('wall', 0.0)
+    return totals
+
+#----------------------------------------------------------------------------
+
+def trace_report(tracefile, top=20, oldtracefile=None):
+    records = read_trace(tracefile)
+    runs = list(record for record in records if record.get('event') == 'run')
+    spans = list(record for record in records if record.get('event') == 'span')
+    commands = list(record for record in records if record.get('event') == 'command')
+
+    # Total time of the build, from the first start to the last end
+    if runs:
+        first = min(record['start'] for record in runs)
+        last = max(record['start'] + record['wall'] for record in runs)
+        total = sum(record['wall'] for record in runs)
+        print('Build trace:  ' + tracefile)
+        print('Install script calls:  ' + str(len(runs)))
+        print('Elapsed time:  {:.2f} s  (sum of all calls {:.2f} s)'.format(
+		last - first, total))
+
+    print_table('Slowest install script calls',
+		list((record['wall'], record.get('cpu'), describe_run(record))
+		for record in runs), top)
+
+    rows = []
+    for record in spans:
+        name = record['name']
+        counts = []
+        for key in ['files', 'bytes', 'substitutions', 'symlinks']:
+            if record.get(key):
+                counts.append(str(record[key]) + ' ' + key)
+        if counts:
+            name += ' (' + ', '.join(counts) + ')'
+        rows.append((record['wall'], record.get('cpu'), name))
+    print_table('Slowest steps', rows, top)
+
+    rows = []
+    for record in commands:
+        cpu = None
+        if record.get('user') is not None:
+            cpu = record['user'] + record['sys']
+        name = os.path.split(record.get('cmd', [record['name']])[0])[1]
+        name += ' in ' + record.get('cwd', '')
+        if record.get('maxrss'):
+            name += ' (' + str(record['maxrss'] // 1024) + ' MB)'
+        rows.append((record['wall'], cpu, name))
+    print_table('Slowest commands', rows, top)
+
+    # Time by kind of step, where the kind is the first word of the name
+    # (e.g., "gds2mag", "compile", "install", "filter")
+    kinds = {}
+    for record in spans:
+        kind = record.get('script', '') + ': ' + record['name'].split()[0]
+        wall, cpu, count = kinds.get(kind, (0.0, 0.0, 0))
+        kinds[kind] = (wall + record['wall'], cpu + (record.get('cpu') or 0.0),
+		count + 1)
+    print_table('Time by kind of step',
+		list((wall, cpu, kind + ' (' + str(count) + ')')
+		for kind, (wall, cpu, count) in kinds.items()), top)
+
+    if oldtracefile:
+        newtotals = step_totals(records)
+        oldtotals = step_totals(read_trace(oldtracefile))
+        changes = []
+        for key in set(newtotals.keys()) | set(oldtotals.keys()):
+            newwall = newtotals.get(key, 0.0)
+            oldwall = oldtotals.get(key, 0.0)
+            changes.append((newwall - oldwall, oldwall, newwall, key))
+        changes.sort(key=lambda change: -abs(change[0]))
+
+        title = 'Largest changes from ' + oldtracefile
+        print('')
+        print(title)
+        print('-' * len(title))
+        print('{:>10} {:>10} {:>10}  {}'.format('change', 'old (s)', 'new (s)', 'name'))
+        for delta, oldwall, newwall, key in changes[0:top]:
+            print('{:+10.2f} {:10.2f} {:10.2f}  {}'.format(delta, oldwall, newwall, key))
+
+#----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    options = []
+    arguments = []
+    for item in sys.argv[1:]:
+        if item.find('-', 0) == 0:
+            options.append(item[1:])
+        else:
+            arguments.append(item)
+
+    if len(arguments) != 1:
+        usage()
+        sys.exit(1)
+
+    top = 20
+    oldtracefile = None
+    for option in options:
+        keyval = option.split('=')
+        if keyval[0] == 'top' and len(keyval) == 2:
+            top = int(keyval[1])
+        elif keyval[0] == 'compare' and len(keyval) == 2:
+            oldtracefile = keyval[1]
+        else:
+            print('Unknown option "' + option + '"')
+            usage()
+            sys.exit(1)
+
+    trace_report(arguments[0], top, oldtracefile)
+    sys.exit(0)
@@ -22,12 +22,17 @@
 import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import gds_stream
+
 def filter(inname, outname):
 
+    if not outname:
+        outname = inname
+
     # Read input
     try:
-        with open(inname, 'rb') as inFile:
-            data = inFile.read()
+        gds = gds_stream.GDSFile(inname)
     except:
         print('fix_sram_gds.py: failed to open ' + inname + ' for reading.', file=sys.stderr)
         return 1
@@ -48,25 +53,32 @@ def filter(inname, outname):
     # that causes issues in magic by being too close to the contact array to the side.
     orig_data3 = b'\x00\x04\x08\x00\x00\x06\x0d\x02\x00\x21\x00\x06\x0e\x02\x00\x00\x00\x2c\x10\x03\x00\x00\x24\x9f\xff\xff\xff\x92\x00\x00\x24\x9f\x00\x00\x00\x6e\x00\x00\x25\x7b\x00\x00\x00\x6e\x00\x00\x25\x7b\xff\xff\xff\x92\x00\x00\x24\x9f\xff\xff\xff\x92\x00\x04\x11\x00'
 
-    # This is not efficient, but only needs to be done once.
+    # All three patterns are found in a single pass over the mapped file.
+
+    chunks, count = gds_stream.replace_bytes(gds.buffer, gds.data, {
+		orig_data: replace_data,
+		orig_data2: orig_data2 + replace_data,
+		orig_data3: b''})
 
-    data = data.replace(orig_data, replace_data)
-    data = data.replace(orig_data2, orig_data2 + replace_data)
-    data = data.replace(orig_data3, b'')
+    # If the output is the input file and no modifications have been made,
+    # then leave it alone.
+    if count == 0 and os.path.abspath(outname) == os.path.abspath(inname):
+        gds.close()
+        return 0
 
-    # If the output is a symbolic link but no modifications have been made,
-    # then leave it alone.  If it was modified, then remove the symbolic
-    # link before writing.
+    # If the output is a symbolic link, then remove the symbolic link
+    # before writing.
     if os.path.islink(outname):
         os.unlink(outname)
 
     # Write output
     try:
-        with open(outname, 'wb') as ofile:
-            ofile.write(data)
+        gds_stream.write_gds(outname, chunks)
     except:
         print('fix_sram_gds.py: failed to open ' + outname + ' for writing.', file=sys.stderr)
         return 1
+    finally:
+        gds.close()
 
 
 if __name__ == '__main__':
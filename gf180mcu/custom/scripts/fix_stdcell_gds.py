@@ -20,12 +20,17 @@
 import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import gds_stream
+
 def filter(inname, outname):
 
+    if not outname:
+        outname = inname
+
     # Read input
     try:
-        with open(inname, 'rb') as inFile:
-            data = inFile.read()
+        gds = gds_stream.GDSFile(inname)
     except:
         print('fix_stdcell_gds.py: failed to open ' + inname + ' for reading.', file=sys.stderr)
         return 1
@@ -40,25 +45,32 @@ def filter(inname, outname):
     # with text "VPW", both at scale 0.25 (um).
     replace_data = b'\x00\x12\x19\x06\x26\x20\x4d\x65\x74\x72\x69\x63\x20\x31\x2e\x30\x30\x00\x00\x04\x11\x00\x00\x04\x0c\x00\x00\x06\x0d\x02\x00\x15\x00\x06\x16\x02\x00\x0a\x00\x06\x17\x01\x00\x05\x00\x06\x1a\x01\x00\x00\x00\x0c\x1b\x05\x40\x33\x33\x33\x33\x34\x00\x00\x00\x0c\x10\x03\x00\x00\x01\x59\x00\x00\x0f\x50\x00\x08\x19\x06\x56\x4e\x57\x00\x00\x04\x11\x00\x00\x04\x0c\x00\x00\x06\x0d\x02\x00\xcc\x00\x06\x16\x02\x00\x0a\x00\x06\x17\x01\x00\x05\x00\x06\x1a\x01\x00\x00\x00\x0c\x1b\x05\x40\x33\x33\x33\x33\x34\x00\x00\x00\x0c\x10\x03\x00\x00\x01\x54\xff\xff\xff\xab\x00\x08\x19\x06\x56\x50\x57\x00\x00\x04\x11\x00'
 
-    # This is not efficient, but only needs to be done once.
-
     # Ignore cells "filltie" and "endcap"
     if 'filltie' not in inname and 'endcap' not in inname:
-        data = data.replace(orig_data, replace_data)
+        chunks, count = gds_stream.replace_bytes(gds.buffer, gds.data,
+		{orig_data: replace_data})
+    else:
+        chunks, count = [gds.data], 0
+
+    # If the output is the input file and no modifications have been made,
+    # then leave it alone.
+    if count == 0 and os.path.abspath(outname) == os.path.abspath(inname):
+        gds.close()
+        return 0
 
-    # If the output is a symbolic link but no modifications have been made,
-    # then leave it alone.  If it was modified, then remove the symbolic
-    # link before writing.
+    # If the output is a symbolic link, then remove the symbolic link
+    # before writing.
     if os.path.islink(outname):
         os.unlink(outname)
 
     # Write output
     try:
-        with open(outname, 'wb') as ofile:
-            ofile.write(data)
+        gds_stream.write_gds(outname, chunks)
     except:
         print('fix_stdcell_gds.py: failed to open ' + outname + ' for writing.', file=sys.stderr)
         return 1
+    finally:
+        gds.close()
 
 
 if __name__ == '__main__':
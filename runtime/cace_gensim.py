@@ -71,6 +71,9 @@ from functools import reduce
 from spiceunits import spice_unit_convert
 from spiceunits import numeric
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import magic_session
+
 # Application path (path where this script is located)
 apps_path = os.path.realpath(os.path.dirname(__file__))
 
@@ -1705,42 +1708,50 @@ def regenerate_netlists(localmode, dspath, dsheet):
             os.makedirs(pexpath)
 
         print("Extracting LVS netlist from layout. . .")
-        mproc = subprocess.Popen(['magic', '-dnull', '-noconsole',
-		layoutpath], stdin = subprocess.PIPE, stdout=subprocess.PIPE,
-		stderr=subprocess.STDOUT, cwd = dspath + '/mag',
-		universal_newlines = True)
-        mproc.stdin.write("select top cell\n")
-        mproc.stdin.write("expand true\n")
-        mproc.stdin.write("extract all\n")
-        mproc.stdin.write("ext2spice hierarchy on\n")
-        mproc.stdin.write("ext2spice format ngspice\n")
-        mproc.stdin.write("ext2spice scale off\n")
-        mproc.stdin.write("ext2spice renumber off\n")
-        mproc.stdin.write("ext2spice subcircuit on\n")
-        mproc.stdin.write("ext2spice global off\n")
+        mscript = []
+        mscript.append("load " + magic_session.tcl_quote(os.path.splitext(layoutpath)[0]) + "\n")
+        mscript.append("select top cell\n")
+        mscript.append("expand true\n")
+        mscript.append("extract all\n")
+        mscript.append("ext2spice hierarchy on\n")
+        mscript.append("ext2spice format ngspice\n")
+        mscript.append("ext2spice scale off\n")
+        mscript.append("ext2spice renumber off\n")
+        mscript.append("ext2spice subcircuit on\n")
+        mscript.append("ext2spice global off\n")
         # Don't want black box entries, but create them so that we know which
         # subcircuits are in the ip path, then replace them.
-        mproc.stdin.write("ext2spice blackbox on\n")
+        mscript.append("ext2spice blackbox on\n")
         if need_lvs_extract:
-            mproc.stdin.write("ext2spice cthresh infinite\n")
-            mproc.stdin.write("ext2spice rthresh infinite\n")
-            mproc.stdin.write("ext2spice -o " + laynetlist + "\n")
+            mscript.append("ext2spice cthresh infinite\n")
+            mscript.append("ext2spice rthresh infinite\n")
+            mscript.append("ext2spice -o " + laynetlist + "\n")
         if need_pex_extract:
-            mproc.stdin.write("ext2spice cthresh 0.005\n")
-            mproc.stdin.write("ext2spice rthresh 1\n")
-            mproc.stdin.write("ext2spice -o " + pexnetlist + "\n")
-        mproc.stdin.write("quit -noprompt\n")
-        magout = mproc.communicate()[0]
-        printwarn(magout)
-        if mproc.returncode != 0:
-            print('Magic process returned error code ' + str(mproc.returncode) + '\n')
+            mscript.append("ext2spice cthresh 0.005\n")
+            mscript.append("ext2spice rthresh 1\n")
+            mscript.append("ext2spice -o " + pexnetlist + "\n")
+        mscript.append("quit -noprompt\n")
+
+        # Run on a magic process kept for the next netlist.  Magic reads
+        # the .magicrc file in the layout directory, if there is one, the
+        # same as if it were started there.
+        rcfile = dspath + '/mag/.magicrc'
+        if not os.path.isfile(rcfile):
+            rcfile = None
+        maglines = []
+        returncode = magic_session.get_pool().run_script(''.join(mscript),
+		dspath + '/mag', rcfile, outfunc=maglines.append,
+		errfunc=maglines.append)[0]
+        printwarn('\n'.join(maglines))
+        if returncode != 0:
+            print('Magic process returned error code ' + str(returncode) + '\n')
 
         if need_lvs_extract and not os.path.isfile(laynetlist):
             print('Error:  No LVS netlist extracted from magic.')
         if need_pex_extract and not os.path.isfile(pexnetlist):
             print('Error:  No parasitic extracted netlist extracted from magic.')
 
-        if (mproc.returncode != 0) or (need_lvs_extract and not os.path.isfile(laynetlist)) or (need_pex_extract and not os.path.isfile(pexnetlist)):
+        if (returncode != 0) or (need_lvs_extract and not os.path.isfile(laynetlist)) or (need_pex_extract and not os.path.isfile(pexnetlist)):
             return False
 
         if need_pex_extract and os.path.isfile(pexnetlist):
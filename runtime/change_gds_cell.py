@@ -10,12 +10,143 @@
 # There are no checks to ensure that the replacement cell is in any way compatible
 # with the existing cell.  Validation must be done independently.  This script is
 # only a simple GDS data compositor.
+#
+# With option "-cells", replace many cells in one pass:  "-cells" alone
+# replaces every cell in the alternate GDS file that is also in the source
+# GDS file, and "-cells=<name>[:<checksum>],..." replaces the listed cells
+# (each checked against its checksum, if given).
+#
+# Cells are found using a structure index of each GDS file (see
+# gds_index.py), which is saved next to the file and used again by later
+# runs, so that the files do not have to be searched each time.  Option
+# "-noindex" searches the files without reading or saving an index.
 
 import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import gds_stream
+import gds_index
+
 def usage():
-    print('change_gds_cell.py <cell_name> <path_to_cell_gds> <path_to_gds_in> [<path_to_gds_out>] [-checksum=<checksum>]')
+    print('change_gds_cell.py <cell_name> <path_to_cell_gds> <path_to_gds_in> [<path_to_gds_out>] [-checksum=<checksum>] [-noindex]')
+    print('change_gds_cell.py -cells[=<cell_name>[:<checksum>],...] <path_to_cell_gds> <path_to_gds_in> [<path_to_gds_out>] [-noindex]')
+
+#----------------------------------------------------------------------
+# Replace the cells in "cellnames" in GDS file "source" with the cells of
+# the same name in GDS file "cellsource", and write the result to "dest".
+# "checksums" is a dictionary of checksums by cell name, for the cells to
+# be checked.  If "required" is False, then cells that are not in both
+# files are skipped instead of being an error.  Returns 0 on success or 1
+# on failure.
+#----------------------------------------------------------------------
+
+def change_cells(cellnames, checksums, cellsource, source, dest, required=True,
+		use_index=True, debug=False):
+
+    if cellnames and len(cellnames) == 1:
+        print('Reading GDS file for alternate cell ' + cellnames[0])
+    else:
+        print('Reading GDS file for alternate cells ' + cellsource)
+    cellgds = gds_stream.GDSFile(cellsource)
+    celldata = cellgds.data
+    try:
+        cellindex = gds_index.GDSIndex(cellsource, celldata, use_index)
+    except gds_stream.GDSError as e:
+        print('Error: ' + str(e))
+        return 1
+
+    if cellnames is None:
+        cellnames = list(entry.name for entry in cellindex.entries)
+
+    #----------------------------------------------------------------------
+    # Find the extent of the data from 'beginstr' to 'endstr' of each cell
+    #----------------------------------------------------------------------
+
+    newcells = {}
+    for cellname in cellnames:
+        entry = cellindex.find(cellname)
+        if not entry:
+            if required:
+                print('Failed to find the cell data for ' + cellname)
+                return 1
+            continue
+        print('Cell ' + cellname + ' found at position ' + str(entry.start))
+        print('Cell ' + cellname + ' ends at position ' + str(entry.end))
+        newcells[cellname] = entry
+    if debug:
+        for entry in cellindex.entries:
+            if entry.name not in newcells:
+                print('Cell ' + entry.name + ' position ' + str(entry.nameoffset) + ' (ignored)')
+
+    #-----------------------------------------------------------------
+    # Now do the same thing for the source GDS file.
+    #-----------------------------------------------------------------
+
+    print('Reading GDS file for original source ' + source)
+    gds = gds_stream.GDSFile(source)
+    gdsdata = gds.data
+    try:
+        index = gds_index.GDSIndex(source, gdsdata, use_index)
+    except gds_stream.GDSError as e:
+        print('Error: ' + str(e))
+        return 1
+
+    oldcells = []
+    for cellname in cellnames:
+        if cellname not in newcells:
+            continue
+        entry = index.find(cellname)
+        if not entry:
+            if required:
+                print('Failed to find the cell data for ' + cellname)
+                return 1
+            print('Cell ' + cellname + ' is not in ' + source + ' (skipped)')
+            continue
+
+        # Checksum is the sum of the length of all records in the cell of
+        # interest, from the structure name through the end of the structure.
+        cellchecksum = entry.end - entry.nameoffset
+        print('Cell ' + cellname + ' found at position ' + str(entry.start))
+        print('Cell ' + cellname + ' ends at position ' + str(entry.end))
+        print('Cell ' + cellname + ' checksum is ' + str(cellchecksum))
+
+        checksum = checksums.get(cellname, 0)
+        if checksum != 0:
+            if cellchecksum == checksum:
+                print('Info:  Structure ' + cellname + ' matches checksum ' + str(checksum))
+            else:
+                print('Info:  Structure ' + cellname + ' at ' + str(entry.start) + ' to ' +
+			str(entry.end) + ' has checksum ' + str(cellchecksum) +
+			' != ' + str(checksum) + ' (checksum failure)')
+                return 1
+        else:
+            print('Info:  Structure ' + cellname + ' checksum is ' + str(cellchecksum))
+
+        print('Info:  Structure ' + cellname + ' at ' + str(entry.start) + ' to ' +
+			str(entry.end) + ' will be replaced by alternate data.')
+        oldcells.append(entry)
+
+    if debug:
+        for entry in index.entries:
+            if entry.name not in newcells:
+                print('Cell ' + entry.name + ' position ' + str(entry.nameoffset) + ' (copied)')
+
+    # Reassemble the GDS data around the new cells
+    oldcells.sort(key=lambda entry: entry.start)
+    chunks = []
+    dataptr = 0
+    for entry in oldcells:
+        newentry = newcells[entry.name]
+        chunks.append(gdsdata[dataptr:entry.start])
+        chunks.append(celldata[newentry.start:newentry.end])
+        dataptr = entry.end
+    chunks.append(gdsdata[dataptr:])
+    gds_stream.write_gds(dest, chunks)
+
+    gds.close()
+    cellgds.close()
+    return 0
 
 if __name__ == '__main__':
     debug = False
@@ -34,191 +165,57 @@ if __name__ == '__main__':
         else:
             arguments.append(option)
 
-    if len(arguments) < 3 or len(arguments) > 4:
-        print("Wrong number of arguments given to change_gds_cell.py.")
-        usage()
-        sys.exit(0)
-
     checksum = '0'
+    cellnames = None
+    batch = False
+    use_index = True
+    checksums = {}
     for option in optionlist:
         if option == '-debug':
             debug = True
+        elif option == '-noindex':
+            use_index = False
         elif option.split('=')[0] == '-checksum':
             checksum = option.split('=')[1]
+        elif option.split('=')[0] == '-cells':
+            batch = True
+            if '=' in option:
+                cellnames = []
+                for item in option.split('=', 1)[1].split(','):
+                    cellname, sep, cellsum = item.partition(':')
+                    cellnames.append(cellname)
+                    if cellsum:
+                        checksums[cellname] = cellsum
+
+    nargs = 2 if batch else 3
+    if len(arguments) < nargs or len(arguments) > nargs + 1:
+        print("Wrong number of arguments given to change_gds_cell.py.")
+        usage()
+        sys.exit(0)
+
+    if not batch:
+        cellnames = [arguments[0]]
+        checksums[arguments[0]] = checksum
+        arguments = arguments[1:]
 
     try:
-        checksum = int(checksum)
+        checksums = dict((key, int(value)) for key, value in checksums.items())
     except:
         print('Checksum must evaluate to an integer.')
         sys.exit(1)
 
-    cellname = arguments[0]
-    cellsource = arguments[1]
-    source = arguments[2]
+    cellsource = arguments[0]
+    source = arguments[1]
 
-    # If only three arguments are provided, then overwrite the source file.
-    if len(arguments) == 4:
-        dest = arguments[3]
-    else:
+    # If only the source file is provided, then overwrite the source file.
+    if len(arguments) == 3:
         dest = arguments[2]
-
-    cellsrcdir = os.path.split(cellsource)[0]
-    cellinfile = os.path.split(cellsource)[1]
-    sourcedir = os.path.split(source)[0]
-    gdsinfile = os.path.split(source)[1]
-
-    destdir = os.path.split(dest)[0]
-    gdsoutfile = os.path.split(dest)[1]
-
-    print('Reading GDS file for alternate cell ' + cellname)
-    with open(cellsource, 'rb') as ifile:
-        celldata = ifile.read()
-
-    #----------------------------------------------------------------------
-    # Assume that celldata contains the cell in question.
-    # Find the extend of the data from 'beginstr' to 'endstr'
-    #----------------------------------------------------------------------
-    
-    datalen = len(celldata)
-    dataptr = 0
-    incell = False
-    datastart = dataend = -1
-    while dataptr < datalen:
-        # Read stream records up to 'beginstr', then save data through 'endstr'
-        bheader = celldata[dataptr:dataptr + 2]
-        reclen = int.from_bytes(bheader, 'big')
-        if reclen == 0:
-            print('Error: found zero-length record at position ' + str(dataptr))
-            break
-
-        rectype = celldata[dataptr + 2]
-        datatype = celldata[dataptr + 3]
-
-        brectype = rectype.to_bytes(1, byteorder='big')
-        bdatatype = datatype.to_bytes(1, byteorder='big')
-
-        if rectype == 5:            # beginstr
-            saveptr = dataptr
-
-        elif rectype == 6:            # strname
-            if datatype != 6:
-                print('Error: Structure name record is not a string!')
-                sys.exit(1)
-
-            bstring = celldata[dataptr + 4: dataptr + reclen]
-            # Odd length strings end in null byte which needs to be removed
-            if bstring[-1] == 0:
-                bstring = bstring[:-1]
-            strname = bstring.decode('ascii')
-            if strname == cellname:
-                print('Cell ' + cellname + ' found at position ' + str(saveptr))
-                datastart = saveptr
-                incell = True
-            elif debug:
-                print('Cell ' + strname + ' position ' + str(dataptr) + ' (ignored)')
-
-        elif rectype == 7:		# endstr
-            if incell:
-                incell = False
-                dataend = dataptr + reclen
-                print('Cell ' + cellname + ' ends at position ' + str(dataend))
-
-        # Advance the pointer past the data
-        dataptr += reclen
-
-    if datastart == -1 or dataend == -1:
-        print('Failed to find the cell data for ' + cellname)
-        sys.exit(1)
-
-    #-----------------------------------------------------------------
-    # Now do the same thing for the source GDS file.
-    #-----------------------------------------------------------------
-
-    print('Reading GDS file for original source ' + source)
-    with open(source, 'rb') as ifile:
-        gdsdata = ifile.read()
-
-    datalen = len(gdsdata)
-    dataptr = 0
-    incell = False
-    cellchecksum = 0
-    oldstart = oldend = -1
-    while dataptr < datalen:
-        # Read stream records up to any structure, then check for structure name
-        bheader = gdsdata[dataptr:dataptr + 2]
-        reclen = int.from_bytes(bheader, 'big')
-        if reclen == 0:
-            print('Error: found zero-length record at position ' + str(dataptr))
-            break
-
-        rectype = gdsdata[dataptr + 2]
-        datatype = gdsdata[dataptr + 3]
-
-        brectype = rectype.to_bytes(1, byteorder='big')
-        bdatatype = datatype.to_bytes(1, byteorder='big')
-
-        if rectype == 5:            # beginstr
-            saveptr = dataptr
-
-        elif rectype == 6:            # strname
-            if datatype != 6:
-                print('Error: Structure name record is not a string!')
-                sys.exit(1)
-
-            bstring = gdsdata[dataptr + 4: dataptr + reclen]
-            # Odd length strings end in null byte which needs to be removed
-            if bstring[-1] == 0:
-                bstring = bstring[:-1]
-            strname = bstring.decode('ascii')
-            if strname == cellname:
-                print('Cell ' + cellname + ' found at position ' + str(saveptr))
-                oldstart = saveptr
-                incell = True
-            elif debug:
-                print('Cell ' + strname + ' position ' + str(dataptr) + ' (copied)')
-
-        elif rectype == 7:		# endstr
-            if incell:
-                incell = False
-                cellchecksum = cellchecksum + reclen
-                oldend = dataptr + reclen
-                print('Cell ' + cellname + ' ends at position ' + str(oldend))
-                print('Cell ' + cellname + ' checksum is ' + str(cellchecksum))
-
-        # Find checksum (sum of length of all records in the cell of interest)
-        if incell:
-            cellchecksum = cellchecksum + reclen
-
-        # Advance the pointer past the data
-        dataptr += reclen
-
-    if oldstart == -1 or oldend == -1:
-        print('Failed to find the cell data for ' + cellname)
-        sys.exit(1)
-
-    if checksum != 0:
-        if cellchecksum == checksum:
-            print('Info:  Structure ' + cellname + ' matches checksum ' + str(checksum))
-        else:
-            print('Info:  Structure ' + cellname + ' at ' + str(oldstart) + ' to ' +
-		str(oldend) + ' has checksum ' + str(cellchecksum) +
-		' != ' + str(checksum) + ' (checksum failure)')
-            sys.exit(1)
     else:
-        print('Info:  Structure ' + cellname + ' checksum is ' + str(cellchecksum))
-
-    print('Info:  Structure ' + cellname + ' at ' + str(oldstart) + ' to ' +
-		str(oldend) + ' will be replaced by alternate data.')
-
-    before = gdsdata[0:oldstart]
-    after = gdsdata[oldend:]
-
-    cellstrdata = celldata[datastart:dataend]
-
-    # Reassemble the GDS data around the new cell
-    gdsdata = before + cellstrdata + after
-
-    with open(dest, 'wb') as ofile:
-        ofile.write(gdsdata)
-
-    exit(0)
+        dest = arguments[1]
+
+    # With "-cells" and no list of cells, cells in the alternate GDS file
+    # that are not in the source GDS file are skipped.
+    required = cellnames is not None
+    result = change_cells(cellnames, checksums, cellsource, source, dest,
+		required, use_index, debug)
+    sys.exit(result)
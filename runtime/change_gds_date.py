@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 # Script to read a GDS file, modify the timestamp(s), and rewrite the GDS file.
+#
+# With option "-tree", set the timestamps of every GDS file in the given
+# files and directories (searched recursively), changing the date records
+# of each file in place.  Files whose dates are already correct are not
+# changed.  Option "-jobs=<n>" handles <n> files at a time, and option
+# "-verbose" lists the files changed and the files that were already
+# correct.
 
 import os
 import sys
-import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import gds_stream
+import gds_dates
 
 def usage():
     print('change_gds_date.py <create_stamp> <mod_stamp> <path_to_gds_in> [<path_to_gds_out>]')
+    print('change_gds_date.py -tree [-jobs=<n>] [-verbose] <create_stamp> <mod_stamp> <path> ...')
 
 if __name__ == '__main__':
     debug = False
@@ -25,14 +36,36 @@ if __name__ == '__main__':
         else:
             arguments.append(option)
 
+    tree = False
+    jobs = 1
+    verbose = False
+    for option in optionlist:
+        opval = option.split('=')
+        if opval[0] == '-debug':
+            debug = True
+        elif opval[0] == '-tree':
+            tree = True
+        elif opval[0] == '-verbose':
+            verbose = True
+        elif opval[0] == '-jobs' and len(opval) == 2:
+            jobs = max(1, int(opval[1]))
+
+    if tree:
+        if len(arguments) < 3:
+            print("Wrong number of arguments given to change_gds_date.py.")
+            usage()
+            sys.exit(0)
+        results = gds_dates.set_tree_dates(arguments[2:], arguments[0],
+			arguments[1], jobs)
+        if gds_dates.print_results(results, verbose) > 0:
+            sys.exit(1)
+        sys.exit(0)
+
     if len(arguments) < 3 or len(arguments) > 4:
         print("Wrong number of arguments given to change_gds_date.py.")
         usage()
         sys.exit(0)
 
-    if '-debug' in optionlist:
-        debug = True
-
     createstamp = arguments[0]
     modstamp = arguments[1]
     source = arguments[2]
@@ -57,86 +90,43 @@ if __name__ == '__main__':
     destdir = os.path.split(dest)[0]
     gdsoutfile = os.path.split(dest)[1]
 
-    with open(source, 'rb') as ifile:
-        gdsdata = ifile.read()
-
-    # Generate 12-byte modification timestamp data from date.
-    try:
-        modtime = datetime.datetime.fromtimestamp(int(modstamp))
-    except:
-        modtime = datetime.datetime.strptime(modstamp, "%m/%d/%Y %H:%M:%S")
-
-    modyear = modtime.year - 1900
-
-    year = modyear.to_bytes(2, byteorder='big')
-    month = modtime.month.to_bytes(2, byteorder='big')
-    day = modtime.day.to_bytes(2, byteorder='big')
-    hour = modtime.hour.to_bytes(2, byteorder='big')
-    minute = modtime.minute.to_bytes(2, byteorder='big')
-    second = modtime.second.to_bytes(2, byteorder='big')
-
-    gdsmodstamp = year + month + day + hour + minute + second
-
-    # Generate 12-byte creation timestamp data from date.
-    try:
-        createtime = datetime.datetime.fromtimestamp(int(createstamp))
-    except:
-        createtime = datetime.datetime.strptime(createstamp, "%m/%d/%Y %H:%M:%S")
-
-    createyear = createtime.year - 1900
-
-    year = createyear.to_bytes(2, byteorder='big')
-    month = createtime.month.to_bytes(2, byteorder='big')
-    day = createtime.day.to_bytes(2, byteorder='big')
-    hour = createtime.hour.to_bytes(2, byteorder='big')
-    minute = createtime.minute.to_bytes(2, byteorder='big')
-    second = createtime.second.to_bytes(2, byteorder='big')
-
-    gdscreatestamp = year + month + day + hour + minute + second
+    # Generate 12-byte modification and creation timestamp data from dates.
+    gdsmodstamp = gds_stream.make_timestamp(modstamp)
+    gdscreatestamp = gds_stream.make_timestamp(createstamp)
 
     # To be done:  Allow the user to select which datestamps to change
     # (library or structure).  Otherwise, apply the same datestamps to both.
 
     recordtypes = ['beginstr', 'beginlib']
-    recordfilter = [5, 1]
+    recordfilter = [gds_stream.BGNSTR, gds_stream.BGNLIB]
 
-    datalen = len(gdsdata)
+    gds = gds_stream.GDSFile(source)
+    gdsdata = gds.data
+
+    # The date records do not change size, so the output is the original
+    # data with the dates of each record replaced.
+    chunks = []
     dataptr = 0
-    while dataptr < datalen:
-        # Read stream records up to any string, then search for search text.
-        bheader = gdsdata[dataptr:dataptr + 2]
-        reclen = int.from_bytes(bheader, 'big')
-        if reclen == 0:
-            print('Error: found zero-length record at position ' + str(dataptr))
-            break
-
-        rectype = gdsdata[dataptr + 2]
-        datatype = gdsdata[dataptr + 3]
-
-        brectype = rectype.to_bytes(1, byteorder='big')
-        bdatatype = datatype.to_bytes(1, byteorder='big')
-
-        if rectype in recordfilter:
-            # Datatype should be 2
-            if datatype != 2:
-                print('Error:  Header data type is not 2-byte integer!')
-            if reclen != 28:
-                print('Error:  Header record length is not 28!')
-            if debug:
-                print('Record type = ' + str(rectype) + ' data type = ' + str(datatype) + ' length = ' + str(reclen))
-
-            before = gdsdata[0:dataptr]
-            after = gdsdata[dataptr + reclen:]
-
-            # Assemble the new record
-            newrecord = bheader + brectype + bdatatype + gdscreatestamp + gdsmodstamp
-            # Reassemble the GDS data around the new record
-            gdsdata = before + newrecord + after
-
-        # Advance the pointer past the data
-        dataptr += reclen
-
-    with open(dest, 'wb') as ofile:
-        ofile.write(gdsdata)
+    try:
+        for offset, reclen, rectype, datatype in gds_stream.records(gdsdata):
+            if rectype in recordfilter:
+                # Datatype should be 2
+                if datatype != gds_stream.INT2:
+                    print('Error:  Header data type is not 2-byte integer!')
+                if reclen != 28:
+                    print('Error:  Header record length is not 28!')
+                    continue
+                if debug:
+                    print('Record type = ' + str(rectype) + ' data type = ' + str(datatype) + ' length = ' + str(reclen))
+
+                chunks.append(gdsdata[dataptr:offset + 4])
+                chunks.append(gdscreatestamp + gdsmodstamp)
+                dataptr = offset + reclen
+    except gds_stream.GDSError as e:
+        print('Error: ' + str(e))
+
+    chunks.append(gdsdata[dataptr:])
+    gds_stream.write_gds(dest, chunks)
+    gds.close()
 
     exit(0)
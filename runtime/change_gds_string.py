@@ -4,17 +4,235 @@
 # library name, structure name, instance name, and other strings, and the
 # replacement made everywhere it occurs, finding the bounds of the entire
 # string around the search text, and adjusting the record bounds accordingly.
+#
+# Batch mode:  With option "-map=<file>", the strings and replacements are
+# read from a mapping file with one "<old_string> <new_string>" pair per
+# line (blank lines and lines beginning with "#" are ignored), and every
+# GDS file given on the command line (or matched by a glob pattern) is
+# rewritten in place.  In batch mode the search strings are literal
+# strings (not regular expressions), all of them are matched in a single
+# pass over each string, and a replacement is not searched again for other
+# strings.  Option "-jobs=<n>" processes n files in parallel.
 
 import os
 import re
 import sys
+import glob
+import io
+import contextlib
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import gds_stream
+
+# To be done:  Allow the user to select a specific record type or types
+# in which to restrict the string substitution.  If no restrictions are
+# specified, then substitue in library name, structure name, and strings.
+
+recordtypes = ['libname', 'strname', 'sname', 'string']
+recordfilter = [gds_stream.LIBNAME, gds_stream.STRNAME, gds_stream.SNAME,
+		gds_stream.STRING]
 
 def usage():
     print('change_gds_string.py <old_string> <new_string> [...] <path_to_gds_in> [<path_to_gds_out>]')
+    print('change_gds_string.py -map=<mapping_file> [-jobs=<n>] <path_to_gds> [...]')
+
+#----------------------------------------------------------------------
+# Replace strings in the string records of GDS file "source" and write
+# the result to "dest".  "substitute" is a function that takes the
+# contents of a string record (bytes) and returns the contents with the
+# strings replaced.  If "always" is False and nothing was replaced, then
+# the output is not written.  Returns the number of records changed.
+#----------------------------------------------------------------------
+
+def change_strings(source, dest, substitute, always=True, debug=0):
+    gds = gds_stream.GDSFile(source)
+    gdsdata = gds.data
+
+    datalen = len(gdsdata)
+    if debug > 0:
+        print('Original data length = ' + str(datalen))
+
+    # Unchanged data is copied from the source in pieces between the
+    # records that were changed.
+    chunks = []
+    dataptr = 0
+    changed = 0
+    try:
+        for offset, reclen, rectype, datatype in gds_stream.records(gdsdata):
+            if rectype not in recordfilter:
+                continue
+
+            # Datatype 6 is STRING
+            if datatype != gds_stream.ASCII:
+                if debug > 1:
+                    idx = recordfilter.index(rectype)
+                    print(recordtypes[idx] + ' record = ' + str(datatype) + ' is not a string')
+                continue
+
+            bstring = bytes(gdsdata[offset + 4:offset + reclen])
+            if debug > 1:
+                idx = recordfilter.index(rectype)
+                print(recordtypes[idx] + ' string = ' + str(bstring))
+
+            repstring = substitute(bstring)
+            if repstring == bstring:
+                continue
+
+            # Record sizes must be even.  Remove any null byte that padded
+            # the original string, and pad the new string if needed.
+            if repstring.endswith(b'\x00'):
+                repstring = repstring[0:-1]
+            if len(repstring) % 2 != 0:
+                repstring += b'\x00'
+            newlen = len(repstring) + 4
+            if newlen > 0xffff:
+                raise gds_stream.GDSError('replacement string at position ' +
+			str(offset) + ' is too long for a GDS record')
+
+            # Assemble the new record
+            chunks.append(gdsdata[dataptr:offset])
+            chunks.append(gds_stream.header.pack(newlen, rectype, datatype) + repstring)
+            dataptr = offset + reclen
+            changed += 1
+    except gds_stream.GDSError as e:
+        print('Error: ' + str(e))
+
+    chunks.append(gdsdata[dataptr:])
+
+    if changed or always:
+        gds_stream.write_gds(dest, chunks)
+    gds.close()
+    return changed
+
+#----------------------------------------------------------------------
+# Return a substitution function (for change_strings()) that applies each
+# pair of regular expression "oldstrings" and replacement "newstrings"
+# in turn.
+#----------------------------------------------------------------------
+
+def pair_substitution(oldstrings, newstrings, verbatim=False, debug=0):
+    bsearchlist = list(bytes(item, 'ascii') for item in oldstrings)
+    breplist = list(bytes(item, 'ascii') for item in newstrings)
+    bpatterns = list(re.compile(bsearch) for bsearch in bsearchlist)
+
+    if debug > 1:
+        print('Search list = ' + str(bsearchlist))
+        print('Replace list = ' + str(breplist))
+
+    def substitute(bstring):
+        repstring = bstring
+        for bsearch, bpattern, brep in zip(bsearchlist, bpatterns, breplist):
+            # Verbatim option:  search string must match GDS string exactly
+            if verbatim:
+                blen = len(repstring)
+                if repstring.endswith(b'\x00'):
+                    blen = blen - 1
+                if len(bsearch) != blen:
+                    continue
+            newstring = bpattern.sub(brep, repstring)
+            if newstring != repstring:
+                if debug > 0:
+                    print('Replaced ' + str(repstring) + ' with ' + str(newstring))
+                repstring = newstring
+        return repstring
+
+    return substitute
+
+#----------------------------------------------------------------------
+# Literal string replacements for batch mode.  All of the search strings
+# are compiled into one regular expression, longest first, so that each
+# string record is searched once no matter how many strings there are.
+# Record strings repeat often (e.g., the cell name of every instance of a
+# cell), so the result for each distinct string is saved.  With
+# "verbatim", a search string must match the entire record string.
+#----------------------------------------------------------------------
+
+class StringMap(object):
+
+    def __init__(self, pairs, verbatim=False):
+        self.table = dict((bytes(old, 'ascii'), bytes(new, 'ascii')) for old, new in pairs)
+        self.verbatim = verbatim
+        keys = sorted(self.table.keys(), key=lambda key: -len(key))
+        keys = list(key for key in keys if key)
+        self.pattern = re.compile(b'|'.join(re.escape(key) for key in keys)) if keys else None
+        self.results = {}
+
+    def substitute(self, bstring):
+        repstring = self.results.get(bstring)
+        if repstring is not None:
+            return repstring
+        if self.pattern is None:
+            repstring = bstring
+        elif self.verbatim:
+            key = bstring[0:-1] if bstring.endswith(b'\x00') else bstring
+            repstring = self.table.get(key, bstring)
+        else:
+            repstring = self.pattern.sub(lambda match: self.table[match.group(0)], bstring)
+        self.results[bstring] = repstring
+        return repstring
+
+#----------------------------------------------------------------------
+# Read a mapping file of "<old_string> <new_string>" pairs.
+#----------------------------------------------------------------------
+
+def read_mapfile(mapfile):
+    pairs = []
+    with open(mapfile, 'r') as ifile:
+        for line in ifile:
+            tokens = line.split()
+            if not tokens or tokens[0].startswith('#'):
+                continue
+            if len(tokens) != 2:
+                raise ValueError('Bad line in mapping file ' + mapfile + ': ' + line.strip())
+            pairs.append((tokens[0], tokens[1]))
+    return pairs
+
+# Same as change_strings() on one file in batch mode, but return the
+# output instead of printing it, for use in a worker process.  Returns
+# (number of records changed, output).
+
+def change_strings_captured(filepath, stringmap, debug=0):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            changed = change_strings(filepath, filepath, stringmap.substitute, False, debug)
+        except (OSError, gds_stream.GDSError) as e:
+            print('Error:  ' + filepath + ': ' + str(e))
+            changed = 0
+    return (changed, output.getvalue())
+
+#----------------------------------------------------------------------
+# Batch mode:  Apply the replacements in "stringmap" to every file in
+# "filelist", in place, with "jobs" files in parallel.  Returns the
+# total number of records changed.
+#----------------------------------------------------------------------
+
+def change_files(filelist, stringmap, jobs=1, debug=0):
+    if jobs == 1 or len(filelist) < 2:
+        results = list(change_strings_captured(filepath, stringmap, debug)
+			for filepath in filelist)
+    else:
+        sys.stdout.flush()
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(min(jobs, len(filelist))) as pool:
+            results = pool.starmap(change_strings_captured, list((filepath,
+			stringmap, debug) for filepath in filelist), chunksize=4)
+
+    total = 0
+    for filepath, (changed, output) in zip(filelist, results):
+        sys.stdout.write(output)
+        if changed:
+            print(filepath + ': ' + str(changed) + ' strings replaced')
+        total += changed
+    sys.stdout.flush()
+    return total
 
 if __name__ == '__main__':
     debug = 0
     verbatim = False
+    mapfile = None
+    jobs = 1
 
     if len(sys.argv) == 1:
         print("No options given to change_gds_string.py.")
@@ -30,11 +248,6 @@ if __name__ == '__main__':
         else:
             arguments.append(option)
 
-    if len(arguments) < 3:
-        print("Wrong number of arguments given to change_gds_string.py.")
-        usage()
-        sys.exit(0)
-
     for option in optionlist:
         opval = option.split('=')
         if opval[0] == '-debug':
@@ -44,6 +257,39 @@ if __name__ == '__main__':
                 debug = 1
         elif opval[0] == '-verbatim':
             verbatim = True
+        elif opval[0] == '-map' and len(opval) == 2:
+            mapfile = opval[1]
+        elif opval[0] == '-jobs' and len(opval) == 2:
+            jobs = max(1, int(opval[1]))
+
+    if mapfile:
+        if len(arguments) < 1:
+            print("No GDS files given to change_gds_string.py.")
+            usage()
+            sys.exit(0)
+
+        try:
+            pairs = read_mapfile(mapfile)
+        except (OSError, ValueError) as e:
+            print('Error:  ' + str(e))
+            sys.exit(1)
+
+        # Arguments are file names or glob patterns
+        filelist = []
+        for argument in arguments:
+            if os.path.isfile(argument):
+                filelist.append(argument)
+            else:
+                filelist.extend(sorted(glob.glob(argument)))
+
+        total = change_files(filelist, StringMap(pairs, verbatim), jobs, debug)
+        print('Replaced ' + str(total) + ' strings in ' + str(len(filelist)) + ' files.')
+        sys.exit(0)
+
+    if len(arguments) < 3:
+        print("Wrong number of arguments given to change_gds_string.py.")
+        usage()
+        sys.exit(0)
 
     # If next-to-last argument is a valid path, then the last argument should
     # be the path to GDS out.  Otherwise, overwrite the source file.
@@ -63,99 +309,7 @@ if __name__ == '__main__':
         print('Error:  List of strings and replacements is not in pairs.')
         sys.exit(1)
 
-    sourcedir = os.path.split(source)[0]
-    gdsinfile = os.path.split(source)[1]
-
-    destdir = os.path.split(dest)[0]
-    gdsoutfile = os.path.split(dest)[1]
-
-    with open(source, 'rb') as ifile:
-        gdsdata = ifile.read()
-
-    # To be done:  Allow the user to select a specific record type or types
-    # in which to restrict the string substitution.  If no restrictions are
-    # specified, then substitue in library name, structure name, and strings.
-
-    recordtypes = ['libname', 'strname', 'sname', 'string']
-    recordfilter = [2, 6, 18, 25]
-    bsearchlist = list(bytes(item, 'ascii') for item in oldstrings)
-    breplist = list(bytes(item, 'ascii') for item in newstrings)
-
-    if debug > 1:
-        print('Search list = ' + str(bsearchlist))
-        print('Replace list = ' + str(breplist))
-
-    datalen = len(gdsdata)
-    if debug > 0:
-        print('Original data length = ' + str(datalen))
-    dataptr = 0
-    while dataptr < datalen:
-        # Read stream records up to any string, then search for search text.
-        bheader = gdsdata[dataptr:dataptr + 2]
-        reclen = int.from_bytes(bheader, 'big')
-        newlen = reclen
-        if newlen == 0:
-            print('Error: found zero-length record at position ' + str(dataptr))
-            break
-
-        rectype = gdsdata[dataptr + 2]
-        datatype = gdsdata[dataptr + 3]
-
-        if rectype in recordfilter:
-            # Datatype 6 is STRING
-            if datatype == 6:
-                bstring = gdsdata[dataptr + 4: dataptr + reclen]
-                if debug > 1:
-                    idx = recordfilter.index(rectype)
-                    print(recordtypes[idx] + ' string = ' + str(bstring))
-
-                for bsearch,brep in zip(bsearchlist, breplist):
-                    # Verbatim option:  search string must match GDS string exactly
-                    if verbatim:
-                        blen = reclen - 4
-                        if bstring[-1] == 0:
-                            blen = blen - 1
-                        if len(bsearch) != blen:
-                            continue
-                    repstring = re.sub(bsearch, brep, bstring)
-                    if repstring != bstring:
-                        before = gdsdata[0:dataptr]
-                        after = gdsdata[dataptr + reclen:]
-                        newlen = len(repstring) + 4
-                        # Record sizes must be even
-                        if newlen % 2 != 0:
-                            # Was original string padded with null byte?  If so,
-                            # remove the null byte and reduce newlen.  Otherwise,
-                            # add a null byte and increase newlen.
-                            if bstring[-1] == 0:
-                                repstring = repstring[0:-1]
-                                newlen -= 1
-                            else:
-                                repstring += b'\x00'
-                                newlen += 1
-                            
-                        bnewlen = newlen.to_bytes(2, byteorder='big')
-                        brectype = rectype.to_bytes(1, byteorder='big')
-                        bdatatype = datatype.to_bytes(1, byteorder='big')
-
-                        # Assemble the new record
-                        newrecord = bnewlen + brectype + bdatatype + repstring
-                        # Reassemble the GDS data around the new record
-                        gdsdata = before + newrecord[0:newlen] + after
-                        # Adjust the data end location
-                        datalen += (newlen - reclen)
-
-                        if debug > 0:
-                            print('Replaced ' + str(bstring) + ' with ' + str(repstring)) 
-            else:
-                if debug > 1:
-                    idx = recordfilter.index(rectype)
-                    print(recordtypes[idx] + ' record = ' + str(datatype) + ' is not a string')
-
-        # Advance the pointer past the data
-        dataptr += newlen
-
-    with open(dest, 'wb') as ofile:
-        ofile.write(gdsdata)
+    substitute = pair_substitution(oldstrings, newstrings, verbatim, debug)
+    change_strings(source, dest, substitute, True, debug)
 
     exit(0)
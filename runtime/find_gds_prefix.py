@@ -3,13 +3,19 @@
 # Script to read a GDS file, and find the given cellname if it has the
 # standard random two-character prefix generated by magic when writing
 # out a vendor GDS, and report the prefix.  No changes are made to any
-# file.
+# file (except for the structure index of the GDS file, which is saved
+# next to the file to speed up later searches;  see gds_index.py.  Use
+# option "-noindex" to search the file without the index).
 
 import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import gds_stream
+import gds_index
+
 def usage():
-    print('find_gds_prefix.py <cell_name> <path_to_cell_gds>')
+    print('find_gds_prefix.py <cell_name> <path_to_cell_gds> [-noindex]')
 
 if __name__ == '__main__':
     debug = False
@@ -33,9 +39,12 @@ if __name__ == '__main__':
         usage()
         sys.exit(0)
 
+    use_index = True
     for option in optionlist:
         if option == '-debug':
             debug = True
+        elif option == '-noindex':
+            use_index = False
 
     cellname = arguments[0]
     cellsource = arguments[1]
@@ -44,56 +53,33 @@ if __name__ == '__main__':
     cellinfile = os.path.split(cellsource)[1]
 
     print('Reading GDS file looking for prefixed cell ' + cellname)
-    with open(cellsource, 'rb') as ifile:
-        celldata = ifile.read()
+    gds = gds_stream.GDSFile(cellsource)
 
     #----------------------------------------------------------------------
-    # Assume that celldata contains the cell in question.
-    # Find the extend of the data from 'beginstr' to 'endstr'
+    # Assume that the GDS data contains the cell in question.
     #----------------------------------------------------------------------
-    
-    datalen = len(celldata)
-    dataptr = 0
+
     found = False
-    while dataptr < datalen:
-        # Read stream records up to 'beginstr'
-        bheader = celldata[dataptr:dataptr + 2]
-        reclen = int.from_bytes(bheader, 'big')
-        if reclen == 0:
-            print('Error: found zero-length record at position ' + str(dataptr))
-            break
-
-        rectype = celldata[dataptr + 2]
-        datatype = celldata[dataptr + 3]
-
-        brectype = rectype.to_bytes(1, byteorder='big')
-        bdatatype = datatype.to_bytes(1, byteorder='big')
-
-        if rectype == 5:            # beginstr
-            saveptr = dataptr
-
-        elif rectype == 6:            # strname
-            if datatype != 6:
-                print('Error: Structure name record is not a string!')
-                sys.exit(1)
-
-            bstring = celldata[dataptr + 4: dataptr + reclen]
-            # Odd length strings end in null byte which needs to be removed
-            if bstring[-1] == 0:
-                bstring = bstring[:-1]
-            strname = bstring.decode('ascii')
+    try:
+        if use_index:
+            cells = gds_index.GDSIndex(cellsource, gds.data).entries
+        else:
+            cells = gds_stream.structures(gds.data)
+        for cell in cells:
+            strname = cell.name
             if strname[3:] == cellname:
-                print('Cell ' + strname + ' found at position ' + str(saveptr))
+                print('Cell ' + strname + ' found at position ' + str(cell.start))
                 print('Prefix: ' + strname[0:3])
                 found = True
                 break
             elif strname == cellname:
-                print('Unprefixed cell ' + strname + ' found at position ' + str(saveptr))
+                print('Unprefixed cell ' + strname + ' found at position ' + str(cell.start))
             elif debug:
-                print('Cell ' + strname + ' position ' + str(dataptr) + ' (ignored)')
+                print('Cell ' + strname + ' position ' + str(cell.nameoffset) + ' (ignored)')
+    except gds_stream.GDSError as e:
+        print('Error: ' + str(e))
 
-        # Advance the pointer past the data
-        dataptr += reclen
+    gds.close()
 
     if not found:
         print('Failed to find a prefixed cell ' + cellname)
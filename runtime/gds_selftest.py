@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+#
+# gds_selftest.py ---
+#
+#    Check the GDS stream routines (gds_stream.py, gds_index.py) and the
+#    GDS rewriting scripts (change_gds_string.py, change_gds_cell.py) on a
+#    small GDS library written by this script:  Records and structures
+#    must be found where they were written, the structure index must match
+#    the file (and must not be used once the file has changed), and each
+#    string or cell replacement, followed by the reverse replacement, must
+#    give back the original file byte for byte.
+#
+#    Usage:  gds_selftest.py [-keep]
+#
+#    Prints each failed check and exits with status 1 if any check failed.
+#    With "-keep", the GDS files written are left in a temporary directory.
+#
+
+import os
+import io
+import sys
+import shutil
+import tempfile
+import contextlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import gds_stream
+import gds_index
+import change_gds_string
+import change_gds_cell
+
+failures = []
+
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print('Failed:  ' + message)
+
+#----------------------------------------------------------------------
+# Return a GDS record of type "rectype" with data type "datatype" and
+# the contents "body" (bytes).
+#----------------------------------------------------------------------
+
+def record(rectype, datatype=gds_stream.NODATA, body=b''):
+    return gds_stream.header.pack(len(body) + 4, rectype, datatype) + body
+
+def int2_record(rectype, values):
+    body = b''.join(value.to_bytes(2, 'big', signed=True) for value in values)
+    return record(rectype, gds_stream.INT2, body)
+
+def int4_record(rectype, values):
+    body = b''.join(value.to_bytes(4, 'big', signed=True) for value in values)
+    return record(rectype, gds_stream.INT4, body)
+
+#----------------------------------------------------------------------
+# Return the records of a structure named "name" with one rectangle on
+# each (layer, datatype) in "layers", a text label "label", and an SREF
+# to each structure in "children".
+#----------------------------------------------------------------------
+
+def structure(name, layers, label, children=[]):
+    stamp = gds_stream.make_timestamp('01/02/2020 03:04:05')
+    data = [record(gds_stream.BGNSTR, gds_stream.INT2, stamp + stamp)]
+    data.append(gds_stream.string_record(gds_stream.STRNAME, name))
+    for size, (layer, datatype) in enumerate(layers, 1):
+        data.append(record(gds_stream.BOUNDARY))
+        data.append(int2_record(gds_stream.LAYER, [layer]))
+        data.append(int2_record(gds_stream.DATATYPE, [datatype]))
+        data.append(int4_record(gds_stream.XY, [0, 0, size, 0, size, size,
+			0, size, 0, 0]))
+        data.append(record(gds_stream.ENDEL))
+    data.append(record(gds_stream.TEXT))
+    data.append(int2_record(gds_stream.LAYER, [layers[0][0]]))
+    data.append(int2_record(gds_stream.TEXTTYPE, [16]))
+    data.append(int4_record(gds_stream.XY, [1, 1]))
+    data.append(gds_stream.string_record(gds_stream.STRING, label))
+    data.append(record(gds_stream.ENDEL))
+    for child in children:
+        data.append(record(gds_stream.SREF))
+        data.append(gds_stream.string_record(gds_stream.SNAME, child))
+        data.append(int4_record(gds_stream.XY, [100, 200]))
+        data.append(record(gds_stream.ENDEL))
+    data.append(record(gds_stream.ENDSTR))
+    return b''.join(data)
+
+#----------------------------------------------------------------------
+# Return a GDS library named "libname" containing "structs" (a list of
+# structures from structure()).
+#----------------------------------------------------------------------
+
+def library(libname, structs):
+    stamp = gds_stream.make_timestamp('01/02/2020 03:04:05')
+    data = [int2_record(gds_stream.HEADER, [600])]
+    data.append(record(gds_stream.BGNLIB, gds_stream.INT2, stamp + stamp))
+    data.append(gds_stream.string_record(gds_stream.LIBNAME, libname))
+    data.append(record(gds_stream.UNITS, gds_stream.REAL8, bytes(16)))
+    data.extend(structs)
+    data.append(record(gds_stream.ENDLIB))
+    return b''.join(data)
+
+def write_file(filepath, data):
+    with open(filepath, 'wb') as ofile:
+        ofile.write(data)
+
+def read_file(filepath):
+    with open(filepath, 'rb') as ifile:
+        return ifile.read()
+
+#----------------------------------------------------------------------
+# Records, structures, and library header of gds_stream.py, and writing
+# and reading back a compressed file.
+#----------------------------------------------------------------------
+
+def check_stream(workdir, data):
+    offsets = []
+    expected = 0
+    for offset, reclen, rectype, datatype in gds_stream.records(data):
+        check(offset == expected, 'record at ' + str(offset) + ' follows the last record')
+        expected = offset + reclen
+        offsets.append(offset)
+    check(expected == len(data), 'records end at the end of the data')
+
+    names = list(item.name for item in gds_stream.structures(data))
+    check(names == ['leaf_a', 'leaf_bb', 'top'], 'structure names ' + str(names))
+    for item in gds_stream.structures(data):
+        check(item.start in offsets and item.nameoffset in offsets,
+		'structure ' + item.name + ' starts on a record')
+
+    libheader = gds_stream.library_header(data)
+    libname = libheader.get(gds_stream.LIBNAME)
+    check(libname is not None and gds_stream.record_string(libname, 0,
+		len(libname)) == 'selftest', 'library name')
+
+    gzpath = os.path.join(workdir, 'lib.gds.gz')
+    gds_stream.write_gds(gzpath, [data[0:100], data[100:]])
+    check(gds_stream.is_gzip(gzpath), 'compressed file is written with gzip')
+    with gds_stream.GDSFile(gzpath) as gds:
+        check(bytes(gds.data) == data, 'compressed file reads back unchanged')
+
+#----------------------------------------------------------------------
+# Structure index of gds_index.py:  Built from the data, saved, read back
+# while the file is unchanged, and rebuilt after the file has changed.
+#----------------------------------------------------------------------
+
+def check_index(workdir, data):
+    gdspath = os.path.join(workdir, 'index.gds')
+    write_file(gdspath, data)
+
+    entries = gds_index.build_index(data)
+    structs = list(gds_stream.structures(data))
+    check(list(entry[0:4] for entry in entries) == list(tuple(item) for item in structs),
+		'index entries match the structures')
+    top = entries[-1]
+    check(top.children == ['leaf_a', 'leaf_bb'], 'children of top ' + str(top.children))
+    check(entries[0].layers == [[68, 20], [69, 20], [68, 16]],
+		'layers of leaf_a ' + str(entries[0].layers))
+
+    with gds_stream.GDSFile(gdspath) as gds:
+        index = gds_index.GDSIndex(gdspath, gds.data)
+        check(not index.cached, 'index is built the first time')
+    check(os.path.isfile(gds_index.index_file(gdspath)), 'index is saved')
+    with gds_stream.GDSFile(gdspath) as gds:
+        index = gds_index.GDSIndex(gdspath, gds.data)
+        check(index.cached, 'saved index is used while the file is unchanged')
+        check(list(index.entries) == entries, 'saved index matches the file')
+        check(index.closure('top')[0] == ['leaf_a', 'leaf_bb', 'top'],
+		'hierarchy of top ' + str(index.closure('top')[0]))
+
+    # Move the structures, then make sure that the old index is not used
+    newdata = data.replace(gds_stream.string_record(gds_stream.LIBNAME,
+		'selftest'), gds_stream.string_record(gds_stream.LIBNAME,
+		'selftest_renamed'))
+    write_file(gdspath, newdata)
+    with gds_stream.GDSFile(gdspath) as gds:
+        index = gds_index.GDSIndex(gdspath, gds.data)
+        check(not index.cached, 'saved index is not used after the file has changed')
+        check(list(index.entries) == gds_index.build_index(newdata),
+		'rebuilt index matches the changed file')
+
+#----------------------------------------------------------------------
+# String replacement of change_gds_string.py, with a pattern and with a
+# mapping (batch mode), each followed by the reverse replacement.
+#----------------------------------------------------------------------
+
+def check_strings(workdir, data):
+    gdspath = os.path.join(workdir, 'strings.gds')
+    outpath = os.path.join(workdir, 'strings_out.gds')
+    write_file(gdspath, data)
+
+    # Odd to even length strings and back, so that records are padded and
+    # unpadded.
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        substitute = change_gds_string.pair_substitution(['leaf_'], ['cell_x'])
+        changed = change_gds_string.change_strings(gdspath, outpath, substitute)
+    check(changed == 5, 'strings changed ' + str(changed))
+    outdata = read_file(outpath)
+    names = list(item.name for item in gds_stream.structures(outdata))
+    check(names == ['cell_xa', 'cell_xbb', 'top'], 'renamed structures ' + str(names))
+    check(gds_index.build_index(outdata)[-1].children == ['cell_xa', 'cell_xbb'],
+		'renamed references')
+
+    with contextlib.redirect_stdout(output):
+        substitute = change_gds_string.pair_substitution(['cell_x'], ['leaf_'])
+        change_gds_string.change_strings(outpath, outpath, substitute)
+    check(read_file(outpath) == data, 'pattern replacement and reverse give the original')
+
+    # Batch mode, in place, on two files at once
+    otherpath = os.path.join(workdir, 'strings2.gds')
+    shutil.copyfile(gdspath, otherpath)
+    filelist = [gdspath, otherpath]
+    with contextlib.redirect_stdout(output):
+        stringmap = change_gds_string.StringMap([('leaf_a', 'leaf_a_long'),
+			('LABEL', 'LBL')])
+        total = change_gds_string.change_files(filelist, stringmap, jobs=2)
+    check(total == 10, 'batch mode strings changed ' + str(total))
+    for filepath in filelist:
+        check(b'leaf_a_long' in read_file(filepath), 'batch mode replaced ' + filepath)
+
+    with contextlib.redirect_stdout(output):
+        stringmap = change_gds_string.StringMap([('leaf_a_long', 'leaf_a'),
+			('LBL', 'LABEL')])
+        change_gds_string.change_files(filelist, stringmap, jobs=1)
+    for filepath in filelist:
+        check(read_file(filepath) == data, 'batch replacement and reverse give the original')
+
+#----------------------------------------------------------------------
+# Cell replacement of change_gds_cell.py:  Replace a cell with the cell
+# from another file, then put the original cell back.
+#----------------------------------------------------------------------
+
+def check_cells(workdir, data, altdata):
+    gdspath = os.path.join(workdir, 'cells.gds')
+    altpath = os.path.join(workdir, 'cells_alt.gds')
+    origpath = os.path.join(workdir, 'cells_orig.gds')
+    outpath = os.path.join(workdir, 'cells_out.gds')
+    write_file(gdspath, data)
+    write_file(altpath, altdata)
+    write_file(origpath, data)
+
+    altentry = gds_index.build_index(altdata)[1]
+    oldentry = gds_index.build_index(data)[1]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = change_gds_cell.change_cells(['leaf_bb'],
+			{'leaf_bb': oldentry.end - oldentry.nameoffset},
+			altpath, gdspath, outpath)
+    check(result == 0, 'cell replaced with matching checksum')
+    outdata = read_file(outpath)
+    outentry = gds_index.build_index(outdata)[1]
+    check(outdata[outentry.start:outentry.end] ==
+		altdata[altentry.start:altentry.end], 'cell data is the alternate cell')
+    check(outdata[:outentry.start] == data[:oldentry.start] and
+		outdata[outentry.end:] == data[oldentry.end:],
+		'data around the cell is unchanged')
+
+    with contextlib.redirect_stdout(output):
+        result = change_gds_cell.change_cells(['leaf_bb'], {'leaf_bb': 1},
+			altpath, gdspath, outpath)
+    check(result == 1, 'cell not replaced with wrong checksum')
+
+    # Put back all of the cells in the original file, in place, with the
+    # index saved on the first pass.
+    with contextlib.redirect_stdout(output):
+        change_gds_cell.change_cells(['leaf_bb'], {}, altpath, gdspath, gdspath)
+        result = change_gds_cell.change_cells(None, {}, origpath, gdspath, gdspath,
+			required=False)
+    check(result == 0, 'cells put back')
+    check(read_file(gdspath) == data, 'cell replacement and reverse give the original')
+
+if __name__ == '__main__':
+    keep = False
+    for option in sys.argv[1:]:
+        if option == '-keep':
+            keep = True
+        else:
+            print('Usage:  gds_selftest.py [-keep]')
+            sys.exit(1)
+
+    leaf_a = structure('leaf_a', [(68, 20), (69, 20), (68, 16)], 'LABEL')
+    leaf_bb = structure('leaf_bb', [(70, 20)], 'LABEL')
+    alt_bb = structure('leaf_bb', [(70, 20), (71, 20)], 'OTHER_LABEL')
+    top = structure('top', [(72, 20)], 'TOP', ['leaf_a', 'leaf_bb', 'leaf_a'])
+    data = library('selftest', [leaf_a, leaf_bb, top])
+    altdata = library('alternate', [leaf_a, alt_bb])
+
+    workdir = tempfile.mkdtemp(prefix='gds_selftest_')
+    try:
+        check_stream(workdir, data)
+        check_index(workdir, data)
+        check_strings(workdir, data)
+        check_cells(workdir, data, altdata)
+    finally:
+        if keep:
+            print('Files left in ' + workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    if failures:
+        print(str(len(failures)) + ' checks failed.')
+        sys.exit(1)
+    print('All GDS checks passed.')
+    sys.exit(0)
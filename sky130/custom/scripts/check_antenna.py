@@ -14,12 +14,14 @@
 # 	
 #-------------------------------------------------------------------------
 
-import subprocess
 import shutil
 import sys
 import os
 import re
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import magic_session
+
 # Work in progress
 
 def run_antenna(layout_name, output_file):
@@ -100,24 +102,24 @@ def run_antenna(layout_name, output_file):
 
     print('Running: magic -dnull -noconsole') 
 
-    mproc = subprocess.run(['magic', '-dnull', '-noconsole',
-		'-rcfile', rcfile, 'run_magic_antenna.tcl'],
-		env = myenv, cwd = magpath,
-		stdin = subprocess.DEVNULL, stdout = subprocess.PIPE,
-		stderr = subprocess.PIPE, universal_newlines = True)
-    if mproc.stdout:
-        for line in mproc.stdout.splitlines():
+    magic_pool = magic_session.MagicPool(env=myenv)
+    returncode, outlines, errlines = magic_pool.run_script('source ' +
+		magic_session.tcl_quote(os.path.abspath('run_magic_antenna.tcl')),
+		magpath, rcfile)
+    magic_pool.close()
+    if outlines:
+        for line in outlines:
             print(line)
             print(line, file=ofile)
-    if mproc.stderr:
+    if errlines:
         print('\nError message output from magic:')
         print('\nError message output from magic:', file=ofile)
-        for line in mproc.stderr.splitlines():
+        for line in errlines:
             print(line)
             print(line, file=ofile)
-    if mproc.returncode != 0:
-        print('\nERROR:  Magic exited with status ' + str(mproc.returncode))
-        print('\nERROR:  Magic exited with status ' + str(mproc.returncode), file=ofile)
+    if returncode != 0:
+        print('\nERROR:  Magic exited with status ' + str(returncode))
+        print('\nERROR:  Magic exited with status ' + str(returncode), file=ofile)
 
     ofile.close()
 
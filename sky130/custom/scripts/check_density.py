@@ -24,20 +24,641 @@ import sys
 import os
 import re
 import glob
-import select
-import subprocess
+import json
+import zlib
+import struct
+import threading
+import concurrent.futures
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import magic_session
+
+try:
+    import numpy
+except ImportError:
+    print('Error:  check_density.py requires the python3 "numpy" module.')
+    sys.exit(1)
+
+# Density rules.  For each layer:  The name printed in the magic output, the
+# "cif ostyle density" layer measured, the name used in the results, and the
+# minimum and maximum density (None if there is no limit).  Adding a layer
+# to the checks only requires adding an entry here.
+
+density_layers = [
+	['FOM',  'fom_all',  'FOM',  0.33, 0.57],
+	['POLY', 'poly_all', 'POLY', None, None],
+	['LI1',  'li_all',   'LI',   0.35, 0.60],
+	['MET1', 'm1_all',   'MET1', 0.35, 0.60],
+	['MET2', 'm2_all',   'MET2', 0.35, 0.60],
+	['MET3', 'm3_all',   'MET3', 0.35, 0.60],
+	['MET4', 'm4_all',   'MET4', 0.35, 0.60],
+	['MET5', 'm5_all',   'MET5', 0.45, 0.76]
+]
+
+# GDS layers (layer, datatype) that make up each density layer, used only
+# for the approximate density measured without magic (option "-approx").
+# These are the drawing, pin, and fill layers and the layers of cells that
+# magic reads as the same material.
+
+density_gds_layers = {
+	'FOM':  [(65, 20), (65, 44), (23, 28), (65, 99)],
+	'POLY': [(66, 20), (66, 16), (28, 28), (66, 99)],
+	'LI1':  [(67, 20), (67, 16), (56, 28), (67, 99)],
+	'MET1': [(68, 20), (68, 16), (36, 28), (68, 99)],
+	'MET2': [(69, 20), (69, 16), (41, 28), (69, 99)],
+	'MET3': [(70, 20), (70, 16), (34, 28), (70, 99)],
+	'MET4': [(71, 20), (71, 16), (51, 28), (71, 99)],
+	'MET5': [(72, 20), (72, 16), (59, 28), (72, 99)]
+}
+
+# Density is measured by magic in tiles of tilesize x tilesize microns, and
+# checked over windows of windowsize x windowsize tiles, stepped by one tile.
+
+tilesize = 70
+windowsize = 10
 
 def usage():
     print("Usage:")
-    print("check_density.py [<layout_file_name>] [-keep]")
+    print("check_density.py [<layout_file_name>] [-keep] [-jobs <n>] [-approx | -validate]")
+    print("		[-resolution=<um>] [-fill=<fill_file_name>]")
+    print("		[-output=<directory> | -nooutput] [-heatmap]")
+    print("		[-incremental[=<cache_file>]]")
     print("")
     print("where:")
     print("   <layout_file_name> is the path to the .gds or .mag file to be checked.")
     print("")
     print("  If '-keep' is specified, then keep the check script.")
     print("  If '-debug' is specified, then print diagnostic information.")
+    print("  If '-jobs <n>' is specified, then run <n> magic processes at once,")
+    print("  each measuring one band of the rows of tiles.")
+    print("  If '-approx' is specified, then measure the density of a GDS file")
+    print("  directly, without running magic.  The results are APPROXIMATE and")
+    print("  are not a substitute for the checks run with magic.")
+    print("  If '-validate' is specified, then run the checks with magic, and")
+    print("  also report how far the '-approx' results are from them.")
+    print("  If '-resolution=<um>' is specified, then measure the approximate")
+    print("  density on a grid of <um> microns (default 0.5).")
+    print("  If '-fill=<fill_file_name>' is specified with '-approx', then add the")
+    print("  fill in that GDS file (from generate_fill.py) to the layout.")
+    print("")
+    print("  The results are also written to directory <layout_name>_density next")
+    print("  to the layout (or to <directory> if '-output=<directory>' is specified):")
+    print("  a summary of the errors of each layer in density.json, and the tile and")
+    print("  window densities of each layer as .npy and .csv files.  If '-heatmap'")
+    print("  is specified, then also write each of them as a PNG image.  If")
+    print("  '-nooutput' is specified, then do not write any of these files.")
+    print("")
+    print("  If '-incremental' is specified, then keep the results of each tile in")
+    print("  <layout_name>_density_cache.json next to the layout (or <cache_file>),")
+    print("  and when the layout is checked again, measure only the tiles whose")
+    print("  contents in the GDS file have changed.")
     return 0
 
+#----------------------------------------------------------------------------
+# Return the weight of each tile in a grid of xtiles x ytiles tiles, which
+# is the fraction of the tile that is inside the layout.  The tiles of the
+# last column and the last row extend past the layout by (1 - xfrac) and
+# (1 - yfrac) of a tile, respectively.
+#----------------------------------------------------------------------------
+
+def tile_weights(xtiles, ytiles, xfrac, yfrac):
+    xweights = numpy.ones(xtiles)
+    xweights[-1] = xfrac
+    yweights = numpy.ones(ytiles)
+    yweights[-1] = yfrac
+    return numpy.outer(yweights, xweights)
+
+#----------------------------------------------------------------------------
+# Return the sum of each "size" x "size" window of the 2-D array "grid", for
+# each window position stepped by one tile, from the summed-area table
+# (integral image) of the grid.
+#----------------------------------------------------------------------------
+
+def window_sums(grid, size):
+    table = numpy.zeros((grid.shape[0] + 1, grid.shape[1] + 1))
+    table[1:, 1:] = grid.cumsum(axis=0).cumsum(axis=1)
+    return (table[size:, size:] - table[:-size, size:] -
+		table[size:, :-size] + table[:-size, :-size])
+
+#----------------------------------------------------------------------------
+# Return the density of each window of tile density grid "grid" with tile
+# weights "weights" (from tile_weights()).  Each tile's density counts in
+# proportion to the area of the tile inside the layout.
+#----------------------------------------------------------------------------
+
+def window_densities(grid, weights, size=windowsize):
+    return window_sums(grid * weights, size) / window_sums(weights, size)
+
+#----------------------------------------------------------------------------
+# Return the density over the whole layout of tile density grid "grid".
+#----------------------------------------------------------------------------
+
+def global_density(grid, weights):
+    return (grid * weights).sum() / weights.sum()
+
+#----------------------------------------------------------------------------
+# Return the error message for density value "density" of a layer with
+# limits "mindensity" and "maxdensity", or None if there is no error.
+#----------------------------------------------------------------------------
+
+def density_error(name, density, mindensity, maxdensity):
+    if mindensity is not None and density < mindensity:
+        return '***Error:  ' + name + ' Density < ' + str(round(mindensity * 100)) + '%'
+    elif maxdensity is not None and density > maxdensity:
+        return '***Error:  ' + name + ' Density > ' + str(round(maxdensity * 100)) + '%'
+    return None
+
+#----------------------------------------------------------------------------
+# Write the Tcl script to run in magic to check local density across
+# stepped regions to "ofile".  The tiles are measured in rows;  the rows
+# are split into "nbands" bands of about the same size, and the script
+# measures the tiles of band number "band" only.  If "tiles" is given,
+# then the script measures only those tiles (a list of (x, y)) instead.
+#----------------------------------------------------------------------------
+
+def write_density_script(ofile, project, project_file, is_gds, band=0, nbands=1,
+		tiles=None):
+    print('#!/bin/env wish', file=ofile)
+    print('crashbackups stop', file=ofile)
+    print('drc off', file=ofile)
+    print('snap internal', file=ofile)
+
+    print('set starttime [orig_clock format [orig_clock seconds] -format "%D %T"]', file=ofile)
+    print('puts stdout "Started reading GDS: $starttime"', file=ofile)
+    print('', file=ofile)
+    print('flush stdout', file=ofile)
+    print('update idletasks', file=ofile)
+
+    if is_gds:
+        # Read GDS file
+        print('gds readonly true', file=ofile)
+        print('gds rescale false', file=ofile)
+        print('gds read ' + project_file, file=ofile)
+        print('', file=ofile)
+
+    # NOTE:  This assumes that the name of the GDS file is the name of the
+    # topmost cell (which should be passed as an option)
+    print('load ' + project, file=ofile)
+    print('', file=ofile)
+
+    print('set midtime [orig_clock format [orig_clock seconds] -format "%D %T"]', file=ofile)
+    print('puts stdout "Starting density checks: $midtime"', file=ofile)
+    print('', file=ofile)
+    print('flush stdout', file=ofile)
+    print('update idletasks', file=ofile)
+
+    # Get step box dimensions (700um for size and 70um for step)
+    print('box values 0 0 0 0', file=ofile)
+    # print('box size 700um 700um', file=ofile)
+    # print('set stepbox [box values]', file=ofile)
+    # print('set stepwidth [lindex $stepbox 2]', file=ofile)
+    # print('set stepheight [lindex $stepbox 3]', file=ofile)
+
+    print('box size ' + str(tilesize) + 'um ' + str(tilesize) + 'um', file=ofile)
+    print('set stepbox [box values]', file=ofile)
+    print('set stepsizex [lindex $stepbox 2]', file=ofile)
+    print('set stepsizey [lindex $stepbox 3]', file=ofile)
+
+    print('select top cell', file=ofile)
+    print('expand', file=ofile)
+    # Override with FIXED_BBOX, if it is defined
+    print('set fullbox [property FIXED_BBOX]', file=ofile)
+    print('if {$fullbox == ""} {', file=ofile)
+    print('    set fullbox [box values]', file=ofile)
+    print('}', file=ofile)
+    print('set xmax [lindex $fullbox 2]', file=ofile)
+    print('set xmin [lindex $fullbox 0]', file=ofile)
+    print('set fullwidth [expr {$xmax - $xmin}]', file=ofile)
+    print('set xtiles [expr {int(ceil(($fullwidth + 0.0) / $stepsizex))}]', file=ofile)
+    print('set ymax [lindex $fullbox 3]', file=ofile)
+    print('set ymin [lindex $fullbox 1]', file=ofile)
+    print('set fullheight [expr {$ymax - $ymin}]', file=ofile)
+    print('set ytiles [expr {int(ceil(($fullheight + 0.0) / $stepsizey))}]', file=ofile)
+    print('box size $stepsizex $stepsizey', file=ofile)
+    print('set xbase [lindex $fullbox 0]', file=ofile)
+    print('set ybase [lindex $fullbox 1]', file=ofile)
+    print('', file=ofile)
+
+    print('puts stdout "XTILES: $xtiles"', file=ofile)
+    print('puts stdout "YTILES: $ytiles"', file=ofile)
+    print('', file=ofile)
+
+    # Need to know what fraction of a full tile is the last row and column
+    print('set xfrac [expr {1.0 - ($xtiles * $stepsizex - $fullwidth + 0.0) / $stepsizex}]', file=ofile)
+    print('set yfrac [expr {1.0 - ($ytiles * $stepsizey - $fullheight + 0.0) / $stepsizey}]', file=ofile)
+
+    # If the last row/column fraction is zero, then set to 1 (might never happen?)
+    print('if {$xfrac == 0.0} {set xfrac 1.0}', file=ofile)
+    print('if {$yfrac == 0.0} {set yfrac 1.0}', file=ofile)
+
+    print('puts stdout "XFRAC: $xfrac"', file=ofile)
+    print('puts stdout "YFRAC: $yfrac"', file=ofile)
+
+    print('cif ostyle density', file=ofile)
+
+    # Process density at steps.  For efficiency, this is done in 70x70 um
+    # areas, dumped to a file, and then aggregated into the 700x700 areas.
+
+    if tiles is None:
+        print('set ystart [expr {(' + str(band) + ' * $ytiles) / ' + str(nbands) + '}]', file=ofile)
+        print('set yend [expr {(' + str(band + 1) + ' * $ytiles) / ' + str(nbands) + '}]', file=ofile)
+        print('for {set y $ystart} {$y < $yend} {incr y} {', file=ofile)
+        print('    for {set x 0} {$x < $xtiles} {incr x} {', file=ofile)
+    else:
+        print('foreach {x y} {' + ' '.join(str(x) + ' ' + str(y) for x, y in tiles) +
+			'} {', file=ofile)
+    print('        set xlo [expr $xbase + $x * $stepsizex]', file=ofile)
+    print('        set ylo [expr $ybase + $y * $stepsizey]', file=ofile)
+    print('        set xhi [expr $xlo + $stepsizex]', file=ofile)
+    print('        set yhi [expr $ylo + $stepsizey]', file=ofile)
+    print('        box values $xlo $ylo $xhi $yhi', file=ofile)
+
+    # Flatten this area
+    print('        flatten -dobbox -nolabels tile', file=ofile)
+    print('        load tile', file=ofile)
+    print('        select top cell', file=ofile)
+
+    # Run density check for each layer
+    print('        puts stdout "Density results for tile x=$x y=$y"', file=ofile)
+
+    for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+        print('        puts stdout "' + layer + ': [cif list cover ' + ciflayer + ']"', file=ofile)
+    print('        flush stdout', file=ofile)
+    print('        update idletasks', file=ofile)
+
+    print('        load ' + project, file=ofile)
+    print('        cellname delete tile', file=ofile)
+
+    if tiles is None:
+        print('    }', file=ofile)
+    print('}', file=ofile)
+
+    print('set endtime [orig_clock format [orig_clock seconds] -format "%D %T"]', file=ofile)
+    print('puts stdout "Ended: $endtime"', file=ofile)
+    print('quit -noprompt', file=ofile)
+    print('', file=ofile)
+
+#----------------------------------------------------------------------------
+# Run magic on each of the Tcl scripts "scriptfiles" at the same time, and
+# print the output of each as it arrives.  Returns the list of lines of
+# standard output of each run.  Exits if any run of magic fails.  The magic
+# processes are kept in "magic_pool" for the next call.
+#----------------------------------------------------------------------------
+
+magic_pool = None
+
+def run_magic(scriptfiles, rcfile_path, cwd, env):
+    global magic_pool
+    if not magic_pool:
+        magic_pool = magic_session.MagicPool(len(scriptfiles), env=env)
+    magic_pool.size = max(magic_pool.size, len(scriptfiles))
+
+    printlock = threading.Lock()
+    outlines = list([] for scriptfile in scriptfiles)
+
+    def run_one(index):
+        def output(line):
+            line = line.strip()
+            outlines[index].append(line)
+            with printlock:
+                print(line, flush=True)
+
+        def error(line):
+            with printlock:
+                print(line.strip(), flush=True)
+
+        script = 'source ' + magic_session.tcl_quote(scriptfiles[index])
+        return magic_pool.run_script(script, cwd, rcfile_path, outfunc=output,
+			errfunc=error)[0]
+
+    with concurrent.futures.ThreadPoolExecutor(len(scriptfiles)) as executor:
+        statuses = list(executor.map(run_one, range(len(scriptfiles))))
+
+    for status in statuses:
+        print('Magic exited with status ' + str(status))
+        if status != 0:
+            sys.exit(status)
+    return outlines
+
+#----------------------------------------------------------------------------
+# Write the Tcl scripts to check the density of layout "project" (file
+# "project_file" in directory "layoutpath"), and run them in magic with
+# startup script "rcfile_path", "jobs" at once.  If "tiles" is given, then
+# only those tiles (a list of (x, y)) are measured.  Returns the lines of
+# standard output from magic.  The scripts are removed unless "keepmode".
+#----------------------------------------------------------------------------
+
+def measure_tiles(layoutpath, project, project_file, is_gds, rcfile_path, jobs,
+		tiles=None, keepmode=False):
+    # With more than one job, the rows of tiles (or the list of tiles) are
+    # split into bands, each measured by its own magic process.
+    if tiles is None:
+        tilesets = [None] * jobs
+    else:
+        ntiles = len(tiles)
+        tilesets = list(tiles[(band * ntiles) // jobs:((band + 1) * ntiles) // jobs]
+			for band in range(min(jobs, ntiles)))
+
+    if len(tilesets) == 1:
+        scriptfiles = [layoutpath + '/check_density.tcl']
+    else:
+        scriptfiles = list(layoutpath + '/check_density_' + str(band) + '.tcl'
+			for band in range(len(tilesets)))
+    for band, scriptfile in enumerate(scriptfiles):
+        with open(scriptfile, 'w') as ofile:
+            write_density_script(ofile, project, project_file, is_gds, band,
+			len(tilesets), tilesets[band])
+
+    myenv = os.environ.copy()
+    myenv['MAGTYPE'] = 'mag'
+
+    dlines = []
+    for outlines in run_magic(scriptfiles, rcfile_path, layoutpath, myenv):
+        dlines.extend(outlines)
+
+    if not keepmode:
+        for scriptfile in scriptfiles:
+            if os.path.isfile(scriptfile):
+                os.remove(scriptfile)
+    return dlines
+
+#----------------------------------------------------------------------------
+# Return True if the tiles "grid" and "other" (xtiles, ytiles, xfrac,
+# yfrac) are the same.
+#----------------------------------------------------------------------------
+
+def same_grid(grid, other):
+    return (tuple(grid[0:2]) == tuple(other[0:2]) and
+		abs(grid[2] - other[2]) < 1e-3 and abs(grid[3] - other[3]) < 1e-3)
+
+#----------------------------------------------------------------------------
+# Read the tile densities from the magic output lines "dlines".  Returns
+# (grids, xtiles, ytiles, xfrac, yfrac), where "grids" is a dictionary of
+# the tile densities of each layer as an array of [y, x].  Tiles that magic
+# did not measure are taken from "cached" (a dictionary of {layer: density}
+# by (x, y)), and if magic did not measure any tiles, then the number of
+# tiles and fractions are taken from "grid" (xtiles, ytiles, xfrac, yfrac).
+# Exits if any results are missing.
+#----------------------------------------------------------------------------
+
+def read_tile_results(dlines, debugmode=False, cached=None, grid=None):
+    layernames = list(layer[0] for layer in density_layers)
+
+    # Results for each tile, keyed by (x, y)
+    tiles = {}
+    tile = None
+    if grid is None:
+        xtiles, ytiles, xfrac, yfrac = 0, 0, 0.0, 0.0
+    else:
+        xtiles, ytiles, xfrac, yfrac = grid
+
+    for line in dlines:
+        dpair = line.split(':')
+        if debugmode:
+            print('Magic output line: ' + line)
+        tmatch = re.match(r'Density results for tile x=([0-9]+) y=([0-9]+)', line)
+        if tmatch:
+            tile = tiles.setdefault((int(tmatch.group(1)), int(tmatch.group(2))), {})
+        elif len(dpair) == 2:
+            layer = dpair[0]
+            try:
+                density = float(dpair[1].strip())
+            except:
+                continue
+            if layer in layernames and tile is not None:
+                tile[layer] = density
+            elif layer == 'XTILES':
+                xtiles = int(dpair[1].strip())
+            elif layer == 'YTILES':
+                ytiles = int(dpair[1].strip())
+            elif layer == 'XFRAC':
+                xfrac = float(dpair[1].strip())
+            elif layer == 'YFRAC':
+                yfrac = float(dpair[1].strip())
+
+    if ytiles == 0 or xtiles == 0:
+        print('Failed to read XTILES or YTILES from output.')
+        sys.exit(1)
+
+    if cached:
+        for position, results in cached.items():
+            tiles.setdefault(position, results)
+
+    grids = {}
+    for layer in layernames:
+        grid = numpy.full((ytiles, xtiles), numpy.nan)
+        for (x, y), results in tiles.items():
+            if layer in results and x < xtiles and y < ytiles:
+                grid[y, x] = results[layer]
+        missing = numpy.count_nonzero(numpy.isnan(grid))
+        if missing > 0:
+            print('Error:  Missing ' + layer + ' results for ' + str(missing) +
+			' of ' + str(xtiles * ytiles) + ' tiles from magic.')
+            sys.exit(1)
+        grids[layer] = grid
+
+    return grids, xtiles, ytiles, xfrac, yfrac
+
+#----------------------------------------------------------------------------
+# Measure the tile densities of GDS file "gdsfile" with top cell "project"
+# without magic (see gds_density.py), on a grid of "resolution" microns,
+# with the fill in GDS file "fillfile" added, if given.  Returns the same
+# as read_tile_results().  The results are approximate.
+#----------------------------------------------------------------------------
+
+def approx_tile_results(gdsfile, project, resolution, fillfile=None):
+    import gds_density
+
+    layers = list((layer[0], density_gds_layers[layer[0]]) for layer in density_layers)
+    try:
+        return gds_density.tile_densities(gdsfile, layers, project, tilesize, resolution,
+			fillfile)
+    except (OSError, gds_density.gds_stream.GDSError) as e:
+        print('Error:  Cannot measure density of ' + gdsfile + ':  ' + str(e))
+        sys.exit(1)
+
+#----------------------------------------------------------------------------
+# Print the density results and errors for each window and for the whole
+# layout, from the tile results (see read_tile_results()).
+#----------------------------------------------------------------------------
+
+def print_density_results(grids, xtiles, ytiles, xfrac, yfrac):
+    total_tiles = (ytiles - windowsize + 1) * (xtiles - windowsize + 1)
+
+    print('')
+    print('Stepped area density results (total tiles = ' + str(total_tiles) + '):')
+
+    # Full areas are 10 x 10 tiles = 100.  But the right and top sides are
+    # not full tiles, so the full area must be prorated.
+
+    print('Side adjustment = ' + '{:.3f}'.format(xfrac))
+    print('Top adjustment = ' + '{:.3f}'.format(yfrac))
+
+    weights = tile_weights(xtiles, ytiles, xfrac, yfrac)
+
+    for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+        densities = window_densities(grids[layer], weights)
+        outlines = ['', name + ' Density:']
+        for y in range(densities.shape[0]):
+            for x in range(densities.shape[1]):
+                density = densities[y, x]
+                outlines.append('Tile (' + str(x) + ', ' + str(y) + '):   ' +
+				'{:.3f}'.format(density))
+                errmsg = density_error(name, density, mindensity, maxdensity)
+                if errmsg:
+                    outlines.append(errmsg)
+        print('\n'.join(outlines))
+
+    print('')
+    print('Whole-chip (global) density results:')
+
+    for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+        density = global_density(grids[layer], weights)
+        print('')
+        print(name + ' Density: ' + '{:.3f}'.format(density))
+        errmsg = density_error(name, density, mindensity, maxdensity)
+        if errmsg:
+            print(errmsg)
+
+#----------------------------------------------------------------------------
+# Return a summary of the density results (see read_tile_results()) for
+# machine-readable output:  the tiles, and for each layer, the density
+# limits, the global density, the range of the window densities, and each
+# window (by the position of its lower left tile) whose density is out of
+# limits.  "info" is a dictionary of other entries for the summary.
+#----------------------------------------------------------------------------
+
+def density_summary(grids, xtiles, ytiles, xfrac, yfrac, info):
+    weights = tile_weights(xtiles, ytiles, xfrac, yfrac)
+    summary = dict(info)
+    summary.update({'tilesize': tilesize, 'windowsize': windowsize,
+		'xtiles': xtiles, 'ytiles': ytiles, 'xfrac': xfrac, 'yfrac': yfrac})
+    layers = []
+    errors = 0
+    for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+        densities = window_densities(grids[layer], weights)
+        density = global_density(grids[layer], weights)
+        violations = []
+        for limit, value in [('min', mindensity), ('max', maxdensity)]:
+            if value is None:
+                continue
+            bad = densities < value if limit == 'min' else densities > value
+            for y, x in zip(*numpy.nonzero(bad)):
+                violations.append({'x': int(x), 'y': int(y),
+				'density': round(float(densities[y, x]), 4), 'limit': limit})
+        violations.sort(key=lambda item: (item['y'], item['x']))
+        global_error = density_error(name, density, mindensity, maxdensity) is not None
+        errors += len(violations) + (1 if global_error else 0)
+        layers.append({'name': name, 'min': mindensity, 'max': maxdensity,
+		'global': round(float(density), 4), 'global_error': global_error,
+		'window_min': round(float(densities.min()), 4),
+		'window_max': round(float(densities.max()), 4),
+		'violations': violations})
+    summary['errors'] = errors
+    summary['layers'] = layers
+    return summary
+
+#----------------------------------------------------------------------------
+# Write the 8-bit RGB image "image" (an array of [row, column, color], with
+# the top row first) to PNG file "filepath".
+#----------------------------------------------------------------------------
+
+def write_png(filepath, image):
+    height, width = image.shape[0:2]
+    # Each row of the image data starts with a filter type byte (0 = none).
+    rows = numpy.zeros((height, width * 3 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(ctype, cdata):
+        return (struct.pack('>I', len(cdata)) + ctype + cdata +
+			struct.pack('>I', zlib.crc32(ctype + cdata)))
+
+    with open(filepath, 'wb') as ofile:
+        ofile.write(b'\x89PNG\r\n\x1a\n')
+        ofile.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        ofile.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        ofile.write(chunk(b'IEND', b''))
+
+#----------------------------------------------------------------------------
+# Return a heatmap image of density grid "grid" (indexed [y, x]), with
+# each grid entry drawn as "scale" x "scale" pixels and y = 0 at the
+# bottom.  Density is drawn in gray from black (0) to white (1), except
+# that densities below "mindensity" are drawn in blue and those above
+# "maxdensity" in red.
+#----------------------------------------------------------------------------
+
+def density_heatmap(grid, mindensity=None, maxdensity=None, scale=8):
+    level = (numpy.clip(grid, 0.0, 1.0) * 255).astype(numpy.uint8)
+    image = numpy.stack([level, level, level], axis=-1)
+    if mindensity is not None:
+        image[grid < mindensity] = [0, 0, 255]
+    if maxdensity is not None:
+        image[grid > maxdensity] = [255, 0, 0]
+    image = image[::-1].repeat(scale, axis=0).repeat(scale, axis=1)
+    return image
+
+#----------------------------------------------------------------------------
+# Write the machine-readable density results to directory "outdir":  the
+# summary from density_summary() to "density.json", and the tile and window
+# density grids of each layer (indexed [y, x]) to "tiles_<layer>.npy",
+# "windows_<layer>.npy", and the same as CSV files (one row of the grid per
+# line, starting from y = 0).  If "heatmap" is True, then also write the
+# heatmaps of each grid to "tiles_<layer>.png" and "windows_<layer>.png".
+#----------------------------------------------------------------------------
+
+def write_density_outputs(outdir, results, summary, heatmap=False):
+    grids, xtiles, ytiles, xfrac, yfrac = results
+    weights = tile_weights(xtiles, ytiles, xfrac, yfrac)
+    os.makedirs(outdir, exist_ok=True)
+
+    with open(os.path.join(outdir, 'density.json'), 'w') as ofile:
+        json.dump(summary, ofile, indent=2)
+
+    for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+        for prefix, grid in [('tiles_', grids[layer]),
+			('windows_', window_densities(grids[layer], weights))]:
+            filepath = os.path.join(outdir, prefix + name)
+            numpy.save(filepath + '.npy', grid)
+            numpy.savetxt(filepath + '.csv', grid, fmt='%.4f', delimiter=',')
+            if heatmap:
+                # Tile densities are not checked against the limits.
+                if prefix == 'tiles_':
+                    image = density_heatmap(grid)
+                else:
+                    image = density_heatmap(grid, mindensity, maxdensity)
+                write_png(filepath + '.png', image)
+
+#----------------------------------------------------------------------------
+# Print how far the approximate tile results "approx" (from
+# approx_tile_results()) are from the results "exact" measured by magic:
+# the largest and mean absolute difference of the tile and window densities
+# of each layer.  Returns the largest window density difference.
+#----------------------------------------------------------------------------
+
+def print_comparison(exact, approx):
+    grids, xtiles, ytiles, xfrac, yfrac = exact
+    agrids, axtiles, aytiles, axfrac, ayfrac = approx
+
+    print('')
+    print('Approximate (-approx) vs. magic density results:')
+    if (axtiles, aytiles) != (xtiles, ytiles):
+        print('Tiles do not match:  ' + str(axtiles) + ' x ' + str(aytiles) +
+		' (approximate) vs. ' + str(xtiles) + ' x ' + str(ytiles) + ' (magic).')
+        return None
+
+    weights = tile_weights(xtiles, ytiles, xfrac, yfrac)
+    worst = 0.0
+    for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+        tilediff = numpy.abs(agrids[layer] - grids[layer])
+        windiff = numpy.abs(window_densities(agrids[layer], weights) -
+			window_densities(grids[layer], weights))
+        worst = max(worst, windiff.max())
+        print(name + ':  tile max ' + '{:.4f}'.format(tilediff.max()) +
+		' mean ' + '{:.4f}'.format(tilediff.mean()) +
+		';  window max ' + '{:.4f}'.format(windiff.max()) +
+		' mean ' + '{:.4f}'.format(windiff.mean()))
+    return worst
+
 if __name__ == '__main__':
 
     optionlist = []
@@ -45,8 +666,21 @@ if __name__ == '__main__':
 
     debugmode = False
     keepmode = False
-
-    for option in sys.argv[1:]:
+    approxmode = False
+    validatemode = False
+    jobs = 1
+    resolution = 0.5
+    fillfile = None
+    outdir = None
+    outputmode = True
+    heatmapmode = False
+    incrementalmode = False
+    cachefile = None
+
+    options = iter(sys.argv[1:])
+    for option in options:
+        if option == '-jobs':
+            option = '-jobs=' + next(options, '1')
         if option.find('-', 0) == 0:
             optionlist.append(option)
         else:
@@ -68,6 +702,47 @@ if __name__ == '__main__':
             print('Keeping all files after running.')
     elif debugmode:
         print('Temporary files will be removed after running.')
+    if '-approx' in optionlist:
+        approxmode = True
+    if '-validate' in optionlist:
+        validatemode = True
+    if '-nooutput' in optionlist:
+        outputmode = False
+    if '-heatmap' in optionlist:
+        heatmapmode = True
+    if '-incremental' in optionlist:
+        incrementalmode = True
+    for option in optionlist:
+        if option.startswith('-jobs='):
+            try:
+                jobs = max(1, int(option.split('=')[1]))
+            except ValueError:
+                print('Bad value for option ' + option)
+                usage()
+                sys.exit(1)
+        elif option.startswith('-resolution='):
+            try:
+                resolution = float(option.split('=')[1])
+            except ValueError:
+                resolution = 0.0
+            if resolution <= 0.0:
+                print('Bad value for option ' + option)
+                usage()
+                sys.exit(1)
+        elif option.startswith('-fill='):
+            fillfile = option.split('=', 1)[1]
+        elif option.startswith('-output='):
+            outdir = option.split('=', 1)[1]
+        elif option.startswith('-incremental='):
+            incrementalmode = True
+            cachefile = option.split('=', 1)[1]
+
+    if fillfile and not approxmode:
+        print('Error:  Option -fill can only be used with -approx.')
+        sys.exit(1)
+    if fillfile and not os.path.isfile(fillfile):
+        print('Error:  Fill file "' + fillfile + '" does not exist or is not readable.')
+        sys.exit(1)
 
     # Find layout from command-line argument
 
@@ -117,6 +792,45 @@ if __name__ == '__main__':
         print('Error:  Project "' + user_project_path + '" does not exist or is not readable.')
         sys.exit(1)
 
+    if (approxmode or validatemode) and not is_gds:
+        print('Error:  Approximate density can only be measured from a GDS file.')
+        sys.exit(1)
+    if incrementalmode and (approxmode or not is_gds):
+        print('Error:  Option -incremental can only be used to check a GDS file with magic.')
+        sys.exit(1)
+
+    project_file = os.path.split(user_project_path)[1]
+    project = project_file.split(os.extsep, 1)[0]
+
+    if not outdir:
+        outdir = layoutpath + '/' + project + '_density'
+    outinfo = {'layout': user_project_path, 'fill': fillfile,
+		'approximate': approxmode, 'resolution': resolution if approxmode else None}
+
+    if approxmode:
+        print('Measuring APPROXIMATE density of file ' + user_project_path +
+		' without magic (not for signoff)', flush=True)
+        results = approx_tile_results(user_project_path, project, resolution, fillfile)
+        xtiles, ytiles = results[1:3]
+        if xtiles < windowsize or ytiles < windowsize:
+            wsize = str(tilesize * windowsize) + 'um'
+            print('Layout is < ' + wsize + ' x ' + wsize + ';  cannot run density checks.')
+            sys.exit(1)
+        print('')
+        print('*** APPROXIMATE density results (' + str(resolution) +
+		'um resolution, not measured by magic) ***')
+        print_density_results(*results)
+        if outputmode:
+            write_density_outputs(outdir, results, density_summary(*results, outinfo),
+			heatmapmode)
+            print('')
+            print('Density results written to ' + outdir)
+        print('')
+        print('*** APPROXIMATE results;  run without -approx for signoff. ***')
+        print('')
+        print('Done!')
+        sys.exit(0)
+
     # The path where the fill generation script resides should be the same
     # path where the magic startup script resides, for the same PDK
     scriptpath = os.path.dirname(os.path.realpath(__file__))
@@ -141,685 +855,82 @@ if __name__ == '__main__':
         print('Unknown path to magic startup script.  Please set $PDK_ROOT')
         sys.exit(1)
 
-    project_file = os.path.split(user_project_path)[1]
-    project = project_file.split(os.extsep, 1)[0]
-    
-    # Create the Tcl script to run in magic to check local density across
-    # stepped regions.
+    # With -incremental, find the tiles whose contents are the same as when
+    # the cache was written, and measure only the others.
 
-    with open(layoutpath + '/check_density.tcl', 'w') as ofile:
-        print('#!/bin/env wish', file=ofile)
-        print('crashbackups stop', file=ofile)
-        print('drc off', file=ofile)
-        print('snap internal', file=ofile)
+    tilelist = None
+    cached = {}
+    if incrementalmode:
+        import density_cache
 
-        print('set starttime [orig_clock format [orig_clock seconds] -format "%D %T"]', file=ofile)
-        print('puts stdout "Started reading GDS: $starttime"', file=ofile)
-        print('', file=ofile)
-        print('flush stdout', file=ofile)
-        print('update idletasks', file=ofile)
-
-        if is_gds:
-            # Read GDS file
-            print('gds readonly true', file=ofile)
-            print('gds rescale false', file=ofile)
-            print('gds read ' + project_file, file=ofile)
-            print('', file=ofile)
-
-        # NOTE:  This assumes that the name of the GDS file is the name of the
-        # topmost cell (which should be passed as an option)
-        print('load ' + project, file=ofile)
-        print('', file=ofile)
-
-        print('set midtime [orig_clock format [orig_clock seconds] -format "%D %T"]', file=ofile)
-        print('puts stdout "Starting density checks: $midtime"', file=ofile)
-        print('', file=ofile)
-        print('flush stdout', file=ofile)
-        print('update idletasks', file=ofile)
-
-        # Get step box dimensions (700um for size and 70um for step)
-        print('box values 0 0 0 0', file=ofile)
-        # print('box size 700um 700um', file=ofile)
-        # print('set stepbox [box values]', file=ofile)
-        # print('set stepwidth [lindex $stepbox 2]', file=ofile)
-        # print('set stepheight [lindex $stepbox 3]', file=ofile)
-
-        print('box size 70um 70um', file=ofile)
-        print('set stepbox [box values]', file=ofile)
-        print('set stepsizex [lindex $stepbox 2]', file=ofile)
-        print('set stepsizey [lindex $stepbox 3]', file=ofile)
-
-        print('select top cell', file=ofile)
-        print('expand', file=ofile)
-        # Override with FIXED_BBOX, if it is defined
-        print('set fullbox [property FIXED_BBOX]', file=ofile)
-        print('if {$fullbox == ""} {', file=ofile)
-        print('    set fullbox [box values]', file=ofile)
-        print('}', file=ofile)
-        print('set xmax [lindex $fullbox 2]', file=ofile)
-        print('set xmin [lindex $fullbox 0]', file=ofile)
-        print('set fullwidth [expr {$xmax - $xmin}]', file=ofile)
-        print('set xtiles [expr {int(ceil(($fullwidth + 0.0) / $stepsizex))}]', file=ofile)
-        print('set ymax [lindex $fullbox 3]', file=ofile)
-        print('set ymin [lindex $fullbox 1]', file=ofile)
-        print('set fullheight [expr {$ymax - $ymin}]', file=ofile)
-        print('set ytiles [expr {int(ceil(($fullheight + 0.0) / $stepsizey))}]', file=ofile)
-        print('box size $stepsizex $stepsizey', file=ofile)
-        print('set xbase [lindex $fullbox 0]', file=ofile)
-        print('set ybase [lindex $fullbox 1]', file=ofile)
-        print('', file=ofile)
-
-        print('puts stdout "XTILES: $xtiles"', file=ofile)
-        print('puts stdout "YTILES: $ytiles"', file=ofile)
-        print('', file=ofile)
-
-        # Need to know what fraction of a full tile is the last row and column
-        print('set xfrac [expr {1.0 - ($xtiles * $stepsizex - $fullwidth + 0.0) / $stepsizex}]', file=ofile)
-        print('set yfrac [expr {1.0 - ($ytiles * $stepsizey - $fullheight + 0.0) / $stepsizey}]', file=ofile)
-
-        # If the last row/column fraction is zero, then set to 1 (might never happen?)
-        print('if {$xfrac == 0.0} {set xfrac 1.0}', file=ofile)
-        print('if {$yfrac == 0.0} {set yfrac 1.0}', file=ofile)
-
-        print('puts stdout "XFRAC: $xfrac"', file=ofile)
-        print('puts stdout "YFRAC: $yfrac"', file=ofile)
-
-        print('cif ostyle density', file=ofile)
-
-        # Process density at steps.  For efficiency, this is done in 70x70 um
-        # areas, dumped to a file, and then aggregated into the 700x700 areas.
-
-        print('for {set y 0} {$y < $ytiles} {incr y} {', file=ofile)
-        print('    for {set x 0} {$x < $xtiles} {incr x} {', file=ofile)
-        print('        set xlo [expr $xbase + $x * $stepsizex]', file=ofile)
-        print('        set ylo [expr $ybase + $y * $stepsizey]', file=ofile)
-        print('        set xhi [expr $xlo + $stepsizex]', file=ofile)
-        print('        set yhi [expr $ylo + $stepsizey]', file=ofile)
-        print('        box values $xlo $ylo $xhi $yhi', file=ofile)
-
-        # Flatten this area
-        print('        flatten -dobbox -nolabels tile', file=ofile)
-        print('        load tile', file=ofile)
-        print('        select top cell', file=ofile)
-
-        # Run density check for each layer
-        print('        puts stdout "Density results for tile x=$x y=$y"', file=ofile)
-
-        print('        set fdens  [cif list cover fom_all]', file=ofile)
-        print('        set pdens  [cif list cover poly_all]', file=ofile)
-        print('        set ldens  [cif list cover li_all]', file=ofile)
-        print('        set m1dens [cif list cover m1_all]', file=ofile)
-        print('        set m2dens [cif list cover m2_all]', file=ofile)
-        print('        set m3dens [cif list cover m3_all]', file=ofile)
-        print('        set m4dens [cif list cover m4_all]', file=ofile)
-        print('        set m5dens [cif list cover m5_all]', file=ofile)
-        print('        puts stdout "FOM: $fdens"', file=ofile)
-        print('        puts stdout "POLY: $pdens"', file=ofile)
-        print('        puts stdout "LI1: $ldens"', file=ofile)
-        print('        puts stdout "MET1: $m1dens"', file=ofile)
-        print('        puts stdout "MET2: $m2dens"', file=ofile)
-        print('        puts stdout "MET3: $m3dens"', file=ofile)
-        print('        puts stdout "MET4: $m4dens"', file=ofile)
-        print('        puts stdout "MET5: $m5dens"', file=ofile)
-        print('        flush stdout', file=ofile)
-        print('        update idletasks', file=ofile)
-
-        print('        load ' + project, file=ofile)
-        print('        cellname delete tile', file=ofile)
-
-        print('    }', file=ofile)
-        print('}', file=ofile)
-
-        print('set endtime [orig_clock format [orig_clock seconds] -format "%D %T"]', file=ofile)
-        print('puts stdout "Ended: $endtime"', file=ofile)
-        print('quit -noprompt', file=ofile)
-        print('', file=ofile)
-
-
-    myenv = os.environ.copy()
-    myenv['MAGTYPE'] = 'mag'
+        if not cachefile:
+            cachefile = layoutpath + '/' + project + '_density_cache.json'
+        try:
+            keys, bbox, keygrid = density_cache.tile_keys(user_project_path, project, tilesize)
+        except (OSError, density_cache.gds_stream.GDSError) as e:
+            print('Error:  Cannot read ' + user_project_path + ':  ' + str(e))
+            sys.exit(1)
+        setup = density_cache.setup_digest(rcfile_path, [tilesize, density_layers])
+        cache = density_cache.read_cache(cachefile, setup, bbox)
+        cached = density_cache.cached_tiles(cache, keys)
+        if cached:
+            tilelist = sorted((position for position in keys if position not in cached),
+			key=lambda position: (position[1], position[0]))
+            print('Density cache:  ' + str(len(cached)) + ' of ' + str(len(keys)) +
+			' tiles unchanged, ' + str(len(tilelist)) + ' tiles to measure.')
+        else:
+            # Measure all of the tiles found by magic, which may not be the
+            # same as those found from the GDS file.
+            print('Density cache:  No tiles unchanged;  measuring all tiles.')
 
     print('Running density checks on file ' + user_project_path, flush=True)
-    
-    magic_run_opts = [
-		'magic',
-		'-dnull',
-		'-noconsole',
-		'-rcfile', rcfile_path,
-		layoutpath + '/check_density.tcl']
-
-    mproc = subprocess.Popen(magic_run_opts,
-		stdin = subprocess.DEVNULL,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.PIPE,
-		cwd = layoutpath,
-		env = myenv,
-		universal_newlines = True)
-
-    # Use signal to poll the process and generate any output as it arrives
 
     dlines = []
-
-    while mproc:
-        status = mproc.poll()
-        if status != None:
-            try:
-                output = mproc.communicate(timeout=1)
-            except ValueError:
-                print('Magic forced stop, status ' + str(status))
-                sys.exit(1)
-            else:
-                outlines = output[0]
-                errlines = output[1]
-                for line in outlines.splitlines():
-                    dlines.append(line)
-                    print(line)
-                for line in errlines.splitlines():
-                    print(line)
-                print('Magic exited with status ' + str(status))
-                if int(status) != 0:
-                    sys.exit(int(status))
-                else:
-                    break
-        else:
-            n = 0
-            while True:
-                n += 1
-                if n > 100:
-                    n = 0
-                    status = mproc.poll()
-                    if status != None:
-                        break
-                sresult = select.select([mproc.stdout, mproc.stderr], [], [], 0)[0]
-                if mproc.stdout in sresult:
-                    outstring = mproc.stdout.readline().strip()
-                    dlines.append(outstring)
-                    print(outstring)
-                elif mproc.stderr in sresult:
-                    outstring = mproc.stderr.readline().strip()
-                    print(outstring)
-                else:
-                    break
-
-    fomfill  = []
-    polyfill = []
-    lifill   = []
-    met1fill = []
-    met2fill = []
-    met3fill = []
-    met4fill = []
-    met5fill = []
-    xtiles = 0
-    ytiles = 0
-    xfrac = 0.0
-    yfrac = 0.0
-
-    for line in dlines:
-        dpair = line.split(':')
-        if debugmode:
-            print('Magic output line: ' + line)
-        if len(dpair) == 2:
-            layer = dpair[0]
-            try:
-                density = float(dpair[1].strip())
-            except:
-                continue
-            if layer == 'FOM':
-                fomfill.append(density)
-            elif layer == 'POLY':
-                polyfill.append(density)
-            elif layer == 'LI1':
-                lifill.append(density)
-            elif layer == 'MET1':
-                met1fill.append(density)
-            elif layer == 'MET2':
-                met2fill.append(density)
-            elif layer == 'MET3':
-                met3fill.append(density)
-            elif layer == 'MET4':
-                met4fill.append(density)
-            elif layer == 'MET5':
-                met5fill.append(density)
-            elif layer == 'XTILES':
-                xtiles = int(dpair[1].strip())
-            elif layer == 'YTILES':
-                ytiles = int(dpair[1].strip())
-            elif layer == 'XFRAC':
-                xfrac = float(dpair[1].strip())
-            elif layer == 'YFRAC':
-                yfrac = float(dpair[1].strip())
-
-    if ytiles == 0 or xtiles == 0:
-        print('Failed to read XTILES or YTILES from output.')
+    if tilelist is None or len(tilelist) > 0:
+        dlines = measure_tiles(layoutpath, project, project_file, is_gds, rcfile_path,
+			jobs, tilelist, keepmode)
+
+    if cached:
+        results = read_tile_results(dlines, debugmode, cached, cache['grid'])
+        if not same_grid(results[1:], cache['grid']) or not same_grid(results[1:], keygrid):
+            print('Warning:  Tiles have changed since the density cache was written;  '
+			'measuring all tiles.', flush=True)
+            cached = {}
+            dlines = measure_tiles(layoutpath, project, project_file, is_gds,
+			rcfile_path, jobs, None, keepmode)
+    if not cached:
+        results = read_tile_results(dlines, debugmode)
+    grids, xtiles, ytiles, xfrac, yfrac = results
+
+    if xtiles < windowsize or ytiles < windowsize:
+        wsize = str(tilesize * windowsize) + 'um'
+        print('Layout is < ' + wsize + ' x ' + wsize + ';  cannot run density checks.')
         sys.exit(1)
 
-    if xtiles < 10 or ytiles < 10:
-        print('Layout is < 700um x 700um;  cannot run density checks.')
-        sys.exit(1)
-
-    total_tiles = (ytiles - 9) * (xtiles - 9)
-
-    print('')
-    print('Stepped area density results (total tiles = ' + str(total_tiles) + '):')
-
-    # Full areas are 10 x 10 tiles = 100.  But the right and top sides are
-    # not full tiles, so the full area must be prorated.
-
-    print('Side adjustment = ' + '{:.3f}'.format(xfrac))
-    print('Top adjustment = ' + '{:.3f}'.format(yfrac))
-
     if debugmode:
         with open('tile_densities.txt', 'w') as dfile:
-            print(str(fomfill), file=dfile)
-            print(str(polyfill), file=dfile)
-            print(str(lifill), file=dfile)
-            print(str(met1fill), file=dfile)
-            print(str(met2fill), file=dfile)
-            print(str(met3fill), file=dfile)
-            print(str(met4fill), file=dfile)
-            print(str(met5fill), file=dfile)
-
-    print('')
-    print('FOM Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            fomaccum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                fomaccum += sum(fomfill[base : base + 9])
-                fomaccum += fomfill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            fomaccum += sum(fomfill[base : base + 9]) * locyfrac
-            fomaccum += fomfill[base + 9] * locxfrac * locyfrac
-                    
-            fomaccum /= atotal
-            fomstr = "{:.3f}".format(fomaccum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + fomstr)
-            if fomaccum < 0.33:
-                print('***Error:  FOM Density < 33%')
-            elif fomaccum > 0.57:
-                print('***Error:  FOM Density > 57%')
-
-    print('')
-    print('POLY Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            polyaccum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                polyaccum += sum(polyfill[base : base + 9])
-                polyaccum += polyfill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            polyaccum += sum(polyfill[base : base + 9]) * locyfrac
-            polyaccum += polyfill[base + 9] * locxfrac * locyfrac
-                    
-            polyaccum /= atotal
-            polystr = "{:.3f}".format(polyaccum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + polystr)
-
-    print('')
-    print('LI Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            liaccum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                liaccum += sum(lifill[base : base + 9])
-                liaccum += lifill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            liaccum += sum(lifill[base : base + 9]) * locyfrac
-            liaccum += lifill[base + 9] * locxfrac * locyfrac
-                    
-            liaccum /= atotal
-            listr = "{:.3f}".format(liaccum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + listr)
-            if liaccum < 0.35:
-                print('***Error:  LI Density < 35%')
-            elif liaccum > 0.60:
-                print('***Error:  LI Density > 60%')
-
-    print('')
-    print('MET1 Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            met1accum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                met1accum += sum(met1fill[base : base + 9])
-                met1accum += met1fill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            met1accum += sum(met1fill[base : base + 9]) * locyfrac
-            met1accum += met1fill[base + 9] * locxfrac * locyfrac
-                    
-            met1accum /= atotal
-            met1str = "{:.3f}".format(met1accum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + met1str)
-            if met1accum < 0.35:
-                print('***Error:  MET1 Density < 35%')
-            elif met1accum > 0.60:
-                print('***Error:  MET1 Density > 60%')
+            for layer, ciflayer, name, mindensity, maxdensity in density_layers:
+                print(str(grids[layer].flatten().tolist()), file=dfile)
 
-    print('')
-    print('MET2 Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            met2accum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                met2accum += sum(met2fill[base : base + 9])
-                met2accum += met2fill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            met2accum += sum(met2fill[base : base + 9]) * locyfrac
-            met2accum += met2fill[base + 9] * locxfrac * locyfrac
-                    
-            met2accum /= atotal
-            met2str = "{:.3f}".format(met2accum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + met2str)
-            if met2accum < 0.35:
-                print('***Error:  MET2 Density < 35%')
-            elif met2accum > 0.60:
-                print('***Error:  MET2 Density > 60%')
+    print_density_results(*results)
 
-    print('')
-    print('MET3 Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            met3accum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                met3accum += sum(met3fill[base : base + 9])
-                met3accum += met3fill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            met3accum += sum(met3fill[base : base + 9]) * locyfrac
-            met3accum += met3fill[base + 9] * locxfrac * locyfrac
-                    
-            met3accum /= atotal
-            met3str = "{:.3f}".format(met3accum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + met3str)
-            if met3accum < 0.35:
-                print('***Error:  MET3 Density < 35%')
-            elif met3accum > 0.60:
-                print('***Error:  MET3 Density > 60%')
+    if outputmode:
+        write_density_outputs(outdir, results, density_summary(*results, outinfo),
+		heatmapmode)
+        print('')
+        print('Density results written to ' + outdir)
 
-    print('')
-    print('MET4 Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
-        else:
-            locyfrac = 1.0
-
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            met4accum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                met4accum += sum(met4fill[base : base + 9])
-                met4accum += met4fill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            met4accum += sum(met4fill[base : base + 9]) * locyfrac
-            met4accum += met4fill[base + 9] * locxfrac * locyfrac
-                    
-            met4accum /= atotal
-            met4str = "{:.3f}".format(met4accum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + met4str)
-            if met4accum < 0.35:
-                print('***Error:  MET4 Density < 35%')
-            elif met4accum > 0.60:
-                print('***Error:  MET4 Density > 60%')
+    if validatemode:
+        print_comparison(results, approx_tile_results(user_project_path, project, resolution))
 
-    print('')
-    print('MET5 Density:')
-    for y in range(0, ytiles - 9):
-        if y == ytiles - 10:
-            locyfrac = yfrac
+    if incrementalmode:
+        # The keys are only good for the tiles measured by magic if the
+        # tiles are the same as those found from the GDS file.
+        if same_grid(results[1:], keygrid):
+            density_cache.write_cache(cachefile, setup, bbox, results[1:], keys, grids)
         else:
-            locyfrac = 1.0
-        for x in range(0, xtiles - 9):
-            if x == xtiles - 10:
-                locxfrac = xfrac
-            else:
-                locxfrac = 1.0
-
-            met5accum = 0
-            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
-
-            for w in range(y, y + 9):
-                base = xtiles * w + x
-                met5accum += sum(met5fill[base : base + 9])
-                met5accum += met5fill[base + 9] * locxfrac
-            base = xtiles * (y + 9) + x
-            met5accum += sum(met5fill[base : base + 9]) * locyfrac
-            met5accum += met5fill[base + 9] * locxfrac * locyfrac
-                    
-            met5accum /= atotal
-            met5str = "{:.3f}".format(met5accum)
-            print('Tile (' + str(x) + ', ' + str(y) + '):   ' + met5str)
-            if met5accum < 0.45:
-                print('***Error:  MET5 Density < 45%')
-            elif met5accum > 0.76:
-                print('***Error:  MET5 Density > 76%')
-
-    print('')
-    print('Whole-chip (global) density results:')
-
-    atotal = ((xtiles - 1.0) * (ytiles - 1.0)) + ((ytiles - 1.0) * xfrac) + ((xtiles - 1.0) * yfrac) + (xfrac * yfrac)
-
-    fomaccum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        fomaccum += sum(fomfill[base:base + xtiles - 1])
-        fomaccum += fomfill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    fomaccum += sum(fomfill[base:base + xtiles - 1]) * yfrac
-    fomaccum += fomfill[base + xtiles - 1] * xfrac * yfrac
-
-    fomaccum /= atotal
-    fomstr = "{:.3f}".format(fomaccum)
-    print('')
-    print('FOM Density: ' + fomstr)
-    if fomaccum < 0.33:
-        print('***Error:  FOM Density < 33%')
-    elif fomaccum > 0.57:
-        print('***Error:  FOM Density > 57%')
-
-    polyaccum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        polyaccum += sum(polyfill[base:base + xtiles - 1])
-        polyaccum += polyfill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    polyaccum += sum(polyfill[base:base + xtiles - 1]) * yfrac
-    polyaccum += polyfill[base + xtiles - 1] * xfrac * yfrac
-
-    polyaccum /= atotal
-    polystr = "{:.3f}".format(polyaccum)
-    print('')
-    print('POLY Density: ' + polystr)
-
-    liaccum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        liaccum += sum(lifill[base:base + xtiles - 1])
-        liaccum += lifill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    liaccum += sum(lifill[base:base + xtiles - 1]) * yfrac
-    liaccum += lifill[base + xtiles - 1] * xfrac * yfrac
-
-    liaccum /= atotal
-    listr = "{:.3f}".format(liaccum)
-    print('')
-    print('LI Density: ' + listr)
-    if liaccum < 0.35:
-        print('***Error:  LI Density < 35%')
-    elif liaccum > 0.60:
-        print('***Error:  LI Density > 60%')
-
-    met1accum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        met1accum += sum(met1fill[base:base + xtiles - 1])
-        met1accum += met1fill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    met1accum += sum(met1fill[base:base + xtiles - 1]) * yfrac
-    met1accum += met1fill[base + xtiles - 1] * xfrac * yfrac
-
-    met1accum /= atotal
-    met1str = "{:.3f}".format(met1accum)
-    print('')
-    print('MET1 Density: ' + met1str)
-    if met1accum < 0.35:
-        print('***Error:  MET1 Density < 35%')
-    elif met1accum > 0.60:
-        print('***Error:  MET1 Density > 60%')
-
-    met2accum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        met2accum += sum(met2fill[base:base + xtiles - 1])
-        met2accum += met2fill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    met2accum += sum(met2fill[base:base + xtiles - 1]) * yfrac
-    met2accum += met2fill[base + xtiles - 1] * xfrac * yfrac
-
-    met2accum /= atotal
-    met2str = "{:.3f}".format(met2accum)
-    print('')
-    print('MET2 Density: ' + met2str)
-    if met2accum < 0.35:
-        print('***Error:  MET2 Density < 35%')
-    elif met2accum > 0.60:
-        print('***Error:  MET2 Density > 60%')
-
-    met3accum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        met3accum += sum(met3fill[base:base + xtiles - 1])
-        met3accum += met3fill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    met3accum += sum(met3fill[base:base + xtiles - 1]) * yfrac
-    met3accum += met3fill[base + xtiles - 1] * xfrac * yfrac
-
-    met3accum /= atotal
-    met3str = "{:.3f}".format(met3accum)
-    print('')
-    print('MET3 Density: ' + met3str)
-    if met3accum < 0.35:
-        print('***Error:  MET3 Density < 35%')
-    elif met3accum > 0.60:
-        print('***Error:  MET3 Density > 60%')
-
-    met4accum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        met4accum += sum(met4fill[base:base + xtiles - 1])
-        met4accum += met4fill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    met4accum += sum(met4fill[base:base + xtiles - 1]) * yfrac
-    met4accum += met4fill[base + xtiles - 1] * xfrac * yfrac
-
-    met4accum /= atotal
-    met4str = "{:.3f}".format(met4accum)
-    print('')
-    print('MET4 Density: ' + met4str)
-    if met4accum < 0.35:
-        print('***Error:  MET4 Density < 35%')
-    elif met4accum > 0.60:
-        print('***Error:  MET4 Density > 60%')
-
-    met5accum = 0
-    for y in range(0, ytiles - 1):
-        base = xtiles * y
-        met5accum += sum(met5fill[base:base + xtiles - 1])
-        met5accum += met5fill[base + xtiles - 1] * xfrac
-    base = xtiles * (ytiles - 1)
-    met5accum += sum(met5fill[base:base + xtiles - 1]) * yfrac
-    met5accum += met5fill[base + xtiles - 1] * xfrac * yfrac
-
-    met5accum /= atotal
-    met5str = "{:.3f}".format(met5accum)
-    print('')
-    print('MET5 Density: ' + met5str)
-    if met5accum < 0.45:
-        print('***Error:  MET5 Density < 45%')
-    elif met5accum > 0.76:
-        print('***Error:  MET5 Density > 76%')
-
-    if not keepmode:
-        if os.path.isfile(layoutpath + '/check_density.tcl'):
-            os.remove(layoutpath + '/check_density.tcl')
+            print('Warning:  Tiles measured by magic do not match the layout bounds;  '
+			'density cache not written.')
 
     print('')
     print('Done!')
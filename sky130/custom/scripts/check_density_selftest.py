@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2020 Efabless Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# check_density_selftest.py ---
+#
+#    Check the window and whole-chip densities computed by check_density.py
+#    (with NumPy) against the tile-by-tile sums that check_density.py used
+#    to compute them, on random tile grids of several sizes, including
+#    grids of exactly one window and layouts that end on a tile boundary.
+#
+#    Usage:  check_density_selftest.py
+#
+#    Prints each mismatch and exits with status 1 if there was any.
+#
+
+import os
+import sys
+import random
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import check_density
+
+try:
+    import numpy
+except ImportError:
+    print('Error:  check_density_selftest.py requires the python3 "numpy" module.')
+    sys.exit(1)
+
+#----------------------------------------------------------------------------
+# Window densities as computed tile by tile, from the list of tile
+# densities "fill" in row order.  Returns a list of rows of densities.
+#----------------------------------------------------------------------------
+
+def baseline_windows(fill, xtiles, ytiles, xfrac, yfrac):
+    rows = []
+    for y in range(0, ytiles - 9):
+        if y == ytiles - 10:
+            locyfrac = yfrac
+        else:
+            locyfrac = 1.0
+        row = []
+        for x in range(0, xtiles - 9):
+            if x == xtiles - 10:
+                locxfrac = xfrac
+            else:
+                locxfrac = 1.0
+
+            accum = 0
+            atotal = 81.0 + 9.0 * locxfrac + 9.0 * locyfrac + locxfrac * locyfrac
+
+            for w in range(y, y + 9):
+                base = xtiles * w + x
+                accum += sum(fill[base : base + 9])
+                accum += fill[base + 9] * locxfrac
+            base = xtiles * (y + 9) + x
+            accum += sum(fill[base : base + 9]) * locyfrac
+            accum += fill[base + 9] * locxfrac * locyfrac
+
+            row.append(accum / atotal)
+        rows.append(row)
+    return rows
+
+#----------------------------------------------------------------------------
+# Whole-chip density as computed tile by tile.
+#----------------------------------------------------------------------------
+
+def baseline_global(fill, xtiles, ytiles, xfrac, yfrac):
+    atotal = ((xtiles - 1.0) * (ytiles - 1.0) + (ytiles - 1.0) * xfrac +
+		(xtiles - 1.0) * yfrac + xfrac * yfrac)
+
+    accum = 0
+    for y in range(0, ytiles - 1):
+        base = xtiles * y
+        accum += sum(fill[base:base + xtiles - 1])
+        accum += fill[base + xtiles - 1] * xfrac
+    base = xtiles * (ytiles - 1)
+    accum += sum(fill[base:base + xtiles - 1]) * yfrac
+    accum += fill[base + xtiles - 1] * xfrac * yfrac
+
+    return accum / atotal
+
+if __name__ == '__main__':
+    rng = random.Random(1)
+    tolerance = 1e-9
+    failures = 0
+
+    cases = [(10, 10), (11, 10), (10, 13), (17, 24), (40, 31)]
+    for xtiles, ytiles in cases:
+        for xfrac, yfrac in [(1.0, 1.0), (rng.random(), rng.random())]:
+            fill = list(rng.random() for i in range(xtiles * ytiles))
+            grid = numpy.array(fill).reshape(ytiles, xtiles)
+            weights = check_density.tile_weights(xtiles, ytiles, xfrac, yfrac)
+            desc = (str(xtiles) + ' x ' + str(ytiles) + ' tiles, fractions ' +
+			'{:.3f}'.format(xfrac) + ', ' + '{:.3f}'.format(yfrac))
+
+            expected = numpy.array(baseline_windows(fill, xtiles, ytiles, xfrac, yfrac))
+            densities = check_density.window_densities(grid, weights)
+            if densities.shape != expected.shape:
+                print('Failed:  ' + desc + ':  ' + str(densities.shape) +
+			' windows, expected ' + str(expected.shape))
+                failures += 1
+            elif numpy.abs(densities - expected).max() > tolerance:
+                print('Failed:  ' + desc + ':  window densities differ by ' +
+			str(numpy.abs(densities - expected).max()))
+                failures += 1
+
+            expected = baseline_global(fill, xtiles, ytiles, xfrac, yfrac)
+            density = check_density.global_density(grid, weights)
+            if abs(density - expected) > tolerance:
+                print('Failed:  ' + desc + ':  global density ' + str(density) +
+			', expected ' + str(expected))
+                failures += 1
+
+    if failures:
+        print(str(failures) + ' checks failed.')
+        sys.exit(1)
+    print('All density checks passed.')
+    sys.exit(0)
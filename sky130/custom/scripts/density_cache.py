@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------------------------
+# density_cache.py ---  Cache of the density results of each tile of a GDS
+# layout, for use by check_density.py (option "-incremental").
+#
+# Each tile of the layout gets a key, which is a hash of everything in the
+# GDS file that can be inside the tile:  The cells placed inside it and
+# the shapes that cross it.  Each cell has a hash of its own shapes and of
+# the hashes of the cells it uses, so a cell placed entirely inside a
+# tile is represented in the key by its hash and its position alone.  A
+# cell that crosses tiles is opened, and its own shapes and the cells it
+# uses are placed in the tiles they are in, so that a change in one part
+# of a large cell changes the keys of only the tiles around it.  Labels
+# are not part of the keys, as they do not change the density.
+#
+# The cache records the key and the density results of each tile measured
+# by magic.  When the layout is checked again, only the tiles whose keys
+# have changed are measured, and the results of the others are taken from
+# the cache.  The cache is only used if the tiles of the layout, the
+# density rules, and the magic startup script and technology file are the
+# same as when it was written.
+#-------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import math
+import struct
+import hashlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import gds_stream
+import gds_density
+
+# Tiles are grown by this many microns when finding the shapes and cells
+# inside them, for the density rules that grow shapes.
+margin = 2.0
+
+transform = struct.Struct('>?Bqq')
+
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+#----------------------------------------------------------------------------
+# A cell (structure) of the GDS file, as needed for the tile keys:  Its own
+# shapes as a list of (bounding box, hash), its cell instances as a list
+# of (cell name, reflected, quarter turns or None if the instance is not
+# at a multiple of 90 degrees or is magnified, list of (x, y) positions,
+# hash), its bounding box, and the hash of all of it.
+#----------------------------------------------------------------------------
+
+class CellContents(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.shapes = []
+        self.instances = []
+        self.bbox = None
+        self.digest = None
+
+#----------------------------------------------------------------------------
+# Read the GDS data "data" and return (dictionary of CellContents by name,
+# database unit in meters).
+#----------------------------------------------------------------------------
+
+def read_cells(data):
+    int2 = struct.Struct('>h').unpack_from
+    uint2 = struct.Struct('>H').unpack_from
+    int4 = struct.Struct('>i').unpack_from
+    xyformats = {}
+
+    cells = {}
+    dbunit = 1e-9
+    cell = None
+    element = None
+    start = 0
+    sname = points = None
+    width = 0
+    reflect = False
+    angle = 0.0
+    mag = 1.0
+    cols = rows = 1
+
+    for offset, reclen, rectype, datatype in gds_stream.records(data):
+        if rectype == gds_stream.XY:
+            npoints = (reclen - 4) >> 3
+            xyformat = xyformats.get(npoints)
+            if xyformat is None:
+                xyformat = xyformats[npoints] = struct.Struct('>' + str(npoints * 2) + 'i')
+            values = xyformat.unpack_from(data, offset + 4)
+            points = list(zip(values[0::2], values[1::2]))
+        elif rectype == gds_stream.ENDEL:
+            if cell is None or element is None or not points:
+                element = None
+                continue
+            digest = new_hash()
+            digest.update(data[start:offset + reclen])
+            if element in [gds_stream.BOUNDARY, gds_stream.BOX, gds_stream.PATH]:
+                grow = abs(width) / 2 if element == gds_stream.PATH else 0
+                xs = list(point[0] for point in points)
+                ys = list(point[1] for point in points)
+                cell.shapes.append(((min(xs) - grow, min(ys) - grow,
+				max(xs) + grow, max(ys) + grow), digest.digest()))
+            else:
+                quarters = int(round(angle / 90.0))
+                if abs(angle - quarters * 90.0) > 1e-6 or mag != 1.0:
+                    quarters = None
+                else:
+                    quarters %= 4
+                if element == gds_stream.SREF:
+                    positions = points[0:1]
+                else:
+                    (x0, y0), (xc, yc), (xr, yr) = points[0:3]
+                    cstep = ((xc - x0) / cols, (yc - y0) / cols)
+                    rstep = ((xr - x0) / rows, (yr - y0) / rows)
+                    positions = list((x0 + i * cstep[0] + j * rstep[0],
+				y0 + i * cstep[1] + j * rstep[1])
+				for j in range(rows) for i in range(cols))
+                cell.instances.append((sname, reflect, quarters, positions, digest.digest()))
+            element = None
+        elif rectype in [gds_stream.BOUNDARY, gds_stream.BOX, gds_stream.PATH,
+			gds_stream.SREF, gds_stream.AREF]:
+            element = rectype
+            start = offset
+            points = None
+            width = 0
+            reflect = False
+            angle = 0.0
+            mag = 1.0
+            cols = rows = 1
+        elif rectype in [gds_stream.TEXT, gds_stream.NODE]:
+            element = None
+        elif rectype == gds_stream.WIDTH:
+            width = int4(data, offset + 4)[0]
+        elif rectype == gds_stream.SNAME:
+            sname = gds_stream.record_string(data, offset, reclen)
+        elif rectype == gds_stream.STRANS:
+            reflect = bool(uint2(data, offset + 4)[0] & 0x8000)
+        elif rectype == gds_stream.ANGLE:
+            angle = gds_stream.read_real8(data, offset + 4)
+        elif rectype == gds_stream.MAG:
+            mag = gds_stream.read_real8(data, offset + 4)
+        elif rectype == gds_stream.COLROW:
+            cols, rows = int2(data, offset + 4)[0], int2(data, offset + 6)[0]
+        elif rectype == gds_stream.BGNSTR:
+            cell = None
+            element = None
+        elif rectype == gds_stream.STRNAME and cell is None:
+            cell = CellContents(gds_stream.record_string(data, offset, reclen))
+        elif rectype == gds_stream.ENDSTR:
+            if cell is not None:
+                cells[cell.name] = cell
+            cell = None
+        elif rectype == gds_stream.UNITS:
+            dbunit = gds_stream.read_real8(data, offset + 12)
+    return cells, dbunit
+
+#----------------------------------------------------------------------------
+# Compute the hash and the bounding box of each cell used by "topcell", and
+# return the names of the cells in order, each after the cells it uses.
+#----------------------------------------------------------------------------
+
+def cell_digests(cells, topcell):
+    order = []
+    done = set()
+    stack = [(topcell, iter(cells[topcell].instances))]
+    while stack:
+        name, instances = stack[-1]
+        for instance in instances:
+            child = instance[0]
+            if child not in cells:
+                print('Warning:  Cell ' + child + ' is used but not defined.')
+                cells[child] = CellContents(child)
+            if child not in done:
+                done.add(child)
+                stack.append((child, iter(cells[child].instances)))
+                break
+        else:
+            stack.pop()
+            order.append(name)
+
+    for name in order:
+        cell = cells[name]
+        digest = new_hash()
+        bbox = None
+        for shapebox, shapedigest in cell.shapes:
+            bbox = merge_bbox(bbox, shapebox)
+        for shapedigest in sorted(shape[1] for shape in cell.shapes):
+            digest.update(shapedigest)
+        for child, reflect, quarters, positions, instdigest in cell.instances:
+            childbox = cells[child].bbox
+            if childbox is not None:
+                for position in positions:
+                    bbox = merge_bbox(bbox, instance_bbox(childbox, reflect, quarters, position))
+        for instdigest, childdigest in sorted((instance[4], cells[instance[0]].digest)
+			for instance in cell.instances):
+            digest.update(instdigest)
+            digest.update(childdigest)
+        cell.bbox = bbox
+        cell.digest = digest.digest()
+    return order
+
+# Return the box containing boxes "bbox" (or None) and "other".
+
+def merge_bbox(bbox, other):
+    if bbox is None:
+        return tuple(other)
+    return (min(bbox[0], other[0]), min(bbox[1], other[1]),
+		max(bbox[2], other[2]), max(bbox[3], other[3]))
+
+# Return the bounding box of a cell with bounding box "bbox" placed at
+# "position" with "quarters" quarter turns (None for any other angle or a
+# magnified instance, in which case the box is only a rough estimate).
+
+def instance_bbox(bbox, reflect, quarters, position):
+    if quarters is None:
+        quarters = 0
+    return gds_density.transform_bbox(bbox, reflect, quarters, position)
+
+#----------------------------------------------------------------------------
+# Return the transform of a cell placed with transform "child" (reflected,
+# quarter turns, x, y) in a cell placed with transform "parent".
+#----------------------------------------------------------------------------
+
+def compose(parent, child):
+    preflect, pquarters, px, py = parent
+    creflect, cquarters, cx, cy = child
+    x0, y0, x1, y1 = gds_density.transform_bbox((cx, cy, cx, cy), preflect, pquarters, (px, py))
+    if preflect:
+        cquarters = -cquarters
+    return (preflect != creflect, (pquarters + cquarters) % 4, x0, y0)
+
+#----------------------------------------------------------------------------
+# Return the key of each tile of the GDS layout "gdsfile" with top cell
+# "topcell", for tiles of "tilesize" microns.  Returns (dictionary of key
+# by (x, y), bounding box of the layout in microns, (number of tiles in
+# x, number of tiles in y, fraction of the last column of tiles inside the
+# layout, fraction of the last row)).  The tiles are computed as by
+# gds_density.tile_densities() and magic, from the layout's bounding box.
+#----------------------------------------------------------------------------
+
+def tile_keys(gdsfile, topcell, tilesize):
+    with gds_stream.GDSFile(gdsfile) as gds:
+        cells, dbunit = read_cells(gds.data)
+    topcell = gds_density.find_top_cell(cells, topcell, gdsfile)
+    cell_digests(cells, topcell)
+    bbox = cells[topcell].bbox
+    if bbox is None:
+        raise gds_stream.GDSError('Layout ' + gdsfile + ' is empty')
+
+    dbmicron = 1e-6 / dbunit
+    tile = tilesize * dbmicron
+    grow = margin * dbmicron
+    width = bbox[2] - bbox[0]
+    height = bbox[3] - bbox[1]
+    xtiles = int(math.ceil(width / tile))
+    ytiles = int(math.ceil(height / tile))
+    xfrac = 1.0 - (xtiles * tile - width) / tile
+    yfrac = 1.0 - (ytiles * tile - height) / tile
+    if xfrac == 0.0:
+        xfrac = 1.0
+    if yfrac == 0.0:
+        yfrac = 1.0
+
+    # Range of tiles (x0, y0, x1, y1, inclusive) that a box is in
+    def tile_range(box):
+        return (max(0, int((box[0] - grow - bbox[0]) // tile)),
+		max(0, int((box[1] - grow - bbox[1]) // tile)),
+		min(xtiles - 1, int((box[2] + grow - bbox[0]) // tile)),
+		min(ytiles - 1, int((box[3] + grow - bbox[1]) // tile)))
+
+    alltiles = (0, 0, xtiles - 1, ytiles - 1)
+    items = {}
+    def add_item(trange, item):
+        for y in range(trange[1], trange[3] + 1):
+            for x in range(trange[0], trange[2] + 1):
+                items.setdefault((x, y), []).append(item)
+
+    # Each cell to open is (cell name, transform);  the transform is
+    # (reflected, quarter turns, x, y).
+    stack = [(topcell, (False, 0, 0, 0))]
+    while stack:
+        name, xform = stack.pop()
+        reflect, quarters, dx, dy = xform
+        xformbytes = transform.pack(*xform)
+        cell = cells[name]
+        for shapebox, shapedigest in cell.shapes:
+            box = gds_density.transform_bbox(shapebox, reflect, quarters, (dx, dy))
+            add_item(tile_range(box), shapedigest + xformbytes)
+        for child, creflect, cquarters, positions, instdigest in cell.instances:
+            childcell = cells[child]
+            if childcell.bbox is None:
+                continue
+            for position in positions:
+                if cquarters is None:
+                    # Not at a multiple of 90 degrees:  Count the instance
+                    # in every tile.
+                    add_item(alltiles, childcell.digest + instdigest + xformbytes +
+				struct.pack('>dd', *position))
+                    continue
+                childxform = compose(xform, (creflect, cquarters,
+				int(round(position[0])), int(round(position[1]))))
+                box = gds_density.transform_bbox(childcell.bbox, childxform[0],
+				childxform[1], childxform[2:4])
+                trange = tile_range(box)
+                if trange[0] == trange[2] and trange[1] == trange[3]:
+                    add_item(trange, childcell.digest + transform.pack(*childxform))
+                else:
+                    stack.append((child, childxform))
+
+    keys = {}
+    for y in range(ytiles):
+        for x in range(xtiles):
+            digest = new_hash()
+            for item in sorted(items.get((x, y), [])):
+                digest.update(item)
+            keys[(x, y)] = digest.hexdigest()
+    micron = list(value / dbmicron for value in bbox)
+    return keys, micron, (xtiles, ytiles, xfrac, yfrac)
+
+#----------------------------------------------------------------------------
+# Return a string that identifies how the densities were measured:  The
+# contents of magic startup script "rcfile" and of each technology file it
+# loads ("tech load"), and "rules" (the density rules, as JSON data).  If
+# the PDK is changed in place, then the string changes with it.
+#----------------------------------------------------------------------------
+
+def setup_digest(rcfile, rules):
+    digest = new_hash()
+    digest.update(json.dumps(rules).encode('utf-8'))
+    with open(rcfile, 'rb') as ifile:
+        rctext = ifile.read()
+    digest.update(rctext)
+    rctext = rctext.decode('utf-8', 'replace')
+
+    # The startup script finds the technology file from PDK_ROOT, or from
+    # the default it sets if PDK_ROOT is not set.
+    pdkroot = os.environ.get('PDK_ROOT')
+    if not pdkroot:
+        rmatch = re.search(r'set\s+PDK_ROOT\s+(\S+)', rctext)
+        pdkroot = rmatch.group(1) if rmatch else ''
+    for techpath in re.findall(r'^\s*tech\s+load\s+(\S+)', rctext, re.MULTILINE):
+        techpath = re.sub(r'\$\{?PDK_ROOT\}?', lambda m: pdkroot, techpath)
+        if not os.path.isabs(techpath):
+            techpath = os.path.join(os.path.dirname(os.path.abspath(rcfile)), techpath)
+        digest.update(techpath.encode('utf-8'))
+        if os.path.isfile(techpath):
+            with open(techpath, 'rb') as ifile:
+                digest.update(ifile.read())
+    return digest.hexdigest()
+
+#----------------------------------------------------------------------------
+# Read the cache file "cachefile".  Returns the cache (a dictionary) if it
+# was written for the same "setup" (from setup_digest()) and layout
+# bounding box "bbox", or else None.
+#----------------------------------------------------------------------------
+
+def read_cache(cachefile, setup, bbox):
+    if not os.path.isfile(cachefile):
+        return None
+    try:
+        with open(cachefile, 'r') as ifile:
+            cache = json.load(ifile)
+    except (OSError, ValueError):
+        print('Warning:  Cannot read density cache ' + cachefile)
+        return None
+    if cache.get('setup') != setup:
+        return None
+    if cache.get('bbox') is None or any(abs(a - b) > 1e-3 for a, b in
+			zip(cache['bbox'], bbox)):
+        return None
+    return cache
+
+#----------------------------------------------------------------------------
+# Return the cached results of the tiles in "cache" (from read_cache())
+# whose keys are the same as in "keys" (from tile_keys()), as a dictionary
+# of {layer: density} by (x, y).
+#----------------------------------------------------------------------------
+
+def cached_tiles(cache, keys):
+    results = {}
+    if cache is None:
+        return results
+    for name, entry in cache.get('tiles', {}).items():
+        x, y = (int(value) for value in name.split(','))
+        if keys.get((x, y)) == entry.get('key'):
+            results[(x, y)] = entry['densities']
+    return results
+
+#----------------------------------------------------------------------------
+# Write the cache file "cachefile" for "setup" and layout bounding box
+# "bbox", with the tiles "grid" (xtiles, ytiles, xfrac, yfrac), the key of
+# each tile in "keys", and the tile density grid of each layer in "grids"
+# (indexed [y, x]).
+#----------------------------------------------------------------------------
+
+def write_cache(cachefile, setup, bbox, grid, keys, grids):
+    tiles = {}
+    for (x, y), key in keys.items():
+        densities = dict((layer, float(values[y, x])) for layer, values in grids.items())
+        tiles[str(x) + ',' + str(y)] = {'key': key, 'densities': densities}
+    cache = {'setup': setup, 'bbox': bbox, 'grid': list(grid), 'tiles': tiles}
+    with open(cachefile, 'w') as ofile:
+        json.dump(cache, ofile)
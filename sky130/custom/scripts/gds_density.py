@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------------------------
+# gds_density.py ---  Approximate layer density of a GDS layout, measured
+# without magic, for use by check_density.py (option "-approx").
+#
+# The GDS file is read directly, and the coverage of each density layer
+# is drawn into a raster (bitmap) of resolution x resolution pixels, where
+# each pixel holds the fraction of its area that is covered (0 to 255).
+# The hierarchy is flattened by raster, not by shape:  The raster of each
+# cell is drawn once, and copied into the raster of its parent at each
+# place the cell is used (after rotation and reflection, which are exact
+# for multiples of 90 degrees).  The coverage of each tile is then the
+# sum over the pixels of the tile of the top cell's raster.
+#
+# The results are APPROXIMATE, for quick checks only, and are not a
+# substitute for the density checks run by magic:
+#
+#   - Cell placements are rounded to the nearest pixel, so shapes may
+#     move by up to half a pixel (area is not changed).
+#   - Overlapping shapes that each cover part of a pixel are combined by
+#     taking the larger coverage, which can undercount the union.
+#   - Layers are taken from the GDS layer and datatype numbers in the
+#     density layer table, not from the magic techfile's CIF rules.
+#   - Rotations that are not multiples of 90 degrees are rounded, and
+#     magnification of cell instances is ignored.
+#
+# Use check_density.py -validate to compare the results against magic.
+#-------------------------------------------------------------------------
+
+import os
+import sys
+import math
+import struct
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import gds_stream
+
+# Number of samples per pixel (in each direction) used to measure the
+# coverage of polygons that are not rectangles.
+supersample = 4
+
+#----------------------------------------------------------------------------
+# A cell (structure) of the GDS file:  Its rectangles and other polygons on
+# each density layer (by index), its cell instances, and the bounding box
+# of all of its own shapes on all layers.  Each instance is (cell name,
+# reflected, number of quarter turns, list of (x, y) positions).
+#----------------------------------------------------------------------------
+
+class Cell(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.rects = {}
+        self.polygons = {}
+        self.instances = []
+        self.bbox = None
+
+    def add_bbox(self, x0, y0, x1, y1):
+        if self.bbox is None:
+            self.bbox = [x0, y0, x1, y1]
+        else:
+            bbox = self.bbox
+            bbox[0] = min(bbox[0], x0)
+            bbox[1] = min(bbox[1], y0)
+            bbox[2] = max(bbox[2], x1)
+            bbox[3] = max(bbox[3], y1)
+
+    # Add shape "points" (a list of (x, y), with the closing point
+    # removed), which is on density layer "index" (or None).
+
+    def add_shape(self, index, points):
+        xs = list(point[0] for point in points)
+        ys = list(point[1] for point in points)
+        x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+        self.add_bbox(x0, y0, x1, y1)
+        if index is None:
+            return
+        if len(points) == 4 and all((points[i][0] == points[i - 1][0]) !=
+			(points[i][1] == points[i - 1][1]) for i in range(4)):
+            self.rects.setdefault(index, []).append((x0, y0, x1, y1))
+        else:
+            self.polygons.setdefault(index, []).append(numpy.array(points, dtype=float))
+
+#----------------------------------------------------------------------------
+# Return the shapes (lists of points) covered by a path with the points
+# "points", width "width", and path type "pathtype".  Each segment is a
+# separate shape, extended by half the width at each joint so that corners
+# are filled, and at the ends of the path for pathtype 2.
+#----------------------------------------------------------------------------
+
+def path_shapes(points, width, pathtype):
+    half = abs(width) / 2
+    shapes = []
+    nsegs = len(points) - 1
+    for i in range(nsegs):
+        xa, ya = points[i]
+        xb, yb = points[i + 1]
+        length = math.hypot(xb - xa, yb - ya)
+        if length == 0:
+            continue
+        dx = (xb - xa) / length
+        dy = (yb - ya) / length
+        ext0 = half if (i > 0 or pathtype == 2) else 0
+        ext1 = half if (i < nsegs - 1 or pathtype == 2) else 0
+        xa -= dx * ext0
+        ya -= dy * ext0
+        xb += dx * ext1
+        yb += dy * ext1
+        nx = -dy * half
+        ny = dx * half
+        shapes.append([(xa + nx, ya + ny), (xa - nx, ya - ny),
+			(xb - nx, yb - ny), (xb + nx, yb + ny)])
+    return shapes
+
+#----------------------------------------------------------------------------
+# Read the GDS data "data" and return (dictionary of Cell by name, database
+# unit in meters).  "layermap" is a dictionary of the density layer index
+# for each (layer, datatype) to be measured.
+#----------------------------------------------------------------------------
+
+def read_cells(data, layermap):
+    int2 = struct.Struct('>h').unpack_from
+    uint2 = struct.Struct('>H').unpack_from
+    int4 = struct.Struct('>i').unpack_from
+    xyformats = {}
+
+    cells = {}
+    dbunit = 1e-9
+    cell = None
+    element = None
+    warned = set()
+    layer = sname = points = None
+    dtype = width = pathtype = 0
+    reflect = False
+    angle = 0.0
+    mag = 1.0
+    cols = rows = 1
+
+    for offset, reclen, rectype, datatype in gds_stream.records(data):
+        if rectype == gds_stream.XY:
+            npoints = (reclen - 4) >> 3
+            xyformat = xyformats.get(npoints)
+            if xyformat is None:
+                xyformat = xyformats[npoints] = struct.Struct('>' + str(npoints * 2) + 'i')
+            values = xyformat.unpack_from(data, offset + 4)
+            points = list(zip(values[0::2], values[1::2]))
+        elif rectype == gds_stream.LAYER:
+            layer = int2(data, offset + 4)[0]
+        elif rectype in [gds_stream.DATATYPE, gds_stream.BOXTYPE]:
+            dtype = int2(data, offset + 4)[0]
+        elif rectype == gds_stream.ENDEL:
+            if cell is None or element is None or not points:
+                pass
+            elif element in [gds_stream.BOUNDARY, gds_stream.BOX]:
+                if len(points) > 1 and points[0] == points[-1]:
+                    points = points[:-1]
+                cell.add_shape(layermap.get((layer, dtype)), points)
+            elif element == gds_stream.PATH:
+                for shape in path_shapes(points, width, pathtype):
+                    cell.add_shape(layermap.get((layer, dtype)), shape)
+            elif element in [gds_stream.SREF, gds_stream.AREF]:
+                quarters = int(round(angle / 90.0))
+                if abs(angle - quarters * 90.0) > 1e-6 and 'angle' not in warned:
+                    print('Warning:  Instance angle ' + str(angle) +
+				' rounded to a multiple of 90 degrees.')
+                    warned.add('angle')
+                if mag != 1.0 and 'mag' not in warned:
+                    print('Warning:  Instance magnification ignored.')
+                    warned.add('mag')
+                if element == gds_stream.SREF:
+                    positions = points[0:1]
+                else:
+                    (x0, y0), (xc, yc), (xr, yr) = points[0:3]
+                    cstep = ((xc - x0) / cols, (yc - y0) / cols)
+                    rstep = ((xr - x0) / rows, (yr - y0) / rows)
+                    positions = list((x0 + i * cstep[0] + j * rstep[0],
+				y0 + i * cstep[1] + j * rstep[1])
+				for j in range(rows) for i in range(cols))
+                cell.instances.append((sname, reflect, quarters % 4, positions))
+            element = None
+        elif rectype in [gds_stream.BOUNDARY, gds_stream.BOX, gds_stream.PATH,
+			gds_stream.SREF, gds_stream.AREF]:
+            element = rectype
+            layer = None
+            dtype = 0
+            points = None
+            width = 0
+            pathtype = 0
+            reflect = False
+            angle = 0.0
+            mag = 1.0
+            cols = rows = 1
+        elif rectype in [gds_stream.TEXT, gds_stream.NODE]:
+            element = None
+        elif rectype == gds_stream.WIDTH:
+            width = int4(data, offset + 4)[0]
+        elif rectype == gds_stream.PATHTYPE:
+            pathtype = int2(data, offset + 4)[0]
+        elif rectype == gds_stream.SNAME:
+            sname = gds_stream.record_string(data, offset, reclen)
+        elif rectype == gds_stream.STRANS:
+            reflect = bool(uint2(data, offset + 4)[0] & 0x8000)
+        elif rectype == gds_stream.ANGLE:
+            angle = gds_stream.read_real8(data, offset + 4)
+        elif rectype == gds_stream.MAG:
+            mag = gds_stream.read_real8(data, offset + 4)
+        elif rectype == gds_stream.COLROW:
+            cols, rows = int2(data, offset + 4)[0], int2(data, offset + 6)[0]
+        elif rectype == gds_stream.BGNSTR:
+            cell = None
+            element = None
+        elif rectype == gds_stream.STRNAME and cell is None:
+            cell = Cell(gds_stream.record_string(data, offset, reclen))
+        elif rectype == gds_stream.ENDSTR:
+            if cell is not None:
+                cells[cell.name] = cell
+            cell = None
+        elif rectype == gds_stream.UNITS:
+            dbunit = gds_stream.read_real8(data, offset + 12)
+    return cells, dbunit
+
+#----------------------------------------------------------------------------
+# Return the names of the cells used by cell "topcell" (including itself),
+# each after all of the cells it uses, and the number of cells that use
+# each cell.  Cells that are used but not defined are reported and left
+# out.
+#----------------------------------------------------------------------------
+
+def cell_order(cells, topcell):
+    order = []
+    parents = {topcell: 0}
+    stack = [(topcell, iter(cells[topcell].instances))]
+    while stack:
+        name, instances = stack[-1]
+        for instance in instances:
+            child = instance[0]
+            if child not in cells:
+                print('Warning:  Cell ' + child + ' is used but not defined.')
+                cells[child] = Cell(child)
+            if child not in parents:
+                parents[child] = 0
+                stack.append((child, iter(cells[child].instances)))
+                break
+        else:
+            stack.pop()
+            order.append(name)
+            for child in set(instance[0] for instance in cells[name].instances):
+                parents[child] += 1
+    return order, parents
+
+#----------------------------------------------------------------------------
+# Return the box (x0, y0, x1, y1) "bbox" after reflection about the x axis
+# (if "reflect"), "quarters" quarter turns counterclockwise, and moving to
+# "position".
+#----------------------------------------------------------------------------
+
+def transform_bbox(bbox, reflect, quarters, position):
+    x0, y0, x1, y1 = bbox
+    if reflect:
+        y0, y1 = -y1, -y0
+    for i in range(quarters):
+        x0, y0, x1, y1 = -y1, x0, -y0, x1
+    return (x0 + position[0], y0 + position[1], x1 + position[0], y1 + position[1])
+
+#----------------------------------------------------------------------------
+# Compute the bounding box of each cell in "order" (from cell_order()),
+# including the cells it uses, and return the bounding box of the last one.
+#----------------------------------------------------------------------------
+
+def cell_bboxes(cells, order):
+    bboxes = {}
+    for name in order:
+        cell = cells[name]
+        bbox = list(cell.bbox) if cell.bbox else None
+        for child, reflect, quarters, positions in cell.instances:
+            childbox = bboxes.get(child)
+            if childbox is None:
+                continue
+            for position in positions:
+                x0, y0, x1, y1 = transform_bbox(childbox, reflect, quarters, position)
+                if bbox is None:
+                    bbox = [x0, y0, x1, y1]
+                else:
+                    bbox = [min(bbox[0], x0), min(bbox[1], y0),
+				max(bbox[2], x1), max(bbox[3], y1)]
+        bboxes[name] = bbox
+    return bboxes[order[-1]]
+
+#----------------------------------------------------------------------------
+# Raster functions.  A raster is (array, x0, y0), where "array" is a 2-D
+# uint8 array indexed [row, column] of the coverage of each pixel (255 =
+# fully covered), and (x0, y0) is the pixel of array[0, 0], in pixels from
+# the origin of the cell.  Pixel (x, y) covers x to x + 1 and y to y + 1.
+#----------------------------------------------------------------------------
+
+# Return the coverage (0 to 1) of the pixels from pixel "p0" to "p1" by the
+# interval from "lo" to "hi" (in pixels).
+
+def interval_coverage(lo, hi, p0, p1):
+    pixels = numpy.arange(p0, p1)
+    return numpy.clip(numpy.minimum(hi, pixels + 1) - numpy.maximum(lo, pixels), 0, 1)
+
+# Return the raster of the polygon "points" (in pixels), measured by
+# sampling each pixel at supersample x supersample points.
+
+def polygon_raster(points):
+    xmin, ymin = numpy.floor(points.min(axis=0)).astype(int)
+    xmax, ymax = numpy.ceil(points.max(axis=0)).astype(int)
+    if xmax <= xmin or ymax <= ymin:
+        return None
+    xs = xmin + (numpy.arange((xmax - xmin) * supersample) + 0.5) / supersample
+    ys = ymin + (numpy.arange((ymax - ymin) * supersample) + 0.5) / supersample
+    inside = numpy.zeros((len(ys), len(xs)), dtype=bool)
+    # Each edge crossing toggles the samples to its right (even-odd rule)
+    for (xa, ya), (xb, yb) in zip(points, numpy.roll(points, -1, axis=0)):
+        if ya == yb:
+            continue
+        rows = numpy.nonzero((ys >= min(ya, yb)) & (ys < max(ya, yb)))[0]
+        if len(rows) == 0:
+            continue
+        xcross = xa + (ys[rows] - ya) * (xb - xa) / (yb - ya)
+        inside[rows] ^= xs[numpy.newaxis, :] >= xcross[:, numpy.newaxis]
+    coverage = inside.reshape(ymax - ymin, supersample, xmax - xmin, supersample).mean(axis=(1, 3))
+    return ((coverage * 255 + 0.5).astype(numpy.uint8), xmin, ymin)
+
+# Return raster "raster" after reflection about the x axis (if "reflect")
+# and "quarters" quarter turns counterclockwise.  The arrays returned are
+# views of the original.
+
+def transform_raster(raster, reflect, quarters):
+    array, x0, y0 = raster
+    if reflect:
+        y0 = -(y0 + array.shape[0])
+        array = array[::-1, :]
+    for i in range(quarters):
+        x0, y0 = -(y0 + array.shape[0]), x0
+        array = array[::-1, :].T
+    return (array, x0, y0)
+
+#----------------------------------------------------------------------------
+# Return the raster of density layer "index" of cell "cell", given the
+# rasters of the cells it uses in "rasters", at "pixel" database units per
+# pixel.  Returns None if the cell has nothing on the layer.
+#----------------------------------------------------------------------------
+
+def cell_raster(cell, index, rasters, pixel):
+    rects = numpy.array(cell.rects.get(index, []), dtype=float).reshape(-1, 4) / pixel
+    pieces = []
+    for polygon in cell.polygons.get(index, []):
+        raster = polygon_raster(polygon / pixel)
+        if raster:
+            pieces.append(raster)
+    for child, reflect, quarters, positions in cell.instances:
+        raster = rasters.get(child)
+        if raster is None:
+            continue
+        array, x0, y0 = transform_raster(raster, reflect, quarters)
+        for x, y in positions:
+            pieces.append((array, x0 + int(round(x / pixel)), y0 + int(round(y / pixel))))
+
+    if len(rects) == 0 and len(pieces) == 0:
+        return None
+    xmins = [piece[1] for piece in pieces]
+    ymins = [piece[2] for piece in pieces]
+    xmaxs = [piece[1] + piece[0].shape[1] for piece in pieces]
+    ymaxs = [piece[2] + piece[0].shape[0] for piece in pieces]
+    if len(rects) > 0:
+        xmins.append(int(numpy.floor(rects[:, 0].min())))
+        ymins.append(int(numpy.floor(rects[:, 1].min())))
+        xmaxs.append(int(numpy.ceil(rects[:, 2].max())))
+        ymaxs.append(int(numpy.ceil(rects[:, 3].max())))
+    x0 = min(xmins)
+    y0 = min(ymins)
+    target = numpy.zeros((max(ymaxs) - y0, max(xmaxs) - x0), dtype=numpy.uint8)
+
+    for rx0, ry0, rx1, ry1 in rects:
+        c0 = int(math.floor(rx0))
+        c1 = int(math.ceil(rx1))
+        r0 = int(math.floor(ry0))
+        r1 = int(math.ceil(ry1))
+        coverage = numpy.outer(interval_coverage(ry0, ry1, r0, r1),
+			interval_coverage(rx0, rx1, c0, c1))
+        region = target[r0 - y0:r1 - y0, c0 - x0:c1 - x0]
+        numpy.maximum(region, (coverage * 255 + 0.5).astype(numpy.uint8), out=region)
+
+    for array, px0, py0 in pieces:
+        region = target[py0 - y0:py0 - y0 + array.shape[0], px0 - x0:px0 - x0 + array.shape[1]]
+        numpy.maximum(region, array, out=region)
+
+    return (target, x0, y0)
+
+#----------------------------------------------------------------------------
+# Return the sum of raster "raster" over each tile of the layout, where
+# "xtile" and "ytile" are the tile number of each column and row of
+# pixels (from "px0" and "py0"), or -1 for pixels outside the layout.
+#----------------------------------------------------------------------------
+
+def tile_sums(raster, xtile, ytile, px0, py0, xtiles, ytiles):
+    array, x0, y0 = raster
+    sums = numpy.zeros((ytiles, xtiles))
+    # Clip the raster to the layout
+    c0 = max(x0, px0)
+    c1 = min(x0 + array.shape[1], px0 + len(xtile))
+    r0 = max(y0, py0)
+    r1 = min(y0 + array.shape[0], py0 + len(ytile))
+    if c1 <= c0 or r1 <= r0:
+        return sums
+    array = array[r0 - y0:r1 - y0, c0 - x0:c1 - x0]
+    xt = xtile[c0 - px0:c1 - px0]
+    yt = ytile[r0 - py0:r1 - py0]
+    # Tile numbers increase along each row and column, so the pixels of
+    # each tile are a contiguous range.
+    xstarts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(xt))[0] + 1))
+    ystarts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(yt))[0] + 1))
+    colsums = numpy.add.reduceat(array, xstarts, axis=1, dtype=numpy.int64)
+    blocksums = numpy.add.reduceat(colsums, ystarts, axis=0)
+    sums[numpy.ix_(yt[ystarts], xt[xstarts])] = blocksums
+    return sums
+
+#----------------------------------------------------------------------------
+# Return the name of the top cell of "cells" read from "gdsfile":  "topcell"
+# if it is in the file, or else the one cell not used by any other cell.
+#----------------------------------------------------------------------------
+
+def find_top_cell(cells, topcell, gdsfile):
+    if topcell in cells:
+        return topcell
+    used = set()
+    for cell in cells.values():
+        used.update(instance[0] for instance in cell.instances)
+    tops = list(name for name in cells if name not in used)
+    if len(tops) != 1:
+        raise gds_stream.GDSError('Cannot determine the top cell of ' + gdsfile)
+    return tops[0]
+
+#----------------------------------------------------------------------------
+# Measure the density of each tile of the GDS layout "gdsfile".
+#
+# "layers" is a list of (name, list of (GDS layer, datatype)) for each
+# density layer.  "topcell" is the name of the top cell (if it is not in
+# the file, the one cell not used by any other is used).  Tiles are
+# "tilesize" microns, and pixels are "resolution" microns.  If "fillfile"
+# is given, then it is a GDS file of fill for the layout (as made by
+# generate_fill.py), and the density is measured with the fill added.
+#
+# Returns (dictionary of the tile density grid of each layer, indexed
+# [y, x], number of tiles in x, number of tiles in y, fraction of the last
+# column of tiles inside the layout, fraction of the last row).  As with
+# magic, the density of each tile is the fraction of the tile covered,
+# over the part of the tile inside the layout.
+#----------------------------------------------------------------------------
+
+def tile_densities(gdsfile, layers, topcell=None, tilesize=70.0, resolution=0.5,
+		fillfile=None):
+    layermap = {}
+    for index, (name, gdslayers) in enumerate(layers):
+        for gdslayer in gdslayers:
+            layermap[tuple(gdslayer)] = index
+
+    with gds_stream.GDSFile(gdsfile) as gds:
+        cells, dbunit = read_cells(gds.data, layermap)
+    topcell = find_top_cell(cells, topcell, gdsfile)
+
+    # The tiles are those of the layout, without the fill.
+    order, parents = cell_order(cells, topcell)
+    bbox = cell_bboxes(cells, order)
+    if bbox is None:
+        raise gds_stream.GDSError('Layout ' + gdsfile + ' is empty')
+
+    if fillfile:
+        with gds_stream.GDSFile(fillfile) as gds:
+            fillcells, filldbunit = read_cells(gds.data, layermap)
+        if abs(filldbunit - dbunit) > dbunit * 1e-6:
+            raise gds_stream.GDSError('Units of ' + fillfile + ' do not match ' + gdsfile)
+        filltop = find_top_cell(fillcells, None, fillfile)
+        for name in fillcells:
+            if name in cells:
+                raise gds_stream.GDSError('Cell ' + name + ' is in both ' + gdsfile +
+				' and ' + fillfile)
+        cells.update(fillcells)
+        # An unnamed cell holds the layout and the fill.
+        combined = Cell('')
+        combined.instances.append((topcell, False, 0, [(0, 0)]))
+        combined.instances.append((filltop, False, 0, [(0, 0)]))
+        cells[''] = combined
+        topcell = ''
+        order, parents = cell_order(cells, topcell)
+
+    # Tiles, in database units, as computed by check_density.py with magic
+    dbmicron = 1e-6 / dbunit
+    tile = tilesize * dbmicron
+    pixel = resolution * dbmicron
+    width = bbox[2] - bbox[0]
+    height = bbox[3] - bbox[1]
+    xtiles = int(math.ceil(width / tile))
+    ytiles = int(math.ceil(height / tile))
+    xfrac = 1.0 - (xtiles * tile - width) / tile
+    yfrac = 1.0 - (ytiles * tile - height) / tile
+    if xfrac == 0.0:
+        xfrac = 1.0
+    if yfrac == 0.0:
+        yfrac = 1.0
+
+    # Tile of each column and row of pixels inside the layout (by the
+    # pixel center)
+    px0 = int(math.ceil(bbox[0] / pixel - 0.5))
+    px1 = int(math.ceil(bbox[2] / pixel - 0.5))
+    py0 = int(math.ceil(bbox[1] / pixel - 0.5))
+    py1 = int(math.ceil(bbox[3] / pixel - 0.5))
+    xtile = numpy.minimum(((numpy.arange(px0, px1) + 0.5) * pixel - bbox[0]) // tile,
+		xtiles - 1).astype(int)
+    ytile = numpy.minimum(((numpy.arange(py0, py1) + 0.5) * pixel - bbox[1]) // tile,
+		ytiles - 1).astype(int)
+    tilepixels = numpy.outer(numpy.bincount(ytile, minlength=ytiles),
+		numpy.bincount(xtile, minlength=xtiles)) * 255.0
+
+    grids = {}
+    for index, (name, gdslayers) in enumerate(layers):
+        # Each cell's raster is kept until all cells using it are done.
+        rasters = {}
+        users = dict(parents)
+        for cellname in order:
+            cell = cells[cellname]
+            rasters[cellname] = cell_raster(cell, index, rasters, pixel)
+            for child in set(instance[0] for instance in cell.instances):
+                users[child] -= 1
+                if users[child] == 0:
+                    del rasters[child]
+        raster = rasters.pop(topcell)
+        if raster is None:
+            grids[name] = numpy.zeros((ytiles, xtiles))
+        else:
+            sums = tile_sums(raster, xtile, ytile, px0, py0, xtiles, ytiles)
+            grids[name] = numpy.divide(sums, tilepixels, out=numpy.zeros_like(sums),
+			where=tilepixels > 0)
+    return grids, xtiles, ytiles, xfrac, yfrac
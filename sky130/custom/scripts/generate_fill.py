@@ -24,13 +24,17 @@ import sys
 import os
 import re
 import glob
-import functools
+import threading
 import subprocess
 import multiprocessing
+import concurrent.futures
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'common'))
+import magic_session
 
 def usage():
     print("Usage:")
-    print("generate_fill.py <layout_name> [-keep] [-test] [-dist]")
+    print("generate_fill.py <layout_name> [-keep] [-test] [-dist] [-nodensity]")
     print("")
     print("where:")
     print("    <layout_name> is the path to the GDS file to be filled.")
@@ -38,43 +42,68 @@ def usage():
     print("  If '-keep' is specified, then keep the generation script.")
     print("  If '-test' is specified, then create but do not run the generation script.")
     print("  If '-dist' is specified, then run distributed (multi-processing).")
+    print("  If '-nodensity' is specified, then do not measure the density of the")
+    print("  filled layout.  Otherwise, the approximate density of the layout with")
+    print("  the fill is measured (see check_density.py -approx), and the results")
+    print("  are written to directory <layout_name>_fill_density.")
     return 0
 
-def makegds(file, techfile):
-    # Procedure for multiprocessing only:  Run the distributed processing
-    # script to load a .mag file of one flattened square area of the layout,
-    # and run the fill generator to produce a .gds file output from it.
-
-    layoutpath = os.path.split(file)[0]
-    filename = os.path.split(file)[1]
+#----------------------------------------------------------------------------
+# Print the result (returncode, stdout lines, stderr lines) of a magic run.
+#----------------------------------------------------------------------------
 
-    myenv = os.environ.copy()
-    myenv['MAGTYPE'] = 'mag'
-
-    magic_run_opts = [
-		'magic',
-		'-dnull',
-		'-noconsole',
-		'-T', techfile,
-		layoutpath + '/generate_fill_dist.tcl',
-		filename]
-
-    mproc = subprocess.run(magic_run_opts,
-		stdin = subprocess.DEVNULL,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.PIPE,
-		cwd = layoutpath,
-		env = myenv,
-		universal_newlines = True)
-    if mproc.stdout:
-        for line in mproc.stdout.splitlines():
-            print(line)
-    if mproc.stderr:
+def print_magic_result(result):
+    returncode, outlines, errlines = result
+    for line in outlines:
+        print(line)
+    if errlines:
         print('Error message output from magic:')
-        for line in mproc.stderr.splitlines():
+        for line in errlines:
             print(line)
-        if mproc.returncode != 0:
-            print('ERROR:  Magic exited with status ' + str(mproc.returncode))
+        if returncode != 0:
+            print('ERROR:  Magic exited with status ' + str(returncode))
+
+#----------------------------------------------------------------------------
+# Procedure for distributed mode only:  Load each .mag file in "magfiles" (one
+# flattened square area of the layout), and run the fill generator to
+# produce a .gds file output from it.  This runs "jobs" magic processes at
+# once.  Each process runs the setup script generate_fill_dist.tcl once,
+# and then the procedure defined there for each of the files it is given.
+# A process that fails is replaced by a new one.
+#----------------------------------------------------------------------------
+
+def makegds(magfiles, layoutpath, rcfile, techfile, env, jobs):
+    setupscript = 'source ' + magic_session.tcl_quote(layoutpath + '/generate_fill_dist.tcl')
+    pending = list(magfiles)
+    lock = threading.Lock()
+
+    def worker():
+        session = None
+        while True:
+            with lock:
+                if not pending:
+                    break
+                magfile = pending.pop(0)
+            results = []
+            if not session:
+                session = magic_session.MagicSession(rcfile, ['-T', techfile], env)
+                results.append(session.run_script(setupscript, layoutpath))
+            script = 'make_fill_gds ' + magic_session.tcl_quote(os.path.splitext(magfile)[0])
+            results.append(session.run_script(script, layoutpath, reset=False))
+            with lock:
+                for result in results:
+                    print_magic_result(result)
+                sys.stdout.flush()
+            if session.failed:
+                session.close()
+                session = None
+        if session:
+            session.close()
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = list(executor.submit(worker) for job in range(jobs))
+        for future in futures:
+            future.result()
 
 
 if __name__ == '__main__':
@@ -86,6 +115,7 @@ if __name__ == '__main__':
     keepmode = False
     testmode = False
     distmode = False
+    densitymode = True
 
     for option in sys.argv[1:]:
         if option.find('-', 0) == 0:
@@ -119,6 +149,8 @@ if __name__ == '__main__':
             print('Running in distributed (multi-processing) mode.')
     elif debugmode:
         print('Running in single-processor mode.')
+    if '-nodensity' in optionlist:
+        densitymode = False
 
     # Find layout from command-line argument
 
@@ -312,11 +344,13 @@ if __name__ == '__main__':
             print('scalegrid 1 2', file=ofile)
             print('snap internal', file=ofile)
             print('box values 0 0 0 0', file=ofile)
-            print('set filename [file root [lindex $argv $argc-1]]', file=ofile)
-            print('load $filename', file=ofile)
             print('cif ostyle wafflefill(tiled)', file=ofile)
-            print('gds write [file root $filename].gds', file=ofile)
-            print('quit -noprompt', file=ofile)
+            print('proc make_fill_gds {filename} {', file=ofile)
+            print('    load $filename', file=ofile)
+            print('    gds write $filename.gds', file=ofile)
+            print('    load', file=ofile)
+            print('    cellname delete [file tail $filename]', file=ofile)
+            print('}', file=ofile)
 
         ofile = open(layoutpath + '/generate_fill_final.tcl', 'w')
         print('#!/usr/bin/env wish', file=ofile)
@@ -384,75 +418,66 @@ if __name__ == '__main__':
         print('This script will generate files ' + project + '_fill_pattern_x_y.gds')
         print('Now generating fill patterns.  This may take. . . quite. . . a while.', flush=True)
         
-        magic_run_opts = [
-		'magic',
-		'-dnull',
-		'-noconsole',
-		'-T', techfile_path,
-		layoutpath + '/generate_fill.tcl']
+        # Magic reads the .magicrc file in the layout directory, if there is
+        # one, the same as if it were started there.
+        rcfile = layoutpath + '/.magicrc'
+        if not os.path.isfile(rcfile):
+            rcfile = None
+        magic_options = ['-T', techfile_path]
+        magic_pool = magic_session.MagicPool(env=myenv)
 
         if debugmode:
-            print('Running: ' + ' '.join(magic_run_opts))
-
-        mproc = subprocess.run(magic_run_opts,
-		stdin = subprocess.DEVNULL,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.PIPE,
-		cwd = layoutpath,
-		env = myenv,
-		universal_newlines = True)
-        
-        if mproc.stdout:
-            for line in mproc.stdout.splitlines():
-                print(line)
-        if mproc.stderr:
-            print('Error message output from magic:')
-            for line in mproc.stderr.splitlines():
-                print(line)
-            if mproc.returncode != 0:
-                print('ERROR:  Magic exited with status ' + str(mproc.returncode))
-	
-	
+            print('Running: magic -dnull -noconsole ' + ' '.join(magic_options) +
+			' ' + layoutpath + '/generate_fill.tcl')
+
+        print_magic_result(magic_pool.run_script('source ' +
+			magic_session.tcl_quote(layoutpath + '/generate_fill.tcl'),
+			layoutpath, rcfile, magic_options))
+
         if distmode:
             # If using distributed mode, then run magic on each of the generated
             # layout files
-            pool = multiprocessing.Pool()
             magfiles = glob.glob(layoutpath + '/' + project + '_fill_pattern_*.mag')
-            # NOTE:  Adding 'x' to the end of each filename, or else magic will
-            # try to read it from the command line as well as passing it as an
-            # argument to the script.  We only want it passed as an argument.
-            magxfiles = list(item + 'x' for item in magfiles)
-            makegdsfunc = functools.partial(makegds, techfile=techfile_path)
-            pool.map(makegdsfunc, magxfiles)
+            makegds(magfiles, layoutpath, rcfile, techfile_path, myenv,
+			min(multiprocessing.cpu_count(), max(len(magfiles), 1)))
 
             # If using distributed mode, then remove all of the temporary .mag files
             # and then run the final generation script.
             for file in magfiles:
                 os.remove(file)
 
-            magic_run_opts = [
-			'magic',
-			'-dnull',
-			'-noconsole',
-			'-T', techfile_path,
-			layoutpath + '/generate_fill_final.tcl']
-
-            mproc = subprocess.run(magic_run_opts,
+            print_magic_result(magic_pool.run_script('source ' +
+			magic_session.tcl_quote(layoutpath + '/generate_fill_final.tcl'),
+			layoutpath, rcfile, magic_options))
+
+        # Measure the approximate density of the layout with the fill added,
+        # and write the results for the layout and fill together.
+        fillfile = gdspath + '/' + project + '_fill_pattern.gds.gz'
+        if densitymode and os.path.isfile(fillfile):
+            print('Measuring approximate density of the filled layout.', flush=True)
+            dproc = subprocess.run([sys.executable,
+			scriptpath + '/check_density.py',
+			user_project_path,
+			'-approx',
+			'-fill=' + fillfile,
+			'-output=' + layoutpath + '/' + project + '_fill_density'],
 			stdin = subprocess.DEVNULL,
 			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			cwd = layoutpath,
-			env = myenv,
+			stderr = subprocess.STDOUT,
 			universal_newlines = True)
-            if mproc.stdout:
-                for line in mproc.stdout.splitlines():
-                    print(line)
-            if mproc.stderr:
-                print('Error message output from magic:')
-                for line in mproc.stderr.splitlines():
+            dlines = dproc.stdout.splitlines()
+            if dproc.returncode != 0:
+                for line in dlines:
                     print(line)
-                if mproc.returncode != 0:
-                    print('ERROR:  Magic exited with status ' + str(mproc.returncode))
+                print('Warning:  Density of the filled layout could not be measured.')
+            else:
+                # Print only the whole-layout results;  the results for
+                # each window are in the output directory.
+                if 'Whole-chip (global) density results:' in dlines:
+                    dlines = dlines[dlines.index('Whole-chip (global) density results:'):]
+                for line in dlines:
+                    if line != 'Done!':
+                        print(line)
 
     if not keepmode:
         # Remove fill generation script